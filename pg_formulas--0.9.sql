@@ -1,6 +1,10 @@
 --------------------------------------------------------------------------------
 -- INTERNAL/UTILITY FUNCTIONS
 --------------------------------------------------------------------------------
+-- The metadata table is created once when the script is loaded, rather than on each formula creation.
+CREATE TABLE IF NOT EXISTS pgf_metadata(id TEXT primary key, kind TEXT, args JSONB, created_at TIMESTAMP, triggers JSONB);
+ALTER TABLE pgf_metadata ADD COLUMN IF NOT EXISTS triggers JSONB; -- [{"table": ..., "name": ...}], see _pgf_internal_post_create
+
 -- Insert a row inot the metadata table. args is a JSON object containing procedure arguments.
 CREATE or replace PROCEDURE _pgf_internal_insert_metadata (
 	id TEXT,
@@ -9,8 +13,8 @@ CREATE or replace PROCEDURE _pgf_internal_insert_metadata (
 )
 LANGUAGE plpgsql AS $proc$
 BEGIN
-	CREATE TABLE IF NOT EXISTS pgf_metadata(id TEXT primary key, kind TEXT, args JSONB, created_at TIMESTAMP);
 	insert into pgf_metadata values(id, kind, args, CURRENT_TIMESTAMP);
+	call _pgf_internal_check_cycles(id);
 END;
 $proc$;
 
@@ -32,7 +36,6 @@ LANGUAGE plpgsql AS $proc$
 DECLARE
 	res JSONB;
 BEGIN
-	CREATE TABLE IF NOT EXISTS pgf_metadata(id TEXT primary key, kind TEXT, args JSONB, created_at TIMESTAMP);
 	select args || jsonb_build_object('kind', kind) INTO res from pgf_metadata m where m.id = _pgf_internal_get_metadata.id;
 	return res;
 END;
@@ -108,6 +111,219 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE;
 
+/* Position at which elem must be inserted into the sorted array arr (after the elements equal to elem), found by binary search.
+Nulls are sorted first if nulls_first is true, last otherwise. */
+CREATE OR REPLACE FUNCTION _pgf_internal_array_sorted_position(arr anyarray, elem anyelement, descending boolean, nulls_first boolean)
+RETURNS int AS $$
+DECLARE
+	lo int := 1;
+	hi int := coalesce(cardinality(arr), 0) + 1;
+	mid int;
+BEGIN
+	while lo < hi loop
+		mid := (lo + hi) / 2;
+		if (case when elem is null then arr[mid] is not null and nulls_first
+				when arr[mid] is null then not nulls_first
+				when descending then elem > arr[mid]
+				else elem < arr[mid] end) then
+			hi := mid;
+		else
+			lo := mid + 1;
+		end if;
+	end loop;
+	return lo;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+
+/* Insert elem into the sorted array arr. A NULL array is considered empty. */
+CREATE OR REPLACE FUNCTION _pgf_internal_array_insert_sorted(arr anyarray, elem anyelement, descending boolean, nulls_first boolean)
+RETURNS anyarray AS $$
+DECLARE
+	pos int := _pgf_internal_array_sorted_position(arr, elem, descending, nulls_first);
+BEGIN
+	if arr is null then
+		return array[elem];
+	end if;
+	return arr[1:pos - 1] || elem || arr[pos:];
+END;
+$$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+
+/* Remove the first occurrence of elem from arr. Returns NULL instead of an empty array, like ARRAY_AGG over no rows. */
+CREATE OR REPLACE FUNCTION _pgf_internal_array_remove_one(arr anyarray, elem anyelement)
+RETURNS anyarray AS $$
+DECLARE
+	pos int := array_position(arr, elem);
+BEGIN
+	if pos is null then
+		return arr;
+	elsif cardinality(arr) = 1 then
+		return NULL;
+	end if;
+	return arr[1:pos - 1] || arr[pos + 1:];
+END;
+$$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+
+-- Create, if it does not exist yet, the aggregate _pgf_internal_minmax_agg(value, id) for the types of the given columns.
+-- The aggregate computes (min_value, id_of_min, max_value, id_of_max, row_count) in a single pass, and runs under parallel query.
+-- Rows are ordered by (value asc nulls last, id asc) for the min, and by (value desc nulls last, id desc) for the max.
+CREATE or replace PROCEDURE _pgf_internal_create_minmax_agg (
+	table_name TEXT,
+	value_column TEXT,
+	id_column TEXT
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	value_type TEXT;
+	id_type TEXT;
+	state_type TEXT;
+BEGIN
+	select format_type(v.atttypid, NULL), format_type(i.atttypid, NULL) into value_type, id_type
+	from pg_attribute v, pg_attribute i
+	where v.attrelid = to_regclass(format('%I', table_name)) and v.attname = value_column
+	and i.attrelid = v.attrelid and i.attname = id_column;
+
+	if to_regprocedure(format('_pgf_internal_minmax_agg(%s, %s)', value_type, id_type)) is not null then
+		return;
+	end if;
+	state_type := '_pgf_internal_minmax_state_' || left(md5(value_type || ',' || id_type), 12);
+
+	execute format('CREATE TYPE %I AS (min_value %s, id_of_min %s, max_value %s, id_of_max %s, row_count bigint)',
+		state_type, value_type, id_type, value_type, id_type);
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_minmax_sfunc(state %I, value %s, id %s) -- state_type, value_type, id_type
+		RETURNS %I AS $inner_fun$ -- state_type
+		BEGIN
+			if state.row_count = 0 or (value is not null and state.min_value is null) or value < state.min_value
+				or (value is not distinct from state.min_value and id < state.id_of_min) then
+				state.min_value := value;
+				state.id_of_min := id;
+			end if;
+			if state.row_count = 0 or (value is not null and state.max_value is null) or value > state.max_value
+				or (value is not distinct from state.max_value and id > state.id_of_max) then
+				state.max_value := value;
+				state.id_of_max := id;
+			end if;
+			state.row_count := state.row_count + 1;
+			return state;
+		END;
+		$inner_fun$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+		$fun$,
+		state_type, value_type, id_type,
+		state_type
+	);
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_minmax_combine(a %I, b %I) -- state_type, state_type
+		RETURNS %I AS $inner_fun$ -- state_type
+		BEGIN
+			if b.row_count = 0 then
+				return a;
+			elsif a.row_count = 0 then
+				return b;
+			end if;
+			if (b.min_value is not null and a.min_value is null) or b.min_value < a.min_value
+				or (b.min_value is not distinct from a.min_value and b.id_of_min < a.id_of_min) then
+				a.min_value := b.min_value;
+				a.id_of_min := b.id_of_min;
+			end if;
+			if (b.max_value is not null and a.max_value is null) or b.max_value > a.max_value
+				or (b.max_value is not distinct from a.max_value and b.id_of_max > a.id_of_max) then
+				a.max_value := b.max_value;
+				a.id_of_max := b.id_of_max;
+			end if;
+			a.row_count := a.row_count + b.row_count;
+			return a;
+		END;
+		$inner_fun$ LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE;
+		$fun$,
+		state_type, state_type,
+		state_type
+	);
+
+	execute format($agg$
+		CREATE AGGREGATE _pgf_internal_minmax_agg(%s, %s) ( -- value_type, id_type
+			sfunc = _pgf_internal_minmax_sfunc,
+			stype = %I, -- state_type
+			initcond = '(,,,,0)',
+			combinefunc = _pgf_internal_minmax_combine,
+			parallel = safe
+		)
+		$agg$,
+		value_type, id_type,
+		state_type
+	);
+END;
+$proc$;
+
+-- Return the name of a session-level prepared statement for the given query, preparing it on first use.
+-- Used by shared trigger functions: each formula gets its own cached plan without needing its own function.
+-- arg_types is the comma-separated list of parameter types, e.g. 'invoice, int'.
+create or replace function _pgf_internal_prepare(query TEXT, arg_types TEXT)
+returns text
+LANGUAGE plpgsql AS $$
+DECLARE
+	stmt_name TEXT;
+BEGIN
+	stmt_name := '_pgf_' || md5(current_setting('search_path') || arg_types || query);
+	-- the statement may have been deallocated by the client (DEALLOCATE ALL, DISCARD ALL, connection poolers)
+	if not exists (select 1 from pg_prepared_statements where name = stmt_name) then
+		execute format('prepare %I(%s) as %s', stmt_name, arg_types, query);
+	end if;
+	return stmt_name;
+END;
+$$;
+
+-- Columns of the given tables, read from pg_catalog (much cheaper than information_schema.columns).
+-- Table names are resolved using the search_path.
+create or replace function _pgf_internal_table_columns(table_names TEXT[])
+returns table(table_name TEXT, column_name TEXT, data_type TEXT, ordinal_position int)
+LANGUAGE sql STABLE AS $$
+	select c.relname::text, a.attname::text, format_type(a.atttypid, a.atttypmod), a.attnum::int
+	from unnest(table_names) t(name)
+	join pg_class c on c.oid = to_regclass(format('%I', t.name))
+	join pg_attribute a on a.attrelid = c.oid
+	where a.attnum > 0 and not a.attisdropped
+	order by c.relname, a.attnum;
+$$;
+
+-- Table storing the result of a formula aggregating linked rows: the base table, or the side table (option side_table).
+create or replace function _pgf_internal_result_table(args JSONB)
+returns TEXT
+LANGUAGE sql IMMUTABLE AS $$
+	select coalesce(args->'options'->>'side_table', args->>'base_table_name');
+$$;
+
+-- Called at the end of each formula creation procedure: record the triggers created with the formula,
+-- order triggers along the dependency graph and run the initial full refresh.
+-- When the formula is being created by pgf_deploy, ordering and refreshes are run once at the end.
+CREATE or replace PROCEDURE _pgf_internal_post_create (
+	id TEXT
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	-- triggers of a formula are created on its source tables, and are not owned by another formula yet.
+	update pgf_metadata m set triggers = (
+		select coalesce(jsonb_agg(jsonb_build_object('table', c.relname, 'name', t.tgname) order by c.relname, t.tgname), '[]'::JSONB)
+		from pg_trigger t
+		join pg_class c on c.oid = t.tgrelid
+		where c.oid in (select to_regclass(format('%I', s.name)) from unnest(_pgf_internal_source_tables(m.kind, m.args)) s(name))
+		and t.tgname like '\_pgf\_internal\_%'
+		and not exists (
+			select 1 from pgf_metadata o, jsonb_array_elements(o.triggers) e
+			where o.id <> m.id and e->>'table' = c.relname and e->>'name' = t.tgname
+		)
+	)
+	where m.id = _pgf_internal_post_create.id;
+
+	if current_setting('pg_formulas.deploying', true) = 'on' then
+		return;
+	end if;
+	call _pgf_internal_order_triggers();
+	call pgf_refresh(id);
+END;
+$proc$;
+
 --------------------------------------------------------------------------------
 -- COMMON FUNCTIONS
 --------------------------------------------------------------------------------
@@ -123,12 +339,116 @@ BEGIN
 	kind := args->>'kind';
 	IF kind = 'revdate' or kind = 'audit_table' then
 		-- no op
+	ELSIF (args->'options'->>'shared_trigger')::boolean then
+		execute format('call _pgf_internal_%s_shared_refresh(%L);', kind, id);
 	ELSE
 		execute format('call "_pgf_internal_refresh_%I"();', id);
 	end IF;
 END;
 $proc$;
 
+/* Full refresh of the base rows whose primary key is in the range [range_start, range_end).
+A NULL bound means the range is unbounded on that side.
+Refreshes of disjoint ranges can run concurrently in separate connections.
+Only supported for formulas aggregating a linked table into a base table column (see _pgf_internal_range_refresh_kinds). */
+create or replace procedure pgf_refresh_range(
+	id TEXT,
+	range_start TEXT,
+	range_end TEXT
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	args JSONB;
+	kind TEXT;
+	base_table_name TEXT;
+	base_pk TEXT;
+	aggregate_column TEXT;
+	linked_table_name TEXT;
+	linked_fk TEXT;
+	row_filter TEXT;
+	base_range_clause TEXT; -- SQL fragment: 'pk >= range_start and pk < range_end'
+	linked_range_clause TEXT; -- SQL fragment: 'fk >= range_start and fk < range_end'
+	reset_value TEXT; -- value of the aggregate column when there are no linked rows
+	aggregate_query TEXT; -- query returning (id, value) for each parent in range. ID_OF_MIN, ID_OF_MAX: (id, value, extremum)
+	value_column TEXT; -- ID_OF_MIN, ID_OF_MAX: companion column holding the extremum
+BEGIN
+	args := _pgf_internal_get_metadata(id);
+	kind := args->>'kind';
+	if not kind = any(_pgf_internal_range_refresh_kinds()) then
+		raise exception 'pgf_refresh_range is not supported for formulas of kind %', kind;
+	end if;
+
+	base_table_name := _pgf_internal_result_table(args);
+	base_pk := args->>'base_pk';
+	aggregate_column := coalesce(args->>'base_aggregate_column', args->>'base_count_column');
+	linked_table_name := args->>'linked_table_name';
+	linked_fk := args->>'linked_fk';
+	row_filter := coalesce(nullif(args->'options'->>'filter', ''), 'true');
+
+	base_range_clause := 'true';
+	linked_range_clause := 'true';
+	if range_start is not null then
+		base_range_clause := base_range_clause || format(' and %I >= %L', base_pk, range_start);
+		linked_range_clause := linked_range_clause || format(' and %I >= %L', linked_fk, range_start);
+	end if;
+	if range_end is not null then
+		base_range_clause := base_range_clause || format(' and %I < %L', base_pk, range_end);
+		linked_range_clause := linked_range_clause || format(' and %I < %L', linked_fk, range_end);
+	end if;
+
+	if kind = 'count' then
+		reset_value := '0';
+		aggregate_query := format('select %I as id, count(*) as value from %I where (%s) and %s group by %I',
+			linked_fk, linked_table_name, row_filter, linked_range_clause, linked_fk);
+	elsif kind = 'sum' then
+		reset_value := '0';
+		aggregate_query := format('select %I as id, sum(%I) as value from %I where (%s) and %s group by %I',
+			linked_fk, args->>'linked_value_column', linked_table_name, row_filter, linked_range_clause, linked_fk);
+	elsif kind in ('min', 'max') then
+		reset_value := 'NULL';
+		aggregate_query := format('select %I as id, %s(%I) as value from %I where (%s) and %s group by %I',
+			linked_fk, kind, args->>'linked_value_column', linked_table_name, row_filter, linked_range_clause, linked_fk);
+	elsif kind in ('id_of_min', 'id_of_max') then
+		reset_value := 'NULL';
+		value_column := args->'options'->>'value_column';
+		aggregate_query := format('select distinct on (%I) %I as id, %I as value, %I as extremum from %I where (%s) and %s order by %I, %I %s nulls last, %I %s',
+			linked_fk, linked_fk, args->>'linked_pk', args->>'linked_value_column', linked_table_name, row_filter, linked_range_clause,
+			linked_fk, args->>'linked_value_column', case when kind = 'id_of_min' then 'asc' else 'desc' end,
+			args->>'linked_pk', case when kind = 'id_of_min' then 'asc' else 'desc' end);
+	end if;
+
+	-- MIN, MAX, ID_OF_MIN, ID_OF_MAX with option cache_size: rebuild the cache entries of the range first
+	if coalesce((args->'options'->>'cache_size')::int, 0) > 0 then
+		execute format('call _pgf_internal_refresh_cache_range_%I(%L, %L)', id, range_start, range_end);
+	end if;
+
+	execute format('update %I set %I = %s%s where %s', base_table_name, aggregate_column, reset_value,
+		case when value_column is null then '' else format(', %I = NULL', value_column) end, base_range_clause);
+	execute format('update %I set %I = sub.value%s from (%s) sub where %I.%I = sub.id',
+		base_table_name, aggregate_column, case when value_column is null then '' else format(', %I = sub.extremum', value_column) end, aggregate_query, base_table_name, base_pk);
+
+	-- ID_OF_MIN, ID_OF_MAX without value_column nor cache: store the value of the new extremums
+	if kind in ('id_of_min', 'id_of_max') and value_column is null and coalesce((args->'options'->>'cache_size')::int, 0) = 0 then
+		execute format($sql$
+			insert into %I (parent_id, value) -- value_table_name
+			select b.%I, (select l.%I from %I l where l.%I = b.%I) from %I b -- base_pk, linked_value_column, linked_table_name, linked_pk, aggregate_column, base_table_name
+			where %s and b.%I is not null -- base_range_clause, aggregate_column
+			on conflict (parent_id) do update set value = excluded.value
+			$sql$,
+			'_pgf_internal_value_' || id,
+			base_pk, args->>'linked_value_column', linked_table_name, args->>'linked_pk', aggregate_column, base_table_name,
+			base_range_clause, aggregate_column);
+	end if;
+END;
+$proc$;
+
+-- Formula kinds supported by pgf_refresh_range.
+create or replace function _pgf_internal_range_refresh_kinds()
+returns TEXT[]
+LANGUAGE sql IMMUTABLE AS $$
+	select ARRAY['count', 'sum', 'min', 'max', 'id_of_min', 'id_of_max'];
+$$;
+
 CREATE or replace PROCEDURE pgf_drop (
 	id TEXT
 )
@@ -143,6 +463,7 @@ declare
 begin
 	args := _pgf_internal_get_metadata(id);
 	kind := args->>'kind';
+	call _pgf_internal_reset_trigger_names(id);
 	
 	-- drop refresh procedure
 	execute format('drop procedure if exists _pgf_internal_refresh_%I', id);
@@ -157,19 +478,95 @@ begin
 		table_name := args->>'linked_table_name';
 		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I', kind, id, table_name);
 		execute format('drop trigger if exists _pgf_internal_%s_trg_truncate_%I on %I', kind, id, table_name);
+		call _pgf_internal_drop_adaptive_triggers(id, kind, table_name);
 		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
 
 	ELSIF kind = 'sum' then
 		table_name := args->>'linked_table_name';
 		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I', kind, id, table_name);
 		execute format('drop trigger if exists _pgf_internal_%s_trg_truncate_%I on %I', kind, id, table_name);
+		call _pgf_internal_drop_adaptive_triggers(id, kind, table_name);
+		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
+
+	ELSIF kind in ('count_distinct', 'approx_count_distinct') then
+		table_name := args->>'linked_table_name';
+		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_update_%I on %I', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_delete_%I on %I', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_truncate_%I on %I', kind, id, table_name);
+		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
+		execute format('drop table if exists %I', case when kind = 'count_distinct' then '_pgf_internal_refcount_' else '_pgf_internal_hll_' end || id);
+
+	ELSIF kind in ('running_sum', 'rank') then
+		table_name := args->>'table_name';
+		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_update_%I on %I', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_delete_%I on %I', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_truncate_%I on %I', kind, id, table_name);
+		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
+		execute format('drop view if exists %I', args->'options'->>'view_name');
+		execute format('drop function if exists _pgf_internal_%s_block_%I', kind, id);
+		execute format('drop table if exists %I', '_pgf_internal_blocks_' || id);
+
+	ELSIF kind in ('window_count', 'window_sum') then
+		table_name := args->>'linked_table_name';
+		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_update_%I on %I', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_delete_%I on %I', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_truncate_%I on %I', kind, id, table_name);
 		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
+		execute format('drop procedure if exists _pgf_internal_window_expire_%I', id);
+		execute format('drop table if exists %I', '_pgf_internal_window_' || id);
+		execute format('drop table if exists %I', '_pgf_internal_window_start_' || id);
 
 	ELSIF kind = 'minmax_table' then
 		table_name := args->>'table_name';
 		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I;', kind, id, table_name);
 		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
 
+	ELSIF kind = 'sum_table' then
+		table_name := args->>'table_name';
+		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I;', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_truncate_%I on %I;', kind, id, table_name);
+		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_add_%I', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_remove_%I', kind, id);
+
+	ELSIF kind = 'count_table' then
+		table_name := args->>'table_name';
+		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I;', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_truncate_%I on %I;', kind, id, table_name);
+		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_add_%I', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_remove_%I', kind, id);
+
+	ELSIF kind = 'histogram_table' then
+		table_name := args->>'table_name';
+		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I;', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_truncate_%I on %I;', kind, id, table_name);
+		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_add_%I', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_remove_%I', kind, id);
+
+	ELSIF kind = 'timeseries_table' then
+		table_name := args->>'table_name';
+		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I;', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_truncate_%I on %I;', kind, id, table_name);
+		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_add_%I', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_remove_%I', kind, id);
+
+	ELSIF kind = 'topn_table' then
+		table_name := args->>'table_name';
+		execute format('drop trigger if exists _pgf_internal_%s_trg_%I on %I;', kind, id, table_name);
+		execute format('drop trigger if exists _pgf_internal_%s_trg_stmt_%I on %I;', kind, id, table_name);
+		execute format('drop function if exists _pgf_internal_%s_trgfun_%I()', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_add_%I', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_remove_%I', kind, id);
+		execute format('drop procedure if exists _pgf_internal_%s_refill_%I', kind, id);
+		execute format('drop table if exists %I', '_pgf_internal_topn_buffer_' || id);
+		execute format('drop table if exists %I', '_pgf_internal_topn_group_' || id);
+
 	ELSIF kind = 'tree_level' then
 		table_name := args->>'table_name';
 		execute format('DROP TRIGGER IF EXISTS _pgf_internal_%s_trg_%I ON %I;', kind, id, table_name);
@@ -226,25 +623,46 @@ begin
 	ELSIF kind in ('min', 'max') then
 		table_name := args->>'linked_table_name';
 		execute format('DROP TRIGGER IF EXISTS _pgf_internal_%s_trg_%I ON %I CASCADE;', kind, id, table_name);
+		call _pgf_internal_drop_adaptive_triggers(id, kind, table_name);
+		execute format('DROP TRIGGER IF EXISTS _pgf_internal_%s_trg_refill_%I ON %I;', kind, id, table_name);
 		execute format('DROP FUNCTION IF EXISTS _pgf_internal_%s_trgfun_%I() CASCADE;', kind, id);
+		execute format('drop table if exists %I', '_pgf_internal_cache_' || id);
+		execute format('drop table if exists %I', '_pgf_internal_cache_stale_' || id);
+		execute format('drop procedure if exists _pgf_internal_refresh_cache_range_%I', id);
 
-	elsif kind in ('id_of_min', 'if_of_max') then
+	elsif kind in ('id_of_min', 'id_of_max') then
 		table_name := args->>'linked_table_name';
 		execute format('DROP TRIGGER IF EXISTS _pgf_internal_%s_trg_%I ON %I CASCADE;', kind, id, table_name);
+		execute format('DROP TRIGGER IF EXISTS _pgf_internal_%s_trg_refill_%I ON %I;', kind, id, table_name);
 		execute format('DROP FUNCTION IF EXISTS _pgf_internal_%s_trgfun_%I() CASCADE;', kind, id);
 		execute format('drop procedure if exists _pgf_internal_refresh_single_%I', id);
+		execute format('drop table if exists %I', '_pgf_internal_value_' || id);
+		execute format('drop table if exists %I', '_pgf_internal_cache_' || id);
+		execute format('drop table if exists %I', '_pgf_internal_cache_stale_' || id);
+		execute format('drop procedure if exists _pgf_internal_refresh_cache_range_%I', id);
 
-	elsif kind = 'array_agg' then
+	elsif kind in ('array_agg', 'string_agg') then
 		table_name := args->>'linked_table_name';
 		execute format('DROP TRIGGER IF EXISTS _pgf_internal_%s_trg_%I ON %I CASCADE;', kind, id, table_name);
+		execute format('DROP TRIGGER IF EXISTS _pgf_internal_%s_trg_refill_%I ON %I;', kind, id, table_name);
 		execute format('DROP FUNCTION IF EXISTS _pgf_internal_%s_trgfun_%I() CASCADE;', kind, id);
 		execute format('drop procedure if exists _pgf_internal_refresh_single_%I', id);
+		execute format('drop function if exists _pgf_internal_%s_add_%I', kind, id);
+		execute format('drop function if exists _pgf_internal_%s_remove_%I', kind, id);
+		execute format('drop table if exists %I', '_pgf_internal_refcount_' || id);
+		execute format('drop table if exists %I', '_pgf_internal_elements_' || id);
+		execute format('drop table if exists %I', '_pgf_internal_stale_' || id);
 
 
 	else
 		raise exception 'Unknown value for argument "kind": %', kind;
 	end if;
 
+	-- option side_table (COUNT, SUM, MIN, MAX)
+	if kind in ('count', 'sum', 'min', 'max') and args->'options'->>'side_table' is not null then
+		call _pgf_internal_drop_side_table(args->>'base_table_name', args->>'base_pk', args->'options'->>'side_table',
+			coalesce(args->>'base_aggregate_column', args->>'base_count_column'));
+	end if;
 
 	call _pgf_internal_delete_metadata(id);
 
@@ -268,6 +686,7 @@ begin
 	args := _pgf_internal_get_metadata(id);
 	kind := args->>'kind';
 	enable_fragment := case when enabled then 'enable' else 'disable' end;
+	call _pgf_internal_reset_trigger_names(id);
 
 	if kind = 'revdate' then
 		table_name := args->>'table_name';
@@ -280,6 +699,10 @@ begin
 		end if;
 		execute format('alter table %I %s trigger _pgf_internal_count_trg_%I', table_name, enable_fragment, id);
 		execute format('alter table %I %s trigger _pgf_internal_count_trg_truncate_%I', table_name, enable_fragment, id);
+		if args->'options'->>'strategy' = 'adaptive' then
+			execute format('alter table %I %s trigger _pgf_internal_count_trg_update_%I', table_name, enable_fragment, id);
+			execute format('alter table %I %s trigger _pgf_internal_count_trg_delete_%I', table_name, enable_fragment, id);
+		end if;
 
 	elsif kind = 'sum' then
 		table_name := args->>'linked_table_name';
@@ -288,6 +711,10 @@ begin
 		end if;
 		execute format('alter table %I %s trigger _pgf_internal_%s_trg_%I', table_name, enable_fragment, kind, id);
 		execute format('alter table %I %s trigger _pgf_internal_%s_trg_truncate_%I', table_name, enable_fragment, kind, id);
+		if args->'options'->>'strategy' = 'adaptive' then
+			execute format('alter table %I %s trigger _pgf_internal_%s_trg_update_%I', table_name, enable_fragment, kind, id);
+			execute format('alter table %I %s trigger _pgf_internal_%s_trg_delete_%I', table_name, enable_fragment, kind, id);
+		end if;
 
 
 	elsif kind = 'minmax_table' then
@@ -297,6 +724,46 @@ begin
 		end if;
 		execute format('alter table %I %s trigger _pgf_internal_minmax_table_trg_%I;', table_name, enable_fragment, id);
 
+	elsif kind = 'sum_table' then
+		table_name := args->>'table_name';
+		if enabled then
+			execute format('LOCK TABLE %I IN EXCLUSIVE MODE;', table_name); -- allow reads but not writes
+		end if;
+		execute format('alter table %I %s trigger _pgf_internal_sum_table_trg_%I;', table_name, enable_fragment, id);
+		execute format('alter table %I %s trigger _pgf_internal_sum_table_trg_truncate_%I;', table_name, enable_fragment, id);
+
+	elsif kind = 'count_table' then
+		table_name := args->>'table_name';
+		if enabled then
+			execute format('LOCK TABLE %I IN EXCLUSIVE MODE;', table_name); -- allow reads but not writes
+		end if;
+		execute format('alter table %I %s trigger _pgf_internal_count_table_trg_%I;', table_name, enable_fragment, id);
+		execute format('alter table %I %s trigger _pgf_internal_count_table_trg_truncate_%I;', table_name, enable_fragment, id);
+
+	elsif kind = 'histogram_table' then
+		table_name := args->>'table_name';
+		if enabled then
+			execute format('LOCK TABLE %I IN EXCLUSIVE MODE;', table_name); -- allow reads but not writes
+		end if;
+		execute format('alter table %I %s trigger _pgf_internal_histogram_table_trg_%I;', table_name, enable_fragment, id);
+		execute format('alter table %I %s trigger _pgf_internal_histogram_table_trg_truncate_%I;', table_name, enable_fragment, id);
+
+	elsif kind = 'timeseries_table' then
+		table_name := args->>'table_name';
+		if enabled then
+			execute format('LOCK TABLE %I IN EXCLUSIVE MODE;', table_name); -- allow reads but not writes
+		end if;
+		execute format('alter table %I %s trigger _pgf_internal_timeseries_table_trg_%I;', table_name, enable_fragment, id);
+		execute format('alter table %I %s trigger _pgf_internal_timeseries_table_trg_truncate_%I;', table_name, enable_fragment, id);
+
+	elsif kind = 'topn_table' then
+		table_name := args->>'table_name';
+		if enabled then
+			execute format('LOCK TABLE %I IN EXCLUSIVE MODE;', table_name); -- allow reads but not writes
+		end if;
+		execute format('alter table %I %s trigger _pgf_internal_topn_table_trg_%I;', table_name, enable_fragment, id);
+		execute format('alter table %I %s trigger _pgf_internal_topn_table_trg_stmt_%I;', table_name, enable_fragment, id);
+
 	elsif kind = 'tree_level' then
 		table_name := args->>'table_name';
 		if enabled then
@@ -359,6 +826,13 @@ begin
 		end if;
 		execute format('alter table %I %s trigger _pgf_internal_%s_trg_%I', table_name, enable_fragment, kind, id);
 		execute format('alter table %I %s trigger _pgf_internal_%s_trg_truncate_%I', table_name, enable_fragment, kind, id);
+		if coalesce((args->'options'->>'cache_size')::int, 0) > 0 then
+			execute format('alter table %I %s trigger _pgf_internal_%s_trg_refill_%I', table_name, enable_fragment, kind, id);
+		end if;
+		if args->'options'->>'strategy' = 'adaptive' then
+			execute format('alter table %I %s trigger _pgf_internal_%s_trg_update_%I', table_name, enable_fragment, kind, id);
+			execute format('alter table %I %s trigger _pgf_internal_%s_trg_delete_%I', table_name, enable_fragment, kind, id);
+		end if;
 
 	elsif kind in ('id_of_min', 'id_of_max') then
 		table_name := args->>'linked_table_name';
@@ -367,1383 +841,6618 @@ begin
 		end if;
 		execute format('alter table %I %s trigger _pgf_internal_%s_trg_%I', table_name, enable_fragment, kind, id);
 		execute format('alter table %I %s trigger _pgf_internal_%s_trg_truncate_%I', table_name, enable_fragment, kind, id);
+		if coalesce((args->'options'->>'cache_size')::int, 0) > 0 then
+			execute format('alter table %I %s trigger _pgf_internal_%s_trg_refill_%I', table_name, enable_fragment, kind, id);
+		end if;
 
-	elsif kind = 'array_agg' then
+	elsif kind in ('count_distinct', 'approx_count_distinct', 'window_count', 'window_sum', 'running_sum', 'rank') then
+		table_name := coalesce(args->>'linked_table_name', args->>'table_name');
+		if enabled then
+			execute format('LOCK TABLE %I IN EXCLUSIVE MODE;', table_name); -- allow reads but not writes
+		end if;
+		execute format('alter table %I %s trigger _pgf_internal_%s_trg_%I', table_name, enable_fragment, kind, id);
+		execute format('alter table %I %s trigger _pgf_internal_%s_trg_update_%I', table_name, enable_fragment, kind, id);
+		execute format('alter table %I %s trigger _pgf_internal_%s_trg_delete_%I', table_name, enable_fragment, kind, id);
+		execute format('alter table %I %s trigger _pgf_internal_%s_trg_truncate_%I', table_name, enable_fragment, kind, id);
+
+	elsif kind in ('array_agg', 'string_agg') then
 		table_name := args->>'linked_table_name';
 		if enabled then
 			execute format('LOCK TABLE %I IN EXCLUSIVE MODE;', table_name); -- allow reads but not writes
 		end if;
 		execute format('alter table %I %s trigger _pgf_internal_%s_trg_%I', table_name, enable_fragment, kind, id);
 		execute format('alter table %I %s trigger _pgf_internal_%s_trg_truncate_%I', table_name, enable_fragment, kind, id);
+		if to_regclass(format('%I', '_pgf_internal_stale_' || id)) is not null then -- the formula has a refill trigger
+			execute format('alter table %I %s trigger _pgf_internal_%s_trg_refill_%I', table_name, enable_fragment, kind, id);
+		end if;
 
 	else
 		raise exception 'Unknown value for argument "kind": %', kind;
 	end if;
 
+	call _pgf_internal_order_triggers();
 	call pgf_refresh(id);
 end;
 $proc$;
 
 
 
--------------------------------------------------------------------------------
--- REVDATE
 --------------------------------------------------------------------------------
-CREATE or replace PROCEDURE pgf_revdate (
-	id TEXT,
-    table_name TEXT,
-    column_name TEXT
+-- DEPENDENCIES
+--------------------------------------------------------------------------------
+-- Columns read by a formula, given its kind and arguments (as stored in the metadata table).
+-- A NULL column_name means any column of the table may be read (e.g. by a row filter).
+CREATE or replace FUNCTION _pgf_internal_source_columns (
+	kind TEXT,
+	args JSONB
 )
-LANGUAGE plpgsql AS $proc$
+RETURNS TABLE(table_name TEXT, column_name TEXT)
+LANGUAGE plpgsql IMMUTABLE AS $proc$
+DECLARE
+	whole_row boolean; -- true if the formula has a row filter or an order by expression
 BEGIN
-	call _pgf_internal_insert_metadata(id, 'revdate', jsonb_build_object('table_name', table_name, 'column_name', column_name));
-	execute format($fun$
-		CREATE OR REPLACE FUNCTION _pgf_internal_revdate_trgfun_%I()
-		RETURNS TRIGGER AS $inner_trg$
-			BEGIN
-			    NEW.%I := CURRENT_TIMESTAMP;
-			    RETURN NEW;
-			END;
-			$inner_trg$ LANGUAGE plpgsql;
-		$fun$, id,
-		column_name
-	);
-
-    execute format($trg$
-		CREATE TRIGGER _pgf_internal_revdate_trg_%I
-		before insert or UPDATE ON %I
-		FOR EACH ROW
-		execute procedure _pgf_internal_revdate_trgfun_%I();
-		$trg$, id,
-		table_name,
-		id
-	);
+	whole_row := coalesce(nullif(args->'options'->>'filter', ''), 'true') <> 'true' or args->'options'->>'order_by' is not null;
 
-	-- no full refresh necessay here
+	if kind = 'revdate' then
+		-- fired on any change, but no column value is read
+		return query select args->>'table_name', args->>'column_name';
+	elsif kind in ('count', 'sum', 'min', 'max', 'id_of_min', 'id_of_max', 'array_agg', 'string_agg', 'count_distinct', 'approx_count_distinct', 'window_count', 'window_sum') then
+		return query select args->>'linked_table_name', c
+		from unnest(case when whole_row then ARRAY[NULL] else ARRAY[args->>'linked_fk', args->>'linked_value_column', args->>'linked_pk', args->>'linked_timestamp_column'] end) c
+		where whole_row or c is not null;
+	elsif kind = 'minmax_table' then
+		return query select args->>'table_name', c
+		from unnest(case when whole_row then ARRAY[NULL] else ARRAY[args->>'pk', args->>'aggregate_column']
+			|| coalesce(_pgf_internal_jsonb_to_text_array(args->'options'->'group_by_column'), ARRAY[]::TEXT[]) end) c;
+	elsif kind in ('sum_table', 'histogram_table') then
+		return query select args->>'table_name', c
+		from unnest(case when whole_row then ARRAY[NULL] else ARRAY[args->>'aggregate_column']
+			|| coalesce(_pgf_internal_jsonb_to_text_array(args->'options'->'group_by_column'), ARRAY[]::TEXT[]) end) c;
+	elsif kind = 'count_table' then
+		return query select args->>'table_name', c
+		from unnest(case when whole_row or jsonb_array_length(args->'options'->'group_by_column') = 0 then ARRAY[NULL]
+			else _pgf_internal_jsonb_to_text_array(args->'options'->'group_by_column') end) c;
+	elsif kind = 'running_sum' then
+		return query select args->>'table_name', c
+		from unnest(ARRAY[args->>'pk', args->>'partition_column', args->>'order_column', args->>'value_column']) c;
+	elsif kind = 'rank' then
+		return query select args->>'table_name', c
+		from unnest(ARRAY[args->>'pk', args->>'partition_column', args->>'order_column']) c where c is not null;
+	elsif kind = 'timeseries_table' then
+		return query select args->>'table_name', c
+		from unnest(case when whole_row then ARRAY[NULL] else ARRAY[args->>'timestamp_column']
+			|| coalesce(_pgf_internal_jsonb_to_text_array(args->'options'->'group_by_column'), ARRAY[]::TEXT[])
+			|| coalesce(_pgf_internal_jsonb_to_text_array(args->'options'->'sum_columns'), ARRAY[]::TEXT[])
+			|| coalesce(_pgf_internal_jsonb_to_text_array(args->'options'->'min_columns'), ARRAY[]::TEXT[])
+			|| coalesce(_pgf_internal_jsonb_to_text_array(args->'options'->'max_columns'), ARRAY[]::TEXT[]) end) c;
+	elsif kind = 'topn_table' then
+		return query select args->>'table_name', c
+		from unnest(case when whole_row then ARRAY[NULL] else ARRAY[args->>'pk', args->>'sort_column']
+			|| coalesce(_pgf_internal_jsonb_to_text_array(args->'options'->'group_by_column'), ARRAY[]::TEXT[]) end) c;
+	elsif kind in ('tree_level', 'tree_closure_table') then
+		return query select args->>'table_name', c from unnest(ARRAY[args->>'pk_column', args->>'parent_column']) c;
+	elsif kind = 'sync' then
+		return query select args->>'table_name', c from unnest(ARRAY[args->>'column1', args->>'column2']) c;
+	elsif kind = 'inheritance_table' and args->>'sync_direction' = 'SUB_TO_BASE' then
+		return query select t, NULL::TEXT from unnest(_pgf_internal_jsonb_to_text_array(args->'sub_tables')) t;
+	elsif kind = 'inheritance_table' then
+		return query select args->>'base_table_name', NULL::TEXT;
+	elsif kind = 'audit_table' then
+		return query select t, NULL::TEXT from unnest(_pgf_internal_jsonb_to_text_array(args->'audited_table_names')) t;
+	elsif kind in ('intersect_table', 'union_table') then
+		return query select t, c
+		from unnest(_pgf_internal_jsonb_to_text_array(args->'table_names')) t,
+		unnest(_pgf_internal_jsonb_to_text_array(args->'column_names')) c;
+	else
+		raise exception 'Unknown value for argument "kind": %', kind;
+	end if;
+END;
+$proc$;
 
+-- Columns written by a formula, given its kind and arguments (as stored in the metadata table).
+-- A NULL column_name means the whole table is written.
+CREATE or replace FUNCTION _pgf_internal_target_columns (
+	kind TEXT,
+	args JSONB
+)
+RETURNS TABLE(table_name TEXT, column_name TEXT)
+LANGUAGE plpgsql IMMUTABLE AS $proc$
+BEGIN
+	if kind = 'revdate' then
+		return query select args->>'table_name', args->>'column_name';
+	elsif kind in ('count', 'count_distinct', 'approx_count_distinct', 'window_count') then
+		return query select _pgf_internal_result_table(args), args->>'base_count_column';
+	elsif kind in ('sum', 'min', 'max', 'id_of_min', 'id_of_max', 'array_agg', 'string_agg', 'window_sum') then
+		return query select _pgf_internal_result_table(args), c
+		from unnest(ARRAY[args->>'base_aggregate_column', args->'options'->>'value_column']) c
+		where c is not null;
+	elsif kind = 'minmax_table' then
+		return query select args->'options'->>'agg_table', NULL::TEXT;
+	elsif kind = 'sum_table' then
+		return query select args->'options'->>'agg_table', NULL::TEXT;
+	elsif kind in ('count_table', 'histogram_table') then
+		return query select args->'options'->>'agg_table', NULL::TEXT;
+	elsif kind = 'timeseries_table' then
+		return query select args->'options'->>'agg_table', NULL::TEXT
+		union all
+		select r->>'agg_table', NULL::TEXT from jsonb_array_elements(args->'options'->'rollups') r;
+	elsif kind = 'topn_table' then
+		return query select args->'options'->>'topn_table', NULL::TEXT;
+	elsif kind = 'tree_level' then
+		return query select args->>'table_name', args->>'level_column';
+	elsif kind in ('running_sum', 'rank') then
+		return query select args->>'table_name', args->>'target_column';
+	elsif kind = 'tree_closure_table' then
+		return query select args->'options'->>'closure_table_name', NULL::TEXT;
+	elsif kind = 'sync' then
+		return query select args->>'table_name', c from unnest(ARRAY[args->>'column1', args->>'column2']) c;
+	elsif kind = 'inheritance_table' and args->>'sync_direction' = 'SUB_TO_BASE' then
+		return query select args->>'base_table_name', NULL::TEXT;
+	elsif kind = 'inheritance_table' then
+		return query select t, NULL::TEXT from unnest(_pgf_internal_jsonb_to_text_array(args->'sub_tables')) t;
+	elsif kind = 'audit_table' then
+		return query select args->>'audit_table_name', NULL::TEXT;
+	elsif kind = 'intersect_table' then
+		return query select args->>'intersect_table_name', NULL::TEXT;
+	elsif kind = 'union_table' then
+		return query select args->>'union_table_name', NULL::TEXT;
+	else
+		raise exception 'Unknown value for argument "kind": %', kind;
+	end if;
 END;
 $proc$;
 
+-- Tables read by a formula, given its kind and arguments (as stored in the metadata table).
+CREATE or replace FUNCTION _pgf_internal_source_tables (
+	kind TEXT,
+	args JSONB
+)
+RETURNS TEXT[]
+LANGUAGE sql IMMUTABLE AS $$
+	select array_agg(distinct c.table_name) from _pgf_internal_source_columns(kind, args) c;
+$$;
 
---------------------------------------------------------------------------------
--- COUNT
---------------------------------------------------------------------------------
-CREATE or replace PROCEDURE pgf_count (
-	id TEXT,
-    base_table_name TEXT,
-    base_pk TEXT,
-    base_count_column TEXT,
-    linked_table_name TEXT,
-    linked_fk TEXT,
-	options JSONB default '{}'::JSONB
+-- Tables written by a formula, given its kind and arguments (as stored in the metadata table).
+CREATE or replace FUNCTION _pgf_internal_target_tables (
+	kind TEXT,
+	args JSONB
+)
+RETURNS TEXT[]
+LANGUAGE sql IMMUTABLE AS $$
+	select array_agg(distinct c.table_name) from _pgf_internal_target_columns(kind, args) c;
+$$;
+
+-- Dependency graph: formula 'id' depends on formula 'depends_on_id' if it reads a column written by it.
+-- 'columns' lists the columns linking the two formulas, as 'table.column' ('table.*' for the whole table).
+CREATE or replace VIEW pgf_dependency AS
+with src as (
+	select m.id, c.table_name, c.column_name from pgf_metadata m, _pgf_internal_source_columns(m.kind, m.args) c
+), tgt as (
+	select m.id, c.table_name, c.column_name from pgf_metadata m, _pgf_internal_target_columns(m.kind, m.args) c
+)
+select src.id, tgt.id as depends_on_id,
+	array_agg(distinct src.table_name || '.' || coalesce(src.column_name, tgt.column_name, '*')) as columns
+from src
+join tgt on tgt.table_name = src.table_name and tgt.id <> src.id
+	and (src.column_name is null or tgt.column_name is null or src.column_name = tgt.column_name)
+group by src.id, tgt.id;
+
+-- Level of each formula in the dependency graph: 0 if it does not depend on any formula,
+-- otherwise 1 + the highest level of the formulas it depends on.
+CREATE or replace FUNCTION _pgf_internal_formula_levels()
+RETURNS TABLE(id TEXT, level int)
+LANGUAGE sql STABLE AS $$
+	with recursive lv(id, level) as (
+		select m.id, 0 from pgf_metadata m
+		union all
+		select d.id, lv.level + 1 from lv join pgf_dependency d on d.depends_on_id = lv.id
+		where lv.level < (select count(*) from pgf_metadata) -- guard against cycles created before cycles were checked
+	)
+	select lv.id, max(lv.level) from lv group by lv.id;
+$$;
+
+-- Raise an exception if formula 'id' is part of a dependency cycle.
+CREATE or replace PROCEDURE _pgf_internal_check_cycles (
+	id TEXT
 )
 LANGUAGE plpgsql AS $proc$
 DECLARE
-	row_filter TEXT;
+	cycle TEXT[]; -- formulas that both depend on 'id' and that 'id' depends on
 BEGIN
-	-- set default values for optional arguments
-	options := jsonb_build_object(
-		'filter', 'true'
-	) || options;
-	row_filter := options->>'filter';
-	if row_filter is null or row_filter = '' then
-		row_filter := 'true';
+	with recursive upstream(id) as (
+		select d.depends_on_id from pgf_dependency d where d.id = _pgf_internal_check_cycles.id
+		union
+		select d.depends_on_id from pgf_dependency d join upstream u on d.id = u.id
+	), downstream(id) as (
+		select d.id from pgf_dependency d where d.depends_on_id = _pgf_internal_check_cycles.id
+		union
+		select d.id from pgf_dependency d join downstream u on d.depends_on_id = u.id
+	)
+	select array_agg(u.id order by u.id) into cycle from upstream u where u.id in (select dn.id from downstream dn);
+
+	if cycle is not null then
+		raise exception 'Formula % would create a dependency cycle with formulas: %', id, array_to_string(cycle, ', ');
 	end if;
+END;
+$proc$;
 
-	call _pgf_internal_insert_metadata(id, 'count', jsonb_build_object(
-		'base_table_name', base_table_name,
-		'base_pk', base_pk,
-		'base_count_column', base_count_column,
-		'linked_table_name', linked_table_name,
-		'linked_fk', linked_fk,
-		'options', options
-	));
+-- Triggers of each formula (see _pgf_internal_post_create), with their canonical and current names.
+CREATE or replace FUNCTION _pgf_internal_formula_triggers()
+RETURNS TABLE(id TEXT, table_name TEXT, canonical_name TEXT, current_name TEXT)
+LANGUAGE sql STABLE AS $$
+	select m.id, e.t->>'table', e.t->>'name', tg.tgname::TEXT
+	from pgf_metadata m
+	cross join lateral jsonb_array_elements(coalesce(m.triggers, '[]'::JSONB)) e(t)
+	join pg_trigger tg on tg.tgrelid = to_regclass(format('%I', e.t->>'table'))
+		and (tg.tgname = e.t->>'name' or (tg.tgname ~ '^_pgf_o[0-9]{4}_' and substr(tg.tgname, 12) = substr(e.t->>'name', 15)));
+$$;
 
-	execute format($fun$
-		CREATE OR REPLACE FUNCTION _pgf_internal_count_trgfun_%I() -- id
-		RETURNS TRIGGER AS $inner_trg$
-			DECLARE
-				old_row_matches_filter boolean := true;
-				new_row_matches_filter boolean := true;
-			BEGIN
-				/* test if OLD row matches filter */
-				select case when count(*)=1 then true else false end into old_row_matches_filter from (
-					select * from (
-						select (OLD.*)
-					) t
-					where %s -- row_filter
-				) t2;
+/* PostgreSQL fires the triggers of a table in name order.
+Triggers of formulas at level N > 0 of the dependency graph are renamed from '_pgf_internal_xxx' to '_pgf_oNNNN_xxx',
+so that they fire after the triggers of the formulas they depend on. */
+CREATE or replace PROCEDURE _pgf_internal_order_triggers()
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	r RECORD;
+BEGIN
+	for r in
+		select t.table_name, t.current_name,
+			case when l.level = 0 then t.canonical_name
+			else format('_pgf_o%s_%s', lpad(l.level::TEXT, 4, '0'), substr(t.canonical_name, 15)) end as ordered_name
+		from _pgf_internal_formula_triggers() t
+		join _pgf_internal_formula_levels() l on l.id = t.id
+	loop
+		if r.current_name <> r.ordered_name then
+			execute format('alter trigger %I on %I rename to %I', r.current_name, r.table_name, r.ordered_name);
+		end if;
+	end loop;
+END;
+$proc$;
 
-				/* test if NEW row matches filter */
-				select case when count(*)=1 then true else false end into new_row_matches_filter from (
-					select * from (
-						select NEW.*
-					) t
-					where %s -- row_filter
-				) t2;
+-- Restore the canonical names of the triggers of a formula. Called before dropping, enabling or disabling them by name.
+CREATE or replace PROCEDURE _pgf_internal_reset_trigger_names (
+	id TEXT
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	r RECORD;
+BEGIN
+	for r in select * from _pgf_internal_formula_triggers() t where t.id = _pgf_internal_reset_trigger_names.id loop
+		if r.current_name <> r.canonical_name then
+			execute format('alter trigger %I on %I rename to %I', r.current_name, r.table_name, r.canonical_name);
+		end if;
+	end loop;
+END;
+$proc$;
 
-				IF TG_OP='INSERT' and new_row_matches_filter then
-			    	update %I set %I=%I+1 where %I=NEW.%I; -- base_table_name, base_count_column, base_count_column, base_pk, linked_fk
-				ELSIF TG_OP='DELETE' and old_row_matches_filter then
-					update %I set %I=%I-1 where %I=OLD.%I; -- base_table_name, base_count_column, base_count_column, base_pk, linked_fk
-				ELSIF TG_OP='UPDATE' and OLD.%I <> NEW.%I then -- linked_fk, linked_fk
-					/* case : foreign key is updated */
-					if (old_row_matches_filter) then
-						update %I set %I=%I-1 where %I=OLD.%I; -- base_table_name, base_count_column, base_count_column, base_pk, linked_fk
-					end if;
-					if new_row_matches_filter then
-						update %I set %I=%I+1 where %I=NEW.%I; -- base_table_name, base_count_column, base_count_column, base_pk, linked_fk
-					end if;
-				ELSIF TG_OP='TRUNCATE' then
-					update %I set %I=0; -- base_table_name, base_count_column
-				END IF;
-				RETURN NEW;
-			END;
-			$inner_trg$ LANGUAGE plpgsql;
-		$fun$,
-			id,
-			row_filter,
-			row_filter,
-			base_table_name, base_count_column, base_count_column, base_pk, linked_fk,
-			base_table_name, base_count_column, base_count_column, base_pk, linked_fk,
-			linked_fk, linked_fk,
-			base_table_name, base_count_column, base_count_column, base_pk, linked_fk,
-			base_table_name, base_count_column, base_count_column, base_pk, linked_fk,
-			base_table_name, base_count_column
-		);
+-- Full refresh of all formulas, in dependency order.
+CREATE or replace PROCEDURE pgf_refresh_all()
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	fid TEXT;
+BEGIN
+	for fid in select l.id from _pgf_internal_formula_levels() l order by l.level, l.id loop
+		call pgf_refresh(fid);
+	end loop;
+END;
+$proc$;
 
-	execute format($inner_proc$
-		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
-		LANGUAGE plpgsql
-		AS $inner_proc2$
-			begin
-				update %I set %I = 0; -- base_table_name, base_count_column
-			    update %I set %I = sub.cpt -- base_table_name, base_count_column
-				from (
-					select %I as id, count(*) as cpt -- linked_fk
-					from %I -- linked_table_name
-					group by %I -- linked_fk
-				) as sub
-				where %I.%I = sub.id; -- base_table_name, base_pk
-			end;
-			$inner_proc2$;
-		$inner_proc$,
-		id, -- function name
-		base_table_name, base_count_column,
-		base_table_name, base_count_column,
-		linked_fk,
-		linked_table_name,
-		linked_fk,
-		base_table_name, base_pk
+--------------------------------------------------------------------------------
+-- DEPLOY
+--------------------------------------------------------------------------------
+-- Create a formula given its kind and arguments (as stored in the metadata table).
+CREATE or replace PROCEDURE _pgf_internal_create (
+	id TEXT,
+	kind TEXT,
+	args JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	options JSONB;
+BEGIN
+	options := coalesce(args->'options', '{}'::JSONB);
+
+	if kind = 'revdate' then
+		call pgf_revdate(id, args->>'table_name', args->>'column_name');
+	elsif kind = 'count' then
+		call pgf_count(id, args->>'base_table_name', args->>'base_pk', args->>'base_count_column', args->>'linked_table_name', args->>'linked_fk', options);
+	elsif kind = 'sum' then
+		call pgf_sum(id, args->>'base_table_name', args->>'base_pk', args->>'base_aggregate_column', args->>'linked_table_name', args->>'linked_fk', args->>'linked_value_column', options);
+	elsif kind = 'min' then
+		call pgf_min(id, args->>'base_table_name', args->>'base_pk', args->>'base_aggregate_column', args->>'linked_table_name', args->>'linked_fk', args->>'linked_value_column', options);
+	elsif kind = 'max' then
+		call pgf_max(id, args->>'base_table_name', args->>'base_pk', args->>'base_aggregate_column', args->>'linked_table_name', args->>'linked_fk', args->>'linked_value_column', options);
+	elsif kind = 'id_of_min' then
+		call pgf_id_of_min(id, args->>'base_table_name', args->>'base_pk', args->>'base_aggregate_column', args->>'linked_table_name', args->>'linked_pk', args->>'linked_fk', args->>'linked_value_column', options);
+	elsif kind = 'id_of_max' then
+		call pgf_id_of_max(id, args->>'base_table_name', args->>'base_pk', args->>'base_aggregate_column', args->>'linked_table_name', args->>'linked_pk', args->>'linked_fk', args->>'linked_value_column', options);
+	elsif kind = 'array_agg' then
+		call pgf_array_agg(id, args->>'base_table_name', args->>'base_pk', args->>'base_aggregate_column', args->>'linked_table_name', args->>'linked_fk', args->>'linked_value_column', options);
+	elsif kind = 'string_agg' then
+		call pgf_string_agg(id, args->>'base_table_name', args->>'base_pk', args->>'base_aggregate_column', args->>'linked_table_name', args->>'linked_fk', args->>'linked_value_column', options);
+	elsif kind = 'count_distinct' then
+		call pgf_count_distinct(id, args->>'base_table_name', args->>'base_pk', args->>'base_count_column', args->>'linked_table_name', args->>'linked_fk', args->>'linked_value_column', options);
+	elsif kind = 'approx_count_distinct' then
+		call pgf_approx_count_distinct(id, args->>'base_table_name', args->>'base_pk', args->>'base_count_column', args->>'linked_table_name', args->>'linked_fk', args->>'linked_value_column', options);
+	elsif kind = 'window_count' then
+		call pgf_window_count(id, args->>'base_table_name', args->>'base_pk', args->>'base_count_column', args->>'linked_table_name', args->>'linked_fk', args->>'linked_timestamp_column', options);
+	elsif kind = 'window_sum' then
+		call pgf_window_sum(id, args->>'base_table_name', args->>'base_pk', args->>'base_aggregate_column', args->>'linked_table_name', args->>'linked_fk', args->>'linked_timestamp_column', args->>'linked_value_column', options);
+	elsif kind = 'running_sum' then
+		call pgf_running_sum(id, args->>'table_name', args->>'pk', args->>'partition_column', args->>'order_column', args->>'value_column', args->>'target_column', options);
+	elsif kind = 'rank' then
+		call pgf_rank(id, args->>'table_name', args->>'pk', args->>'partition_column', args->>'order_column', args->>'target_column', options);
+	elsif kind = 'minmax_table' then
+		call pgf_minmax_table(id, args->>'table_name', args->>'pk', args->>'aggregate_column', options);
+	elsif kind = 'sum_table' then
+		call pgf_sum_table(id, args->>'table_name', args->>'aggregate_column', options);
+	elsif kind = 'count_table' then
+		call pgf_count_table(id, args->>'table_name', options);
+	elsif kind = 'histogram_table' then
+		call pgf_histogram_table(id, args->>'table_name', args->>'aggregate_column', options);
+	elsif kind = 'timeseries_table' then
+		call pgf_timeseries_table(id, args->>'table_name', args->>'timestamp_column', options);
+	elsif kind = 'topn_table' then
+		call pgf_topn_table(id, args->>'table_name', args->>'pk', args->>'sort_column', options);
+	elsif kind = 'tree_level' then
+		call pgf_tree_level(id, args->>'table_name', args->>'pk_column', args->>'parent_column', args->>'level_column');
+	elsif kind = 'tree_closure_table' then
+		call pgf_tree_closure_table(id, args->>'table_name', args->>'pk_column', args->>'parent_column', options);
+	elsif kind = 'inheritance_table' then
+		call pgf_inheritance_table(id, args->>'base_table_name', _pgf_internal_jsonb_to_text_array(args->'sub_tables'), args->>'sync_direction', options);
+	elsif kind = 'audit_table' then
+		call pgf_audit_table(id, args->>'audit_table_name', _pgf_internal_jsonb_to_text_array(args->'audited_table_names'), options);
+	elsif kind = 'sync' then
+		call pgf_sync(id, args->>'table_name', args->>'column1', args->>'column2');
+	elsif kind = 'intersect_table' then
+		call pgf_intersect_table(id, _pgf_internal_jsonb_to_text_array(args->'table_names'), _pgf_internal_jsonb_to_text_array(args->'column_names'), args->>'intersect_table_name', options);
+	elsif kind = 'union_table' then
+		call pgf_union_table(id, _pgf_internal_jsonb_to_text_array(args->'table_names'), _pgf_internal_jsonb_to_text_array(args->'column_names'), args->>'union_table_name', options);
+	else
+		raise exception 'Unknown value for argument "kind": %', kind;
+	end if;
+END;
+$proc$;
+
+-- Returns the options of a formula merged with their default values, given its kind and arguments (as stored in the
+-- metadata table). Called by the creation procedure of each kind, and by pgf_deploy to compare a manifest entry with the
+-- stored arguments. NULL for the kinds without options.
+CREATE or replace FUNCTION _pgf_internal_default_options (
+	kind TEXT,
+	args JSONB
+)
+RETURNS JSONB
+LANGUAGE plpgsql IMMUTABLE AS $proc$
+DECLARE
+	options JSONB := coalesce(args->'options', '{}'::JSONB);
+BEGIN
+	if kind in ('revdate', 'tree_level', 'sync') then
+		return NULL;
+	elsif kind in ('count', 'sum') then
+		return jsonb_build_object(
+			'filter', 'true',
+			'shared_trigger', false,
+			'strategy', 'row',
+			'recompute_threshold', 1000,
+			'full_refresh_ratio', 0.3,
+			'ordered_locking', false,
+			'side_table', NULL,
+			'side_table_fillfactor', 90
+		) || options;
+	elsif kind in ('min', 'max') then
+		return jsonb_build_object(
+			'filter', 'true',
+			'strategy', 'row',
+			'recompute_threshold', 1000,
+			'full_refresh_ratio', 0.3,
+			'ordered_locking', false,
+			'side_table', NULL,
+			'side_table_fillfactor', 90,
+			'cache_size', 0
+		) || options;
+	elsif kind in ('id_of_min', 'id_of_max') then
+		return jsonb_build_object(
+			'filter', 'true',
+			'value_column', NULL,
+			'cache_size', 0
+		) || options;
+	elsif kind = 'array_agg' then
+		return jsonb_build_object(
+			'filter', 'true',
+			'order_by', NULL,
+			'distinct', true,
+			'limit', NULL
+		) || options;
+	elsif kind = 'string_agg' then
+		return jsonb_build_object(
+			'filter', 'true',
+			'delimiter', ', ',
+			'order_by', NULL,
+			'distinct', false,
+			'limit', NULL
+		) || options;
+	elsif kind = 'count_distinct' then
+		return jsonb_build_object(
+			'filter', 'true'
+		) || options;
+	elsif kind = 'approx_count_distinct' then
+		return jsonb_build_object(
+			'filter', 'true',
+			'precision', 12,
+			'delete_policy', 'refresh'
+		) || options;
+	elsif kind in ('window_count', 'window_sum') then
+		return jsonb_build_object(
+			'window', '24 hours',
+			'bucket', '1 hour',
+			'filter', 'true'
+		) || options;
+	elsif kind = 'running_sum' then
+		return jsonb_build_object(
+			'block_size', 1000,
+			'view_name', (args->>'table_name') || '_' || (args->>'target_column')
+		) || options;
+	elsif kind = 'rank' then
+		return jsonb_build_object(
+			'rank_function', 'row_number',
+			'order_direction', 'asc',
+			'block_size', 1000,
+			'view_name', (args->>'table_name') || '_' || (args->>'target_column')
+		) || options;
+	elsif kind = 'minmax_table' then
+		return jsonb_build_object(
+			'group_by_column', '[]'::jsonb,
+			'agg_table', (args->>'table_name') || '_minmax',
+			'storage', '{}'::jsonb
+		) || options;
+	elsif kind = 'sum_table' then
+		return jsonb_build_object(
+			'group_by_column', '[]'::jsonb,
+			'filter', 'true',
+			'higher_moments', false,
+			'agg_table', (args->>'table_name') || '_sum',
+			'storage', '{}'::jsonb
+		) || options;
+	elsif kind = 'count_table' then
+		return jsonb_build_object(
+			'group_by_column', '[]'::jsonb,
+			'filter', 'true',
+			'multidimensional_aggregation', NULL,
+			'agg_table', (args->>'table_name') || '_count',
+			'storage', '{}'::jsonb
+		) || options;
+	elsif kind = 'topn_table' then
+		return jsonb_build_object(
+			'group_by_column', '[]'::jsonb,
+			'n', 10,
+			'direction', 'desc',
+			'filter', 'true',
+			'buffer_size', coalesce(options->'n', '10'::jsonb),
+			'topn_table', (args->>'table_name') || '_topn',
+			'storage', '{}'::jsonb
+		) || options;
+	elsif kind = 'histogram_table' then
+		return jsonb_build_object(
+			'group_by_column', '[]'::jsonb,
+			'filter', 'true',
+			'scale', 'linear',
+			'min', NULL,
+			'max', NULL,
+			'bucket_count', 100,
+			'agg_table', (args->>'table_name') || '_histogram',
+			'storage', '{}'::jsonb
+		) || options;
+	elsif kind = 'timeseries_table' then
+		options := jsonb_build_object(
+			'bucket', '1 hour',
+			'group_by_column', '[]'::jsonb,
+			'sum_columns', '[]'::jsonb,
+			'min_columns', '[]'::jsonb,
+			'max_columns', '[]'::jsonb,
+			'filter', 'true',
+			'retention', NULL,
+			'partition_interval', NULL,
+			'rollups', '[]'::jsonb,
+			'agg_table', (args->>'table_name') || '_timeseries',
+			'storage', '{}'::jsonb
+		) || options;
+		-- rollups: same aggregates with coarser buckets, e.g. [{"bucket": "1 day", "retention": "1 year"}]
+		return options || jsonb_build_object('rollups', (
+			select coalesce(jsonb_agg(jsonb_build_object(
+					'agg_table', (options->>'agg_table') || '_' || regexp_replace(x->>'bucket', '\W+', '_', 'g'),
+					'retention', NULL,
+					'partition_interval', NULL
+				) || x order by o), '[]'::jsonb)
+			from jsonb_array_elements(options->'rollups') with ordinality t(x, o)
+		));
+	elsif kind = 'tree_closure_table' then
+		return jsonb_build_object(
+			'closure_table_name', (args->>'table_name') || '_closure',
+			'ancestor_id_column_name', 'ancestor_id',
+			'descendant_id_column_name', 'descendant_id',
+			'depth_column_name', 'depth',
+			'storage', '{}'::jsonb
+		) || options;
+	elsif kind = 'inheritance_table' then
+		return jsonb_build_object(
+			'discriminator_column', 'discriminator',
+			'discriminator_values', args->'sub_tables',
+			'storage', '{}'::jsonb
+		) || options;
+	elsif kind = 'audit_table' then
+		return jsonb_build_object(
+			'operation_column_name', 'OPERATION',
+			'operations_mapping', jsonb_build_object('INSERT', 'INSERT', 'UPDATE', 'UPDATE', 'DELETE', 'DELETE'),
+			'old_value_column_name', 'OLD_VALUE',
+			'new_value_column_name', 'NEW_VALUE',
+			'audited_operations', jsonb_build_array('INSERT', 'UPDATE', 'DELETE'),
+			'storage', '{}'::jsonb
+		) || options;
+	elsif kind in ('intersect_table', 'union_table') then
+		return jsonb_build_object(
+			'storage', '{}'::jsonb
+		) || options;
+	else
+		raise exception 'Unknown value for argument "kind": %', kind;
+	end if;
+END;
+$proc$;
+
+/* Create, update or drop many formulas in a single call.
+manifest format:
+{
+	"formulas": [ {"id": "...", "kind": "count", "args": { ...arguments of pgf_count... }}, ... ],
+	"drop": [ "formula id", ... ], -- optional
+	"drop_unlisted": false -- optional: drop existing formulas absent from the "formulas" list
+}
+Formulas whose kind and arguments are unchanged are skipped. Changed formulas are dropped and re-created.
+Full refreshes are run once at the end, after all formulas are created. */
+CREATE or replace PROCEDURE pgf_deploy (
+	manifest JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	formulas JSONB;
+	f JSONB; -- loop variable: manifest entry
+	fid TEXT; -- loop variable: formula id
+	t TEXT; -- loop variable: table name
+	existing pgf_metadata;
+	missing_tables TEXT[];
+	refresh_ids TEXT[] := ARRAY[]::TEXT[];
+BEGIN
+	formulas := coalesce(manifest->'formulas', '[]'::JSONB);
+
+	-- check source tables with a single catalog lookup. Tables generated by formulas of the manifest do not need to exist yet.
+	select array_agg(distinct src.name order by src.name) into missing_tables
+	from jsonb_array_elements(formulas) e(f),
+	lateral unnest(_pgf_internal_source_tables(e.f->>'kind', e.f->'args')) src(name)
+	where to_regclass(format('%I', src.name)) is null
+	and src.name not in (
+		select unnest(_pgf_internal_target_tables(e2.f->>'kind', e2.f->'args'))
+		from jsonb_array_elements(formulas) e2(f)
 	);
+	if missing_tables is not null then
+		raise exception 'pgf_deploy: tables not found: %', array_to_string(missing_tables, ', ');
+	end if;
 
-    execute format($trg$
-		CREATE TRIGGER _pgf_internal_count_trg_%I -- id
-		after delete or insert or update ON %I -- linked_table_name
-		FOR EACH ROW
-		execute procedure _pgf_internal_count_trgfun_%I(); -- id
+	-- creation procedures must not run their own refresh (see _pgf_internal_post_create)
+	perform set_config('pg_formulas.deploying', 'on', true);
+
+	-- drop formulas
+	for fid in
+		select jsonb_array_elements_text(coalesce(manifest->'drop', '[]'::JSONB))
+		union
+		select m.id from pgf_metadata m
+		where coalesce((manifest->>'drop_unlisted')::boolean, false)
+		and not exists (select 1 from jsonb_array_elements(formulas) e(f) where e.f->>'id' = m.id)
+	loop
+		if exists (select 1 from pgf_metadata m where m.id = fid) then
+			call pgf_drop(fid);
+		end if;
+	end loop;
+
+	-- create or update formulas
+	for f in select * from jsonb_array_elements(formulas) loop
+		select * into existing from pgf_metadata m where m.id = f->>'id';
+		if existing.id is not null then
+			-- the manifest arguments are compared with their default option values (NULL arguments may be omitted)
+			if existing.kind = f->>'kind' and jsonb_strip_nulls(existing.args) = jsonb_strip_nulls(coalesce(f->'args', '{}'::JSONB)
+				|| jsonb_build_object('options', _pgf_internal_default_options(existing.kind, coalesce(f->'args', '{}'::JSONB)))) then
+				continue; -- unchanged
+			end if;
+			call pgf_drop(existing.id);
+			-- these formulas create their table unconditionally
+			if existing.kind in ('minmax_table', 'sum_table', 'count_table', 'histogram_table', 'timeseries_table', 'topn_table', 'intersect_table', 'union_table') then
+				foreach t in array _pgf_internal_target_tables(existing.kind, existing.args) loop
+					execute format('drop table if exists %I', t);
+				end loop;
+			end if;
+		end if;
+		call _pgf_internal_create(f->>'id', f->>'kind', coalesce(f->'args', '{}'::JSONB));
+		refresh_ids := refresh_ids || (f->>'id');
+	end loop;
+
+	perform set_config('pg_formulas.deploying', 'off', true);
+	call _pgf_internal_order_triggers();
+
+	-- batched refresh of created and updated formulas, in dependency order
+	for fid in
+		select l.id from _pgf_internal_formula_levels() l where l.id = any(refresh_ids) order by l.level, l.id
+	loop
+		call pgf_refresh(fid);
+	end loop;
+END;
+$proc$;
+
+
+
+
+--------------------------------------------------------------------------------
+-- ADAPTIVE STRATEGY (COUNT, SUM, MIN, MAX)
+--------------------------------------------------------------------------------
+/* With option strategy='adaptive', row triggers are replaced by statement triggers reading the transition tables.
+Depending on the number of rows changed by the statement:
+- up to recompute_threshold rows: changes are applied as deltas, aggregated by parent row,
+- above recompute_threshold rows: aggregates of the parent rows referenced by changed rows are recomputed,
+- above full_refresh_ratio * (estimated number of rows of the linked table, once analyzed): full refresh.
+With option ordered_locking, the parent rows are locked in primary key order before being updated. */
+CREATE or replace PROCEDURE _pgf_internal_check_strategy (
+	options JSONB
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	if options->>'strategy' not in ('row', 'adaptive') then
+		raise exception 'Unknown value for option "strategy": %', options->>'strategy';
+	end if;
+	if options->>'strategy' = 'adaptive' and coalesce((options->>'shared_trigger')::boolean, false) then
+		raise exception 'Options "shared_trigger" and "strategy"=''adaptive'' cannot be combined';
+	end if;
+	if coalesce((options->>'ordered_locking')::boolean, false) and options->>'strategy' <> 'adaptive' then
+		raise exception 'Option "ordered_locking" requires "strategy"=''adaptive''';
+	end if;
+	if coalesce((options->>'cache_size')::int, 0) > 0 and options->>'strategy' = 'adaptive' then
+		raise exception 'Options "cache_size" and "strategy"=''adaptive'' cannot be combined';
+	end if;
+END;
+$proc$;
+
+-- Create the statement triggers of a formula using the adaptive strategy.
+-- Transition tables cannot be used by triggers with more than one event, hence one trigger per event.
+CREATE or replace PROCEDURE _pgf_internal_create_adaptive_triggers (
+	id TEXT,
+	kind TEXT,
+	linked_table_name TEXT
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_%I -- kind, id
+		after insert ON %I -- linked_table_name
+		REFERENCING NEW TABLE AS pgf_new
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_adaptive_trgfun(%L); -- id
 		$trg$,
-		id,
+		kind, id,
 		linked_table_name,
 		id
 	);
 
-    execute format($trg$
-		CREATE TRIGGER _pgf_internal_count_trg_truncate_%I -- id
-		after truncate ON %I -- linked_table_name
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_update_%I -- kind, id
+		after update ON %I -- linked_table_name
+		REFERENCING OLD TABLE AS pgf_old NEW TABLE AS pgf_new
 		FOR EACH STATEMENT
-		execute procedure _pgf_internal_count_trgfun_%I(); -- id
+		execute procedure _pgf_internal_adaptive_trgfun(%L); -- id
 		$trg$,
-		id,
+		kind, id,
 		linked_table_name,
 		id
 	);
 
-	call pgf_refresh(id);
-
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_delete_%I -- kind, id
+		after delete ON %I -- linked_table_name
+		REFERENCING OLD TABLE AS pgf_old
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_adaptive_trgfun(%L); -- id
+		$trg$,
+		kind, id,
+		linked_table_name,
+		id
+	);
 END;
 $proc$;
 
-
---------------------------------------------------------------------------------
--- SUM
---------------------------------------------------------------------------------
-CREATE or replace PROCEDURE pgf_sum (
+CREATE or replace PROCEDURE _pgf_internal_drop_adaptive_triggers (
 	id TEXT,
-    base_table_name TEXT,
-    base_pk TEXT,
-    base_aggregate_column TEXT,
-    linked_table_name TEXT,
-    linked_fk TEXT,
-	linked_value_column TEXT, -- column to be summed
-	options JSONB default '{}'::JSONB
+	kind TEXT,
+	linked_table_name TEXT
 )
 LANGUAGE plpgsql AS $proc$
+BEGIN
+	execute format('drop trigger if exists _pgf_internal_%s_trg_update_%I on %I', kind, id, linked_table_name);
+	execute format('drop trigger if exists _pgf_internal_%s_trg_delete_%I on %I', kind, id, linked_table_name);
+END;
+$proc$;
+
+-- Statement trigger function shared by all formulas using the adaptive strategy. TG_ARGV[0] = formula id.
+CREATE OR REPLACE FUNCTION _pgf_internal_adaptive_trgfun()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
 DECLARE
+	args JSONB;
+	kind TEXT;
+	base_table_name TEXT;
+	base_pk TEXT;
+	aggregate_column TEXT;
+	linked_table_name TEXT;
+	linked_fk TEXT;
+	linked_value_column TEXT;
 	row_filter TEXT;
+	new_rows TEXT; -- query returning the inserted rows, or the new version of updated rows
+	old_rows TEXT; -- query returning the deleted rows, or the old version of updated rows
+	changed_row_count bigint;
+	linked_row_count float8; -- estimated number of rows in the linked table
+	aggregate_expression TEXT; -- aggregate of the linked rows of a parent row, e.g. 'count(*)'
+	extreme_function TEXT; -- 'least' for min, 'greatest' for max
+	comparison_operator TEXT; -- '<=' for min, '>=' for max
+	full_refresh boolean;
+	parent_keys TEXT; -- query returning the primary keys of the parent rows referenced by changed rows
 BEGIN
-	-- set default values for optional arguments
-	options := jsonb_build_object(
-		'filter', 'true'
-	) || options;
-	row_filter := options->>'filter';
-	if row_filter is null or row_filter = '' then
-		row_filter := 'true';
+	args := _pgf_internal_get_metadata(TG_ARGV[0]);
+	kind := args->>'kind';
+	base_table_name := _pgf_internal_result_table(args);
+	base_pk := args->>'base_pk';
+	aggregate_column := coalesce(args->>'base_aggregate_column', args->>'base_count_column');
+	linked_table_name := args->>'linked_table_name';
+	linked_fk := args->>'linked_fk';
+	linked_value_column := args->>'linked_value_column';
+	row_filter := coalesce(nullif(args->'options'->>'filter', ''), 'true');
+
+	new_rows := case when TG_OP = 'DELETE' then format('select * from %I.%I where false', TG_TABLE_SCHEMA, TG_TABLE_NAME) else 'select * from pgf_new' end;
+	old_rows := case when TG_OP = 'INSERT' then format('select * from %I.%I where false', TG_TABLE_SCHEMA, TG_TABLE_NAME) else 'select * from pgf_old' end;
+
+	execute format('select count(*) from (%s) t', case when TG_OP = 'DELETE' then old_rows else new_rows end) into changed_row_count;
+	if changed_row_count = 0 then
+		return null;
+	end if;
+	select c.reltuples into linked_row_count from pg_class c where c.oid = TG_RELID;
+	full_refresh := changed_row_count > (args->'options'->>'recompute_threshold')::bigint
+		and linked_row_count > 0 -- the table has been analyzed
+		and changed_row_count >= (args->'options'->>'full_refresh_ratio')::float8 * linked_row_count;
+	parent_keys := format('select %I from (%s) n union select %I from (%s) o', linked_fk, new_rows, linked_fk, old_rows);
+
+	if coalesce((args->'options'->>'ordered_locking')::boolean, false) then
+		-- row locks are taken in key order: concurrent statements cannot deadlock on parent rows
+		execute format($sql$
+			select 1 from %I b where %s order by b.%I for no key update -- base_table_name, key filter, base_pk
+			$sql$,
+			base_table_name,
+			case when full_refresh then 'true' else format('b.%I in (%s)', base_pk, parent_keys) end,
+			base_pk
+		);
 	end if;
 
-	call _pgf_internal_insert_metadata(id, 'sum', jsonb_build_object(
-		'base_table_name', base_table_name,
-		'base_pk', base_pk,
-		'base_aggregate_column', base_aggregate_column,
-		'linked_table_name', linked_table_name,
-		'linked_fk', linked_fk,
-		'linked_value_column', linked_value_column,
-		'options', options
-	));
+	if full_refresh then
+		call pgf_refresh(TG_ARGV[0]);
+
+	elsif changed_row_count > (args->'options'->>'recompute_threshold')::bigint then
+		-- recompute the aggregate of each parent row referenced by a changed row
+		aggregate_expression := case kind
+			when 'count' then 'count(*)'
+			when 'sum' then format('coalesce(sum(%I), 0)', linked_value_column)
+			else format('%s(%I)', kind, linked_value_column)
+		end;
+		execute format($sql$
+			update %I b set %I = ( -- base_table_name, aggregate_column
+				select %s from %I l where l.%I = b.%I and (%s) -- aggregate_expression, linked_table_name, linked_fk, base_pk, row_filter
+			)
+			where b.%I in (%s) -- base_pk, parent_keys
+			$sql$,
+			base_table_name, aggregate_column,
+			aggregate_expression, linked_table_name, linked_fk, base_pk, row_filter,
+			base_pk, parent_keys
+		);
 
-	execute format($fun$
-		CREATE OR REPLACE FUNCTION _pgf_internal_sum_trgfun_%I() -- id
-		RETURNS TRIGGER AS $inner_trg$
-		DECLARE
-			old_row_matches_filter boolean := true;
-			new_row_matches_filter boolean := true;
+	elsif kind in ('count', 'sum') then
+		-- apply the changes as deltas, aggregated by parent row
+		execute format($sql$
+			update %I b set %I = b.%I + d.delta -- base_table_name, aggregate_column, aggregate_column
+			from (
+				select c.id, sum(c.delta) as delta from (
+					select %I as id, %s as delta from (%s) n where (%s) -- linked_fk, delta, new_rows, row_filter
+					union all
+					select %I as id, -%s as delta from (%s) o where (%s) -- linked_fk, delta, old_rows, row_filter
+				) c
+				group by c.id
+			) d
+			where b.%I = d.id and d.delta <> 0 -- base_pk
+			$sql$,
+			base_table_name, aggregate_column, aggregate_column,
+			linked_fk, case when kind = 'count' then '1' else format('coalesce(%I, 0)', linked_value_column) end, new_rows, row_filter,
+			linked_fk, case when kind = 'count' then '1' else format('coalesce(%I, 0)', linked_value_column) end, old_rows, row_filter,
+			base_pk
+		);
+
+	else
+		-- min, max: merge new values, then rescan the parent rows whose extreme value may have been removed
+		extreme_function := case when kind = 'min' then 'least' else 'greatest' end;
+		comparison_operator := case when kind = 'min' then '<=' else '>=' end;
+		execute format($sql$
+			update %I b set %I = %s(b.%I, d.value) -- base_table_name, aggregate_column, extreme_function, aggregate_column
+			from (select %I as id, %s(%I) as value from (%s) n where (%s) group by %I) d -- linked_fk, kind, linked_value_column, new_rows, row_filter, linked_fk
+			where b.%I = d.id -- base_pk
+			$sql$,
+			base_table_name, aggregate_column, extreme_function, aggregate_column,
+			linked_fk, kind, linked_value_column, new_rows, row_filter, linked_fk,
+			base_pk
+		);
+		execute format($sql$
+			update %I b set %I = ( -- base_table_name, aggregate_column
+				select %s(%I) from %I l where l.%I = b.%I and (%s) -- kind, linked_value_column, linked_table_name, linked_fk, base_pk, row_filter
+			)
+			where exists (
+				select 1 from (%s) o -- old_rows
+				where o.%I = b.%I and (%s) -- linked_fk, base_pk, row_filter
+				and (b.%I is null or o.%I %s b.%I) -- aggregate_column, linked_value_column, comparison_operator, aggregate_column
+			)
+			$sql$,
+			base_table_name, aggregate_column,
+			kind, linked_value_column, linked_table_name, linked_fk, base_pk, row_filter,
+			old_rows,
+			linked_fk, base_pk, row_filter,
+			aggregate_column, linked_value_column, comparison_operator, aggregate_column
+		);
+	end if;
+	return null;
+END;
+$$;
+
+
+--------------------------------------------------------------------------------
+-- SIDE TABLES (COUNT, SUM, MIN, MAX)
+--------------------------------------------------------------------------------
+/* With option side_table, the formula result is stored in a narrow side table instead of the base table,
+so that updating it does not create a new version of a wide base row, nor update the base table indexes.
+The side table has one row per base row, with the same primary key, and one column per formula.
+It can be shared by several formulas of the same base table.
+The view <side_table>_view joins the base table and the side table. */
+CREATE or replace PROCEDURE _pgf_internal_create_side_table (
+	base_table_name TEXT,
+	base_pk TEXT,
+	options JSONB,
+	column_name TEXT, -- column storing the formula result
+	column_type TEXT,
+	column_default TEXT
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	side_table_name TEXT;
+	pk_type TEXT;
+BEGIN
+	side_table_name := options->>'side_table';
+	select c.data_type into pk_type from _pgf_internal_table_columns(ARRAY[base_table_name]) c where c.column_name = base_pk;
+
+	-- side rows are deleted and re-keyed with their base row. No other index than the primary key.
+	execute format($sql$
+		CREATE TABLE IF NOT EXISTS %I ( -- side_table_name
+			%I %s primary key references %I(%I) on delete cascade on update cascade -- base_pk, pk_type, base_table_name, base_pk
+		) with (fillfactor = %s) -- side_table_fillfactor
+		$sql$,
+		side_table_name,
+		base_pk, pk_type, base_table_name, base_pk,
+		(options->>'side_table_fillfactor')::int
+	);
+	execute format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS %I %s default %s', side_table_name, column_name, column_type, column_default);
+
+	-- create the side rows of existing and future base rows
+	execute format('insert into %I(%I) select %I from %I on conflict do nothing', side_table_name, base_pk, base_pk, base_table_name);
+	execute format('DROP TRIGGER IF EXISTS %I ON %I', '_pgf_internal_side_table_trg_' || side_table_name, base_table_name);
+	execute format($trg$
+		CREATE TRIGGER %I -- '_pgf_internal_side_table_trg_' || side_table_name
+		after insert ON %I -- base_table_name
+		FOR EACH ROW
+		execute procedure _pgf_internal_side_table_trgfun(%L, %L); -- side_table_name, base_pk
+		$trg$,
+		'_pgf_internal_side_table_trg_' || side_table_name,
+		base_table_name,
+		side_table_name, base_pk
+	);
+
+	call _pgf_internal_create_side_view(base_table_name, base_pk, side_table_name);
+END;
+$proc$;
+
+-- (Re-)create the view <side_table>_view exposing the base table with the formula results. A side column replaces the base
+-- column of the same name, if any.
+CREATE or replace PROCEDURE _pgf_internal_create_side_view (
+	base_table_name TEXT,
+	base_pk TEXT,
+	side_table_name TEXT
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	base_columns TEXT; -- SQL fragment: columns of the base table, except the side columns
+	side_columns TEXT; -- SQL fragment: columns of the side table, except the primary key
+BEGIN
+	select string_agg(format('s.%I', c.column_name), ', ' order by c.ordinal_position) into side_columns
+	from _pgf_internal_table_columns(ARRAY[side_table_name]) c
+	where c.column_name <> base_pk;
+	select string_agg(format('b.%I', c.column_name), ', ' order by c.ordinal_position) into base_columns
+	from _pgf_internal_table_columns(ARRAY[base_table_name]) c
+	where c.column_name = base_pk or c.column_name not in (select s.column_name from _pgf_internal_table_columns(ARRAY[side_table_name]) s);
+	execute format('DROP VIEW IF EXISTS %I', side_table_name || '_view');
+	execute format($sql$
+		CREATE VIEW %I AS -- side_table_name || '_view'
+		select %s, %s -- base_columns, side_columns
+		from %I b -- base_table_name
+		left join %I s on s.%I = b.%I -- side_table_name, base_pk, base_pk
+		$sql$,
+		side_table_name || '_view',
+		base_columns, side_columns,
+		base_table_name,
+		side_table_name, base_pk, base_pk
+	);
+END;
+$proc$;
+
+-- Drop the column of a formula from its side table (see pgf_drop). The side table, its view and its trigger are
+-- dropped with the last formula column.
+CREATE or replace PROCEDURE _pgf_internal_drop_side_table (
+	base_table_name TEXT,
+	base_pk TEXT,
+	side_table_name TEXT,
+	column_name TEXT
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	execute format('DROP VIEW IF EXISTS %I', side_table_name || '_view');
+	execute format('ALTER TABLE IF EXISTS %I DROP COLUMN IF EXISTS %I', side_table_name, column_name);
+	if exists (select 1 from _pgf_internal_table_columns(ARRAY[side_table_name]) c where c.column_name <> base_pk) then
+		call _pgf_internal_create_side_view(base_table_name, base_pk, side_table_name);
+	else
+		execute format('DROP TRIGGER IF EXISTS %I ON %I', '_pgf_internal_side_table_trg_' || side_table_name, base_table_name);
+		execute format('DROP TABLE IF EXISTS %I', side_table_name);
+	end if;
+END;
+$proc$;
+
+-- Trigger function creating the side row of a new base row. TG_ARGV[0] = side table name, TG_ARGV[1] = base_pk.
+CREATE OR REPLACE FUNCTION _pgf_internal_side_table_trgfun()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+	execute format('insert into %I(%I) select ($1).%I on conflict do nothing', TG_ARGV[0], TG_ARGV[1], TG_ARGV[1]) using NEW;
+	RETURN NULL;
+END;
+$$;
+
+--------------------------------------------------------------------------------
+-- EXTREME CACHE (MIN, MAX, ID_OF_MIN)
+--------------------------------------------------------------------------------
+/* With option cache_size = K > 0, the formula keeps the K smallest (MAX: largest) entries of each parent
+in the table _pgf_internal_cache_<id>(parent_id, value, [id,] row_count), ordered by value (ID_OF_MIN: by value, id).
+The cache of a parent is always a prefix of its sorted entries, with exact row counts:
+- a new entry is cached if it does not come after the last cached entry, then the cache is trimmed to K entries,
+- a removed entry is removed from the cache, which is refilled from the linked table only when it runs empty.
+A cache that runs empty is refilled once at the end of the statement (statement trigger), from the final state of the
+linked table: its parent is marked stale in _pgf_internal_cache_stale_<id>, and the next row triggers of the statement
+skip it. Linked rows without parent (NULL FK) are not cached.
+The aggregate value is the first cached entry: deleting or increasing the current minimum does not rescan the linked rows.
+This procedure replaces the trigger function and the refresh procedure generated by the formula. */
+CREATE or replace PROCEDURE _pgf_internal_create_cache (
+	id TEXT,
+	kind TEXT, -- 'min', 'max', 'id_of_min' or 'id_of_max'
+	base_table_name TEXT,
+	base_pk TEXT,
+	base_aggregate_column TEXT,
+	linked_table_name TEXT,
+	linked_pk TEXT, -- NULL except for ID_OF_MIN
+	linked_fk TEXT,
+	linked_value_column TEXT,
+	row_filter TEXT,
+	options JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	cache_table_name TEXT := '_pgf_internal_cache_' || id;
+	stale_table_name TEXT := '_pgf_internal_cache_stale_' || id;
+	cache_size int := (options->>'cache_size')::int;
+	key_columns TEXT; -- SQL fragment: cache table columns identifying an entry
+	linked_key_columns TEXT; -- SQL fragment: same columns, in the linked table
+	order_fragment TEXT; -- SQL fragment: order of the cache entries
+	reverse_order_fragment TEXT; -- SQL fragment: reverse order of the cache entries
+	linked_order_fragment TEXT; -- SQL fragment: order of the cache entries, in the linked table
+	cmp TEXT; -- '<=' if the cache keeps the smallest entries, '>=' otherwise
+	result_column TEXT; -- cache column holding the aggregate value
+	value_column TEXT := options->>'value_column'; -- ID_OF_MIN, ID_OF_MAX: companion column holding the min (max) value
+	set_value_fragment TEXT := ''; -- SQL fragment: ', value_column = sub.value'
+	column_types JSONB; -- linked table column name -> type
+BEGIN
+	if coalesce(options->>'strategy', 'row') <> 'row' then
+		raise exception 'Options "cache_size" and "strategy"=''%'' cannot be combined', options->>'strategy';
+	end if;
+
+	select jsonb_object_agg(c.column_name, c.data_type) into column_types
+	from _pgf_internal_table_columns(ARRAY[linked_table_name]) c;
+
+	if kind in ('id_of_min', 'id_of_max') then
+		key_columns := 'value, id';
+		linked_key_columns := format('%I, %I', linked_value_column, linked_pk);
+		order_fragment := case when kind = 'id_of_min' then 'value asc, id asc' else 'value desc, id desc' end;
+		reverse_order_fragment := case when kind = 'id_of_min' then 'value desc, id desc' else 'value asc, id asc' end;
+		linked_order_fragment := case when kind = 'id_of_min' then format('%I asc, %I asc', linked_value_column, linked_pk)
+			else format('%I desc, %I desc', linked_value_column, linked_pk) end;
+		cmp := case when kind = 'id_of_min' then '<=' else '>=' end;
+		result_column := 'id';
+		if value_column is not null then
+			set_value_fragment := format(', %I = sub.value', value_column);
+		end if;
+	else
+		key_columns := 'value';
+		linked_key_columns := format('%I', linked_value_column);
+		order_fragment := case when kind = 'min' then 'value asc' else 'value desc' end;
+		reverse_order_fragment := case when kind = 'min' then 'value desc' else 'value asc' end;
+		linked_order_fragment := format('%I %s', linked_value_column, case when kind = 'min' then 'asc' else 'desc' end);
+		cmp := case when kind = 'min' then '<=' else '>=' end;
+		result_column := 'value';
+	end if;
+
+	execute format('DROP TABLE IF EXISTS %I', cache_table_name);
+	execute format($sql$
+		CREATE TABLE %I ( -- cache_table_name
+			parent_id %s, -- fk type
+			value %s, -- value type
+			%s -- id column (ID_OF_MIN only)
+			row_count bigint not null,
+			primary key (parent_id, %s) -- key_columns
+		)
+		$sql$,
+		cache_table_name,
+		column_types->>linked_fk,
+		column_types->>linked_value_column,
+		case when kind in ('id_of_min', 'id_of_max') then format('id %s,', column_types->>linked_pk) else '' end,
+		key_columns
+	);
+	execute format('DROP TABLE IF EXISTS %I', stale_table_name);
+	execute format('CREATE TABLE %I (parent_id %s primary key)', stale_table_name, column_types->>linked_fk);
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_%s_trgfun_%I() -- kind, id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			old_row_matches_filter boolean := false;
+			new_row_matches_filter boolean := false;
+			stale_parent record;
 		BEGIN
-			/* test if OLD row matches filter */
-			select case when count(*)=1 then true else false end into old_row_matches_filter from (
-				select * from (
-					select (OLD.*)
-				) t
-				where %s -- row_filter
-			) t2;
+			IF TG_OP = 'TRUNCATE' then
+				truncate %I, %I; -- cache_table_name, stale_table_name
+				update %I set %I = NULL; -- base_table_name, base_aggregate_column
+				RETURN NULL;
+			END IF;
 
-			/* test if NEW row matches filter */
-			select case when count(*)=1 then true else false end into new_row_matches_filter from (
-				select * from (
-					select NEW.*
+			/* end of statement: refill the caches that ran empty */
+			IF TG_LEVEL = 'STATEMENT' then
+				insert into %I(parent_id, %s, row_count) -- cache_table_name, key_columns
+				select parent_id, %s, row_count from ( -- linked_key_columns
+					select %I as parent_id, %s, count(*) as row_count, -- linked_fk, linked_key_columns
+						row_number() over (partition by %I order by %s) as rn -- linked_fk, linked_order_fragment
+					from %I -- linked_table_name
+					where %I in (select parent_id from %I) and %I is not null and (%s) -- linked_fk, stale_table_name, linked_value_column, row_filter
+					group by %I, %s -- linked_fk, linked_key_columns
 				) t
-				where %s -- row_filter
-			) t2;
+				where rn <= %s; -- cache_size
+				for stale_parent in delete from %I returning parent_id loop -- stale_table_name
+					%s -- set_result_fragment (stale parent)
+				end loop;
+				RETURN NULL;
+			END IF;
 
-			/* There are only 3 cases :
-			   - Case A : add NEW.value to row identified by NEW.FK
-			   - Case B : remove OLD.value to row identified by OLD.FK
-			   - Case C : add NEW.value-OLD.value to row identified by OLD.FK
+			/* skip rows deleted by a cascade (ON DELETE CASCADE) from their parent row, which is already deleted */
+			IF TG_OP = 'DELETE' and pg_trigger_depth() > 1 and not exists (select 1 from %I where %I = OLD.%I) then -- base_table_name, base_pk, linked_fk
+				delete from %I where parent_id = OLD.%I; -- cache_table_name, linked_fk
+				RETURN NULL;
+			END IF;
 
-			Pseudo-code :
-			new := new_row_matches_filter
-			old := new_row_matches_filter
-			value := value from linked_value_column
-			if INSERT then
-				if new then (A)
-				else (no op)
-			elsif DELETE then
-				if old then (B)
-				else (no op)
-			elsif UPDATE and FK has changed then
-				if new then (A)
-				else (no op)
-				if old then (B)
-				else (no op)
-			elsif UPDATE and value has changed then
-				if new and old then (C)
-				elsif new and !old then (A)
-				elsif !new and old then (B)
-				else (no op) 
-			end if
-			*/
-			IF TG_OP='INSERT' and new_row_matches_filter then
-				/* case A */
-				update %I set %I=%I+NEW.%I where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-			ELSIF TG_OP='DELETE' and old_row_matches_filter then
-				/* case B */
-				update %I set %I=%I-OLD.%I where %I=OLD.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-			ELSIF TG_OP='UPDATE' and OLD.%I <> NEW.%I then -- linked_fk, linked_fk
-				/* case : foreign key is updated (value may or may not change) */
-				if old_row_matches_filter then
-					/* case B */
-					update %I set %I=%I-OLD.%I where %I=OLD.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+			IF TG_OP in ('UPDATE', 'DELETE') and OLD.%I is not null and OLD.%I is not null -- linked_fk, linked_value_column
+				and not exists (select 1 from %I where parent_id = OLD.%I) then -- stale_table_name, linked_fk
+				select count(*) = 1 into old_row_matches_filter from (select OLD.*) t where %s; -- row_filter
+			END IF;
+			IF TG_OP in ('UPDATE', 'INSERT') and NEW.%I is not null and NEW.%I is not null -- linked_fk, linked_value_column
+				and not exists (select 1 from %I where parent_id = NEW.%I) then -- stale_table_name, linked_fk
+				select count(*) = 1 into new_row_matches_filter from (select NEW.*) t where %s; -- row_filter
+			END IF;
+			IF TG_OP = 'UPDATE' and old_row_matches_filter = new_row_matches_filter
+				and (OLD.%I, %s) is not distinct from (NEW.%I, %s) then -- linked_fk, key_old, linked_fk, key_new
+				RETURN NULL; -- the entry has not changed
+			END IF;
+
+			/* remove the old entry. If the cache of its parent runs empty, it is refilled at the end of the statement */
+			IF old_row_matches_filter then
+				delete from %I where parent_id = OLD.%I and (%s) = (%s) and row_count = 1; -- cache_table_name, linked_fk, key_columns, key_old
+				if not found then
+					update %I set row_count = row_count - 1 where parent_id = OLD.%I and (%s) = (%s); -- cache_table_name, linked_fk, key_columns, key_old
 				end if;
-				if new_row_matches_filter then
-					/* case A */
-					update %I set %I=%I+NEW.%I where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+				if not exists (select 1 from %I where parent_id = OLD.%I) then -- cache_table_name, linked_fk
+					insert into %I values (OLD.%I); -- stale_table_name, linked_fk
+					if TG_OP = 'UPDATE' and NEW.%I = OLD.%I then -- linked_fk, linked_fk
+						new_row_matches_filter := false; -- read by the refill
+					end if;
+				else
+					%s -- set_result_fragment (OLD)
 				end if;
-			ELSIF TG_OP = 'UPDATE' and OLD.%I <> NEW.%I then -- linked_value_column, linked_value_column
-				/* case : value is updated, FK stays the same */
-				if old_row_matches_filter and new_row_matches_filter then
-					/* case C */
-					update %I set %I = %I - OLD.%I + NEW.%I where %I = OLD.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, linked_value_column, base_pk, linked_fk
-				elsif new_row_matches_filter and not old_row_matches_filter then
-					/* case A */
-					update %I set %I=%I+NEW.%I where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-				elsif not new_row_matches_filter and old_row_matches_filter then 
-					/* case B */
-					update %I set %I=%I-OLD.%I where %I=OLD.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+			END IF;
+
+			/* add the new entry */
+			IF new_row_matches_filter then
+				if not exists (select 1 from %I where parent_id = NEW.%I) -- cache_table_name, linked_fk
+					or exists (select 1 from %I where parent_id = NEW.%I and (%s) %s (%s)) then -- cache_table_name, linked_fk, key_new, cmp, key_columns
+					insert into %I(parent_id, %s, row_count) values (NEW.%I, %s, 1) -- cache_table_name, key_columns, linked_fk, key_new
+					on conflict (parent_id, %s) do update set row_count = %I.row_count + 1; -- key_columns, cache_table_name
+					delete from %I -- cache_table_name
+					where parent_id = NEW.%I -- linked_fk
+					and (%s) = (select %s from %I where parent_id = NEW.%I order by %s limit 1) -- key_columns, key_columns, cache_table_name, linked_fk, reverse_order_fragment
+					and (select count(*) from %I where parent_id = NEW.%I) > %s; -- cache_table_name, linked_fk, cache_size
+					%s -- set_result_fragment (NEW)
 				end if;
-			ELSIF TG_OP='TRUNCATE' then
-				update %I set %I=0; -- base_table_name, base_aggregate_column
 			END IF;
-			RETURN NEW;
+			RETURN NULL;
 		END;
 		$inner_trg$ LANGUAGE plpgsql;
 	$fun$
-		, id
+		, kind, id
+		, cache_table_name, stale_table_name
+		, base_table_name, base_aggregate_column
+		, cache_table_name, key_columns
+		, linked_key_columns
+		, linked_fk, linked_key_columns
+		, linked_fk, linked_order_fragment
+		, linked_table_name
+		, linked_fk, stale_table_name, linked_value_column, row_filter
+		, linked_fk, linked_key_columns
+		, cache_size
+		, stale_table_name
+		, _pgf_internal_cache_set_result(cache_table_name, base_table_name, base_pk, base_aggregate_column, 'stale_parent.parent_id', result_column, value_column, order_fragment)
+		, base_table_name, base_pk, linked_fk
+		, cache_table_name, linked_fk
+		, linked_fk, linked_value_column
+		, stale_table_name, linked_fk
 		, row_filter
+		, linked_fk, linked_value_column
+		, stale_table_name, linked_fk
 		, row_filter
-		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+		, linked_fk, _pgf_internal_cache_key(kind, 'OLD', linked_value_column, linked_pk), linked_fk, _pgf_internal_cache_key(kind, 'NEW', linked_value_column, linked_pk)
+		, cache_table_name, linked_fk, key_columns, _pgf_internal_cache_key(kind, 'OLD', linked_value_column, linked_pk)
+		, cache_table_name, linked_fk, key_columns, _pgf_internal_cache_key(kind, 'OLD', linked_value_column, linked_pk)
+		, cache_table_name, linked_fk
+		, stale_table_name, linked_fk
 		, linked_fk, linked_fk
-		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-		, linked_value_column, linked_value_column
-		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, linked_value_column, base_pk, linked_fk
-		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-		, base_table_name, base_aggregate_column
+		, _pgf_internal_cache_set_result(cache_table_name, base_table_name, base_pk, base_aggregate_column, format('OLD.%I', linked_fk), result_column, value_column, order_fragment)
+		, cache_table_name, linked_fk
+		, cache_table_name, linked_fk, _pgf_internal_cache_key(kind, 'NEW', linked_value_column, linked_pk), cmp, key_columns
+		, cache_table_name, key_columns, linked_fk, _pgf_internal_cache_key(kind, 'NEW', linked_value_column, linked_pk)
+		, key_columns, cache_table_name
+		, cache_table_name
+		, linked_fk
+		, key_columns, key_columns, cache_table_name, linked_fk, reverse_order_fragment
+		, cache_table_name, linked_fk, cache_size
+		, _pgf_internal_cache_set_result(cache_table_name, base_table_name, base_pk, base_aggregate_column, format('NEW.%I', linked_fk), result_column, value_column, order_fragment)
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_refill_%I -- kind, id
+		after delete or insert or update ON %I -- linked_table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$,
+		kind, id,
+		linked_table_name,
+		kind, id
+	);
+
+	-- full refresh: rebuild the cache, then the aggregate values from the cache
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc2$
+			begin
+				truncate %I, %I; -- cache_table_name, stale_table_name
+				insert into %I(parent_id, %s, row_count) -- cache_table_name, key_columns
+				select parent_id, %s, row_count from ( -- linked_key_columns
+					select %I as parent_id, %s, count(*) as row_count, -- linked_fk, linked_key_columns
+						row_number() over (partition by %I order by %s) as rn -- linked_fk, linked_order_fragment
+					from %I -- linked_table_name
+					where %I is not null and %I is not null and (%s) -- linked_fk, linked_value_column, row_filter
+					group by %I, %s -- linked_fk, linked_key_columns
+				) t
+				where rn <= %s; -- cache_size
+
+				update %I set %I = NULL%s where %I is not null; -- base_table_name, base_aggregate_column, reset_value_fragment, base_aggregate_column
+				update %I set %I = sub.result%s -- base_table_name, base_aggregate_column, set_value_fragment
+				from (
+					select distinct on (parent_id) parent_id, %I as result, value -- result_column
+					from %I -- cache_table_name
+					order by parent_id, %s -- order_fragment
+				) as sub
+				where %I.%I = sub.parent_id; -- base_table_name, base_pk
+			end;
+			$inner_proc2$;
+		$inner_proc$
+		, id
+		, cache_table_name, stale_table_name
+		, cache_table_name, key_columns
+		, linked_key_columns
+		, linked_fk, linked_key_columns
+		, linked_fk, linked_order_fragment
+		, linked_table_name
+		, linked_fk, linked_value_column, row_filter
+		, linked_fk, linked_key_columns
+		, cache_size
+		, base_table_name, base_aggregate_column, case when value_column is null then '' else format(', %I = NULL', value_column) end, base_aggregate_column
+		, base_table_name, base_aggregate_column, set_value_fragment
+		, result_column
+		, cache_table_name
+		, order_fragment
+		, base_table_name, base_pk
+	);
+
+	-- range refresh (see pgf_refresh_range): rebuild the cache entries of the parents in [_pgf_range_start, _pgf_range_end)
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_cache_range_%I(_pgf_range_start %s, _pgf_range_end %s) -- id, fk type, fk type
+		LANGUAGE plpgsql
+		AS $inner_proc2$
+			begin
+				delete from %I -- cache_table_name
+				where (_pgf_range_start is null or parent_id >= _pgf_range_start) and (_pgf_range_end is null or parent_id < _pgf_range_end);
+				insert into %I(parent_id, %s, row_count) -- cache_table_name, key_columns
+				select parent_id, %s, row_count from ( -- linked_key_columns
+					select %I as parent_id, %s, count(*) as row_count, -- linked_fk, linked_key_columns
+						row_number() over (partition by %I order by %s) as rn -- linked_fk, linked_order_fragment
+					from %I -- linked_table_name
+					where %I is not null and %I is not null and (%s) -- linked_fk, linked_value_column, row_filter
+					and (_pgf_range_start is null or %I >= _pgf_range_start) and (_pgf_range_end is null or %I < _pgf_range_end) -- linked_fk, linked_fk
+					group by %I, %s -- linked_fk, linked_key_columns
+				) t
+				where rn <= %s; -- cache_size
+			end;
+			$inner_proc2$;
+		$inner_proc$
+		, id, column_types->>linked_fk, column_types->>linked_fk
+		, cache_table_name
+		, cache_table_name, key_columns
+		, linked_key_columns
+		, linked_fk, linked_key_columns
+		, linked_fk, linked_order_fragment
+		, linked_table_name
+		, linked_fk, linked_value_column, row_filter
+		, linked_fk, linked_fk
+		, linked_fk, linked_key_columns
+		, cache_size
+	);
+END;
+$proc$;
+
+-- SQL fragment: key of the cache entry of the OLD or NEW row (see _pgf_internal_create_cache).
+CREATE or replace FUNCTION _pgf_internal_cache_key (
+	kind TEXT,
+	record_name TEXT, -- 'OLD' or 'NEW'
+	linked_value_column TEXT,
+	linked_pk TEXT
+)
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE AS $$
+	select case when kind in ('id_of_min', 'id_of_max') then format('%s.%I, %s.%I', record_name, linked_value_column, record_name, linked_pk)
+	else format('%s.%I', record_name, linked_value_column) end;
+$$;
+
+-- SQL fragment: set the aggregate value of a parent to its first cache entry (see _pgf_internal_create_cache).
+CREATE or replace FUNCTION _pgf_internal_cache_set_result (
+	cache_table_name TEXT,
+	base_table_name TEXT,
+	base_pk TEXT,
+	base_aggregate_column TEXT,
+	parent_id TEXT, -- SQL expression
+	result_column TEXT,
+	value_column TEXT, -- companion column holding the min (max) value, or NULL
+	order_fragment TEXT
+)
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE AS $$
+	select format($sql$
+		update %I b set %I = c.result%s -- base_table_name, base_aggregate_column, set_value_fragment
+		from (select 1) d left join lateral ( -- no row if the cache is empty
+			select %I as result, value from %I where parent_id = %s order by %s limit 1 -- result_column, cache_table_name, parent_id, order_fragment
+		) c on true
+		where b.%I = %s and (b.%I%s) is distinct from (c.result%s); -- base_pk, parent_id, base_aggregate_column, value_fragment, value_fragment
+		$sql$,
+		base_table_name, base_aggregate_column, case when value_column is null then '' else format(', %I = c.value', value_column) end,
+		result_column, cache_table_name, parent_id, order_fragment,
+		base_pk, parent_id, base_aggregate_column, case when value_column is null then '' else format(', b.%I', value_column) end, case when value_column is null then '' else ', c.value' end
 	);
+$$;
+
+--------------------------------------------------------------------------------
+-- STORAGE (MINMAX_TABLE, SUM_TABLE, COUNT_TABLE, HISTOGRAM_TABLE, TIMESERIES_TABLE, TOPN_TABLE, TREE_CLOSURE_TABLE, INHERITANCE_TABLE, AUDIT_TABLE, INTERSECT_TABLE, UNION_TABLE)
+--------------------------------------------------------------------------------
+/* Option 'storage' of the formulas generating a table. JSON object with optional attributes:
+- unlogged (boolean): the table is not written to the WAL. It is emptied by crash recovery, and rebuilt by pgf_recover_unlogged.
+- fillfactor (int): free space left in each page for HOT updates.
+- autovacuum (object): autovacuum storage parameters, without the 'autovacuum_' prefix. E.g. {"vacuum_scale_factor": 0.01}.
+- partitions (int): number of hash partitions of the table, by its group key. */
+CREATE or replace PROCEDURE _pgf_internal_apply_storage (
+	table_name TEXT,
+	storage JSONB,
+	partition_columns TEXT[] default NULL, -- group key of the table. NULL if the table cannot be partitioned.
+	rebuildable boolean default true -- false if the table cannot be rebuilt by pgf_refresh (it then cannot be unlogged)
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	k TEXT; -- loop variable
+	partitions int;
+	is_empty boolean;
+	tables TEXT[]; -- tables holding the rows (quoted names): the partitions, or the table itself
+	reloptions TEXT[] := '{}';
+BEGIN
+	storage := coalesce(storage, '{}'::JSONB);
+	for k in select jsonb_object_keys(storage) loop
+		if k not in ('unlogged', 'fillfactor', 'autovacuum', 'partitions') then
+			raise exception 'Unknown storage option: %. Allowed options are: unlogged, fillfactor, autovacuum, partitions', k;
+		end if;
+	end loop;
+	if storage = '{}'::JSONB then
+		return;
+	end if;
+	if coalesce((storage->>'unlogged')::boolean, false) and not rebuildable then
+		raise exception 'Storage option unlogged is not supported for table %: it cannot be rebuilt after a crash', table_name;
+	end if;
+
+	partitions := coalesce((storage->>'partitions')::int, 0);
+	tables := ARRAY[quote_ident(table_name)];
+	if partitions > 0 and not exists (select 1 from pg_partitioned_table where partrelid = to_regclass(quote_ident(table_name))) then
+		if partition_columns is null or cardinality(partition_columns) = 0 then
+			raise exception 'Storage option partitions is not supported for table %: it has no group key', table_name;
+		end if;
+		execute format('select not exists (select 1 from %I)', table_name) into is_empty;
+		if not is_empty then
+			raise exception 'Cannot partition table %: it is not empty', table_name;
+		end if;
+
+		-- replace the (empty) table by a partitioned table with the same columns, defaults and constraints
+		execute format('ALTER TABLE %I RENAME TO %I', table_name, table_name || '_pgf_tmp');
+		execute format('CREATE TABLE %I (LIKE %I INCLUDING ALL) PARTITION BY HASH (%s)',
+			table_name, table_name || '_pgf_tmp', _pgf_internal_join(partition_columns));
+		execute format('DROP TABLE %I', table_name || '_pgf_tmp');
+		tables := '{}';
+		for i in 0..partitions - 1 loop
+			execute format('CREATE TABLE %I PARTITION OF %I FOR VALUES WITH (MODULUS %s, REMAINDER %s)',
+				table_name || '_p' || i, table_name, partitions, i);
+			tables := tables || quote_ident(table_name || '_p' || i);
+		end loop;
+	elsif partitions > 0 then
+		select array_agg(inhrelid::regclass::TEXT order by inhrelid) into tables
+		from pg_inherits where inhparent = to_regclass(quote_ident(table_name));
+	end if;
+
+	-- storage parameters are set on each partition: a partitioned table has no storage
+	if storage ? 'fillfactor' then
+		reloptions := reloptions || format('fillfactor = %s', (storage->>'fillfactor')::int);
+	end if;
+	for k in select jsonb_object_keys(coalesce(storage->'autovacuum', '{}'::JSONB)) loop
+		reloptions := reloptions || format('%I = %L', 'autovacuum_' || k, storage->'autovacuum'->>k);
+	end loop;
+	foreach k in array tables loop
+		if cardinality(reloptions) > 0 then
+			execute format('ALTER TABLE %s SET (%s)', k, array_to_string(reloptions, ', '));
+		end if;
+		if coalesce((storage->>'unlogged')::boolean, false) then
+			execute format('ALTER TABLE %s SET UNLOGGED', k);
+		end if;
+	end loop;
+
+	if coalesce((storage->>'unlogged')::boolean, false) and to_regclass('pgf_unlogged_sentinel') is null then
+		CREATE UNLOGGED TABLE pgf_unlogged_sentinel(created_at TIMESTAMP);
+		insert into pgf_unlogged_sentinel values (now());
+	end if;
+END;
+$proc$;
+
+/* Crash recovery empties unlogged tables, including the one-row table pgf_unlogged_sentinel.
+If it is empty, refresh the formulas whose table is unlogged (in dependency order), then mark them as recovered.
+Cheap when there is nothing to recover: call it after each server start. */
+CREATE or replace PROCEDURE pgf_recover_unlogged()
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	fid TEXT;
+	recovered boolean;
+BEGIN
+	if to_regclass('pgf_unlogged_sentinel') is null then
+		return; -- no unlogged table
+	end if;
+	execute 'select exists (select 1 from pgf_unlogged_sentinel)' into recovered;
+	if recovered then
+		return;
+	end if;
+
+	lock table pgf_unlogged_sentinel in exclusive mode; -- one session recovers, the others wait then return
+	execute 'select exists (select 1 from pgf_unlogged_sentinel)' into recovered;
+	if recovered then
+		return;
+	end if;
+	for fid in
+		select l.id from _pgf_internal_formula_levels() l
+		join pgf_metadata m on m.id = l.id
+		where coalesce((m.args->'options'->'storage'->>'unlogged')::boolean, false)
+		order by l.level, l.id
+	loop
+		raise notice 'pg_formulas: rebuilding unlogged table of formula %', fid;
+		call pgf_refresh(fid);
+	end loop;
+	execute 'insert into pgf_unlogged_sentinel values (now())';
+END;
+$proc$;
+
+-------------------------------------------------------------------------------
+-- REVDATE
+--------------------------------------------------------------------------------
+CREATE or replace PROCEDURE pgf_revdate (
+	id TEXT,
+    table_name TEXT,
+    column_name TEXT
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	call _pgf_internal_insert_metadata(id, 'revdate', jsonb_build_object('table_name', table_name, 'column_name', column_name));
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_revdate_trgfun_%I()
+		RETURNS TRIGGER AS $inner_trg$
+			BEGIN
+			    NEW.%I := CURRENT_TIMESTAMP;
+			    RETURN NEW;
+			END;
+			$inner_trg$ LANGUAGE plpgsql;
+		$fun$, id,
+		column_name
+	);
+
+    execute format($trg$
+		CREATE TRIGGER _pgf_internal_revdate_trg_%I
+		before insert or UPDATE ON %I
+		FOR EACH ROW
+		execute procedure _pgf_internal_revdate_trgfun_%I();
+		$trg$, id,
+		table_name,
+		id
+	);
+
+	call _pgf_internal_post_create(id); -- no full refresh necessary here, but triggers are recorded
+
+END;
+$proc$;
+
+
+--------------------------------------------------------------------------------
+-- COUNT
+--------------------------------------------------------------------------------
+CREATE or replace PROCEDURE pgf_count (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_count_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	row_filter TEXT;
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('count', jsonb_build_object('options', options));
+	row_filter := options->>'filter';
+	if row_filter is null or row_filter = '' then
+		row_filter := 'true';
+	end if;
+	call _pgf_internal_check_strategy(options);
+
+	call _pgf_internal_insert_metadata(id, 'count', jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		'base_count_column', base_count_column,
+		'linked_table_name', linked_table_name,
+		'linked_fk', linked_fk,
+		'options', options
+	));
+
+	if options->>'side_table' is not null then
+		call _pgf_internal_create_side_table(base_table_name, base_pk, options, base_count_column, 'bigint', '0');
+		base_table_name := options->>'side_table'; -- the generated code updates the side table
+	end if;
+
+	if (options->>'shared_trigger')::boolean then
+		-- no per-formula function: formula arguments are passed to the shared trigger function
+		execute format($trg$
+			CREATE TRIGGER _pgf_internal_count_trg_%I -- id
+			after delete or insert or update ON %I -- linked_table_name
+			FOR EACH ROW
+			execute procedure _pgf_internal_count_shared_trgfun(%L, %L, %L, %L, %L); -- base_table_name, base_pk, base_count_column, linked_fk, row_filter
+			$trg$,
+			id,
+			linked_table_name,
+			base_table_name, base_pk, base_count_column, linked_fk, row_filter
+		);
+
+		execute format($trg$
+			CREATE TRIGGER _pgf_internal_count_trg_truncate_%I -- id
+			after truncate ON %I -- linked_table_name
+			FOR EACH STATEMENT
+			execute procedure _pgf_internal_count_shared_trgfun(%L, %L, %L, %L, %L); -- base_table_name, base_pk, base_count_column, linked_fk, row_filter
+			$trg$,
+			id,
+			linked_table_name,
+			base_table_name, base_pk, base_count_column, linked_fk, row_filter
+		);
+
+		call _pgf_internal_post_create(id);
+		return;
+	end if;
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_count_trgfun_%I() -- id
+		RETURNS TRIGGER AS $inner_trg$
+			DECLARE
+				old_row_matches_filter boolean := true;
+				new_row_matches_filter boolean := true;
+			BEGIN
+				/* skip rows deleted by a cascade (ON DELETE CASCADE) from their parent row, which is already deleted */
+				IF TG_OP = 'DELETE' and pg_trigger_depth() > 1 and not exists (select 1 from %I where %I = OLD.%I) then -- base_table_name, base_pk, linked_fk
+					RETURN NULL;
+				END IF;
+
+				/* test if OLD row matches filter */
+				select case when count(*)=1 then true else false end into old_row_matches_filter from (
+					select * from (
+						select (OLD.*)
+					) t
+					where %s -- row_filter
+				) t2;
+
+				/* test if NEW row matches filter */
+				select case when count(*)=1 then true else false end into new_row_matches_filter from (
+					select * from (
+						select NEW.*
+					) t
+					where %s -- row_filter
+				) t2;
+
+				IF TG_OP='INSERT' and new_row_matches_filter then
+			    	update %I set %I=%I+1 where %I=NEW.%I; -- base_table_name, base_count_column, base_count_column, base_pk, linked_fk
+				ELSIF TG_OP='DELETE' and old_row_matches_filter then
+					update %I set %I=%I-1 where %I=OLD.%I; -- base_table_name, base_count_column, base_count_column, base_pk, linked_fk
+				ELSIF TG_OP='UPDATE' and OLD.%I <> NEW.%I then -- linked_fk, linked_fk
+					/* case : foreign key is updated */
+					if (old_row_matches_filter) then
+						update %I set %I=%I-1 where %I=OLD.%I; -- base_table_name, base_count_column, base_count_column, base_pk, linked_fk
+					end if;
+					if new_row_matches_filter then
+						update %I set %I=%I+1 where %I=NEW.%I; -- base_table_name, base_count_column, base_count_column, base_pk, linked_fk
+					end if;
+				ELSIF TG_OP='TRUNCATE' then
+					update %I set %I=0; -- base_table_name, base_count_column
+				END IF;
+				RETURN NEW;
+			END;
+			$inner_trg$ LANGUAGE plpgsql;
+		$fun$,
+			id,
+			base_table_name, base_pk, linked_fk,
+			row_filter,
+			row_filter,
+			base_table_name, base_count_column, base_count_column, base_pk, linked_fk,
+			base_table_name, base_count_column, base_count_column, base_pk, linked_fk,
+			linked_fk, linked_fk,
+			base_table_name, base_count_column, base_count_column, base_pk, linked_fk,
+			base_table_name, base_count_column, base_count_column, base_pk, linked_fk,
+			base_table_name, base_count_column
+		);
+
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc2$
+			begin
+				update %I set %I = 0; -- base_table_name, base_count_column
+			    update %I set %I = sub.cpt -- base_table_name, base_count_column
+				from (
+					select %I as id, count(*) as cpt -- linked_fk
+					from %I -- linked_table_name
+					where %s -- row_filter
+					group by %I -- linked_fk
+				) as sub
+				where %I.%I = sub.id; -- base_table_name, base_pk
+			end;
+			$inner_proc2$;
+		$inner_proc$,
+		id, -- function name
+		base_table_name, base_count_column,
+		base_table_name, base_count_column,
+		linked_fk,
+		linked_table_name,
+		row_filter,
+		linked_fk,
+		base_table_name, base_pk
+	);
+
+	if options->>'strategy' = 'adaptive' then
+		call _pgf_internal_create_adaptive_triggers(id, 'count', linked_table_name);
+	else
+		execute format($trg$
+			CREATE TRIGGER _pgf_internal_count_trg_%I -- id
+			after delete or insert or update ON %I -- linked_table_name
+			FOR EACH ROW
+			execute procedure _pgf_internal_count_trgfun_%I(); -- id
+			$trg$,
+			id,
+			linked_table_name,
+			id
+		);
+	end if;
+
+    execute format($trg$
+		CREATE TRIGGER _pgf_internal_count_trg_truncate_%I -- id
+		after truncate ON %I -- linked_table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_count_trgfun_%I(); -- id
+		$trg$,
+		id,
+		linked_table_name,
+		id
+	);
+
+	call _pgf_internal_post_create(id);
+
+END;
+$proc$;
+
+/* Trigger function shared by all COUNT formulas created with option shared_trigger.
+Formula arguments are read from the trigger arguments:
+TG_ARGV[0] = base_table_name, TG_ARGV[1] = base_pk, TG_ARGV[2] = base_count_column, TG_ARGV[3] = linked_fk, TG_ARGV[4] = row_filter.
+Statements are prepared once per session and formula, so that their plans are cached like in a dedicated function. */
+CREATE OR REPLACE FUNCTION _pgf_internal_count_shared_trgfun()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+DECLARE
+	stmt TEXT;
+BEGIN
+	IF TG_OP = 'TRUNCATE' then
+		execute format('update %I set %I = 0', TG_ARGV[0], TG_ARGV[2]);
+		RETURN NULL;
+	END IF;
+
+	-- add $2 to the count of the row referenced by linked row $1, if $1 matches the filter
+	stmt := _pgf_internal_prepare(
+		format($sql$
+			update %I set %I = %I + $2 -- base_table_name, base_count_column, base_count_column
+			where %I = ($1).%I -- base_pk, linked_fk
+			and (select %s from (select ($1).*) t) -- row_filter
+			$sql$,
+			TG_ARGV[0], TG_ARGV[2], TG_ARGV[2],
+			TG_ARGV[1], TG_ARGV[3],
+			TG_ARGV[4]
+		),
+		format('%I.%I, int', TG_TABLE_SCHEMA, TG_TABLE_NAME)
+	);
+
+	IF TG_OP = 'INSERT' then
+		execute format('execute %I(%L, 1)', stmt, NEW);
+	ELSIF TG_OP = 'DELETE' then
+		execute format('execute %I(%L, -1)', stmt, OLD);
+	ELSIF TG_ARGV[4] <> 'true' or to_jsonb(OLD)->TG_ARGV[3] is distinct from to_jsonb(NEW)->TG_ARGV[3] then
+		/* case : foreign key is updated, or the filter result may have changed */
+		execute format('execute %I(%L, -1)', stmt, OLD);
+		execute format('execute %I(%L, 1)', stmt, NEW);
+	END IF;
+	RETURN NULL;
+END;
+$$;
+
+-- Full refresh of a COUNT formula created with option shared_trigger.
+CREATE or replace PROCEDURE _pgf_internal_count_shared_refresh(
+	id TEXT
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	args JSONB;
+BEGIN
+	args := _pgf_internal_get_metadata(id);
+	execute format('update %I set %I = 0', _pgf_internal_result_table(args), args->>'base_count_column');
+	execute format($sql$
+		update %I set %I = sub.cpt -- base_table_name, base_count_column
+		from (
+			select %I as id, count(*) as cpt -- linked_fk
+			from %I -- linked_table_name
+			where %s -- row_filter
+			group by %I -- linked_fk
+		) as sub
+		where %I.%I = sub.id; -- base_table_name, base_pk
+		$sql$,
+		_pgf_internal_result_table(args), args->>'base_count_column',
+		args->>'linked_fk',
+		args->>'linked_table_name',
+		coalesce(nullif(args->'options'->>'filter', ''), 'true'),
+		args->>'linked_fk',
+		_pgf_internal_result_table(args), args->>'base_pk'
+	);
+END;
+$proc$;
+
+
+--------------------------------------------------------------------------------
+-- SUM
+--------------------------------------------------------------------------------
+CREATE or replace PROCEDURE pgf_sum (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT, -- column to be summed
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	row_filter TEXT;
+	side_column_type TEXT;
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('sum', jsonb_build_object('options', options));
+	row_filter := options->>'filter';
+	if row_filter is null or row_filter = '' then
+		row_filter := 'true';
+	end if;
+	call _pgf_internal_check_strategy(options);
+
+	call _pgf_internal_insert_metadata(id, 'sum', jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		'base_aggregate_column', base_aggregate_column,
+		'linked_table_name', linked_table_name,
+		'linked_fk', linked_fk,
+		'linked_value_column', linked_value_column,
+		'options', options
+	));
+
+	if options->>'side_table' is not null then
+		-- side column type: the type of the base column if it exists, else the type of the sum of the linked values
+		select c.data_type into side_column_type from _pgf_internal_table_columns(ARRAY[base_table_name]) c where c.column_name = base_aggregate_column;
+		if side_column_type is null then
+			execute format('select pg_typeof(sum(%I))::text from %I where false', linked_value_column, linked_table_name) into side_column_type;
+		end if;
+		call _pgf_internal_create_side_table(base_table_name, base_pk, options, base_aggregate_column, side_column_type, '0');
+		base_table_name := options->>'side_table'; -- the generated code updates the side table
+	end if;
+
+	if (options->>'shared_trigger')::boolean then
+		-- no per-formula function: formula arguments are passed to the shared trigger function
+		execute format($trg$
+			CREATE TRIGGER _pgf_internal_sum_trg_%I -- id
+			after delete or insert or update ON %I -- linked_table_name
+			FOR EACH ROW
+			execute procedure _pgf_internal_sum_shared_trgfun(%L, %L, %L, %L, %L, %L); -- base_table_name, base_pk, base_aggregate_column, linked_fk, linked_value_column, row_filter
+			$trg$,
+			id,
+			linked_table_name,
+			base_table_name, base_pk, base_aggregate_column, linked_fk, linked_value_column, row_filter
+		);
+
+		execute format($trg$
+			CREATE TRIGGER _pgf_internal_sum_trg_truncate_%I -- id
+			after truncate ON %I -- linked_table_name
+			FOR EACH STATEMENT
+			execute procedure _pgf_internal_sum_shared_trgfun(%L, %L, %L, %L, %L, %L); -- base_table_name, base_pk, base_aggregate_column, linked_fk, linked_value_column, row_filter
+			$trg$,
+			id,
+			linked_table_name,
+			base_table_name, base_pk, base_aggregate_column, linked_fk, linked_value_column, row_filter
+		);
+
+		call _pgf_internal_post_create(id);
+		return;
+	end if;
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_sum_trgfun_%I() -- id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			old_row_matches_filter boolean := true;
+			new_row_matches_filter boolean := true;
+		BEGIN
+			/* skip rows deleted by a cascade (ON DELETE CASCADE) from their parent row, which is already deleted */
+			IF TG_OP = 'DELETE' and pg_trigger_depth() > 1 and not exists (select 1 from %I where %I = OLD.%I) then -- base_table_name, base_pk, linked_fk
+				RETURN NULL;
+			END IF;
+
+			/* test if OLD row matches filter */
+			select case when count(*)=1 then true else false end into old_row_matches_filter from (
+				select * from (
+					select (OLD.*)
+				) t
+				where %s -- row_filter
+			) t2;
+
+			/* test if NEW row matches filter */
+			select case when count(*)=1 then true else false end into new_row_matches_filter from (
+				select * from (
+					select NEW.*
+				) t
+				where %s -- row_filter
+			) t2;
+
+			/* There are only 3 cases :
+			   - Case A : add NEW.value to row identified by NEW.FK
+			   - Case B : remove OLD.value to row identified by OLD.FK
+			   - Case C : add NEW.value-OLD.value to row identified by OLD.FK
+
+			Pseudo-code :
+			new := new_row_matches_filter
+			old := new_row_matches_filter
+			value := value from linked_value_column
+			if INSERT then
+				if new then (A)
+				else (no op)
+			elsif DELETE then
+				if old then (B)
+				else (no op)
+			elsif UPDATE and FK has changed then
+				if new then (A)
+				else (no op)
+				if old then (B)
+				else (no op)
+			elsif UPDATE and value has changed then
+				if new and old then (C)
+				elsif new and !old then (A)
+				elsif !new and old then (B)
+				else (no op) 
+			end if
+			*/
+			IF TG_OP='INSERT' and new_row_matches_filter then
+				/* case A */
+				update %I set %I=%I+NEW.%I where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+			ELSIF TG_OP='DELETE' and old_row_matches_filter then
+				/* case B */
+				update %I set %I=%I-OLD.%I where %I=OLD.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+			ELSIF TG_OP='UPDATE' and OLD.%I <> NEW.%I then -- linked_fk, linked_fk
+				/* case : foreign key is updated (value may or may not change) */
+				if old_row_matches_filter then
+					/* case B */
+					update %I set %I=%I-OLD.%I where %I=OLD.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+				end if;
+				if new_row_matches_filter then
+					/* case A */
+					update %I set %I=%I+NEW.%I where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+				end if;
+			ELSIF TG_OP = 'UPDATE' and OLD.%I <> NEW.%I then -- linked_value_column, linked_value_column
+				/* case : value is updated, FK stays the same */
+				if old_row_matches_filter and new_row_matches_filter then
+					/* case C */
+					update %I set %I = %I - OLD.%I + NEW.%I where %I = OLD.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, linked_value_column, base_pk, linked_fk
+				elsif new_row_matches_filter and not old_row_matches_filter then
+					/* case A */
+					update %I set %I=%I+NEW.%I where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+				elsif not new_row_matches_filter and old_row_matches_filter then 
+					/* case B */
+					update %I set %I=%I-OLD.%I where %I=OLD.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+				end if;
+			ELSIF TG_OP='TRUNCATE' then
+				update %I set %I=0; -- base_table_name, base_aggregate_column
+			END IF;
+			RETURN NEW;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+	$fun$
+		, id
+		, base_table_name, base_pk, linked_fk
+		, row_filter
+		, row_filter
+		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+		, linked_fk, linked_fk
+		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+		, linked_value_column, linked_value_column
+		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, linked_value_column, base_pk, linked_fk
+		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+		, base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+		, base_table_name, base_aggregate_column
+	);
+
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc2$
+			begin
+				update %I set %I = 0; -- base_table_name, base_aggregate_column
+			    update %I set %I = sub.cpt -- base_table_name, base_aggregate_column
+				from (
+					select %I as id, sum(%I) as cpt -- linked_fk, linked_value_column
+					from %I -- linked_table_name
+					where %s -- row_filter
+					group by %I -- linked_fk
+				) as sub
+				where %I.%I = sub.id; -- base_table_name, base_pk
+			end;
+			$inner_proc2$;
+		$inner_proc$
+		, id -- function name
+		, base_table_name, base_aggregate_column
+		, base_table_name, base_aggregate_column
+		, linked_fk, linked_value_column
+		, linked_table_name
+		, row_filter
+		, linked_fk
+		, base_table_name, base_pk
+	);
+
+	if options->>'strategy' = 'adaptive' then
+		call _pgf_internal_create_adaptive_triggers(id, 'sum', linked_table_name);
+	else
+		execute format($trg$
+			CREATE TRIGGER _pgf_internal_sum_trg_%I -- id
+			after delete or insert or update ON %I -- linked_table_name
+			FOR EACH ROW
+			execute procedure _pgf_internal_sum_trgfun_%I(); -- id
+			$trg$,
+			id,
+			linked_table_name,
+			id
+		);
+	end if;
+
+    execute format($trg$
+		CREATE TRIGGER _pgf_internal_sum_trg_truncate_%I -- id
+		after truncate ON %I -- linked_table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_sum_trgfun_%I(); -- id
+		$trg$,
+		id,
+		linked_table_name,
+		id
+	);
+
+	call _pgf_internal_post_create(id);
+
+END;
+$proc$;
+
+/* Trigger function shared by all SUM formulas created with option shared_trigger.
+Formula arguments are read from the trigger arguments:
+TG_ARGV[0] = base_table_name, TG_ARGV[1] = base_pk, TG_ARGV[2] = base_aggregate_column, TG_ARGV[3] = linked_fk,
+TG_ARGV[4] = linked_value_column, TG_ARGV[5] = row_filter.
+Statements are prepared once per session and formula, so that their plans are cached like in a dedicated function. */
+CREATE OR REPLACE FUNCTION _pgf_internal_sum_shared_trgfun()
+RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+DECLARE
+	stmt TEXT;
+	old_json JSONB;
+	new_json JSONB;
+BEGIN
+	IF TG_OP = 'TRUNCATE' then
+		execute format('update %I set %I = 0', TG_ARGV[0], TG_ARGV[2]);
+		RETURN NULL;
+	END IF;
+
+	-- add $2 * value of linked row $1 to the row it references, if $1 matches the filter
+	stmt := _pgf_internal_prepare(
+		format($sql$
+			update %I set %I = %I + $2 * coalesce(($1).%I, 0) -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column
+			where %I = ($1).%I -- base_pk, linked_fk
+			and (select %s from (select ($1).*) t) -- row_filter
+			$sql$,
+			TG_ARGV[0], TG_ARGV[2], TG_ARGV[2], TG_ARGV[4],
+			TG_ARGV[1], TG_ARGV[3],
+			TG_ARGV[5]
+		),
+		format('%I.%I, int', TG_TABLE_SCHEMA, TG_TABLE_NAME)
+	);
+
+	IF TG_OP = 'INSERT' then
+		execute format('execute %I(%L, 1)', stmt, NEW);
+	ELSIF TG_OP = 'DELETE' then
+		execute format('execute %I(%L, -1)', stmt, OLD);
+	ELSE
+		old_json := to_jsonb(OLD);
+		new_json := to_jsonb(NEW);
+		IF TG_ARGV[5] <> 'true'
+			or old_json->TG_ARGV[3] is distinct from new_json->TG_ARGV[3]
+			or old_json->TG_ARGV[4] is distinct from new_json->TG_ARGV[4] then
+			/* case : foreign key or value is updated, or the filter result may have changed */
+			execute format('execute %I(%L, -1)', stmt, OLD);
+			execute format('execute %I(%L, 1)', stmt, NEW);
+		END IF;
+	END IF;
+	RETURN NULL;
+END;
+$$;
+
+-- Full refresh of a SUM formula created with option shared_trigger.
+CREATE or replace PROCEDURE _pgf_internal_sum_shared_refresh(
+	id TEXT
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	args JSONB;
+BEGIN
+	args := _pgf_internal_get_metadata(id);
+	execute format('update %I set %I = 0', _pgf_internal_result_table(args), args->>'base_aggregate_column');
+	execute format($sql$
+		update %I set %I = sub.total -- base_table_name, base_aggregate_column
+		from (
+			select %I as id, coalesce(sum(%I), 0) as total -- linked_fk, linked_value_column
+			from %I -- linked_table_name
+			where %s -- row_filter
+			group by %I -- linked_fk
+		) as sub
+		where %I.%I = sub.id; -- base_table_name, base_pk
+		$sql$,
+		_pgf_internal_result_table(args), args->>'base_aggregate_column',
+		args->>'linked_fk', args->>'linked_value_column',
+		args->>'linked_table_name',
+		coalesce(nullif(args->'options'->>'filter', ''), 'true'),
+		args->>'linked_fk',
+		_pgf_internal_result_table(args), args->>'base_pk'
+	);
+END;
+$proc$;
+
+
+--------------------------------------------------------------------------------
+-- MIN
+--------------------------------------------------------------------------------
+CREATE or replace PROCEDURE pgf_min (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT, -- column to be searched for min value
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	row_filter TEXT;
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('min', jsonb_build_object('options', options));
+	row_filter := options->>'filter';
+	if row_filter is null or row_filter = '' then
+		row_filter := 'true';
+	end if;
+	call _pgf_internal_check_strategy(options);
+
+	call _pgf_internal_insert_metadata(id, 'min', jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		'base_aggregate_column', base_aggregate_column,
+		'linked_table_name', linked_table_name,
+		'linked_fk', linked_fk,
+		'linked_value_column', linked_value_column,
+		'options', options
+	));
+
+	if options->>'side_table' is not null then
+		call _pgf_internal_create_side_table(base_table_name, base_pk, options, base_aggregate_column, (select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_value_column), 'NULL');
+		base_table_name := options->>'side_table'; -- the generated code updates the side table
+	end if;
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_min_trgfun_%I() -- id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			old_row_matches_filter boolean := true;
+			new_row_matches_filter boolean := true;
+		BEGIN
+			/* skip rows deleted by a cascade (ON DELETE CASCADE) from their parent row, which is already deleted */
+			IF TG_OP = 'DELETE' and pg_trigger_depth() > 1 and not exists (select 1 from %I where %I = OLD.%I) then -- base_table_name, base_pk, linked_fk
+				RETURN NULL;
+			END IF;
+
+			/* test if OLD row matches filter */
+			select case when count(*)=1 then true else false end into old_row_matches_filter from (
+				select * from (
+					select (OLD.*)
+				) t
+				where %s -- row_filter
+			) t2;
+
+			/* test if NEW row matches filter */
+			select case when count(*)=1 then true else false end into new_row_matches_filter from (
+				select * from (
+					select NEW.*
+				) t
+				where %s -- row_filter
+			) t2;
+
+			IF TG_OP='INSERT' and new_row_matches_filter then
+				update %I set %I=LEAST(%I, NEW.%I) where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+			ELSIF TG_OP='DELETE' and old_row_matches_filter then
+				update %I set %I=( -- base_table_name, base_aggregate_column
+					case when OLD.%I > %I then %I -- linked_value_column, base_aggregate_column, base_aggregate_column
+					else (select MIN(%I) from %I where %I=OLD.%I and (%s)) -- linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
+					end) 
+				where %I=OLD.%I; -- base_pk, linked_fk
+			ELSIF TG_OP='UPDATE' then
+				/* Same cases as SUM. A rescan only happens when the current min row moves away or gets worse:
+				   - FK unchanged, OLD and NEW rows match the filter, value decreased or unchanged: the min can only decrease
+				   - otherwise the OLD row leaves the OLD FK: rescan if it was the min (OLD value <= current min),
+				     then the NEW row joins the NEW FK if it matches the filter: keep the lowest value */
+				IF OLD.%I = NEW.%I and old_row_matches_filter and new_row_matches_filter and NEW.%I <= OLD.%I then -- linked_fk, linked_fk, linked_value_column, linked_value_column
+					update %I set %I = NEW.%I -- base_table_name, base_aggregate_column, linked_value_column
+					where %I = NEW.%I and (%I is null or NEW.%I < %I); -- base_pk, linked_fk, base_aggregate_column, linked_value_column, base_aggregate_column
+				ELSE
+					if old_row_matches_filter then
+						update %I set %I = ( -- base_table_name, base_aggregate_column
+							select MIN(%I) from %I where %I = OLD.%I and (%s) -- linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
+						)
+						where %I = OLD.%I and OLD.%I <= %I; -- base_pk, linked_fk, linked_value_column, base_aggregate_column
+					end if;
+					if new_row_matches_filter then
+						update %I set %I = NEW.%I -- base_table_name, base_aggregate_column, linked_value_column
+						where %I = NEW.%I and (%I is null or NEW.%I < %I); -- base_pk, linked_fk, base_aggregate_column, linked_value_column, base_aggregate_column
+					end if;
+				END IF;
+			ELSIF TG_OP='TRUNCATE' then
+				update %I set %I=NULL; -- base_table_name, base_aggregate_column
+			END IF;
+			RETURN NEW;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+	$fun$
+        , id
+        , base_table_name, base_pk, linked_fk
+        , row_filter
+        , row_filter
+        , base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+        , base_table_name, base_aggregate_column
+        , linked_value_column, base_aggregate_column, base_aggregate_column
+        , linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
+        , base_pk, linked_fk
+        , linked_fk, linked_fk, linked_value_column, linked_value_column
+        , base_table_name, base_aggregate_column, linked_value_column
+        , base_pk, linked_fk, base_aggregate_column, linked_value_column, base_aggregate_column
+        , base_table_name, base_aggregate_column
+        , linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
+        , base_pk, linked_fk, linked_value_column, base_aggregate_column
+        , base_table_name, base_aggregate_column, linked_value_column
+        , base_pk, linked_fk, base_aggregate_column, linked_value_column, base_aggregate_column
+        , base_table_name, base_aggregate_column
+
+	);
+
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc2$
+			begin
+			    update %I set %I = NULL; -- base_table_name, base_aggregate_column
+				update %I set %I = sub.cpt -- base_table_name, base_aggregate_column
+				from (
+					select %I as id, min(%I) as cpt -- linked_fk, linked_value_column
+					from %I -- linked_table_name
+					where %s -- row_filter
+					group by %I -- linked_fk
+				) as sub
+				where %I.%I = sub.id; -- base_table_name, base_pk
+			end;
+			$inner_proc2$;
+		$inner_proc$
+		, id -- function name
+		, base_table_name, base_aggregate_column
+		, base_table_name, base_aggregate_column
+		, linked_fk, linked_value_column
+		, linked_table_name
+		, row_filter
+		, linked_fk
+		, base_table_name, base_pk
+	);
+
+	if (options->>'cache_size')::int > 0 then
+		call _pgf_internal_create_cache(id, 'min', base_table_name, base_pk, base_aggregate_column, linked_table_name, NULL, linked_fk, linked_value_column, row_filter, options);
+	end if;
+
+	if options->>'strategy' = 'adaptive' then
+		call _pgf_internal_create_adaptive_triggers(id, 'min', linked_table_name);
+	else
+		execute format($trg$
+			CREATE TRIGGER _pgf_internal_min_trg_%I -- id
+			after delete or insert or update ON %I -- linked_table_name
+			FOR EACH ROW
+			execute procedure _pgf_internal_min_trgfun_%I(); -- id
+			$trg$,
+			id,
+			linked_table_name,
+			id
+		);
+	end if;
+
+    execute format($trg$
+		CREATE TRIGGER _pgf_internal_min_trg_truncate_%I -- id
+		after truncate ON %I -- linked_table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_min_trgfun_%I(); -- id
+		$trg$,
+		id,
+		linked_table_name,
+		id
+	);
+
+	call _pgf_internal_post_create(id);
+
+END;
+$proc$;
+
+
+--------------------------------------------------------------------------------
+-- MAX
+--------------------------------------------------------------------------------
+CREATE or replace PROCEDURE pgf_max (
+    id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+    linked_value_column TEXT, -- column to be searched for max value
+    options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+    row_filter TEXT;
+BEGIN
+    -- set default values for optional arguments
+    options := _pgf_internal_default_options('max', jsonb_build_object('options', options));
+    row_filter := options->>'filter';
+    if row_filter is null or row_filter = '' then
+        row_filter := 'true';
+    end if;
+    call _pgf_internal_check_strategy(options);
+
+    call _pgf_internal_insert_metadata(id, 'max', jsonb_build_object(
+        'base_table_name', base_table_name,
+        'base_pk', base_pk,
+        'base_aggregate_column', base_aggregate_column,
+        'linked_table_name', linked_table_name,
+        'linked_fk', linked_fk,
+        'linked_value_column', linked_value_column,
+        'options', options
+    ));
+
+    if options->>'side_table' is not null then
+        call _pgf_internal_create_side_table(base_table_name, base_pk, options, base_aggregate_column, (select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_value_column), 'NULL');
+        base_table_name := options->>'side_table'; -- the generated code updates the side table
+    end if;
+
+    execute format($fun$
+        CREATE OR REPLACE FUNCTION _pgf_internal_max_trgfun_%I() -- id
+        RETURNS TRIGGER AS $inner_trg$
+        DECLARE
+            old_row_matches_filter boolean := true;
+            new_row_matches_filter boolean := true;
+        BEGIN
+            /* skip rows deleted by a cascade (ON DELETE CASCADE) from their parent row, which is already deleted */
+            IF TG_OP = 'DELETE' and pg_trigger_depth() > 1 and not exists (select 1 from %I where %I = OLD.%I) then -- base_table_name, base_pk, linked_fk
+                RETURN NULL;
+            END IF;
+
+            /* test if OLD row matches filter */
+            select case when count(*)=1 then true else false end into old_row_matches_filter from (
+                select * from (
+                    select (OLD.*)
+                ) t
+                where %s -- row_filter
+            ) t2;
+
+            /* test if NEW row matches filter */
+            select case when count(*)=1 then true else false end into new_row_matches_filter from (
+                select * from (
+                    select NEW.*
+                ) t
+                where %s -- row_filter
+            ) t2;
+
+            IF TG_OP='INSERT' and new_row_matches_filter then
+                update %I set %I=GREATEST(%I, NEW.%I) where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+            ELSIF TG_OP='DELETE' and old_row_matches_filter then
+                update %I set %I=( -- base_table_name, base_aggregate_column
+                    case when OLD.%I < %I then %I -- linked_value_column, base_aggregate_column, base_aggregate_column
+                    else (select MAX(%I) from %I where %I=OLD.%I and (%s)) -- linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
+                    end) 
+                where %I=OLD.%I; -- base_pk, linked_fk
+            ELSIF TG_OP='UPDATE' then
+                /* Same cases as SUM. A rescan only happens when the current max row moves away or gets worse:
+                   - FK unchanged, OLD and NEW rows match the filter, value increased or unchanged: the max can only increase
+                   - otherwise the OLD row leaves the OLD FK: rescan if it was the max (OLD value >= current max),
+                     then the NEW row joins the NEW FK if it matches the filter: keep the highest value */
+                IF OLD.%I = NEW.%I and old_row_matches_filter and new_row_matches_filter and NEW.%I >= OLD.%I then -- linked_fk, linked_fk, linked_value_column, linked_value_column
+                    update %I set %I = NEW.%I -- base_table_name, base_aggregate_column, linked_value_column
+                    where %I = NEW.%I and (%I is null or NEW.%I > %I); -- base_pk, linked_fk, base_aggregate_column, linked_value_column, base_aggregate_column
+                ELSE
+                    if old_row_matches_filter then
+                        update %I set %I = ( -- base_table_name, base_aggregate_column
+                            select MAX(%I) from %I where %I = OLD.%I and (%s) -- linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
+                        )
+                        where %I = OLD.%I and OLD.%I >= %I; -- base_pk, linked_fk, linked_value_column, base_aggregate_column
+                    end if;
+                    if new_row_matches_filter then
+                        update %I set %I = NEW.%I -- base_table_name, base_aggregate_column, linked_value_column
+                        where %I = NEW.%I and (%I is null or NEW.%I > %I); -- base_pk, linked_fk, base_aggregate_column, linked_value_column, base_aggregate_column
+                    end if;
+                END IF;
+            ELSIF TG_OP='TRUNCATE' then
+                update %I set %I=NULL; -- base_table_name, base_aggregate_column
+            END IF;
+            RETURN NEW;
+        END;
+        $inner_trg$ LANGUAGE plpgsql;
+    $fun$
+        , id
+        , base_table_name, base_pk, linked_fk
+        , row_filter
+        , row_filter
+        , base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
+        , base_table_name, base_aggregate_column
+        , linked_value_column, base_aggregate_column, base_aggregate_column
+        , linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
+        , base_pk, linked_fk
+        , linked_fk, linked_fk, linked_value_column, linked_value_column
+        , base_table_name, base_aggregate_column, linked_value_column
+        , base_pk, linked_fk, base_aggregate_column, linked_value_column, base_aggregate_column
+        , base_table_name, base_aggregate_column
+        , linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
+        , base_pk, linked_fk, linked_value_column, base_aggregate_column
+        , base_table_name, base_aggregate_column, linked_value_column
+        , base_pk, linked_fk, base_aggregate_column, linked_value_column, base_aggregate_column
+        , base_table_name, base_aggregate_column
+    );
+
+    execute format($inner_proc$
+        CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
+        LANGUAGE plpgsql
+        AS $inner_proc2$
+            begin
+                update %I set %I = NULL; -- base_table_name, base_aggregate_column
+                update %I set %I = sub.cpt -- base_table_name, base_aggregate_column
+                from (
+                    select %I as id, max(%I) as cpt -- linked_fk, linked_value_column
+                    from %I -- linked_table_name
+                    where %s -- row_filter
+                    group by %I -- linked_fk
+                ) as sub
+                where %I.%I = sub.id; -- base_table_name, base_pk
+            end;
+            $inner_proc2$;
+        $inner_proc$
+        , id -- function name
+        , base_table_name, base_aggregate_column
+        , base_table_name, base_aggregate_column
+        , linked_fk, linked_value_column
+        , linked_table_name
+        , row_filter
+        , linked_fk
+        , base_table_name, base_pk
+    );
+
+    if (options->>'cache_size')::int > 0 then
+        call _pgf_internal_create_cache(id, 'max', base_table_name, base_pk, base_aggregate_column, linked_table_name, NULL, linked_fk, linked_value_column, row_filter, options);
+    end if;
+
+    if options->>'strategy' = 'adaptive' then
+        call _pgf_internal_create_adaptive_triggers(id, 'max', linked_table_name);
+    else
+        execute format($trg$
+            CREATE TRIGGER _pgf_internal_max_trg_%I -- id
+            after delete or insert or update ON %I -- linked_table_name
+            FOR EACH ROW
+            execute procedure _pgf_internal_max_trgfun_%I(); -- id
+            $trg$,
+            id,
+            linked_table_name,
+            id
+        );
+    end if;
+
+    execute format($trg$
+        CREATE TRIGGER _pgf_internal_max_trg_truncate_%I -- id
+        after truncate ON %I -- linked_table_name
+        FOR EACH STATEMENT
+        execute procedure _pgf_internal_max_trgfun_%I(); -- id
+        $trg$,
+        id,
+        linked_table_name,
+        id
+    );
+
+    call _pgf_internal_post_create(id);
+
+END;
+$proc$;
+
+
+--------------------------------------------------------------------------------
+-- ID_OF_MIN / ID_OF_MAX
+--------------------------------------------------------------------------------
+-- Common implementation of pgf_id_of_min and pgf_id_of_max.
+-- Rows are ordered by (value, pk), nulls last: ties are broken by the linked primary key, as in the refresh procedure.
+-- The triggers compare the changed rows with the value of the current extremum, as stored by the formula: in the
+-- value_column of the base table, or else in the table _pgf_internal_value_<id>(parent_id, value). Reading it from the
+-- linked row instead would see its value at the end of the statement, before its own row trigger has run.
+CREATE or replace PROCEDURE _pgf_internal_id_of_extremum (
+	id TEXT,
+	kind TEXT, -- 'id_of_min' or 'id_of_max'
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT,
+    linked_table_name TEXT,
+	linked_pk TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT,
+	options JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	row_filter TEXT;
+	value_column TEXT; -- companion column of the base table holding the min (max) value. NULL if not maintained.
+	cmp TEXT; -- '<' for ID_OF_MIN, '>' for ID_OF_MAX
+	linked_order TEXT; -- SQL fragment: 'value asc nulls last, pk asc'
+	set_columns TEXT; -- SQL fragment: columns set in the base table
+	select_columns TEXT; -- SQL fragment: values of set_columns, in the linked table
+	read_current_fragment TEXT; -- SQL fragment: read current_id and current_value of the base row NEW.FK
+	insert_fragment TEXT; -- SQL fragment: add the NEW row to the base row NEW.FK
+	value_table_name TEXT := '_pgf_internal_value_' || id;
+	store_value_fragment TEXT := ''; -- SQL fragment: store the value of the NEW row in the value table
+	refresh_value_fragment TEXT := ''; -- SQL fragment: store the values of the current extremums of the base rows matching _pgf_condition
+BEGIN
+	row_filter := options->>'filter';
+	if row_filter is null or row_filter = '' then
+		row_filter := 'true';
+	end if;
+	value_column := options->>'value_column';
+	cmp := case when kind = 'id_of_min' then '<' else '>' end;
+	linked_order := format('%I %s nulls last, %I %s', linked_value_column, case when kind = 'id_of_min' then 'asc' else 'desc' end,
+		linked_pk, case when kind = 'id_of_min' then 'asc' else 'desc' end);
+	if value_column is null then
+		set_columns := format('%I', base_aggregate_column);
+		select_columns := format('%I', linked_pk);
+		read_current_fragment := format($sql$
+			select %I into current_id from %I where %I = NEW.%I; -- base_aggregate_column, base_table_name, base_pk, linked_fk
+			if current_id is not null then
+				select value into current_value from %I where parent_id = NEW.%I; -- value_table_name, linked_fk
+			end if;
+			$sql$,
+			base_aggregate_column, base_table_name, base_pk, linked_fk,
+			value_table_name, linked_fk);
+		store_value_fragment := format('insert into %I (parent_id, value) values (NEW.%I, NEW.%I) on conflict (parent_id) do update set value = excluded.value; -- value_table_name, linked_fk, linked_value_column',
+			value_table_name, linked_fk, linked_value_column);
+		refresh_value_fragment := format($sql$
+			insert into %I (parent_id, value) -- value_table_name
+			select b.%I, (select l.%I from %I l where l.%I = b.%I) from %I b -- base_pk, linked_value_column, linked_table_name, linked_pk, base_aggregate_column, base_table_name
+			where %%s and b.%I is not null -- _pgf_condition, base_aggregate_column
+			on conflict (parent_id) do update set value = excluded.value;
+			$sql$,
+			value_table_name,
+			base_pk, linked_value_column, linked_table_name, linked_pk, base_aggregate_column, base_table_name,
+			base_aggregate_column);
+
+		execute format('DROP TABLE IF EXISTS %I', value_table_name);
+		if coalesce((options->>'cache_size')::int, 0) = 0 then -- the cache replaces the value table
+			execute format('CREATE TABLE %I (parent_id %s primary key, value %s)', value_table_name,
+				(select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_fk),
+				(select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_value_column));
+		end if;
+	else
+		set_columns := format('(%I, %I)', base_aggregate_column, value_column);
+		select_columns := format('%I, %I', linked_pk, linked_value_column);
+		read_current_fragment := format($sql$
+			select %I, %I into current_id, current_value from %I where %I = NEW.%I; -- base_aggregate_column, value_column, base_table_name, base_pk, linked_fk
+			$sql$,
+			base_aggregate_column, value_column, base_table_name, base_pk, linked_fk);
+	end if;
+
+	-- the NEW row becomes the extremum if it comes first in (value, pk) order, nulls last
+	insert_fragment := format($sql$
+			%s -- read_current_fragment
+			if current_id is null
+				or (NEW.%I is not null and current_value is null) -- linked_value_column
+				or NEW.%I %s current_value -- linked_value_column, cmp
+				or (NEW.%I is not distinct from current_value and NEW.%I %s current_id) then -- linked_value_column, linked_pk, cmp
+				update %I set %I = NEW.%I%s where %I = NEW.%I; -- base_table_name, base_aggregate_column, linked_pk, set_value_fragment, base_pk, linked_fk
+				%s -- store_value_fragment
+			end if;
+		$sql$,
+		read_current_fragment,
+		linked_value_column,
+		linked_value_column, cmp,
+		linked_value_column, linked_pk, cmp,
+		base_table_name, base_aggregate_column, linked_pk, case when value_column is null then '' else format(', %I = NEW.%I', value_column, linked_value_column) end, base_pk, linked_fk,
+		store_value_fragment
+	);
+
+	/* function to update the id of min (max) of a single row identified by its PK given in parameter _pgf_id.*/
+	execute format($proc2$
+		CREATE OR REPLACE PROCEDURE _pgf_internal_refresh_single_%I(_pgf_id %I.%I%%TYPE) -- id, linked_table_name, linked_fk
+		LANGUAGE plpgsql AS $inner_proc2$
+		BEGIN
+			update %I set %s = ( -- base_table_name, set_columns
+				select %s -- select_columns
+				from %I -- linked_table_name
+				where %I = _pgf_id -- linked_fk
+				and (%s) -- row_filter
+				order by %s -- linked_order
+				limit 1
+			) where %I = _pgf_id; -- base_pk
+			%s -- refresh_value_fragment
+		END;
+		$inner_proc2$
+	$proc2$
+	, id, linked_table_name, linked_fk
+	, base_table_name, set_columns
+	, select_columns
+	, linked_table_name
+	, linked_fk
+	, row_filter
+	, linked_order
+	, base_pk
+	, format(refresh_value_fragment, format('b.%I = _pgf_id', base_pk))
+	);
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_%s_trgfun_%I() -- kind, id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			old_row_matches_filter boolean := true;
+			new_row_matches_filter boolean := true;
+			current_id %I.%I%%TYPE; -- linked_table_name, linked_pk
+			current_value %I.%I%%TYPE; -- linked_table_name, linked_value_column
+		BEGIN
+			/* skip rows deleted by a cascade (ON DELETE CASCADE) from their parent row, which is already deleted */
+			IF TG_OP = 'DELETE' and pg_trigger_depth() > 1 and not exists (select 1 from %I where %I = OLD.%I) then -- base_table_name, base_pk, linked_fk
+				RETURN NULL;
+			END IF;
+
+			/* test if OLD row matches filter */
+			select case when count(*)=1 then true else false end into old_row_matches_filter from (
+				select * from (
+					select (OLD.*)
+				) t
+				where %s -- row_filter
+			) t2;
+
+			/* test if NEW row matches filter */
+			select case when count(*)=1 then true else false end into new_row_matches_filter from (
+				select * from (
+					select NEW.*
+				) t
+				where %s -- row_filter
+			) t2;
+
+			IF TG_OP='INSERT' and new_row_matches_filter then
+				%s -- insert_fragment
+			ELSIF TG_OP='DELETE' and old_row_matches_filter then
+				select %I into current_id from %I where %I = OLD.%I; -- base_aggregate_column, base_table_name, base_pk, linked_fk
+				if current_id = OLD.%I then -- linked_pk
+					call _pgf_internal_refresh_single_%I(OLD.%I); -- id, linked_fk
+				end if;
+			ELSIF TG_OP='UPDATE' then
+				if old_row_matches_filter then
+					select %I into current_id from %I where %I = OLD.%I; -- base_aggregate_column, base_table_name, base_pk, linked_fk
+				end if;
+				if old_row_matches_filter and current_id = OLD.%I then -- linked_pk
+					/* the extremum row is updated */
+					if NEW.%I = OLD.%I and new_row_matches_filter -- linked_fk, linked_fk
+						and ((NEW.%I is not null and OLD.%I is null) -- linked_value_column, linked_value_column
+							or NEW.%I %s OLD.%I -- linked_value_column, cmp, linked_value_column
+							or (NEW.%I is not distinct from OLD.%I and NEW.%I %s= OLD.%I)) then -- linked_value_column, linked_value_column, linked_pk, cmp, linked_pk
+						/* it still comes first: no rescan */
+						update %I set %I = NEW.%I%s where %I = NEW.%I; -- base_table_name, base_aggregate_column, linked_pk, set_value_fragment, base_pk, linked_fk
+						%s -- store_value_fragment
+					else
+						/* it moved away or got worse: rescan the OLD FK, then add the NEW row to the NEW FK */
+						call _pgf_internal_refresh_single_%I(OLD.%I); -- id, linked_fk
+						if NEW.%I <> OLD.%I and new_row_matches_filter then -- linked_fk, linked_fk
+							%s -- insert_fragment
+						end if;
+					end if;
+				elsif new_row_matches_filter then
+					%s -- insert_fragment
+				end if;
+			ELSIF TG_OP='TRUNCATE' then
+				update %I set %s = %s; -- base_table_name, set_columns, null_values
+			END IF;
+			RETURN NEW;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+	$fun$
+        , kind, id
+        , linked_table_name, linked_pk
+        , linked_table_name, linked_value_column
+        , base_table_name, base_pk, linked_fk
+        , row_filter
+        , row_filter
+        , insert_fragment
+        , base_aggregate_column, base_table_name, base_pk, linked_fk
+        , linked_pk
+        , id, linked_fk
+        , base_aggregate_column, base_table_name, base_pk, linked_fk
+        , linked_pk
+        , linked_fk, linked_fk
+        , linked_value_column, linked_value_column
+        , linked_value_column, cmp, linked_value_column
+        , linked_value_column, linked_value_column, linked_pk, cmp, linked_pk
+        , base_table_name, base_aggregate_column, linked_pk, case when value_column is null then '' else format(', %I = NEW.%I', value_column, linked_value_column) end, base_pk, linked_fk
+        , store_value_fragment
+        , id, linked_fk
+        , linked_fk, linked_fk
+        , insert_fragment
+        , insert_fragment
+        , base_table_name, set_columns, case when value_column is null then 'NULL' else '(NULL, NULL)' end
+	);
+
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc2$
+			begin
+			    update %I set %s = %s; -- base_table_name, set_columns, null_values
+				update %I set %s = (sub.id%s) -- base_table_name, set_columns, sub_value_fragment
+				from (
+					select distinct on (%I) %I as parent_id, %I as id, %I as value -- linked_fk, linked_fk, linked_pk, linked_value_column
+					from %I -- linked_table_name
+					where %s -- row_filter
+					order by %I, %s -- linked_fk, linked_order
+				) as sub
+				where %I.%I = sub.parent_id; -- base_table_name, base_pk
+				%s -- refresh_value_fragment
+			end;
+			$inner_proc2$;
+		$inner_proc$
+        , id
+        , base_table_name, set_columns, case when value_column is null then 'NULL' else '(NULL, NULL)' end
+        , base_table_name, set_columns, case when value_column is null then '' else ', sub.value' end
+        , linked_fk, linked_fk, linked_pk, linked_value_column
+        , linked_table_name
+        , row_filter
+        , linked_fk, linked_order
+        , base_table_name, base_pk
+        , format(refresh_value_fragment, 'true')
+	);
+
+	if (options->>'cache_size')::int > 0 then
+		call _pgf_internal_create_cache(id, kind, base_table_name, base_pk, base_aggregate_column, linked_table_name, linked_pk, linked_fk, linked_value_column, row_filter, options);
+	end if;
+
+    execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_%I -- kind, id
+		after delete or insert or update ON %I -- linked_table_name
+		FOR EACH ROW
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$,
+		kind, id,
+		linked_table_name,
+		kind, id
+	);
+
+    execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_truncate_%I -- kind, id
+		after truncate ON %I -- linked_table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$,
+		kind, id,
+		linked_table_name,
+		kind, id
+	);
+
+	call _pgf_internal_post_create(id);
+END;
+$proc$;
+
+CREATE or replace PROCEDURE pgf_id_of_min (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT, -- column holding the 'id of min' value
+    linked_table_name TEXT,
+	linked_pk TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT, -- column to be searched for min value
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('id_of_min', jsonb_build_object('options', options));
+
+	call _pgf_internal_insert_metadata(id, 'id_of_min', jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		'base_aggregate_column', base_aggregate_column,
+		'linked_table_name', linked_table_name,
+		'linked_pk', linked_pk,
+		'linked_fk', linked_fk,
+		'linked_value_column', linked_value_column,
+		'options', options
+	));
+
+	call _pgf_internal_id_of_extremum(id, 'id_of_min', base_table_name, base_pk, base_aggregate_column, linked_table_name, linked_pk, linked_fk, linked_value_column, options);
+END;
+$proc$;
+
+CREATE or replace PROCEDURE pgf_id_of_max (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT, -- column holding the 'id of max' value
+    linked_table_name TEXT,
+	linked_pk TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT, -- column to be searched for max value
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('id_of_max', jsonb_build_object('options', options));
+
+	call _pgf_internal_insert_metadata(id, 'id_of_max', jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		'base_aggregate_column', base_aggregate_column,
+		'linked_table_name', linked_table_name,
+		'linked_pk', linked_pk,
+		'linked_fk', linked_fk,
+		'linked_value_column', linked_value_column,
+		'options', options
+	));
+
+	call _pgf_internal_id_of_extremum(id, 'id_of_max', base_table_name, base_pk, base_aggregate_column, linked_table_name, linked_pk, linked_fk, linked_value_column, options);
+END;
+$proc$;
+
+--------------------------------------------------------------------------------
+-- ARRAY_AGG / STRING_AGG
+--------------------------------------------------------------------------------
+-- Common implementation of pgf_array_agg and pgf_string_agg.
+-- ARRAY_AGG maintains the array in base_aggregate_column. STRING_AGG maintains the array of its elements in the table
+-- _pgf_internal_elements_<id>, so that values containing the delimiter can be removed, and joins them into base_aggregate_column.
+CREATE or replace PROCEDURE _pgf_internal_array_agg (
+	id TEXT,
+	kind TEXT, -- 'array_agg' or 'string_agg'
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT,
+	options JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	row_filter TEXT;
+	order_by TEXT;
+	distinct_values boolean;
+	max_length int;
+	order_by_clause TEXT;
+	limit_clause TEXT;
+	order_by_match TEXT[]; -- order_by parsed as (column, asc/desc, nulls first/last)
+	maintenance TEXT; -- 'sorted' (order_by on linked_value_column) or 'recompute' (other order_by)
+	descending boolean := false;
+	nulls_first boolean := false;
+	element_type TEXT; -- type of the array elements
+	array_type TEXT; -- type of the array
+	array_table_name TEXT; -- table holding the array: base_table_name, or the elements table (STRING_AGG)
+	array_pk TEXT; -- primary key of array_table_name
+	array_column TEXT; -- column holding the array
+	elements_table_name TEXT := '_pgf_internal_elements_' || id;
+	refcount_table_name TEXT := '_pgf_internal_refcount_' || id;
+	stale_table_name TEXT := '_pgf_internal_stale_' || id;
+	aggregate_expression TEXT; -- SQL fragment: array of the linked rows, in the aggregate query
+	add_expression TEXT; -- SQL fragment: new array value after adding _pgf_value
+	add_condition TEXT := ''; -- SQL fragment: 'limit' is honored, i.e. _pgf_value comes before the cutoff
+	refcount_add_fragment TEXT := ''; -- SQL fragment: count _pgf_value in the refcount table, return if already in the array
+	refcount_remove_fragment TEXT := ''; -- SQL fragment: uncount _pgf_value in the refcount table, return if still in the array
+	limit_remove_fragment TEXT := ''; -- SQL fragment: return if _pgf_value is beyond the cutoff, or if the array must be refilled
+	set_string_fragment TEXT := ''; -- SQL fragment: STRING_AGG only, join new_elements into base_aggregate_column
+	reset_fragment TEXT := ''; -- SQL fragment: empty the refcount, elements and stale tables
+	refill_fragment TEXT := ''; -- SQL fragment: re-aggregate the stale parents, at the end of the statement
+BEGIN
+	row_filter := options->>'filter';
+	order_by := options->>'order_by';
+	distinct_values := options->>'distinct';
+	max_length := options->>'limit';
+	if row_filter is null or row_filter = '' then
+		row_filter := 'true';
+	end if;
+	if kind = 'string_agg' then
+		row_filter := format('(%s) and %I is not null', row_filter, linked_value_column); -- like STRING_AGG, NULL values are ignored
+	end if;
+	if max_length <= 0 then
+		max_length := NULL;
+	end if;
+	if order_by is null or order_by = '' then
+		-- the values are sorted, so that the triggers and the refresh procedure agree on the order of the elements
+		order_by := format('%I', linked_value_column);
+	end if;
+
+	/* set SQL clauses */
+	order_by_clause := 'ORDER BY ' || order_by;
+	limit_clause := case when max_length IS NULL then '' else '[1:' || max_length::text || ']' end;
+	aggregate_expression := format('(_pgf_internal_array_dedup(array_agg(%I %s), %s))%s', linked_value_column, order_by_clause, distinct_values::text, limit_clause);
+
+	/* choose how the triggers maintain the array: the array can be maintained from the changed value alone
+	if it is ordered by the value itself. Otherwise the linked rows of the parent are re-aggregated. */
+	order_by_match := regexp_match(order_by, '^\s*(\w+|"[^"]+")\s*(asc|desc)?\s*(nulls\s+(first|last))?\s*$', 'i');
+	if order_by_match[1] in (linked_value_column, format('%I', linked_value_column)) then
+		maintenance := 'sorted';
+		descending := coalesce(lower(order_by_match[2]) = 'desc', false);
+		nulls_first := coalesce(lower(order_by_match[4]) = 'first', descending);
+	else
+		maintenance := 'recompute';
+	end if;
+
+	if kind = 'array_agg' then
+		array_table_name := base_table_name;
+		array_pk := base_pk;
+		array_column := base_aggregate_column;
+		select format_type(t.typelem, NULL) into element_type
+		from pg_attribute a join pg_type t on t.oid = a.atttypid
+		where a.attrelid = to_regclass(format('%I', base_table_name)) and a.attname = base_aggregate_column;
+		array_type := format('%I.%I%%TYPE', base_table_name, base_aggregate_column);
+	else
+		array_table_name := elements_table_name;
+		array_pk := 'parent_id';
+		array_column := 'elements';
+		select c.data_type into element_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_value_column;
+		array_type := element_type || '[]';
+		set_string_fragment := format('update %I set %I = array_to_string(new_elements, %L) where %I = _pgf_id; -- base_table_name, base_aggregate_column, delimiter, base_pk',
+			base_table_name, base_aggregate_column, options->>'delimiter', base_pk);
+		reset_fragment := format('truncate %I;', elements_table_name);
+
+		execute format('DROP TABLE IF EXISTS %I', elements_table_name);
+		execute format($sql$
+			CREATE TABLE %I ( -- elements_table_name
+				parent_id %s primary key, -- fk type
+				elements %s -- array_type
+			)
+			$sql$,
+			elements_table_name,
+			(select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_fk),
+			array_type
+		);
+	end if;
+
+	/* function to update the array_agg value of a single row identified by its PK given in parameter _pgf_id.*/
+	execute format($proc2$
+		CREATE OR REPLACE PROCEDURE _pgf_internal_refresh_single_%I(_pgf_id %I.%I%%TYPE) -- id, linked_table_name, linked_fk
+		LANGUAGE plpgsql AS $inner_proc2$
+		DECLARE
+			new_elements %s; -- array_type
+		BEGIN
+			new_elements := (
+				select %s from ( -- aggregate_expression
+					select * /* need to select all columns in case they are referenced in the order by clause */
+					from %I -- linked_table_name
+					where %I = _pgf_id -- linked_fk
+					and (%s) -- row_filter
+				) t
+			);
+			%s -- set_array_fragment
+			%s -- set_string_fragment
+		END;
+		$inner_proc2$
+	$proc2$
+        , id, linked_table_name, linked_fk
+        , array_type
+        , aggregate_expression
+        , linked_table_name
+        , linked_fk
+        , row_filter
+        , case when kind = 'array_agg' then format('update %I set %I = new_elements where %I = _pgf_id; -- base_table_name, base_aggregate_column, base_pk',
+				base_table_name, base_aggregate_column, base_pk)
+			else format('insert into %I (parent_id, elements) values (_pgf_id, new_elements) on conflict (parent_id) do update set elements = excluded.elements; -- elements_table_name',
+				elements_table_name) end
+        , set_string_fragment
+	);
+
+	if maintenance <> 'recompute' then
+		add_expression := format('(_pgf_internal_array_insert_sorted(%I, _pgf_value, %L, %L))%s', array_column, descending, nulls_first, limit_clause);
+		if max_length is not null then
+			add_condition := format('and (%I is null or _pgf_internal_array_sorted_position(%I, _pgf_value, %L, %L) <= %s)',
+				array_column, array_column, descending, nulls_first, max_length);
+		end if;
+
+		/* with option distinct, count the linked rows of each (parent, value): a value is added to the array by its first row
+		and removed by its last row. NULL values are not counted, their parent is re-aggregated. */
+		if distinct_values then
+			execute format('DROP TABLE IF EXISTS %I', refcount_table_name);
+			execute format($sql$
+				CREATE TABLE %I ( -- refcount_table_name
+					parent_id %s, -- fk type
+					value %s, -- element_type
+					row_count bigint not null,
+					primary key (parent_id, value)
+				)
+				$sql$,
+				refcount_table_name,
+				(select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_fk),
+				element_type
+			);
+			reset_fragment := reset_fragment || format('truncate %I;', refcount_table_name);
+
+			refcount_add_fragment := format($sql$
+				if _pgf_value is null then
+					return true;
+				end if;
+				insert into %I as r (parent_id, value, row_count) values (_pgf_id, _pgf_value, 1) -- refcount_table_name
+				on conflict (parent_id, value) do update set row_count = r.row_count + 1
+				returning r.row_count into value_count;
+				if value_count > 1 then
+					return false; -- the value is already in the array
+				end if;
+				$sql$,
+				refcount_table_name
+			);
+
+			refcount_remove_fragment := format($sql$
+				if _pgf_value is null then
+					return true;
+				end if;
+				update %I set row_count = row_count - 1 where parent_id = _pgf_id and value = _pgf_value -- refcount_table_name
+				returning row_count into value_count;
+				if value_count > 0 then
+					return false; -- the value is still in the array
+				end if;
+				delete from %I where parent_id = _pgf_id and value = _pgf_value; -- refcount_table_name
+				$sql$,
+				refcount_table_name,
+				refcount_table_name
+			);
+		end if;
+
+		/* when add or remove cannot maintain the array of a parent, the parent is marked stale and re-aggregated once
+		at the end of the statement (statement trigger), from the final state of the linked table.
+		The next row triggers of the statement skip it. */
+		execute format('DROP TABLE IF EXISTS %I', stale_table_name);
+		execute format('CREATE TABLE %I (parent_id %s primary key)', stale_table_name,
+			(select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_fk));
+		reset_fragment := reset_fragment || format('truncate %I;', stale_table_name);
+		refill_fragment := format($sql$
+			for stale_parent in delete from %I returning parent_id loop -- stale_table_name
+				%s -- refcount_refill_fragment
+				call _pgf_internal_refresh_single_%I(stale_parent.parent_id); -- id
+			end loop;
+			$sql$,
+			stale_table_name,
+			case when distinct_values then format($sql2$
+				delete from %I where parent_id = stale_parent.parent_id; -- refcount_table_name
+				insert into %I(parent_id, value, row_count) -- refcount_table_name
+				select %I, %I, count(*) from %I -- linked_fk, linked_value_column, linked_table_name
+				where %I = stale_parent.parent_id and %I is not null and (%s) -- linked_fk, linked_value_column, row_filter
+				group by %I, %I; -- linked_fk, linked_value_column
+				$sql2$,
+				refcount_table_name,
+				refcount_table_name,
+				linked_fk, linked_value_column, linked_table_name,
+				linked_fk, linked_value_column, row_filter,
+				linked_fk, linked_value_column)
+			else '' end,
+			id
+		);
+
+		/* with option limit, removing a value from a full array must refill it from the linked table */
+		if max_length is not null then
+			limit_remove_fragment := format($sql$
+				select %I into new_elements from %I where %I = _pgf_id; -- array_column, array_table_name, array_pk
+				if array_position(new_elements, _pgf_value) is null then
+					return false; -- the value is beyond the cutoff
+				elsif cardinality(new_elements) >= %s then -- max_length
+					return true; -- the array must be refilled from the linked table
+				end if;
+				$sql$,
+				array_column, array_table_name, array_pk,
+				max_length
+			);
+		end if;
+
+		/* add a value to the array of a single row identified by its PK given in parameter _pgf_id.
+		Returns true if the row must be re-aggregated instead. */
+		execute format($proc2$
+			CREATE OR REPLACE FUNCTION _pgf_internal_%s_add_%I(_pgf_id %I.%I%%TYPE, _pgf_value %s) -- kind, id, linked_table_name, linked_fk, element_type
+			RETURNS boolean
+			LANGUAGE plpgsql AS $inner_proc2$
+			DECLARE
+				value_count bigint;
+				new_elements %s; -- array_type
+			BEGIN
+				%s -- refcount_add_fragment
+				%s -- insert_elements_fragment
+				update %I set %I = %s where %I = _pgf_id %s -- array_table_name, array_column, add_expression, array_pk, add_condition
+				returning %I into new_elements; -- array_column
+				if found then
+					%s -- set_string_fragment
+				end if;
+				return false;
+			END;
+			$inner_proc2$
+			$proc2$,
+			kind, id, linked_table_name, linked_fk, element_type,
+			array_type,
+			refcount_add_fragment,
+			case when kind = 'array_agg' then '' else format('insert into %I (parent_id) values (_pgf_id) on conflict (parent_id) do nothing;', elements_table_name) end,
+			array_table_name, array_column, add_expression, array_pk, add_condition,
+			array_column,
+			set_string_fragment
+		);
+
+		/* remove a value from the array of a single row identified by its PK given in parameter _pgf_id.
+		Returns true if the row must be re-aggregated instead. */
+		execute format($proc2$
+			CREATE OR REPLACE FUNCTION _pgf_internal_%s_remove_%I(_pgf_id %I.%I%%TYPE, _pgf_value %s) -- kind, id, linked_table_name, linked_fk, element_type
+			RETURNS boolean
+			LANGUAGE plpgsql AS $inner_proc2$
+			DECLARE
+				value_count bigint;
+				new_elements %s; -- array_type
+			BEGIN
+				%s -- refcount_remove_fragment
+				%s -- limit_remove_fragment
+				update %I set %I = _pgf_internal_array_remove_one(%I, _pgf_value) where %I = _pgf_id -- array_table_name, array_column, array_column, array_pk
+				returning %I into new_elements; -- array_column
+				%s -- set_string_fragment
+				return false;
+			END;
+			$inner_proc2$
+			$proc2$,
+			kind, id, linked_table_name, linked_fk, element_type,
+			array_type,
+			refcount_remove_fragment,
+			limit_remove_fragment,
+			array_table_name, array_column, array_column, array_pk,
+			array_column,
+			set_string_fragment
+		);
+	end if;
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_%s_trgfun_%I() -- kind, id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			old_row_matches_filter boolean := false;
+			new_row_matches_filter boolean := false;
+			old_parent_recompute boolean := false;
+			new_parent_recompute boolean := false;
+			stale_parent record;
+		BEGIN
+			IF TG_OP='TRUNCATE' then
+				%s -- reset_fragment
+				update %I set %I=NULL; -- base_table_name, base_aggregate_column
+				RETURN NULL;
+			END IF;
+
+			/* end of statement: re-aggregate the stale parents */
+			IF TG_LEVEL = 'STATEMENT' then
+				%s -- refill_fragment
+				RETURN NULL;
+			END IF;
+
+			/* skip rows deleted by a cascade (ON DELETE CASCADE) from their parent row, which is already deleted */
+			IF TG_OP = 'DELETE' and pg_trigger_depth() > 1 and not exists (select 1 from %I where %I = OLD.%I) then -- base_table_name, base_pk, linked_fk
+				%s -- delete_parent_fragment
+				RETURN NULL;
+			END IF;
+
+			/* test if OLD row matches filter */
+			IF TG_OP in ('UPDATE', 'DELETE') then
+				select count(*) = 1 into old_row_matches_filter from (select OLD.*) t where %s; -- row_filter
+			END IF;
+
+			/* test if NEW row matches filter */
+			IF TG_OP in ('UPDATE', 'INSERT') then
+				select count(*) = 1 into new_row_matches_filter from (select NEW.*) t where %s; -- row_filter
+			END IF;
+
+			%s -- maintenance_fragment
+			RETURN NULL;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+	$fun$
+        , kind, id
+        , reset_fragment
+        , base_table_name, base_aggregate_column
+        , refill_fragment
+        , base_table_name, base_pk, linked_fk
+        , case when maintenance <> 'recompute' then format('delete from %I where parent_id = OLD.%I;', stale_table_name, linked_fk) else '' end
+			|| case when distinct_values and maintenance <> 'recompute' then format('delete from %I where parent_id = OLD.%I;', refcount_table_name, linked_fk) else '' end
+			|| case when kind = 'string_agg' then format('delete from %I where parent_id = OLD.%I;', elements_table_name, linked_fk) else '' end
+        , row_filter
+        , row_filter
+        , case when maintenance = 'recompute' then format($sql$
+			/* re-aggregate the linked rows of the OLD and NEW parents. The rows without parent are skipped */
+			IF old_row_matches_filter and OLD.%I is not null then -- linked_fk
+				call _pgf_internal_refresh_single_%I(OLD.%I); -- id, linked_fk
+			END IF;
+			IF new_row_matches_filter and NEW.%I is not null -- linked_fk
+				and (TG_OP = 'INSERT' or not old_row_matches_filter or OLD.%I is distinct from NEW.%I) then -- linked_fk, linked_fk
+				call _pgf_internal_refresh_single_%I(NEW.%I); -- id, linked_fk
+			END IF;
+			$sql$,
+			linked_fk,
+			id, linked_fk,
+			linked_fk,
+			linked_fk, linked_fk,
+			id, linked_fk)
+		else format($sql$
+			/* skip the rows without parent, and the parents already marked stale */
+			old_row_matches_filter := old_row_matches_filter and OLD.%I is not null -- linked_fk
+				and not exists (select 1 from %I where parent_id = OLD.%I); -- stale_table_name, linked_fk
+			new_row_matches_filter := new_row_matches_filter and NEW.%I is not null -- linked_fk
+				and not exists (select 1 from %I where parent_id = NEW.%I); -- stale_table_name, linked_fk
+			IF TG_OP = 'UPDATE' and old_row_matches_filter = new_row_matches_filter
+				and (OLD.%I, OLD.%I) is not distinct from (NEW.%I, NEW.%I) then -- linked_fk, linked_value_column, linked_fk, linked_value_column
+				RETURN NULL; -- the array has not changed
+			END IF;
+			IF old_row_matches_filter then
+				old_parent_recompute := _pgf_internal_%s_remove_%I(OLD.%I, OLD.%I::%s); -- kind, id, linked_fk, linked_value_column, element_type
+			END IF;
+			IF new_row_matches_filter then
+				new_parent_recompute := _pgf_internal_%s_add_%I(NEW.%I, NEW.%I::%s); -- kind, id, linked_fk, linked_value_column, element_type
+			END IF;
+
+			/* fallback: mark the parents stale, they are re-aggregated at the end of the statement */
+			IF old_parent_recompute then
+				insert into %I values (OLD.%I) on conflict do nothing; -- stale_table_name, linked_fk
+			END IF;
+			IF new_parent_recompute then
+				insert into %I values (NEW.%I) on conflict do nothing; -- stale_table_name, linked_fk
+			END IF;
+			$sql$,
+			linked_fk,
+			stale_table_name, linked_fk,
+			linked_fk,
+			stale_table_name, linked_fk,
+			linked_fk, linked_value_column, linked_fk, linked_value_column,
+			kind, id, linked_fk, linked_value_column, element_type,
+			kind, id, linked_fk, linked_value_column, element_type,
+			stale_table_name, linked_fk,
+			stale_table_name, linked_fk)
+		end
+	);
+
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc2$
+			begin
+				%s -- reset_fragment
+			    update %I set %I = NULL; -- base_table_name, base_aggregate_column
+				%s -- refresh_fragment
+				%s -- refcount_refresh_fragment
+			end;
+			$inner_proc2$;
+		$inner_proc$
+        , id
+        , reset_fragment
+        , base_table_name, base_aggregate_column
+        , case when kind = 'array_agg' then format($sql$
+				update %I set %I = sub.agg -- base_table_name, base_aggregate_column
+				from (
+					select %I as id, %s as agg -- linked_fk, aggregate_expression
+					from %I -- linked_table_name
+					where %s -- row_filter
+					group by %I -- linked_fk
+				) as sub
+				where %I.%I = sub.id; -- base_table_name, base_pk
+				$sql$,
+				base_table_name, base_aggregate_column,
+				linked_fk, aggregate_expression,
+				linked_table_name,
+				row_filter,
+				linked_fk,
+				base_table_name, base_pk)
+			else format($sql$
+				insert into %I (parent_id, elements) -- elements_table_name
+				select %I, %s -- linked_fk, aggregate_expression
+				from %I -- linked_table_name
+				where %I is not null and (%s) -- linked_fk, row_filter
+				group by %I; -- linked_fk
+				update %I set %I = array_to_string(e.elements, %L) -- base_table_name, base_aggregate_column, delimiter
+				from %I e -- elements_table_name
+				where %I.%I = e.parent_id; -- base_table_name, base_pk
+				$sql$,
+				elements_table_name,
+				linked_fk, aggregate_expression,
+				linked_table_name,
+				linked_fk, row_filter,
+				linked_fk,
+				base_table_name, base_aggregate_column, options->>'delimiter',
+				elements_table_name,
+				base_table_name, base_pk)
+			end
+        , case when distinct_values and maintenance <> 'recompute' then format($sql$
+				insert into %I(parent_id, value, row_count) -- refcount_table_name
+				select %I, %I, count(*) from %I -- linked_fk, linked_value_column, linked_table_name
+				where %I is not null and %I is not null and (%s) -- linked_fk, linked_value_column, row_filter
+				group by %I, %I; -- linked_fk, linked_value_column
+				$sql$,
+				refcount_table_name,
+				linked_fk, linked_value_column, linked_table_name,
+				linked_fk, linked_value_column, row_filter,
+				linked_fk, linked_value_column)
+			else '' end
+	);
+
+    execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_%I -- kind, id
+		after delete or insert or update ON %I -- linked_table_name
+		FOR EACH ROW
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$,
+		kind, id,
+		linked_table_name,
+		kind, id
+	);
+
+    execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_truncate_%I -- kind, id
+		after truncate ON %I -- linked_table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$,
+		kind, id,
+		linked_table_name,
+		kind, id
+	);
+
+	if maintenance <> 'recompute' then
+		execute format($trg$
+			CREATE TRIGGER _pgf_internal_%s_trg_refill_%I -- kind, id
+			after delete or insert or update ON %I -- linked_table_name
+			FOR EACH STATEMENT
+			execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+			$trg$,
+			kind, id,
+			linked_table_name,
+			kind, id
+		);
+	end if;
+
+	call _pgf_internal_post_create(id);
+END;
+$proc$;
+
+CREATE or replace PROCEDURE pgf_array_agg (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT, -- column holding the 'ARRAY_AGG' value
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT, -- column to be used for array aggregation
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('array_agg', jsonb_build_object('options', options));
+
+	call _pgf_internal_insert_metadata(id, 'array_agg', jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		'base_aggregate_column', base_aggregate_column,
+		'linked_table_name', linked_table_name,
+		'linked_fk', linked_fk,
+		'linked_value_column', linked_value_column,
+		'options', options
+	));
+
+	call _pgf_internal_array_agg(id, 'array_agg', base_table_name, base_pk, base_aggregate_column, linked_table_name, linked_fk, linked_value_column, options);
+END;
+$proc$;
+
+CREATE or replace PROCEDURE pgf_string_agg (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT, -- column holding the 'STRING_AGG' value
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT, -- column to be concatenated
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('string_agg', jsonb_build_object('options', options));
+
+	call _pgf_internal_insert_metadata(id, 'string_agg', jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		'base_aggregate_column', base_aggregate_column,
+		'linked_table_name', linked_table_name,
+		'linked_fk', linked_fk,
+		'linked_value_column', linked_value_column,
+		'options', options
+	));
+
+	call _pgf_internal_array_agg(id, 'string_agg', base_table_name, base_pk, base_aggregate_column, linked_table_name, linked_fk, linked_value_column, options);
+END;
+$proc$;
+--------------------------------------------------------------------------------
+-- COUNT_DISTINCT
+--------------------------------------------------------------------------------
+-- COUNT_DISTINCT: update a field that counts the distinct values of a column among linked elements.
+-- The number of linked rows of each (parent, value) is kept in the table _pgf_internal_refcount_<id>: the distinct count
+-- of a parent changes only when the row count of one of its values goes from 0 to 1, or from 1 to 0.
+-- Statement triggers read the changed rows from the transition tables, so that a bulk load updates each refcount
+-- and each parent row once.
+CREATE or replace PROCEDURE pgf_count_distinct (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_count_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT,
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	row_filter TEXT;
+	refcount_table_name TEXT := '_pgf_internal_refcount_' || id;
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('count_distinct', jsonb_build_object('options', options));
+
+	call _pgf_internal_insert_metadata(id, 'count_distinct', jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		'base_count_column', base_count_column,
+		'linked_table_name', linked_table_name,
+		'linked_fk', linked_fk,
+		'linked_value_column', linked_value_column,
+		'options', options
+	));
+
+	row_filter := coalesce(nullif(options->>'filter', ''), 'true');
+	-- like COUNT(DISTINCT ...), NULL values are ignored
+	row_filter := format('(%s) and %I is not null and %I is not null', row_filter, linked_fk, linked_value_column);
+
+	execute format('DROP TABLE IF EXISTS %I', refcount_table_name);
+	execute format($sql$
+		CREATE TABLE %I ( -- refcount_table_name
+			parent_id %s, -- fk type
+			value %s, -- value type
+			row_count bigint not null,
+			primary key (parent_id, value)
+		)
+		$sql$,
+		refcount_table_name,
+		(select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_fk),
+		(select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_value_column)
+	);
+
+	/* statement trigger function. The changes of the statement are aggregated by (parent, value), then applied to the
+	refcount table with a single upsert. A parent row is updated if the row count of one of its values crosses 0. */
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_count_distinct_trgfun_%I() -- id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			new_rows TEXT := case when TG_OP = 'DELETE' then 'select * from %I where false' else 'select * from pgf_new' end; -- linked_table_name
+			old_rows TEXT := case when TG_OP = 'INSERT' then 'select * from %I where false' else 'select * from pgf_old' end; -- linked_table_name
+		BEGIN
+			IF TG_OP = 'TRUNCATE' then
+				truncate %I; -- refcount_table_name
+				update %I set %I = 0; -- base_table_name, base_count_column
+				RETURN NULL;
+			END IF;
+
+			execute format($sql$
+				with changes as (
+					select c.parent_id, c.value, sum(c.delta) as delta from (
+						select %I as parent_id, %I as value, 1 as delta from (%%s) n where %s -- linked_fk, linked_value_column, new_rows, row_filter
+						union all
+						select %I as parent_id, %I as value, -1 as delta from (%%s) o where %s -- linked_fk, linked_value_column, old_rows, row_filter
+					) c
+					group by c.parent_id, c.value
+					having sum(c.delta) <> 0
+				), refcounts as (
+					insert into %I as r (parent_id, value, row_count) -- refcount_table_name
+					select parent_id, value, delta from changes
+					on conflict (parent_id, value) do update set row_count = r.row_count + excluded.row_count
+					returning r.parent_id, r.value, r.row_count
+				), distinct_deltas as (
+					select r.parent_id, sum(case
+						when r.row_count > 0 and r.row_count - c.delta <= 0 then 1 -- first row of the value
+						when r.row_count <= 0 and r.row_count - c.delta > 0 then -1 -- last row of the value
+						else 0 end) as delta
+					from refcounts r
+					join changes c on c.parent_id = r.parent_id and c.value = r.value
+					group by r.parent_id
+				)
+				update %I b set %I = b.%I + d.delta -- base_table_name, base_count_column, base_count_column
+				from distinct_deltas d
+				where b.%I = d.parent_id and d.delta <> 0 -- base_pk
+				$sql$, new_rows, old_rows);
+
+			/* values without rows are removed in a second statement: the upsert above is not visible to other parts
+			of its own statement */
+			IF TG_OP <> 'INSERT' then
+				delete from %I r -- refcount_table_name
+				using (select %I as parent_id, %I as value from pgf_old where %s) o -- linked_fk, linked_value_column, row_filter
+				where r.parent_id = o.parent_id and r.value = o.value and r.row_count <= 0;
+			END IF;
+			RETURN NULL;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+		$fun$
+		, id
+		, linked_table_name
+		, linked_table_name
+		, refcount_table_name
+		, base_table_name, base_count_column
+		-- the SQL fragments below are in a format() string: % is escaped
+		, linked_fk, linked_value_column, replace(row_filter, '%', '%%')
+		, linked_fk, linked_value_column, replace(row_filter, '%', '%%')
+		, refcount_table_name
+		, base_table_name, base_count_column, base_count_column
+		, base_pk
+		, refcount_table_name
+		, linked_fk, linked_value_column, row_filter
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_count_distinct_trg_%I -- id
+		after insert ON %I -- linked_table_name
+		REFERENCING NEW TABLE AS pgf_new
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_count_distinct_trgfun_%I(); -- id
+		$trg$, id, linked_table_name, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_count_distinct_trg_update_%I -- id
+		after update ON %I -- linked_table_name
+		REFERENCING OLD TABLE AS pgf_old NEW TABLE AS pgf_new
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_count_distinct_trgfun_%I(); -- id
+		$trg$, id, linked_table_name, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_count_distinct_trg_delete_%I -- id
+		after delete ON %I -- linked_table_name
+		REFERENCING OLD TABLE AS pgf_old
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_count_distinct_trgfun_%I(); -- id
+		$trg$, id, linked_table_name, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_count_distinct_trg_truncate_%I -- id
+		after truncate ON %I -- linked_table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_count_distinct_trgfun_%I(); -- id
+		$trg$, id, linked_table_name, id
+	);
+
+	execute format($proc2$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc$
+			begin
+				truncate %I; -- refcount_table_name
+				insert into %I (parent_id, value, row_count) -- refcount_table_name
+				select %I, %I, count(*) from %I -- linked_fk, linked_value_column, linked_table_name
+				where %s -- row_filter
+				group by %I, %I; -- linked_fk, linked_value_column
+
+				update %I b set %I = coalesce(d.distinct_count, 0) -- base_table_name, base_count_column
+				from %I b2 -- base_table_name
+				left join (select parent_id, count(*) as distinct_count from %I group by parent_id) d on d.parent_id = b2.%I -- refcount_table_name, base_pk
+				where b2.%I = b.%I -- base_pk, base_pk
+				and b.%I is distinct from coalesce(d.distinct_count, 0); -- base_count_column
+			end;
+			$inner_proc$;
+		$proc2$
+		, id
+		, refcount_table_name
+		, refcount_table_name
+		, linked_fk, linked_value_column, linked_table_name
+		, row_filter
+		, linked_fk, linked_value_column
+		, base_table_name, base_count_column
+		, base_table_name
+		, refcount_table_name, base_pk
+		, base_pk, base_pk
+		, base_count_column
+	);
+
+	call _pgf_internal_post_create(id);
+END;
+$proc$;
+
+--------------------------------------------------------------------------------
+-- APPROX_COUNT_DISTINCT
+--------------------------------------------------------------------------------
+-- HyperLogLog sketches. A sketch of precision p is a bytea of 2^p registers (one byte each). A value is hashed on 64
+-- bits: the first p bits select a register, which keeps the max rank (position of the first 1 bit) of the other bits.
+
+-- Register of a 64 bits hash
+CREATE or replace FUNCTION _pgf_internal_hll_index(h bigint, p int)
+RETURNS int
+LANGUAGE sql IMMUTABLE AS $$
+	select ((h >> (64 - p)) & ((1 << p) - 1))::int;
+$$;
+
+-- Rank of a 64 bits hash: position of the first 1 bit after the first p bits (64 - p + 1 if all bits are 0).
+CREATE or replace FUNCTION _pgf_internal_hll_rank(h bigint, p int)
+RETURNS int
+LANGUAGE sql IMMUTABLE AS $$
+	select coalesce(nullif(position('1' in substring(h::bit(64)::text from p + 1)), 0), 65 - p);
+$$;
+
+-- Set the registers idx[i] to max(registers[idx[i]], ranks[i]). A NULL sketch is an empty sketch.
+-- zero_count (number of registers set to 0) and harmonic_sum (sum of 2^(62 - register)) are updated along with the
+-- registers, so that the estimate does not read the registers. harmonic_sum is exact: a sketch has the same estimate
+-- whether it is built incrementally or at once.
+CREATE or replace FUNCTION _pgf_internal_hll_merge(
+	INOUT registers bytea,
+	INOUT zero_count int,
+	INOUT harmonic_sum numeric,
+	p int,
+	idx int[],
+	ranks int[]
+)
+LANGUAGE plpgsql IMMUTABLE AS $$
+DECLARE
+	old_rank int;
+BEGIN
+	if registers is null then
+		registers := decode(repeat('00', 1 << p), 'hex');
+		zero_count := 1 << p;
+		harmonic_sum := (1 << p) * power(2::numeric, 62);
+	end if;
+	for i in 1..coalesce(array_length(idx, 1), 0) loop
+		old_rank := get_byte(registers, idx[i]);
+		if ranks[i] > old_rank then
+			registers := set_byte(registers, idx[i], ranks[i]);
+			zero_count := zero_count - case when old_rank = 0 then 1 else 0 end;
+			harmonic_sum := harmonic_sum + ((1::bigint << (62 - ranks[i])) - (1::bigint << (62 - old_rank)));
+		end if;
+	end loop;
+END;
+$$;
+
+-- Estimated number of distinct values of a sketch of m registers, with the small range correction (linear counting).
+-- The standard error is 1.04 / sqrt(m).
+CREATE or replace FUNCTION _pgf_internal_hll_estimate(m int, zero_count int, harmonic_sum numeric)
+RETURNS bigint
+LANGUAGE sql IMMUTABLE AS $$
+	select case
+		when harmonic_sum is null then 0
+		when e <= 2.5 * m and zero_count > 0 then round(m * ln(m::float8 / zero_count))
+		else round(e) end::bigint
+	from (
+		select (case m when 16 then 0.673 when 32 then 0.697 when 64 then 0.709 else 0.7213 / (1 + 1.079 / m) end)
+			* m * m * power(2::float8, 62) / harmonic_sum::float8 as e
+	) x;
+$$;
+
+-- Estimated number of distinct values of a sketch (e.g. read from a table _pgf_internal_hll_<id>).
+CREATE or replace FUNCTION pgf_hll_estimate(registers bytea)
+RETURNS bigint
+LANGUAGE sql IMMUTABLE AS $$
+	select _pgf_internal_hll_estimate(length(registers), zero_count::int, harmonic_sum)
+	from (
+		select count(*) filter (where v = 0) as zero_count, sum((1::bigint << (62 - v))::numeric) as harmonic_sum
+		from (select get_byte(registers, i) as v from generate_series(0, length(registers) - 1) i) r
+	) s;
+$$;
+
+-- APPROX_COUNT_DISTINCT: update a field that estimates the number of distinct values of a column among linked elements.
+-- The sketch of each parent is kept in the table _pgf_internal_hll_<id>. Inserted values are merged into the sketches;
+-- deleted values cannot be removed from a sketch: see option 'delete_policy'.
+CREATE or replace PROCEDURE pgf_approx_count_distinct (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_count_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_value_column TEXT,
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	row_filter TEXT;
+	p int;
+	hll_table_name TEXT := '_pgf_internal_hll_' || id;
+	hashed_rows TEXT; -- query returning (parent_id, idx, rank) of the linked rows matching the filter; %s = source rows
+	rebuild_sql TEXT; -- statements rebuilding the sketches of some parents; %1$s, %2$s, %3$s = conditions on the parent id
+		-- of the sketch, the linked row and the base row
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('approx_count_distinct', jsonb_build_object('options', options));
+
+	p := (options->>'precision')::int;
+	if p is null or p not between 4 and 16 then
+		raise exception 'Invalid value for option "precision": %. Allowed values are: 4 to 16', options->>'precision';
+	end if;
+	if options->>'delete_policy' not in ('refresh', 'rebuild') then
+		raise exception 'Invalid value for option "delete_policy": %. Allowed values are: refresh, rebuild', options->>'delete_policy';
+	end if;
+
+	call _pgf_internal_insert_metadata(id, 'approx_count_distinct', jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		'base_count_column', base_count_column,
+		'linked_table_name', linked_table_name,
+		'linked_fk', linked_fk,
+		'linked_value_column', linked_value_column,
+		'options', options
+	));
+
+	row_filter := coalesce(nullif(options->>'filter', ''), 'true');
+	-- like COUNT(DISTINCT ...), NULL values are ignored
+	row_filter := format('(%s) and %I is not null and %I is not null', row_filter, linked_fk, linked_value_column);
+
+	execute format('DROP TABLE IF EXISTS %I', hll_table_name);
+	execute format($sql$
+		CREATE TABLE %I ( -- hll_table_name
+			parent_id %s primary key, -- fk type
+			registers bytea not null default decode(repeat('00', %s), 'hex'), -- 2^p
+			zero_count int not null default %s, -- 2^p
+			harmonic_sum numeric not null default %s -- 2^p * 2^62
+		)
+		$sql$,
+		hll_table_name,
+		(select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_fk),
+		1 << p,
+		1 << p,
+		(1 << p) * power(2::numeric, 62)
+	);
+
+	hashed_rows := format($sql$
+		select parent_id, _pgf_internal_hll_index(h, %s) as idx, max(_pgf_internal_hll_rank(h, %s)) as rank -- p, p
+		from (select %I as parent_id, hashtextextended(%I::text, 0) as h from (%%s) s where %s) t -- linked_fk, linked_value_column, row_filter
+		group by 1, 2
+		$sql$,
+		p, p,
+		linked_fk, linked_value_column, replace(row_filter, '%', '%%') -- hashed_rows is a format() string: % is escaped
+	);
+
+	rebuild_sql := format($sql$
+		delete from %I where %%1$s; -- hll_table_name
+		insert into %I (parent_id, registers, zero_count, harmonic_sum) -- hll_table_name
+		select s.parent_id, m.registers, m.zero_count, m.harmonic_sum
+		from (select parent_id, array_agg(idx) as idx, array_agg(rank) as ranks from (%s) r group by parent_id) s, -- hashed_rows
+		lateral _pgf_internal_hll_merge(NULL, NULL, NULL, %s, s.idx, s.ranks) m; -- p
+		update %I b set %I = e.estimate -- base_table_name, base_count_column
+		from (
+			select b.%I as pk, _pgf_internal_hll_estimate(%s, h.zero_count, h.harmonic_sum) as estimate -- base_pk, 2^p
+			from %I b -- base_table_name
+			left join %I h on h.parent_id = b.%I -- hll_table_name, base_pk
+			where %%3$s
+		) e
+		where b.%I = e.pk and b.%I is distinct from e.estimate; -- base_pk, base_count_column
+		$sql$,
+		hll_table_name,
+		hll_table_name,
+		format(replace(hashed_rows, '%%', '%%%%'), format('select * from %I where %%2$s', linked_table_name)), -- rebuild_sql is a format() string: % is escaped
+		p,
+		base_table_name, base_count_column,
+		base_pk, 1 << p,
+		base_table_name,
+		hll_table_name, base_pk,
+		base_pk, base_count_column
+	);
+
+	/* statement trigger function. Inserted values (and the new values of updated rows) are merged into the sketches of
+	their parents. Deleted values (and the old values of updated rows) are kept in the sketches until the next
+	pgf_refresh, unless 'delete_policy' is 'rebuild'. */
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_approx_count_distinct_trgfun_%I() -- id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			new_rows TEXT := case when TG_OP = 'DELETE' then 'select * from %I where false' else 'select * from pgf_new' end; -- linked_table_name
+			old_rows TEXT := case when TG_OP = 'INSERT' then 'select * from %I where false' else 'select * from pgf_old' end; -- linked_table_name
+			parent_keys TEXT;
+		BEGIN
+			IF TG_OP = 'TRUNCATE' then
+				truncate %I; -- hll_table_name
+				update %I set %I = 0; -- base_table_name, base_count_column
+				RETURN NULL;
+			END IF;
+
+			IF TG_OP <> 'INSERT' and %L = 'rebuild' then -- delete_policy
+				parent_keys := format('select %I from (%%s) n union select %I from (%%s) o', new_rows, old_rows); -- linked_fk, linked_fk
+				execute format(%L, format('parent_id in (%%s)', parent_keys), format('%I in (%%s)', parent_keys), format('b.%I in (%%s)', parent_keys)); -- rebuild_sql, linked_fk, base_pk
+				RETURN NULL;
+			END IF;
+
+			execute format($sql$
+				insert into %I (parent_id) -- hll_table_name
+				select distinct parent_id from (%s) r -- hashed_rows
+				on conflict (parent_id) do nothing
+				$sql$, new_rows);
+
+			execute format($sql$
+				with sketches as (
+					select parent_id, array_agg(idx) as idx, array_agg(rank) as ranks from (%s) r -- hashed_rows
+					group by parent_id
+				), merged as (
+					update %I h set (registers, zero_count, harmonic_sum) = ( -- hll_table_name
+						select m.registers, m.zero_count, m.harmonic_sum
+						from _pgf_internal_hll_merge(h.registers, h.zero_count, h.harmonic_sum, %s, s.idx, s.ranks) m -- p
+					)
+					from sketches s
+					where h.parent_id = s.parent_id
+					returning h.parent_id, _pgf_internal_hll_estimate(%s, h.zero_count, h.harmonic_sum) as estimate -- 2^p
+				)
+				update %I b set %I = m.estimate -- base_table_name, base_count_column
+				from merged m
+				where b.%I = m.parent_id and b.%I is distinct from m.estimate -- base_pk, base_count_column
+				$sql$, new_rows);
+			RETURN NULL;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+		$fun$
+		, id
+		, linked_table_name
+		, linked_table_name
+		, hll_table_name
+		, base_table_name, base_count_column
+		, options->>'delete_policy'
+		, linked_fk, linked_fk
+		, rebuild_sql, linked_fk, base_pk
+		, hll_table_name
+		, hashed_rows
+		, hashed_rows
+		, hll_table_name, p
+		, 1 << p
+		, base_table_name, base_count_column
+		, base_pk, base_count_column
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_approx_count_distinct_trg_%I -- id
+		after insert ON %I -- linked_table_name
+		REFERENCING NEW TABLE AS pgf_new
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_approx_count_distinct_trgfun_%I(); -- id
+		$trg$, id, linked_table_name, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_approx_count_distinct_trg_update_%I -- id
+		after update ON %I -- linked_table_name
+		REFERENCING OLD TABLE AS pgf_old NEW TABLE AS pgf_new
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_approx_count_distinct_trgfun_%I(); -- id
+		$trg$, id, linked_table_name, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_approx_count_distinct_trg_delete_%I -- id
+		after delete ON %I -- linked_table_name
+		REFERENCING OLD TABLE AS pgf_old
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_approx_count_distinct_trgfun_%I(); -- id
+		$trg$, id, linked_table_name, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_approx_count_distinct_trg_truncate_%I -- id
+		after truncate ON %I -- linked_table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_approx_count_distinct_trgfun_%I(); -- id
+		$trg$, id, linked_table_name, id
+	);
+
+	execute format($proc2$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc$
+			begin
+				%s -- rebuild_sql
+			end;
+			$inner_proc$;
+		$proc2$
+		, id
+		, format(rebuild_sql, 'true', 'true', 'true')
+	);
+
+	call _pgf_internal_post_create(id);
+END;
+$proc$;
+
+--------------------------------------------------------------------------------
+-- WINDOW_COUNT, WINDOW_SUM
+--------------------------------------------------------------------------------
+-- WINDOW_COUNT: update a field that counts the linked elements whose timestamp is in a sliding time window, e.g. the
+-- orders of the last 24 hours. See _pgf_internal_window_aggregate.
+CREATE or replace PROCEDURE pgf_window_count (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_count_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_timestamp_column TEXT,
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	call _pgf_internal_window_aggregate('window_count', id, base_table_name, base_pk, base_count_column, linked_table_name,
+		linked_fk, linked_timestamp_column, NULL, options);
+END;
+$proc$;
+
+-- WINDOW_SUM: update a field that sums a column of the linked elements whose timestamp is in a sliding time window.
+-- See _pgf_internal_window_aggregate.
+CREATE or replace PROCEDURE pgf_window_sum (
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_timestamp_column TEXT,
+	linked_value_column TEXT,
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	call _pgf_internal_window_aggregate('window_sum', id, base_table_name, base_pk, base_aggregate_column, linked_table_name,
+		linked_fk, linked_timestamp_column, linked_value_column, options);
+END;
+$proc$;
+
+-- The window is divided into buckets (option 'bucket'): the table _pgf_internal_window_<id> stores the row count and
+-- the sum of each (parent, bucket), and the base column is the total of the buckets of the parent. The buckets starting
+-- before the window start, stored in the one-row table _pgf_internal_window_start_<id>, are not stored.
+-- Writes update the buckets from statement triggers. pgf_window_expire moves the window start to the current time: it
+-- deletes the expired buckets of all parents at once, using the index on bucket_start, and subtracts them from the base
+-- column. The window then holds the current bucket and the (window / bucket - 1) previous ones.
+CREATE or replace PROCEDURE _pgf_internal_window_aggregate (
+	kind TEXT, -- 'window_count' or 'window_sum'
+	id TEXT,
+    base_table_name TEXT,
+    base_pk TEXT,
+    base_aggregate_column TEXT,
+    linked_table_name TEXT,
+    linked_fk TEXT,
+	linked_timestamp_column TEXT,
+	linked_value_column TEXT, -- NULL for window_count
+	options JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	row_filter TEXT;
+	window_width interval;
+	bucket_width interval;
+	timestamp_type TEXT;
+	with_time_zone boolean;
+	bucket_sql TEXT; -- SQL fragment: bucket of the row
+	window_start_sql TEXT; -- SQL fragment: window start at the current time
+	value_sql TEXT; -- SQL fragment: value of the row added to value_sum
+	total_column TEXT; -- column of the bucket table summed into the base column
+	bucket_table_name TEXT := '_pgf_internal_window_' || id;
+	start_table_name TEXT := '_pgf_internal_window_start_' || id;
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options(kind, jsonb_build_object('options', options));
+
+	window_width := (options->>'window')::interval;
+	bucket_width := (options->>'bucket')::interval;
+	if date_part('year', bucket_width) <> 0 or date_part('month', bucket_width) <> 0
+		or date_part('year', window_width) <> 0 or date_part('month', window_width) <> 0 then
+		raise exception 'Options "window" and "bucket" must not contain months or years';
+	end if;
+	if extract(epoch from bucket_width) <= 0 or extract(epoch from window_width) < extract(epoch from bucket_width)
+		or extract(epoch from window_width) % extract(epoch from bucket_width) <> 0 then
+		raise exception 'Option "window" (%) must be a multiple of option "bucket" (%)', window_width, bucket_width;
+	end if;
+
+	call _pgf_internal_insert_metadata(id, kind, jsonb_build_object(
+		'base_table_name', base_table_name,
+		'base_pk', base_pk,
+		case when kind = 'window_count' then 'base_count_column' else 'base_aggregate_column' end, base_aggregate_column,
+		'linked_table_name', linked_table_name,
+		'linked_fk', linked_fk,
+		'linked_timestamp_column', linked_timestamp_column,
+		'options', options
+	) || case when kind = 'window_sum' then jsonb_build_object('linked_value_column', linked_value_column) else '{}'::JSONB end);
+
+	row_filter := coalesce(nullif(options->>'filter', ''), 'true');
+	row_filter := format('(%s) and %I is not null and %I is not null', row_filter, linked_fk, linked_timestamp_column);
+	select c.data_type into timestamp_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_timestamp_column;
+	if timestamp_type is null then
+		raise exception 'Column %.% does not exist', linked_table_name, linked_timestamp_column;
+	end if;
+	with_time_zone := timestamp_type like 'timestamp%with time zone';
+	timestamp_type := case when with_time_zone then 'timestamp with time zone' else 'timestamp without time zone' end; -- type of bucket_start
+	bucket_sql := _pgf_internal_time_bucket_sql(bucket_width, quote_ident(linked_timestamp_column), with_time_zone);
+	window_start_sql := format('(%s - %L::interval)', _pgf_internal_time_bucket_sql(bucket_width, format('now()::%s', timestamp_type), with_time_zone),
+		window_width - bucket_width);
+	total_column := case when kind = 'window_count' then 'row_count' else 'value_sum' end;
+	value_sql := case when kind = 'window_count' then '0' else format('coalesce(%I, 0)', linked_value_column) end;
+
+	execute format('DROP TABLE IF EXISTS %I', bucket_table_name);
+	execute format($sql$
+		CREATE TABLE %I ( -- bucket_table_name
+			parent_id %s, -- fk type
+			bucket_start %s, -- timestamp_type
+			row_count bigint not null,
+			value_sum numeric not null,
+			primary key (parent_id, bucket_start)
+		)
+		$sql$,
+		bucket_table_name,
+		(select c.data_type from _pgf_internal_table_columns(ARRAY[linked_table_name]) c where c.column_name = linked_fk),
+		timestamp_type
+	);
+	execute format('CREATE INDEX %I ON %I (bucket_start)', bucket_table_name || '_bucket_start_idx', bucket_table_name);
+	execute format('DROP TABLE IF EXISTS %I', start_table_name);
+	execute format('CREATE TABLE %I (window_start %s not null)', start_table_name, timestamp_type);
+	execute format('insert into %I select %s', start_table_name, window_start_sql);
+
+	/* statement trigger function. The changes of the statement are aggregated by (parent, bucket), then applied to the
+	bucket table with a single upsert, and to the base table. Changes in buckets before the window start are ignored. */
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_%s_trgfun_%I() -- kind, id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			new_rows TEXT := case when TG_OP = 'DELETE' then 'select * from %I where false' else 'select * from pgf_new' end; -- linked_table_name
+			old_rows TEXT := case when TG_OP = 'INSERT' then 'select * from %I where false' else 'select * from pgf_old' end; -- linked_table_name
+			_pgf_window_start %s; -- timestamp_type
+		BEGIN
+			IF TG_OP = 'TRUNCATE' then
+				truncate %I; -- bucket_table_name
+				update %I set %I = 0; -- base_table_name, base_aggregate_column
+				RETURN NULL;
+			END IF;
+
+			-- the window start does not move until the end of the statement (see pgf_window_expire)
+			select window_start into _pgf_window_start from %I for share; -- start_table_name
+
+			execute format($sql$
+				with changes as (
+					select c.parent_id, c.bucket_start, sum(c.row_count) as row_count, sum(c.value_sum) as value_sum from (
+						select %I as parent_id, %s as bucket_start, 1 as row_count, %s as value_sum from (%%s) n where %s -- linked_fk, bucket, value, new_rows, row_filter
+						union all
+						select %I as parent_id, %s as bucket_start, -1 as row_count, -%s as value_sum from (%%s) o where %s -- linked_fk, bucket, value, old_rows, row_filter
+					) c
+					where c.bucket_start >= $1
+					group by c.parent_id, c.bucket_start
+					having sum(c.row_count) <> 0 or sum(c.value_sum) <> 0
+				), buckets as (
+					insert into %I as b (parent_id, bucket_start, row_count, value_sum) -- bucket_table_name
+					select parent_id, bucket_start, row_count, value_sum from changes
+					on conflict (parent_id, bucket_start) do update set row_count = b.row_count + excluded.row_count, value_sum = b.value_sum + excluded.value_sum
+				), deltas as (
+					select parent_id, sum(%I) as delta from changes group by parent_id -- total_column
+				)
+				update %I b set %I = b.%I + d.delta -- base_table_name, base_aggregate_column, base_aggregate_column
+				from deltas d
+				where b.%I = d.parent_id and d.delta <> 0 -- base_pk
+				$sql$, new_rows, old_rows) using _pgf_window_start;
+
+			/* buckets without rows are removed in a second statement: the upsert above is not visible to other parts
+			of its own statement */
+			IF TG_OP <> 'INSERT' then
+				delete from %I b -- bucket_table_name
+				using (select %I as parent_id, %s as bucket_start from pgf_old where %s) o -- linked_fk, bucket, row_filter
+				where b.parent_id = o.parent_id and b.bucket_start = o.bucket_start and b.row_count <= 0;
+			END IF;
+			RETURN NULL;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+		$fun$
+		, kind, id
+		, linked_table_name
+		, linked_table_name
+		, timestamp_type
+		, bucket_table_name
+		, base_table_name, base_aggregate_column
+		, start_table_name
+		-- the SQL fragments below are in a format() string: % is escaped
+		, linked_fk, replace(bucket_sql, '%', '%%'), value_sql, replace(row_filter, '%', '%%')
+		, linked_fk, replace(bucket_sql, '%', '%%'), value_sql, replace(row_filter, '%', '%%')
+		, bucket_table_name
+		, total_column
+		, base_table_name, base_aggregate_column, base_aggregate_column
+		, base_pk
+		, bucket_table_name
+		, linked_fk, bucket_sql, row_filter
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_%I -- kind, id
+		after insert ON %I -- linked_table_name
+		REFERENCING NEW TABLE AS pgf_new
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$, kind, id, linked_table_name, kind, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_update_%I -- kind, id
+		after update ON %I -- linked_table_name
+		REFERENCING OLD TABLE AS pgf_old NEW TABLE AS pgf_new
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$, kind, id, linked_table_name, kind, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_delete_%I -- kind, id
+		after delete ON %I -- linked_table_name
+		REFERENCING OLD TABLE AS pgf_old
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$, kind, id, linked_table_name, kind, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_truncate_%I -- kind, id
+		after truncate ON %I -- linked_table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$, kind, id, linked_table_name, kind, id
+	);
+
+	-- expiry: the buckets before the new window start are deleted and subtracted from their parent
+	execute format($proc2$
+		CREATE or replace PROCEDURE _pgf_internal_window_expire_%I() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc$
+			begin
+				update %I set window_start = %s where window_start < %s; -- start_table_name, window_start_sql, window_start_sql
+				if not found then
+					return;
+				end if;
+				with expired as (
+					delete from %I where bucket_start < (select window_start from %I) -- bucket_table_name, start_table_name
+					returning parent_id, %I as total -- total_column
+				), deltas as (
+					select parent_id, sum(total) as delta from expired group by parent_id
+				)
+				update %I b set %I = b.%I - d.delta -- base_table_name, base_aggregate_column, base_aggregate_column
+				from deltas d
+				where b.%I = d.parent_id and d.delta <> 0; -- base_pk
+			end;
+			$inner_proc$;
+		$proc2$
+		, id
+		, start_table_name, window_start_sql, window_start_sql
+		, bucket_table_name, start_table_name
+		, total_column
+		, base_table_name, base_aggregate_column, base_aggregate_column
+		, base_pk
+	);
+
+	execute format($proc2$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc$
+			begin
+				update %I set window_start = greatest(window_start, %s); -- start_table_name, window_start_sql
+				truncate %I; -- bucket_table_name
+				insert into %I (parent_id, bucket_start, row_count, value_sum) -- bucket_table_name
+				select * from (
+					select %I, %s as bucket_start, count(*), coalesce(sum(%s), 0) from %I -- linked_fk, bucket, value, linked_table_name
+					where %s -- row_filter
+					group by 1, 2
+				) t
+				where bucket_start >= (select window_start from %I); -- start_table_name
+
+				update %I b set %I = coalesce(d.total, 0) -- base_table_name, base_aggregate_column
+				from %I b2 -- base_table_name
+				left join (select parent_id, sum(%I) as total from %I group by parent_id) d on d.parent_id = b2.%I -- total_column, bucket_table_name, base_pk
+				where b2.%I = b.%I -- base_pk, base_pk
+				and b.%I is distinct from coalesce(d.total, 0); -- base_aggregate_column
+			end;
+			$inner_proc$;
+		$proc2$
+		, id
+		, start_table_name, window_start_sql
+		, bucket_table_name
+		, bucket_table_name
+		, linked_fk, bucket_sql, value_sql, linked_table_name
+		, row_filter
+		, start_table_name
+		, base_table_name, base_aggregate_column
+		, base_table_name
+		, total_column, bucket_table_name, base_pk
+		, base_pk, base_pk
+		, base_aggregate_column
+	);
+
+	call _pgf_internal_post_create(id);
+END;
+$proc$;
+
+-- Move the window of a WINDOW_COUNT or WINDOW_SUM formula to the current time (of all of them if id is NULL): the
+-- expired buckets are subtracted from the base column. Schedule it at each bucket, e.g. every hour with pg_cron.
+CREATE or replace PROCEDURE pgf_window_expire(id TEXT default NULL)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	fid TEXT;
+BEGIN
+	if id is not null and not exists (select 1 from pgf_metadata m where m.id = pgf_window_expire.id and m.kind in ('window_count', 'window_sum')) then
+		raise exception 'Formula % is not a WINDOW_COUNT or WINDOW_SUM formula', id;
+	end if;
+	for fid in
+		select m.id from pgf_metadata m
+		where m.kind in ('window_count', 'window_sum') and (pgf_window_expire.id is null or m.id = pgf_window_expire.id)
+		order by m.id
+	loop
+		execute format('call _pgf_internal_window_expire_%I()', fid);
+	end loop;
+END;
+$proc$;
+
+--------------------------------------------------------------------------------
+-- RUNNING_SUM, RANK
+--------------------------------------------------------------------------------
+-- RUNNING_SUM: maintain the running sum of a column over the rows of each partition of a table, in the order of a
+-- column (ties are ordered by primary key), like sum(value) over (partition by ... order by ...).
+-- RANK: maintain the position of each row within its partition, like row_number() or rank() over (partition by ...
+-- order by ...). A rank is the running count of the rows.
+-- The rows of a partition are divided into blocks of consecutive rows, stored in the table _pgf_internal_blocks_<id>
+-- with the total of each block and the total of the previous blocks (block_prefix). The target column stores the
+-- running sum within the block, and the view adds the block prefix: a change in the middle of a history updates the
+-- rows of one block and the blocks of the partition, instead of all the following rows. With blocks of about sqrt(n)
+-- rows, a change costs O(sqrt(n)).
+CREATE or replace PROCEDURE pgf_running_sum (
+	id TEXT,
+    table_name TEXT,
+    pk TEXT,
+    partition_column TEXT,
+    order_column TEXT,
+    value_column TEXT,
+    target_column TEXT,
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('running_sum', jsonb_build_object('table_name', table_name, 'target_column', target_column, 'options', options));
+
+	call _pgf_internal_insert_metadata(id, 'running_sum', jsonb_build_object(
+		'table_name', table_name,
+		'pk', pk,
+		'partition_column', partition_column,
+		'order_column', order_column,
+		'value_column', value_column,
+		'target_column', target_column,
+		'options', options
+	));
+	call _pgf_internal_create_block_formula('running_sum', id, table_name, pk, partition_column, order_column, value_column, target_column, options);
+
+	call _pgf_internal_post_create(id);
+END;
+$proc$;
+
+CREATE or replace PROCEDURE pgf_rank (
+	id TEXT,
+    table_name TEXT,
+    pk TEXT,
+    partition_column TEXT,
+    order_column TEXT,
+    target_column TEXT,
+	options JSONB default '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+BEGIN
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('rank', jsonb_build_object('table_name', table_name, 'target_column', target_column, 'options', options));
+	if options->>'rank_function' not in ('row_number', 'rank') then
+		raise exception 'Invalid value for option "rank_function": %. Allowed values: row_number, rank', options->>'rank_function';
+	end if;
+	if options->>'order_direction' not in ('asc', 'desc') then
+		raise exception 'Invalid value for option "order_direction": %. Allowed values: asc, desc', options->>'order_direction';
+	end if;
+
+	call _pgf_internal_insert_metadata(id, 'rank', jsonb_build_object(
+		'table_name', table_name,
+		'pk', pk,
+		'partition_column', partition_column,
+		'order_column', order_column,
+		'target_column', target_column,
+		'options', options
+	));
+	call _pgf_internal_create_block_formula('rank', id, table_name, pk, partition_column, order_column, NULL, target_column, options);
+
+	call _pgf_internal_post_create(id);
+END;
+$proc$;
+
+-- Create the blocks table, the triggers, the view and the refresh procedure of a RUNNING_SUM or RANK formula.
+-- value_column is NULL for a RANK formula (each row counts for 1); partition_column may be NULL (a single partition).
+-- With the rank function 'rank', the rows with the same order value share the rank of the first one: the rows at the
+-- start of a block with the same order value as the end of the previous block read the rank of their value from the
+-- block (tie_rank), computed from the last order value and the last rank of the blocks.
+CREATE or replace PROCEDURE _pgf_internal_create_block_formula (
+	kind TEXT,
+	id TEXT,
+    table_name TEXT,
+    pk TEXT,
+    partition_column TEXT,
+    order_column TEXT,
+    value_column TEXT,
+    target_column TEXT,
+	options JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	block_size int := (options->>'block_size')::int;
+	blocks_table_name TEXT := '_pgf_internal_blocks_' || id;
+	with_ties boolean := coalesce(options->>'rank_function', '') = 'rank';
+	descending boolean := coalesce(options->>'order_direction', '') = 'desc';
+	-- order of the rows, and row comparisons in this order
+	dir TEXT := case when descending then 'desc' else 'asc' end;
+	rdir TEXT := case when descending then 'asc' else 'desc' end;
+	lt TEXT := case when descending then '>' else '<' end;
+	le TEXT := case when descending then '>=' else '<=' end;
+	gt TEXT := case when descending then '<' else '>' end;
+	ge TEXT := case when descending then '<=' else '>=' end;
+	-- SQL fragments, from the table alias %s
+	partition_sql TEXT := case when partition_column is null then '0' else '%s.' || quote_ident(partition_column) end;
+	value_sql TEXT := case when value_column is null then '1' else 'coalesce(%s.' || quote_ident(value_column) || ', 0)' end;
+	not_null_sql TEXT; -- the row has a partition and an order value
+	-- SQL fragment: window function computing the target column of the rows o, k, v of a block, from the partition clause %s
+	running_sql TEXT := case when with_ties then format('rank() over (%%sorder by o %s)', dir)
+		else format('sum(v) over (%%sorder by o %s, k %s)', dir, dir) end;
+	key_type TEXT[]; -- types of partition_column, order_column, pk
+	changed_keys TEXT; -- SQL fragment: partition, order and pk of the changed rows, from the query %s
+	tie_ranks TEXT := ''; -- SQL statement: tie ranks of the blocks matching the condition %s
+BEGIN
+	if block_size < 1 then
+		raise exception 'Invalid value for option "block_size": %. The value must be positive', options->>'block_size';
+	end if;
+
+	select string_agg(format('%%1$s.%I is not null', c), ' and ') into not_null_sql
+	from unnest(ARRAY[partition_column, order_column]) c where c is not null;
+
+	select ARRAY[
+		coalesce((select c.data_type from _pgf_internal_table_columns(ARRAY[table_name]) c where c.column_name = partition_column), 'int'),
+		(select c.data_type from _pgf_internal_table_columns(ARRAY[table_name]) c where c.column_name = order_column),
+		(select c.data_type from _pgf_internal_table_columns(ARRAY[table_name]) c where c.column_name = pk)
+	] into key_type;
+
+	execute format('DROP TABLE IF EXISTS %I', blocks_table_name);
+	execute format($sql$
+		CREATE TABLE %I ( -- blocks_table_name
+			partition_value %s, -- partition type
+			start_order %s, -- order type
+			start_pk %s, -- pk type
+			block_total numeric not null,
+			block_prefix numeric not null,
+			row_count bigint not null,%s -- tie columns
+			primary key (partition_value, start_order, start_pk)
+		)
+		$sql$,
+		blocks_table_name, key_type[1], key_type[2], key_type[3],
+		case when with_ties then format(' last_order %s, last_rank bigint, tie_rank bigint,', key_type[2]) else '' end
+	);
+
+	if with_ties then
+		-- the rank of the start order value of a block: after the previous block if it ends with this value, else the
+		-- first row of the first block starting with this value
+		tie_ranks := format($sql$
+			update %I b set tie_rank = s.tie_rank -- blocks_table_name
+			from (
+				select b1.partition_value, b1.start_order, b1.start_pk, coalesce(
+					(select e.block_prefix + e.last_rank from (
+						select * from %I e -- blocks_table_name
+						where e.partition_value = b1.partition_value and e.start_order %s b1.start_order -- lt
+						order by e.start_order %s, e.start_pk %s limit 1 -- rdir, rdir
+					) e where e.last_order = b1.start_order),
+					(select e.block_prefix + 1 from %I e -- blocks_table_name
+					where e.partition_value = b1.partition_value and e.start_order = b1.start_order
+					order by e.start_order, e.start_pk %s limit 1) -- dir
+				) as tie_rank
+				from %I b1 -- blocks_table_name
+				where %%s
+			) s
+			where b.partition_value = s.partition_value and b.start_order = s.start_order and b.start_pk = s.start_pk
+			and b.tie_rank is distinct from s.tie_rank;
+			$sql$,
+			blocks_table_name,
+			blocks_table_name, lt,
+			rdir, rdir,
+			blocks_table_name,
+			dir,
+			blocks_table_name
+		);
+	end if;
+
+	/* Recompute the target column of the rows of a block, from its first row to the first row of the next block. A
+	block with more than 2 * block_size rows is split into blocks of block_size rows; an empty block is deleted. */
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_%s_block_%I(_pgf_partition %s, _pgf_start_order %s, _pgf_start_pk %s) -- kind, id, key types
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
+		DECLARE
+			next_block record;
+			end_key record;
+			new_block record;
+			block_row_count bigint;
+			block_formula_setting TEXT := current_setting('pg_formulas.block_formula', true);
+		BEGIN
+			select start_order, start_pk into next_block from %I -- blocks_table_name
+			where partition_value = _pgf_partition and (start_order, start_pk) %s (_pgf_start_order, _pgf_start_pk) -- gt
+			order by start_order %s, start_pk %s limit 1; -- dir, dir
+			-- the rows of the block are scanned up to the first row of the next block (excluded), or the last row of the
+			-- partition: a bounded index range scan
+			if next_block.start_order is null then
+				select t.%I as start_order, t.%I as start_pk into end_key from %I t -- order_column, pk, table_name
+				where %s = _pgf_partition and t.%I is not null -- partition_sql, order_column
+				order by t.%I %s, t.%I %s limit 1; -- order_column, rdir, pk, rdir
+			else
+				end_key := next_block;
+			end if;
+
+			-- the update of the target column must not fire the trigger of the formula again
+			perform set_config('pg_formulas.block_formula', %L, true); -- id
+			with block_rows as (
+				select k, o, v, %s as running_value -- running_sql
+				from (
+					select t.%I as k, t.%I as o, %s as v from %I t -- pk, order_column, value_sql, table_name
+					where %s = _pgf_partition and (t.%I, t.%I) %s (_pgf_start_order, _pgf_start_pk) -- partition_sql, order_column, pk, ge
+					and (t.%I, t.%I) %s (end_key.start_order, end_key.start_pk) and (t.%I, t.%I) is distinct from (next_block.start_order, next_block.start_pk) -- order_column, pk, le, order_column, pk
+					and t.%I %s _pgf_start_order and t.%I %s end_key.start_order -- order_column, ge, order_column, le (row estimate)
+				) r
+			), updated as (
+				update %I t set %I = r.running_value -- table_name, target_column
+				from block_rows r
+				where t.%I = r.k and t.%I is distinct from r.running_value -- pk, target_column
+			)
+			update %I set block_total = (select coalesce(sum(v), 0) from block_rows), row_count = (select count(*) from block_rows)%s -- blocks_table_name, tie columns
+			where partition_value = _pgf_partition and start_order = _pgf_start_order and start_pk = _pgf_start_pk
+			returning row_count into block_row_count;
+			perform set_config('pg_formulas.block_formula', coalesce(block_formula_setting, ''), true);
+
+			if block_row_count = 0 then
+				delete from %I where partition_value = _pgf_partition and start_order = _pgf_start_order and start_pk = _pgf_start_pk; -- blocks_table_name
+			elsif block_row_count > 2 * %s then -- block_size
+				for new_block in
+					select o as start_order, k as start_pk from (
+						select t.%I as o, t.%I as k, row_number() over (order by t.%I %s, t.%I %s) as rn -- order_column, pk, order_column, dir, pk, dir
+						from %I t -- table_name
+						where %s = _pgf_partition and (t.%I, t.%I) %s (_pgf_start_order, _pgf_start_pk) -- partition_sql, order_column, pk, ge
+						and (t.%I, t.%I) %s (end_key.start_order, end_key.start_pk) and (t.%I, t.%I) is distinct from (next_block.start_order, next_block.start_pk) -- order_column, pk, le, order_column, pk
+						and t.%I %s _pgf_start_order and t.%I %s end_key.start_order -- order_column, ge, order_column, le (row estimate)
+					) t
+					where rn > 1 and (rn - 1) %% %s = 0 -- block_size
+				loop
+					insert into %I (partition_value, start_order, start_pk, block_total, block_prefix, row_count) -- blocks_table_name
+					values (_pgf_partition, new_block.start_order, new_block.start_pk, 0, 0, 0);
+				end loop;
+				for new_block in
+					select start_order, start_pk from %I -- blocks_table_name
+					where partition_value = _pgf_partition and (start_order, start_pk) %s (_pgf_start_order, _pgf_start_pk) -- ge
+					and (next_block.start_order is null or (start_order, start_pk) %s (next_block.start_order, next_block.start_pk)) -- lt
+				loop
+					perform _pgf_internal_%s_block_%I(_pgf_partition, new_block.start_order, new_block.start_pk); -- kind, id
+				end loop;
+			end if;
+		END;
+		$inner_fun$
+		$fun$,
+		kind, id, key_type[1], key_type[2], key_type[3],
+		blocks_table_name,
+		gt,
+		dir, dir,
+		order_column, pk, table_name,
+		format(partition_sql, 't'), order_column,
+		order_column, rdir, pk, rdir,
+		id,
+		format(running_sql, ''),
+		pk, order_column, format(value_sql, 't'), table_name,
+		format(partition_sql, 't'), order_column, pk, ge,
+		order_column, pk, le, order_column, pk,
+		order_column, ge, order_column, le,
+		table_name, target_column,
+		pk, target_column,
+		blocks_table_name,
+		case when with_ties then format(', last_order = (select o from block_rows order by o %s, k %s limit 1), last_rank = (select max(running_value) from block_rows)', rdir, rdir) else '' end,
+		blocks_table_name,
+		block_size,
+		order_column, pk, order_column, dir, pk, dir,
+		table_name,
+		format(partition_sql, 't'), order_column, pk, ge,
+		order_column, pk, le, order_column, pk,
+		order_column, ge, order_column, le,
+		block_size,
+		blocks_table_name,
+		blocks_table_name,
+		ge,
+		lt,
+		kind, id
+	);
+
+	-- rows of the query %s whose partition, order, value or target column changed (a target column written by a user
+	-- is recomputed)
+	changed_keys := format($sql$
+		select %s as p, c.%I as o, c.%I as k from (%%s) c -- partition_sql, order_column, pk
+		where %s -- not_null_sql
+		and not exists (
+			select 1 from (%%s) c2 -- the other transition table
+			where c2.%I = c.%I and (%s) is not distinct from (%s) -- pk, pk, compared columns
+		)
+		$sql$,
+		format(partition_sql, 'c'), order_column, pk,
+		format(not_null_sql, 'c'),
+		pk, pk,
+		(select string_agg(format('c2.%I', col), ', ') from unnest(ARRAY[partition_column, order_column, value_column, target_column]) col where col is not null),
+		(select string_agg(format('c.%I', col), ', ') from unnest(ARRAY[partition_column, order_column, value_column, target_column]) col where col is not null)
+	);
+
+	/* statement trigger function:
+	1. a partition without block gets one, and the first block of a partition starts at its first row
+	2. the blocks holding changed rows are recomputed
+	3. the block prefixes (and tie ranks) of the changed partitions are recomputed */
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_%s_trgfun_%I() -- kind, id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			new_rows TEXT := case when TG_OP = 'DELETE' then 'select * from %I where false' else 'select * from pgf_new' end; -- table_name
+			old_rows TEXT := case when TG_OP = 'INSERT' then 'select * from %I where false' else 'select * from pgf_old' end; -- table_name
+			changed TEXT;
+			r record;
+			changed_partitions %s[]; -- partition type
+			null_keys %s[]; -- pk type
+		BEGIN
+			IF TG_OP = 'TRUNCATE' then
+				truncate %I; -- blocks_table_name
+				RETURN NULL;
+			END IF;
+			IF current_setting('pg_formulas.block_formula', true) = %L then -- id
+				RETURN NULL; -- update of the target column by this formula
+			END IF;
+			changed := format(%L, new_rows, old_rows) || ' union ' || format(%L, old_rows, new_rows); -- changed_keys, changed_keys
+
+			-- 1. first blocks
+			for r in execute format('select distinct on (p) p, o, k from (%%s) c order by p, o %s, k %s', format(%L, new_rows, old_rows)) loop -- dir, dir, changed_keys
+				update %I b set start_order = r.o, start_pk = r.k -- blocks_table_name
+				from (select start_order, start_pk from %I where partition_value = r.p order by start_order %s, start_pk %s limit 1) f -- blocks_table_name, dir, dir
+				where b.partition_value = r.p and b.start_order = f.start_order and b.start_pk = f.start_pk
+				and (f.start_order, f.start_pk) %s (r.o, r.k); -- gt
+				insert into %I (partition_value, start_order, start_pk, block_total, block_prefix, row_count) -- blocks_table_name
+				select r.p, r.o, r.k, 0, 0, 0
+				where not exists (select 1 from %I where partition_value = r.p); -- blocks_table_name
+			end loop;
+
+			-- 2. changed blocks
+			for r in execute format($sql$
+				select distinct b.partition_value, b.start_order, b.start_pk
+				from (%%s) c
+				cross join lateral (
+					select * from %I b -- blocks_table_name
+					where b.partition_value = c.p and (b.start_order, b.start_pk) %s (c.o, c.k) -- le
+					order by b.start_order %s, b.start_pk %s limit 1 -- rdir, rdir
+				) b
+				$sql$, changed)
+			loop
+				perform _pgf_internal_%s_block_%I(r.partition_value, r.start_order, r.start_pk); -- kind, id
+			end loop;
+
+			-- 3. block prefixes
+			execute format('select array_agg(distinct p) from (%%s) c', changed) into changed_partitions;
+			update %I b set block_prefix = s.block_prefix -- blocks_table_name
+			from (
+				select partition_value, start_order, start_pk,
+				coalesce(sum(block_total) over (partition by partition_value order by start_order %s, start_pk %s rows between unbounded preceding and 1 preceding), 0) as block_prefix -- dir, dir
+				from %I where partition_value = any(changed_partitions) -- blocks_table_name
+			) s
+			where b.partition_value = s.partition_value and b.start_order = s.start_order and b.start_pk = s.start_pk
+			and b.block_prefix <> s.block_prefix;
+			%s -- tie_ranks
+
+			-- rows without partition or order have no target value (an update of no row would still fire the statement
+			-- triggers of the table, e.g. of another formula on the same table)
+			IF TG_OP <> 'DELETE' then
+				execute format($sql$
+					select array_agg(n.%I) from (%%s) n where not (%s) and n.%I is not null -- pk, not_null_sql, target_column
+					$sql$, new_rows) into null_keys;
+				IF null_keys is not null then
+					perform set_config('pg_formulas.block_formula', %L, true); -- id
+					update %I set %I = NULL where %I = any(null_keys); -- table_name, target_column, pk
+					perform set_config('pg_formulas.block_formula', '', true);
+				END IF;
+			END IF;
+			RETURN NULL;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+		$fun$
+		, kind, id
+		, table_name
+		, table_name
+		, key_type[1]
+		, key_type[3]
+		, blocks_table_name
+		, id
+		, changed_keys, changed_keys
+		, dir, dir, changed_keys
+		, blocks_table_name
+		, blocks_table_name, dir, dir
+		, gt
+		, blocks_table_name
+		, blocks_table_name
+		, blocks_table_name, le
+		, rdir, rdir
+		, kind, id
+		, blocks_table_name
+		, dir, dir
+		, blocks_table_name
+		, format(tie_ranks, 'b1.partition_value = any(changed_partitions)')
+		, pk, replace(format(not_null_sql, 'n'), '%', '%%'), target_column
+		, id
+		, table_name, target_column, pk
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_%I -- kind, id
+		after insert ON %I -- table_name
+		REFERENCING NEW TABLE AS pgf_new
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$, kind, id, table_name, kind, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_update_%I -- kind, id
+		after update ON %I -- table_name
+		REFERENCING OLD TABLE AS pgf_old NEW TABLE AS pgf_new
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$, kind, id, table_name, kind, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_delete_%I -- kind, id
+		after delete ON %I -- table_name
+		REFERENCING OLD TABLE AS pgf_old
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$, kind, id, table_name, kind, id
+	);
+
+	execute format($trg$
+		CREATE TRIGGER _pgf_internal_%s_trg_truncate_%I -- kind, id
+		after truncate ON %I -- table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_%s_trgfun_%I(); -- kind, id
+		$trg$, kind, id, table_name, kind, id
+	);
+
+	-- the view: the table, with the full value in the target column
+	execute format('DROP VIEW IF EXISTS %I', options->>'view_name');
+	execute format($sql$
+		CREATE VIEW %I AS -- view_name
+		select %s -- columns
+		from %I t -- table_name
+		left join lateral (
+			select b.* from %I b -- blocks_table_name
+			where b.partition_value = %s and (b.start_order, b.start_pk) %s (t.%I, t.%I) -- partition_sql, le, order_column, pk
+			order by b.start_order %s, b.start_pk %s limit 1 -- rdir, rdir
+		) b on true
+		$sql$,
+		options->>'view_name',
+		(select string_agg(case when c.column_name <> target_column then format('t.%I', c.column_name)
+			when with_ties then format('case when t.%I = b.start_order then b.tie_rank else t.%I + b.block_prefix end::bigint as %I', order_column, c.column_name, c.column_name)
+			when kind = 'rank' then format('(t.%I + b.block_prefix)::bigint as %I', c.column_name, c.column_name)
+			else format('t.%I + b.block_prefix as %I', c.column_name, c.column_name) end, ', ' order by c.ordinal_position)
+		from _pgf_internal_table_columns(ARRAY[table_name]) c),
+		table_name,
+		blocks_table_name,
+		format(partition_sql, 't'), le, order_column, pk,
+		rdir, rdir
+	);
+
+	-- refresh: each partition is divided into blocks of block_size rows
+	execute format($proc2$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
+		LANGUAGE plpgsql
+		AS $inner_proc$
+			begin
+				truncate %I; -- blocks_table_name
+				-- the update of the target column must not fire the trigger of the formula
+				perform set_config('pg_formulas.block_formula', %L, true); -- id
+				with numbered_rows as (
+					select p, o, k, v, (row_number() over (partition by p order by o %s, k %s) - 1) / %s as block -- dir, dir, block_size
+					from (
+						select %s as p, t.%I as o, t.%I as k, %s as v from %I t -- partition_sql, order_column, pk, value_sql, table_name
+						where %s -- not_null_sql
+					) t
+				), block_rows as (
+					select p, o, k, block, %s as running_value, row_number() over w as rn, sum(v) over (partition by p, block) as block_total, count(*) over (partition by p, block) as row_count -- running_sql
+					from numbered_rows
+					window w as (partition by p, block order by o %s, k %s) -- dir, dir
+				), blocks as (
+					insert into %I (partition_value, start_order, start_pk, block_total, block_prefix, row_count%s) -- blocks_table_name, tie columns
+					select r.p, r.o, r.k, r.block_total, coalesce(sum(r.block_total) over (partition by r.p order by r.block rows between unbounded preceding and 1 preceding), 0), r.row_count%s -- tie values
+					from block_rows r%s -- tie join
+					where r.rn = 1
+				)
+				update %I t set %I = r.running_value -- table_name, target_column
+				from %I t2 -- table_name
+				left join block_rows r on r.k = t2.%I -- pk
+				where t2.%I = t.%I and t.%I is distinct from r.running_value; -- pk, pk, target_column
+				perform set_config('pg_formulas.block_formula', '', true);
+				%s -- tie_ranks
+			end;
+			$inner_proc$;
+		$proc2$
+		, id
+		, blocks_table_name
+		, id
+		, dir, dir, block_size
+		, format(partition_sql, 't'), order_column, pk, format(value_sql, 't'), table_name
+		, format(not_null_sql, 't')
+		, format(running_sql, 'partition by p, block ')
+		, dir, dir
+		, blocks_table_name, case when with_ties then ', last_order, last_rank' else '' end
+		, case when with_ties then ', e.last_order, e.last_rank' else '' end
+		, case when with_ties then format(' join (select distinct on (p, block) p, block, o as last_order, running_value as last_rank from block_rows order by p, block, o %s, k %s) e on e.p = r.p and e.block = r.block', rdir, rdir) else '' end
+		, table_name, target_column
+		, table_name
+		, pk
+		, pk, pk, target_column
+		, format(tie_ranks, 'true')
+	);
+END;
+$proc$;
+
+--------------------------------------------------------------------------------
+-- MINMAX_TABLE
+--------------------------------------------------------------------------------
+CREATE or replace PROCEDURE pgf_minmax_table (
+	id text,
+    table_name TEXT,
+	pk TEXT,
+    aggregate_column TEXT,
+	options JSONB DEFAULT '{}'::JSONB
+)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	group_by_column TEXT[];
+    agg_table TEXT;
+	str TEXT := ''; -- string buffer
+	c TEXT; -- loop index
+	i int; -- loop index
+	group_by_columns_joined TEXT; -- group by column names, joined with ','
+	group_by_columns_new_joined TEXT; -- group by column names where each name is prefixed with 'NEW.', joined with ','
+	where_condition_on_group_by TEXT := ''; -- SQL fragment : "grp1 = OLD.grp1 AND grp2 = OLD.grp2..."
+	where_condition_on_group_by_OLDNEW TEXT := ''; -- SQL fragment : "OLD.grp1 = NEW.grp1 AND OLD.grp2 = NEW.grp2..."
+	where_condition_on_group_by_qual TEXT := ''; -- SQL fragment : "grp1 = table_name.grp1 AND grp2 = table_name.grp2..."
+BEGIN
+
+	create table if not exists log(msg text);
+
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('minmax_table', jsonb_build_object('table_name', table_name, 'options', options));
+
+	call _pgf_internal_insert_metadata(id, 'minmax_table', jsonb_build_object(
+		'table_name', table_name,
+		'pk', pk,
+		'aggregate_column', aggregate_column,
+		'options', options
+	));
+	
+
+	group_by_column = _pgf_internal_jsonb_to_text_array(options->'group_by_column');
+	agg_table = options->>'agg_table';
+
+
+	group_by_columns_joined := _pgf_internal_join(group_by_column);
+	group_by_columns_new_joined := _pgf_internal_join(group_by_column, 'NEW.%s');
+	
+	-- init where condition SQL fragments
+	where_condition_on_group_by := _pgf_internal_join(group_by_column, '%s = OLD.%s', ' AND ');
+	where_condition_on_group_by_qual := _pgf_internal_join(group_by_column, '%s = ' || table_name || '.%s', ' AND ');
+	where_condition_on_group_by_OLDNEW := _pgf_internal_join(group_by_column, 'OLD.%s = NEW.%s', ' AND ');
+	
+	-- create aggregate table
+	execute format($tbl$
+		create table %I as
+		select %s, %I as min_value, %I as id_of_min, %I as max_value, %I as id_of_max, 0::bigint as row_count
+		from %I
+		limit 0;
+		$tbl$,
+		agg_table,
+		group_by_columns_joined,
+		aggregate_column, pk, aggregate_column, pk,
+		table_name
+	);
+
+	execute format($tbl$
+		alter table %I ADD CONSTRAINT %I_PK PRIMARY KEY (%s);
+		$tbl$,
+		agg_table,
+		agg_table,
+		group_by_columns_joined
+	);
+	call _pgf_internal_apply_storage(agg_table, options->'storage', group_by_column);
+
+	-- create main trigger
+	str := format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_minmax_table_trgfun_%I() --id
+		RETURNS TRIGGER AS $inner_trg$
+			DECLARE
+				id_of_min_val %I.%I%%TYPE; -- table_name, pk
+				id_of_max_val %I.%I%%TYPE; -- table_name, pk
+			BEGIN
+				IF TG_OP='INSERT' then
+			    	insert into %I(%s, min_value, id_of_min, max_value, id_of_max, row_count) --agg_table, group_by_columns_joined
+					values(%s, NEW.%I, NEW.%I, NEW.%I, NEW.%I, 1) --group_by_columns_new_joined, aggregate_column, pk, aggregate_column, pk
+					on conflict(%s) do update set -- group_by_columns_joined
+						min_value = least(%I.min_value, NEW.%I), --agg_table, aggregate_column
+						id_of_min=case when NEW.%I < %I.min_value then NEW.%I else %I.id_of_min END, --aggregate_column, agg_table, pk, agg_table
+						max_value=GREATEST(%I.max_value, NEW.%I), --agg_table, aggregate_column
+						id_of_max=case when  NEW.%I > %I.max_value then NEW.%I else %I.id_of_max END, --aggregate_column, agg_table, pk, agg_table
+						row_count=%I.row_count+1; -- agg_table
+				ELSIF TG_OP='DELETE' then
+					select id_of_min, id_of_max
+					into id_of_min_val, id_of_max_val
+					from %I --agg_table
+					where %s; -- where_condition_on_group_by
+
+					update %I set row_count=row_count-1 -- agg_table
+					where %s; -- where_condition_on_group_by
+
+					/* handle case when row_count goes down to zero -> row should be removed */
+					delete from %I -- agg_table
+					where row_count = 0
+					and %s; -- where_condition_on_group_by
+
+					if id_of_min_val = OLD.%I then -- pk
+						update %I set -- agg_table
+							min_value = (select min(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
+							id_of_min = (select %I from %I where %s order by %I asc limit 1) --pk, table_name, where_condition_on_group_by, aggregate_column
+						where %s; -- where_condition_on_group_by
+					end if;
+					if id_of_max_val = OLD.%I then -- pk
+						update %I set -- agg_table
+							max_value = (select max(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
+							id_of_max = (select %I from %I where %s order by %I desc limit 1) --pk, table_name, where_condition_on_group_by, aggregate_column
+						where %s; -- where_condition_on_group_by
+					end if;
+		$fun$
+        , id
+        , table_name, pk
+        , table_name, pk
+        , agg_table, group_by_columns_joined
+        , group_by_columns_new_joined, aggregate_column, pk, aggregate_column, pk
+        , group_by_columns_joined
+        , agg_table, aggregate_column
+        , aggregate_column, agg_table, pk, agg_table
+        , agg_table, aggregate_column
+        , aggregate_column, agg_table, pk, agg_table
+        , agg_table
+        , agg_table
+        , where_condition_on_group_by
+        , agg_table
+        , where_condition_on_group_by
+        , agg_table
+        , where_condition_on_group_by
+        , pk
+        , agg_table
+        , aggregate_column, table_name, where_condition_on_group_by
+        , pk, table_name, where_condition_on_group_by, aggregate_column
+        , where_condition_on_group_by
+        , pk
+        , agg_table
+        , aggregate_column, table_name, where_condition_on_group_by
+        , pk, table_name, where_condition_on_group_by, aggregate_column
+        , where_condition_on_group_by
+		) || format($fun$
+				ELSIF TG_OP = 'UPDATE' then
+					/* Only update if group by columns changed */
+					/* compare each group by column between OLD and NEW */
+					IF NOT (%s) THEN -- where_condition_on_group_by_OLDNEW
+						/* Decrement row_count and update min/max for OLD group */
+						select id_of_min, id_of_max
+						into id_of_min_val, id_of_max_val
+						from %I -- agg_table
+						where %s; -- where_condition_on_group_by
+
+						update %I set row_count=row_count-1 -- agg_table
+						where %s; -- where_condition_on_group_by
+
+						/* handle case when row_count goes down to zero -> row should be removed */
+						delete from %I -- agg_table
+						where row_count = 0
+						and %s; -- where_condition_on_group_by
+
+						if id_of_min_val = OLD.%I then -- pk
+							update %I set -- agg_table
+								min_value = (select min(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
+								id_of_min = (select %I from %I where %s order by %I asc limit 1) -- pk, table_name, where_condition_on_group_by, aggregate_column
+							where %s; -- where_condition_on_group_by
+						end if;
+						if id_of_max_val = OLD.%I then -- pk
+							update %I set -- agg_table
+								max_value = (select max(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
+								id_of_max = (select %I from %I where %s order by %I desc limit 1) -- pk, table_name, where_condition_on_group_by, aggregate_column
+							where %s; -- where_condition_on_group_by
+						end if;
+
+						/* Increment row_count and update min/max for NEW group */
+						insert into %I(%s, min_value, id_of_min, max_value, id_of_max, row_count) -- agg_table, group_by_columns_joined
+						values(%s, NEW.%I, NEW.%I, NEW.%I, NEW.%I, 1) -- group_by_columns_new_joined, aggregate_column, pk, aggregate_column, pk
+						on conflict(%s) do update set -- group_by_columns_joined
+							min_value = least(%I.min_value, NEW.%I), -- agg_table, aggregate_column
+							id_of_min=case when NEW.%I < %I.min_value then NEW.%I else %I.id_of_min END, -- aggregate_column, agg_table, pk, agg_table
+							max_value=GREATEST(%I.max_value, NEW.%I), -- agg_table, aggregate_column
+							id_of_max=case when  NEW.%I > %I.max_value then NEW.%I else %I.id_of_max END, -- aggregate_column, agg_table, pk, agg_table
+							row_count=%I.row_count+1; -- agg_table
+					/* If group by columns did not change, only update min/max if aggregate_column changed */
+					ELSIF OLD.%I <> NEW.%I THEN -- aggregate_column, aggregate_column
+						update %I set -- agg_table
+							min_value = (select min(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
+							id_of_min = (select %I from %I where %s order by %I asc limit 1), -- pk, table_name, where_condition_on_group_by, aggregate_column
+							max_value = (select max(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
+							id_of_max = (select %I from %I where %s order by %I desc limit 1) -- pk, table_name, where_condition_on_group_by, aggregate_column
+						where %s; -- where_condition_on_group_by
+					END IF;
+				END IF;
+				RETURN NEW;
+			END;
+			$inner_trg$ LANGUAGE plpgsql;
+		$fun$
+        , where_condition_on_group_by_OLDNEW
+        , agg_table
+        , where_condition_on_group_by
+        , agg_table
+        , where_condition_on_group_by
+        , agg_table
+        , where_condition_on_group_by
+        , pk
+        , agg_table
+        , aggregate_column, table_name, where_condition_on_group_by
+        , pk, table_name, where_condition_on_group_by, aggregate_column
+        , where_condition_on_group_by
+        , pk
+        , agg_table
+        , aggregate_column, table_name, where_condition_on_group_by
+        , pk, table_name, where_condition_on_group_by, aggregate_column
+        , where_condition_on_group_by
+        , agg_table, group_by_columns_joined
+        , group_by_columns_new_joined, aggregate_column, pk, aggregate_column, pk
+        , group_by_columns_joined
+        , agg_table, aggregate_column
+        , aggregate_column, agg_table, pk, agg_table
+        , agg_table, aggregate_column
+        , aggregate_column, agg_table, pk, agg_table
+        , agg_table
+        , aggregate_column, aggregate_column
+        , agg_table
+        , aggregate_column, table_name, where_condition_on_group_by
+        , pk, table_name, where_condition_on_group_by, aggregate_column
+        , aggregate_column, table_name, where_condition_on_group_by
+        , pk, table_name, where_condition_on_group_by, aggregate_column
+        , where_condition_on_group_by
 
-	execute format($inner_proc$
-		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
-		LANGUAGE plpgsql
-		AS $inner_proc2$
-			begin
-			    update %I set %I = sub.cpt -- base_table_name, base_aggregate_column
-				from (
-					select %I as id, sum(%I) as cpt -- linked_fk, linked_value_column
-					from %I -- linked_table_name
-					where %s -- row_filter
-					group by %I -- linked_fk
-				) as sub
-				where %I.%I = sub.id; -- base_table_name, base_pk
-			end;
-			$inner_proc2$;
-		$inner_proc$
-		, id -- function name
-		, base_table_name, base_aggregate_column
-		, linked_fk, linked_value_column
-		, linked_table_name
-		, row_filter
-		, linked_fk
-		, base_table_name, base_pk
 	);
+	execute str;
 
     execute format($trg$
-		CREATE TRIGGER _pgf_internal_sum_trg_%I -- id
-		after delete or insert or update ON %I -- linked_table_name
+		CREATE TRIGGER _pgf_internal_minmax_table_trg_%I
+		after delete or insert or update ON %I
 		FOR EACH ROW
-		execute procedure _pgf_internal_sum_trgfun_%I(); -- id
+		execute procedure _pgf_internal_minmax_table_trgfun_%I();
 		$trg$,
 		id,
-		linked_table_name,
+		quote_ident(table_name),
 		id
 	);
 
-    execute format($trg$
-		CREATE TRIGGER _pgf_internal_sum_trg_truncate_%I -- id
-		after truncate ON %I -- linked_table_name
-		FOR EACH STATEMENT
-		execute procedure _pgf_internal_sum_trgfun_%I(); -- id
-		$trg$,
-		id,
-		linked_table_name,
-		id
-	);
+	call _pgf_internal_create_minmax_agg(table_name, aggregate_column, pk);
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
+		LANGUAGE plpgsql
+		AS $body$
+			begin
+			    delete from %I; -- agg_table
 
-	call pgf_refresh(id);
+				/* single pass over the table, without sorting */
+				insert into %I(%s, min_value, id_of_min, max_value, id_of_max, row_count) -- agg_table, group_by_columns_joined
+				select %s, (agg).min_value, (agg).id_of_min, (agg).max_value, (agg).id_of_max, (agg).row_count -- group_by_columns_joined
+				from (
+					select %s, _pgf_internal_minmax_agg(%I, %I) as agg -- group_by_columns_joined, aggregate_column, pk
+					from %I -- table_name
+					group by %s -- group_by_columns_joined
+				) t;
+			end;
+			$body$;
+		$inner_proc$
+		, id
+		, agg_table
+		, agg_table, group_by_columns_joined
+		, group_by_columns_joined
+		, group_by_columns_joined, aggregate_column, pk
+		, table_name
+		, group_by_columns_joined
+	);
 
+	call _pgf_internal_post_create(id);
 END;
 $proc$;
 
 
 --------------------------------------------------------------------------------
--- MIN
+-- SUM_TABLE
 --------------------------------------------------------------------------------
-CREATE or replace PROCEDURE pgf_min (
-	id TEXT,
-    base_table_name TEXT,
-    base_pk TEXT,
-    base_aggregate_column TEXT,
-    linked_table_name TEXT,
-    linked_fk TEXT,
-	linked_value_column TEXT, -- column to be searched for min value
-	options JSONB default '{}'::JSONB
+-- SUM_TABLE: maintain, for each group of rows of a table, the row count, the sum and the statistical moments of a column.
+-- Instead of power sums, the table stores the sums of the powers of the deviations from the mean (m2, m3, m4), updated with
+-- the one-pass formulas of Welford and Pebay: they do not lose precision when the variance is small compared to the mean.
+-- Mean, variance and standard deviation (and optionally skewness and kurtosis) are generated columns.
+CREATE or replace PROCEDURE pgf_sum_table (
+	id text,
+    table_name TEXT,
+    aggregate_column TEXT,
+	options JSONB DEFAULT '{}'::JSONB
 )
 LANGUAGE plpgsql AS $proc$
 DECLARE
+	group_by_column TEXT[];
+	agg_table TEXT;
 	row_filter TEXT;
+	higher_moments boolean;
+	has_groups boolean;
+	group_columns_prefix TEXT; -- group by column names joined with ',', followed by ',' if not empty
+	group_values_prefix TEXT; -- group by column names prefixed with '_pgf_row.', joined with ',', followed by ',' if not empty
+	where_condition_on_group_by TEXT; -- SQL fragment : "grp1 = _pgf_row.grp1 AND grp2 = _pgf_row.grp2..."
+	group_by_clause TEXT; -- SQL fragment : "group by grp1, grp2..."
+	moment_columns TEXT; -- SQL fragment : "m2, m3, m4"
 BEGIN
 	-- set default values for optional arguments
-	options := jsonb_build_object(
-		'filter', 'true'
-	) || options;
-	row_filter := options->>'filter';
-	if row_filter is null or row_filter = '' then
-		row_filter := 'true';
-	end if;
+	options := _pgf_internal_default_options('sum_table', jsonb_build_object('table_name', table_name, 'options', options));
 
-	call _pgf_internal_insert_metadata(id, 'min', jsonb_build_object(
-		'base_table_name', base_table_name,
-		'base_pk', base_pk,
-		'base_aggregate_column', base_aggregate_column,
-		'linked_table_name', linked_table_name,
-		'linked_fk', linked_fk,
-		'linked_value_column', linked_value_column,
+	call _pgf_internal_insert_metadata(id, 'sum_table', jsonb_build_object(
+		'table_name', table_name,
+		'aggregate_column', aggregate_column,
 		'options', options
 	));
 
+	group_by_column := _pgf_internal_jsonb_to_text_array(options->'group_by_column');
+	agg_table := options->>'agg_table';
+	higher_moments := options->>'higher_moments';
+	row_filter := coalesce(nullif(options->>'filter', ''), 'true');
+	row_filter := format('(%s) and %I is not null', row_filter, aggregate_column); -- like the SUM and STDDEV aggregates, NULL values are ignored
+
+	has_groups := cardinality(group_by_column) > 0;
+	group_columns_prefix := case when has_groups then _pgf_internal_join(group_by_column) || ', ' else '' end;
+	group_values_prefix := _pgf_internal_join(group_by_column, '_pgf_row.%s, ', '');
+	where_condition_on_group_by := case when has_groups then _pgf_internal_join(group_by_column, '%s = _pgf_row.%s', ' AND ') else 'true' end;
+	group_by_clause := case when has_groups then 'group by ' || _pgf_internal_join(group_by_column) else '' end;
+	moment_columns := case when higher_moments then 'm2, m3, m4' else 'm2' end;
+
+	-- create aggregate table
+	execute format($tbl$
+		create table %I as
+		select %s 0::bigint as row_count, sum(%I) as sum_value, 0::double precision as m2 %s -- group_columns_prefix, aggregate_column, higher moments
+		from %I -- table_name
+		%s -- group_by_clause
+		limit 0;
+		$tbl$,
+		agg_table,
+		group_columns_prefix, aggregate_column, case when higher_moments then ', 0::double precision as m3, 0::double precision as m4' else '' end,
+		table_name,
+		group_by_clause
+	);
+	execute format($tbl$
+		alter table %I
+		add column mean double precision generated always as (sum_value::double precision / nullif(row_count, 0)) stored,
+		add column variance double precision generated always as (case when row_count > 1 then greatest(m2, 0) / (row_count - 1) end) stored,
+		add column stddev double precision generated always as (case when row_count > 1 then sqrt(greatest(m2, 0) / (row_count - 1)) end) stored
+		%s;
+		$tbl$,
+		agg_table,
+		case when higher_moments then ',
+		add column skewness double precision generated always as (case when m2 > 0 then sqrt(row_count::double precision) * m3 / power(m2, 1.5) end) stored,
+		add column kurtosis double precision generated always as (case when m2 > 0 then row_count * m4 / (m2 * m2) - 3 end) stored'
+		else '' end
+	);
+	if has_groups then
+		execute format('alter table %I ADD CONSTRAINT %I PRIMARY KEY (%s);', agg_table, agg_table || '_pk', _pgf_internal_join(group_by_column));
+	end if;
+	call _pgf_internal_apply_storage(agg_table, options->'storage', group_by_column);
+
+	/* add a value to its group. Adding x to a group of n rows: delta_n = (x - mean) / (n + 1), t = delta_n^2 (n + 1) n.
+	delta_n is computed as (x n - sum) / (n (n + 1)), in the type of the column: it is exact for integer and numeric columns.
+	m2 += t
+	m3 += t delta_n (n - 1) - 3 delta_n m2
+	m4 += t delta_n^2 ((n + 1)^2 - 3 (n + 1) + 3) + 6 delta_n^2 m2 - 4 delta_n m3 */
 	execute format($fun$
-		CREATE OR REPLACE FUNCTION _pgf_internal_min_trgfun_%I() -- id
-		RETURNS TRIGGER AS $inner_trg$
+		CREATE OR REPLACE FUNCTION _pgf_internal_sum_table_add_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
 		DECLARE
-			old_row_matches_filter boolean := true;
-			new_row_matches_filter boolean := true;
+			grp %I; -- agg_table
+			n bigint; -- row count after the update
+			delta_n double precision;
+			term double precision;
 		BEGIN
-			/* test if OLD row matches filter */
-			select case when count(*)=1 then true else false end into old_row_matches_filter from (
-				select * from (
-					select (OLD.*)
-				) t
-				where %s -- row_filter
-			) t2;
-
-			/* test if NEW row matches filter */
-			select case when count(*)=1 then true else false end into new_row_matches_filter from (
-				select * from (
-					select NEW.*
-				) t
-				where %s -- row_filter
-			) t2;
-
-			IF TG_OP='INSERT' and new_row_matches_filter then
-				update %I set %I=LEAST(%I, NEW.%I) where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-			ELSIF TG_OP='DELETE' and old_row_matches_filter then
-				update %I set %I=( -- base_table_name, base_aggregate_column
-					case when OLD.%I > %I then %I -- linked_value_column, base_aggregate_column, base_aggregate_column
-					else (select MIN(%I) from %I where %I=OLD.%I and (%s)) -- linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
-					end) 
-				where %I=OLD.%I; -- base_pk, linked_fk
-			ELSIF TG_OP='UPDATE' then
-				/* Case update : recompute the min for OLD row + for min row (if FK has changed) */
-				/* TODO : could be optimized further */
-				update %I set %I = ( -- base_table_name, base_aggregate_column
-					select MIN(%I) -- linked_value_column
-					from %I -- linked_table_name
-					WHERE %I = OLD.%I -- linked_fk, linked_fk
-					AND (%s) -- row_filter
-				)
-				where %I = OLD.%I; -- base_pk, linked_fk
-				
-				if OLD.%I <> NEW.%I then -- linked_fk, linked_fk
-					update %I set %I = ( -- base_table_name, base_aggregate_column
-						select MIN(%I) -- linked_value_column
-						from %I -- linked_table_name
-						WHERE %I = NEW.%I -- linked_fk, linked_fk
-						AND (%s) -- row_filter
-					)
-					where %I = NEW.%I; -- base_pk, linked_fk
-				end if;
-			ELSIF TG_OP='TRUNCATE' then
-				update %I set %I=NULL; -- base_table_name, base_aggregate_column
-			END IF;
-			RETURN NEW;
+			%s -- insert_group_fragment
+			select * into grp from %I where %s for update; -- agg_table, where_condition_on_group_by
+			n := grp.row_count + 1;
+			delta_n := (_pgf_row.%I * grp.row_count - grp.sum_value)::double precision / (greatest(grp.row_count, 1) * n); -- aggregate_column
+			term := delta_n * delta_n * n * grp.row_count;
+			update %I set -- agg_table
+				row_count = n,
+				sum_value = sum_value + _pgf_row.%I, -- aggregate_column
+				m2 = m2 + term
+				%s -- higher moments
+			where %s; -- where_condition_on_group_by
 		END;
-		$inner_trg$ LANGUAGE plpgsql;
-	$fun$
-        , id
-        , row_filter
-        , row_filter
-        , base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-        , base_table_name, base_aggregate_column
-        , linked_value_column, base_aggregate_column, base_aggregate_column
-        , linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
-        , base_pk, linked_fk
-        , base_table_name, base_aggregate_column
-        , linked_value_column
-        , linked_table_name
-        , linked_fk, linked_fk
-        , row_filter
-        , base_pk, linked_fk
-        , linked_fk, linked_fk
-        , base_table_name, base_aggregate_column
-        , linked_value_column
-        , linked_table_name
-        , linked_fk, linked_fk
-        , row_filter
-        , base_pk, linked_fk
-        , base_table_name, base_aggregate_column
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		agg_table,
+		case when has_groups then format($sql$
+			insert into %I (%s row_count, sum_value, %s) values (%s 1, _pgf_row.%I, %s) -- agg_table, group_columns_prefix, moment_columns, group_values_prefix, aggregate_column, zeros
+			on conflict (%s) do nothing; -- group by columns
+			if found then
+				return; -- new group
+			end if;
+			$sql$,
+			agg_table, group_columns_prefix, moment_columns, group_values_prefix, aggregate_column, case when higher_moments then '0, 0, 0' else '0' end,
+			_pgf_internal_join(group_by_column))
+		else '' end,
+		agg_table, where_condition_on_group_by,
+		aggregate_column,
+		agg_table,
+		aggregate_column,
+		case when higher_moments then ',
+				m3 = m3 + term * delta_n * (n - 2) - 3 * delta_n * m2,
+				m4 = m4 + term * delta_n * delta_n * (n * n - 3 * n + 3) + 6 * delta_n * delta_n * m2 - 4 * delta_n * m3' else '' end,
+		where_condition_on_group_by
+	);
 
+	/* remove a value from its group: inverse of the add formulas, where the deviation is taken from the mean of the remaining rows */
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_sum_table_remove_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
+		DECLARE
+			grp %I; -- agg_table
+			n bigint; -- row count after the update
+			delta_n double precision;
+			term double precision;
+			new_m2 double precision := 0;
+			new_m3 double precision := 0;
+			new_m4 double precision := 0;
+		BEGIN
+			select * into grp from %I where %s for update; -- agg_table, where_condition_on_group_by
+			if not found then
+				return;
+			end if;
+			n := grp.row_count - 1;
+			if n = 0 then
+				%s -- empty_group_fragment
+				return;
+			elsif n > 1 then -- the moments of a single row are 0
+				delta_n := (_pgf_row.%I * grp.row_count - grp.sum_value)::double precision / (grp.row_count * n); -- aggregate_column
+				term := delta_n * delta_n * grp.row_count * n;
+				new_m2 := grp.m2 - term;
+				%s -- higher moments
+			end if;
+			update %I set -- agg_table
+				row_count = n,
+				sum_value = sum_value - _pgf_row.%I, -- aggregate_column
+				m2 = new_m2
+				%s -- higher moments
+			where %s; -- where_condition_on_group_by
+		END;
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		agg_table,
+		agg_table, where_condition_on_group_by,
+		case when has_groups then format('delete from %I where %s; -- agg_table, where_condition_on_group_by', agg_table, where_condition_on_group_by)
+			else format('update %I set row_count = 0, sum_value = 0, %s; -- agg_table', agg_table, _pgf_internal_join(string_to_array(moment_columns, ', '), '%s = 0')) end,
+		aggregate_column,
+		case when higher_moments then '
+				new_m3 := grp.m3 - (term * delta_n * (grp.row_count - 2) - 3 * delta_n * new_m2);
+				new_m4 := grp.m4 - (term * delta_n * delta_n * (grp.row_count * grp.row_count - 3 * grp.row_count + 3) + 6 * delta_n * delta_n * new_m2 - 4 * delta_n * new_m3);'
+			else '' end,
+		agg_table,
+		aggregate_column,
+		case when higher_moments then ', m3 = new_m3, m4 = new_m4' else '' end,
+		where_condition_on_group_by
 	);
 
-	execute format($inner_proc$
-		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
-		LANGUAGE plpgsql
-		AS $inner_proc2$
-			begin
-			    update %I set %I = NULL; -- base_table_name, base_aggregate_column
-				update %I set %I = sub.cpt -- base_table_name, base_aggregate_column
-				from (
-					select %I as id, min(%I) as cpt -- linked_fk, linked_value_column
-					from %I -- linked_table_name
-					where %s -- row_filter
-					group by %I -- linked_fk
-				) as sub
-				where %I.%I = sub.id; -- base_table_name, base_pk
-			end;
-			$inner_proc2$;
-		$inner_proc$
-		, id -- function name
-		, base_table_name, base_aggregate_column
-		, base_table_name, base_aggregate_column
-		, linked_fk, linked_value_column
-		, linked_table_name
+	-- create main trigger
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_sum_table_trgfun_%I() -- id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			old_row_matches_filter boolean := false;
+			new_row_matches_filter boolean := false;
+		BEGIN
+			IF TG_OP = 'TRUNCATE' then
+				call _pgf_internal_refresh_%I(); -- id
+				RETURN NULL;
+			END IF;
+
+			/* test if OLD row matches filter */
+			IF TG_OP in ('UPDATE', 'DELETE') then
+				select count(*) = 1 into old_row_matches_filter from (select OLD.*) t where %s; -- row_filter
+			END IF;
+
+			/* test if NEW row matches filter */
+			IF TG_OP in ('UPDATE', 'INSERT') then
+				select count(*) = 1 into new_row_matches_filter from (select NEW.*) t where %s; -- row_filter
+			END IF;
+
+			IF TG_OP = 'UPDATE' and old_row_matches_filter = new_row_matches_filter
+				and (%s OLD.%I) is not distinct from (%s NEW.%I) then -- old_group_values_prefix, aggregate_column, new_group_values_prefix, aggregate_column
+				RETURN NULL; -- the aggregate has not changed
+			END IF;
+			IF old_row_matches_filter then
+				perform _pgf_internal_sum_table_remove_%I(OLD); -- id
+			END IF;
+			IF new_row_matches_filter then
+				perform _pgf_internal_sum_table_add_%I(NEW); -- id
+			END IF;
+			RETURN NULL;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+		$fun$
+		, id
+		, id
 		, row_filter
-		, linked_fk
-		, base_table_name, base_pk
+		, row_filter
+		, _pgf_internal_join(group_by_column, 'OLD.%s, ', ''), aggregate_column, _pgf_internal_join(group_by_column, 'NEW.%s, ', ''), aggregate_column
+		, id
+		, id
 	);
 
     execute format($trg$
-		CREATE TRIGGER _pgf_internal_min_trg_%I -- id
-		after delete or insert or update ON %I -- linked_table_name
+		CREATE TRIGGER _pgf_internal_sum_table_trg_%I -- id
+		after delete or insert or update ON %I -- table_name
 		FOR EACH ROW
-		execute procedure _pgf_internal_min_trgfun_%I(); -- id
+		execute procedure _pgf_internal_sum_table_trgfun_%I(); -- id
 		$trg$,
 		id,
-		linked_table_name,
+		table_name,
 		id
 	);
 
     execute format($trg$
-		CREATE TRIGGER _pgf_internal_min_trg_truncate_%I -- id
-		after truncate ON %I -- linked_table_name
+		CREATE TRIGGER _pgf_internal_sum_table_trg_truncate_%I -- id
+		after truncate ON %I -- table_name
 		FOR EACH STATEMENT
-		execute procedure _pgf_internal_min_trgfun_%I(); -- id
+		execute procedure _pgf_internal_sum_table_trgfun_%I(); -- id
 		$trg$,
 		id,
-		linked_table_name,
+		table_name,
 		id
 	);
 
-	call pgf_refresh(id);
+	/* full refresh. m2 is computed in a single pass by the (numerically stable) var_pop aggregate.
+	m3 and m4 are computed from the deviations to the mean of each group, given by a window aggregate. */
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
+		LANGUAGE plpgsql
+		AS $body$
+			begin
+			    delete from %I; -- agg_table
+				insert into %I (%s row_count, sum_value, %s) -- agg_table, group_columns_prefix, moment_columns
+				%s -- refresh_query
+			end;
+			$body$;
+		$inner_proc$
+		, id
+		, agg_table
+		, agg_table, group_columns_prefix, moment_columns
+		, case when not higher_moments then format($sql$
+				select %s count(*), %s, coalesce(var_pop(%I::double precision) * count(*), 0) -- group_columns_prefix, sum_value, aggregate_column
+				from %I -- table_name
+				where %s -- row_filter
+				%s; -- group_by_clause
+				$sql$,
+				group_columns_prefix, case when has_groups then format('sum(%I)', aggregate_column) else format('coalesce(sum(%I), 0)', aggregate_column) end, aggregate_column,
+				table_name,
+				row_filter,
+				group_by_clause)
+			else format($sql$
+				select %s count(*), %s, -- group_columns_prefix, sum_value
+					coalesce(sum(power(s.%I - s._pgf_mean, 2)), 0), coalesce(sum(power(s.%I - s._pgf_mean, 3)), 0), coalesce(sum(power(s.%I - s._pgf_mean, 4)), 0) -- aggregate_column x3
+				from (
+					select *, avg(%I::double precision) over (%s) as _pgf_mean -- aggregate_column, partition_clause
+					from %I -- table_name
+					where %s -- row_filter
+				) s
+				%s; -- group_by_clause
+				$sql$,
+				group_columns_prefix, case when has_groups then format('sum(%I)', aggregate_column) else format('coalesce(sum(%I), 0)', aggregate_column) end,
+				aggregate_column, aggregate_column, aggregate_column,
+				aggregate_column, case when has_groups then 'partition by ' || _pgf_internal_join(group_by_column) else '' end,
+				table_name,
+				row_filter,
+				group_by_clause)
+			end
+	);
 
+	call _pgf_internal_post_create(id);
 END;
 $proc$;
 
 
 --------------------------------------------------------------------------------
--- MAX
+-- COUNT_TABLE
 --------------------------------------------------------------------------------
-CREATE or replace PROCEDURE pgf_max (
-    id TEXT,
-    base_table_name TEXT,
-    base_pk TEXT,
-    base_aggregate_column TEXT,
-    linked_table_name TEXT,
-    linked_fk TEXT,
-    linked_value_column TEXT, -- column to be searched for max value
-    options JSONB default '{}'::JSONB
+-- COUNT_TABLE: maintain the row count of each group of rows of a table.
+-- With option multidimensional_aggregation ('rollup' or 'cube'), the table also holds the counts of the grouping sets of
+-- GROUP BY ROLLUP(...) or GROUP BY CUBE(...): the aggregated columns are NULL, and the column grouping_id identifies the
+-- grouping set, like the GROUPING() function. Each grouping set has its own partial unique index on its non-aggregated columns.
+CREATE or replace PROCEDURE pgf_count_table (
+	id text,
+    table_name TEXT,
+	options JSONB DEFAULT '{}'::JSONB
 )
 LANGUAGE plpgsql AS $proc$
 DECLARE
-    row_filter TEXT;
+	group_by_column TEXT[];
+	agg_table TEXT;
+	row_filter TEXT;
+	multidimensional_aggregation TEXT;
+	k int; -- number of group by columns
+	grouping_ids int[]; -- grouping sets, as GROUPING() bit masks: bit k - i is set if column i is aggregated
+	grouping_id int; -- loop variable
+	full_mask int; -- grouping set of the grand total
+	i int; -- loop index
+	non_aggregated_columns TEXT[]; -- group by columns which are not aggregated by the current grouping set
+	upserts TEXT[] := ARRAY[]::TEXT[]; -- SQL statements: add _pgf_row to the count of each grouping set
+	add_statement TEXT; -- SQL statement: add _pgf_row to the count of its grouping sets
+	remove_condition TEXT := ''; -- SQL fragment: the rows of the grouping sets of _pgf_row
+	kept_condition TEXT; -- SQL fragment: the rows which are not deleted when their count goes down to zero
+	group_columns_prefix TEXT; -- group by column names joined with ',', followed by ',' if not empty
+	key_columns TEXT; -- SQL fragment: key of the current grouping set, as in its unique index
 BEGIN
-    -- set default values for optional arguments
-    options := jsonb_build_object(
-        'filter', 'true'
-    ) || options;
-    row_filter := options->>'filter';
-    if row_filter is null or row_filter = '' then
-        row_filter := 'true';
-    end if;
+	-- set default values for optional arguments
+	options := _pgf_internal_default_options('count_table', jsonb_build_object('table_name', table_name, 'options', options));
+
+	group_by_column := coalesce(_pgf_internal_jsonb_to_text_array(options->'group_by_column'), ARRAY[]::TEXT[]);
+	agg_table := options->>'agg_table';
+	row_filter := coalesce(nullif(options->>'filter', ''), 'true');
+	multidimensional_aggregation := lower(options->>'multidimensional_aggregation');
+	k := cardinality(group_by_column);
+	if multidimensional_aggregation is not null and multidimensional_aggregation not in ('rollup', 'cube') then
+		raise exception 'Invalid value for option "multidimensional_aggregation": %. Allowed values are: rollup, cube', options->>'multidimensional_aggregation';
+	end if;
+	if multidimensional_aggregation is not null and k = 0 then
+		raise exception 'Option "multidimensional_aggregation" requires at least one group by column';
+	end if;
 
-    call _pgf_internal_insert_metadata(id, 'max', jsonb_build_object(
-        'base_table_name', base_table_name,
-        'base_pk', base_pk,
-        'base_aggregate_column', base_aggregate_column,
-        'linked_table_name', linked_table_name,
-        'linked_fk', linked_fk,
-        'linked_value_column', linked_value_column,
-        'options', options
-    ));
+	call _pgf_internal_insert_metadata(id, 'count_table', jsonb_build_object(
+		'table_name', table_name,
+		'options', options
+	));
 
-    execute format($fun$
-        CREATE OR REPLACE FUNCTION _pgf_internal_max_trgfun_%I() -- id
-        RETURNS TRIGGER AS $inner_trg$
-        DECLARE
-            old_row_matches_filter boolean := true;
-            new_row_matches_filter boolean := true;
-        BEGIN
-            /* test if OLD row matches filter */
-            select case when count(*)=1 then true else false end into old_row_matches_filter from (
-                select * from (
-                    select (OLD.*)
-                ) t
-                where %s -- row_filter
-            ) t2;
+	/* grouping sets. ROLLUP(c1, ..., ck) aggregates the last j columns, for j in 0..k. CUBE(c1, ..., ck) aggregates any subset. */
+	full_mask := (1 << k) - 1;
+	if multidimensional_aggregation = 'rollup' then
+		select array_agg((1 << j) - 1 order by j) into grouping_ids from generate_series(0, k) j;
+	elsif multidimensional_aggregation = 'cube' then
+		select array_agg(m order by m) into grouping_ids from generate_series(0, full_mask) m;
+	else
+		grouping_ids := ARRAY[0];
+	end if;
+	group_columns_prefix := case when k > 0 then _pgf_internal_join(group_by_column) || ', ' else '' end;
 
-            /* test if NEW row matches filter */
-            select case when count(*)=1 then true else false end into new_row_matches_filter from (
-                select * from (
-                    select NEW.*
-                ) t
-                where %s -- row_filter
-            ) t2;
+	-- create aggregate table
+	execute format($tbl$
+		create table %I as
+		select %s %s 0::bigint as row_count -- group_columns_prefix, grouping_id column
+		from %I -- table_name
+		limit 0;
+		$tbl$,
+		agg_table,
+		group_columns_prefix, case when multidimensional_aggregation is null then '' else '0 as grouping_id,' end,
+		table_name
+	);
 
-            IF TG_OP='INSERT' and new_row_matches_filter then
-                update %I set %I=GREATEST(%I, NEW.%I) where %I=NEW.%I; -- base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-            ELSIF TG_OP='DELETE' and old_row_matches_filter then
-                update %I set %I=( -- base_table_name, base_aggregate_column
-                    case when OLD.%I < %I then %I -- linked_value_column, base_aggregate_column, base_aggregate_column
-                    else (select MAX(%I) from %I where %I=OLD.%I and (%s)) -- linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
-                    end) 
-                where %I=OLD.%I; -- base_pk, linked_fk
-            ELSIF TG_OP='UPDATE' then
-                /* Case update : recompute the max for both OLD and NEW rows */
-                /* TODO : could be optimized further */
-                update %I set %I = ( -- base_table_name, base_aggregate_column
-                    select MAX(%I) -- linked_value_column
-                    from %I -- linked_table_name
-                    WHERE %I = OLD.%I -- linked_fk, linked_fk
-                    AND (%s) -- row_filter
-                )
-                where %I = OLD.%I; -- base_pk, linked_fk
-                
-				if OLD.%I <> NEW.%I then -- linked_fk, linked_fk
-                update %I set %I = ( -- base_table_name, base_aggregate_column
-                    select MAX(%I) -- linked_value_column
-                    from %I -- linked_table_name
-                    WHERE %I = NEW.%I -- linked_fk, linked_fk
-                    AND (%s) -- row_filter
-                )
-					where %I = NEW.%I; -- base_pk, linked_fk
-				end if;
-            ELSIF TG_OP='TRUNCATE' then
-                update %I set %I=NULL; -- base_table_name, base_aggregate_column
-            END IF;
-            RETURN NEW;
-        END;
-        $inner_trg$ LANGUAGE plpgsql;
-    $fun$
-        , id
-        , row_filter
-        , row_filter
-        , base_table_name, base_aggregate_column, base_aggregate_column, linked_value_column, base_pk, linked_fk
-        , base_table_name, base_aggregate_column
-        , linked_value_column, base_aggregate_column, base_aggregate_column
-        , linked_value_column, linked_table_name, linked_fk, linked_fk, row_filter
-        , base_pk, linked_fk
-        , base_table_name, base_aggregate_column
-        , linked_value_column
-        , linked_table_name
-        , linked_fk, linked_fk
-        , row_filter
-        , base_pk, linked_fk
-        , linked_fk, linked_fk
-        , base_table_name, base_aggregate_column
-        , linked_value_column
-        , linked_table_name
-        , linked_fk, linked_fk
-        , row_filter
-        , base_pk, linked_fk
-        , base_table_name, base_aggregate_column
-    );
+	if multidimensional_aggregation is null and k > 0 then
+		execute format('alter table %I ADD CONSTRAINT %I PRIMARY KEY (%s);', agg_table, agg_table || '_pk', _pgf_internal_join(group_by_column));
+	end if;
 
-    execute format($inner_proc$
-        CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
-        LANGUAGE plpgsql
-        AS $inner_proc2$
-            begin
-                update %I set %I = NULL; -- base_table_name, base_aggregate_column
-                update %I set %I = sub.cpt -- base_table_name, base_aggregate_column
-                from (
-                    select %I as id, max(%I) as cpt -- linked_fk, linked_value_column
-                    from %I -- linked_table_name
-                    where %s -- row_filter
-                    group by %I -- linked_fk
-                ) as sub
-                where %I.%I = sub.id; -- base_table_name, base_pk
-            end;
-            $inner_proc2$;
-        $inner_proc$
-        , id -- function name
-        , base_table_name, base_aggregate_column
-        , base_table_name, base_aggregate_column
-        , linked_fk, linked_value_column
-        , linked_table_name
-        , row_filter
-        , linked_fk
-        , base_table_name, base_pk
-    );
+	/* add statement: one upsert per grouping set, chained as CTEs in a single statement.
+	remove condition: one disjunct per grouping set, each matching a partial unique index.
+	With ROLLUP or CUBE, the group by columns are indexed and compared as one-element arrays (array[c]): like GROUP BY,
+	NULL values then belong to the same group (NULLS NOT DISTINCT requires PostgreSQL 15). */
+	foreach grouping_id in array grouping_ids loop
+		non_aggregated_columns := ARRAY[]::TEXT[];
+		for i in 1..k loop
+			if grouping_id & (1 << (k - i)) = 0 then
+				non_aggregated_columns := non_aggregated_columns || group_by_column[i];
+			end if;
+		end loop;
+
+		if multidimensional_aggregation is not null then
+			key_columns := coalesce(nullif(_pgf_internal_join(non_aggregated_columns, '(array[%s])'), ''), '(true)');
+			execute format('create unique index %I on %I (%s) where grouping_id = %s', agg_table || '_gs' || grouping_id, agg_table,
+				key_columns, grouping_id);
+		else
+			key_columns := coalesce(nullif(_pgf_internal_join(non_aggregated_columns), ''), '(true)');
+		end if;
+
+		upserts := upserts || format('insert into %I as t (%s %s row_count) values (%s %s 1) on conflict (%s) %s do update set row_count = t.row_count + 1',
+			agg_table,
+			group_columns_prefix, case when multidimensional_aggregation is null then '' else 'grouping_id,' end,
+			(select string_agg(case when c = any(non_aggregated_columns) then '_pgf_row.' || quote_ident(c) else 'NULL' end || ', ', '' order by o)
+				from unnest(group_by_column) with ordinality u(c, o)),
+			case when multidimensional_aggregation is null then '' else grouping_id || ',' end,
+			key_columns,
+			case when multidimensional_aggregation is null then '' else 'where grouping_id = ' || grouping_id end);
+		remove_condition := remove_condition || case when remove_condition = '' then '' else ' or ' end || format('(%s)',
+			concat_ws(' and ',
+				case when multidimensional_aggregation is null then NULL else 'grouping_id = ' || grouping_id end,
+				nullif(_pgf_internal_join(non_aggregated_columns,
+					case when multidimensional_aggregation is null then '%s = _pgf_row.%s' else 'array[%s] = array[_pgf_row.%s]' end, ' and '), '')
+			));
+	end loop;
+	remove_condition := coalesce(nullif(remove_condition, '()'), 'true');
+	if k = 0 then
+		-- single row, holding the count of the whole table
+		add_statement := format('update %I set row_count = row_count + 1', agg_table);
+	elsif cardinality(upserts) = 1 then
+		add_statement := upserts[1];
+	else
+		select 'with ' || string_agg(format('s%s as (%s)', o, u), E',\n\t\t\t' order by o) || E'\n\t\t\t' || upserts[cardinality(upserts)] into add_statement
+		from unnest(upserts[1:cardinality(upserts) - 1]) with ordinality t(u, o);
+	end if;
+	kept_condition := case when multidimensional_aggregation is not null then 'grouping_id = ' || full_mask when k = 0 then 'true' else 'false' end;
+
+	call _pgf_internal_apply_storage(agg_table, options->'storage', case when multidimensional_aggregation is null then group_by_column end);
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_count_table_add_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
+		BEGIN
+			%s; -- add_statement
+		END;
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		add_statement
+	);
+
+	/* rows going down to zero are deleted, except the grand total (like GROUP BY ROLLUP and CUBE, which always return it) */
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_count_table_remove_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
+		BEGIN
+			with deleted as (
+				delete from %I where row_count = 1 and not (%s) and (%s) -- agg_table, kept_condition, remove_condition
+			)
+			update %I set row_count = row_count - 1 where (row_count > 1 or %s) and (%s); -- agg_table, kept_condition, remove_condition
+		END;
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		agg_table, kept_condition, remove_condition,
+		agg_table, kept_condition, remove_condition
+	);
+
+	-- create main trigger
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_count_table_trgfun_%I() -- id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			old_row_matches_filter boolean := false;
+			new_row_matches_filter boolean := false;
+		BEGIN
+			IF TG_OP = 'TRUNCATE' then
+				call _pgf_internal_refresh_%I(); -- id
+				RETURN NULL;
+			END IF;
+
+			/* test if OLD row matches filter */
+			IF TG_OP in ('UPDATE', 'DELETE') then
+				select count(*) = 1 into old_row_matches_filter from (select OLD.*) t where %s; -- row_filter
+			END IF;
+
+			/* test if NEW row matches filter */
+			IF TG_OP in ('UPDATE', 'INSERT') then
+				select count(*) = 1 into new_row_matches_filter from (select NEW.*) t where %s; -- row_filter
+			END IF;
+
+			IF TG_OP = 'UPDATE' and old_row_matches_filter = new_row_matches_filter
+				and (%s true) is not distinct from (%s true) then -- old_group_values_prefix, new_group_values_prefix
+				RETURN NULL; -- the counts have not changed
+			END IF;
+			IF old_row_matches_filter then
+				perform _pgf_internal_count_table_remove_%I(OLD); -- id
+			END IF;
+			IF new_row_matches_filter then
+				perform _pgf_internal_count_table_add_%I(NEW); -- id
+			END IF;
+			RETURN NULL;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+		$fun$
+		, id
+		, id
+		, row_filter
+		, row_filter
+		, _pgf_internal_join(group_by_column, 'OLD.%s, ', ''), _pgf_internal_join(group_by_column, 'NEW.%s, ', '')
+		, id
+		, id
+	);
 
     execute format($trg$
-        CREATE TRIGGER _pgf_internal_max_trg_%I -- id
-        after delete or insert or update ON %I -- linked_table_name
-        FOR EACH ROW
-        execute procedure _pgf_internal_max_trgfun_%I(); -- id
-        $trg$,
-        id,
-        linked_table_name,
-        id
-    );
+		CREATE TRIGGER _pgf_internal_count_table_trg_%I -- id
+		after delete or insert or update ON %I -- table_name
+		FOR EACH ROW
+		execute procedure _pgf_internal_count_table_trgfun_%I(); -- id
+		$trg$,
+		id,
+		table_name,
+		id
+	);
 
     execute format($trg$
-        CREATE TRIGGER _pgf_internal_max_trg_truncate_%I -- id
-        after truncate ON %I -- linked_table_name
-        FOR EACH STATEMENT
-        execute procedure _pgf_internal_max_trgfun_%I(); -- id
-        $trg$,
-        id,
-        linked_table_name,
-        id
-    );
+		CREATE TRIGGER _pgf_internal_count_table_trg_truncate_%I -- id
+		after truncate ON %I -- table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_count_table_trgfun_%I(); -- id
+		$trg$,
+		id,
+		table_name,
+		id
+	);
 
-    call pgf_refresh(id);
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
+		LANGUAGE plpgsql
+		AS $body$
+			begin
+			    delete from %I; -- agg_table
+				insert into %I (%s %s row_count) -- agg_table, group_columns_prefix, grouping_id column
+				select %s %s count(*) -- group_columns_prefix, grouping_id expression
+				from %I -- table_name
+				where %s -- row_filter
+				%s; -- group_by_clause
+			end;
+			$body$;
+		$inner_proc$
+		, id
+		, agg_table
+		, agg_table, group_columns_prefix, case when multidimensional_aggregation is null then '' else 'grouping_id,' end
+		, group_columns_prefix, case when multidimensional_aggregation is null then '' else format('grouping(%s),', _pgf_internal_join(group_by_column)) end
+		, table_name
+		, row_filter
+		, case when k = 0 then ''
+			when multidimensional_aggregation is null then 'group by ' || _pgf_internal_join(group_by_column)
+			else format('group by %s(%s)', multidimensional_aggregation, _pgf_internal_join(group_by_column)) end
+	);
 
+	call _pgf_internal_post_create(id);
 END;
 $proc$;
 
 
 --------------------------------------------------------------------------------
--- ID_OF_MIN
+-- TOPN_TABLE
 --------------------------------------------------------------------------------
-CREATE or replace PROCEDURE pgf_id_of_min (
-	id TEXT,
-    base_table_name TEXT,
-    base_pk TEXT,
-    base_aggregate_column TEXT, -- column holding the 'id of min' value
-    linked_table_name TEXT,
-	linked_pk TEXT,
-    linked_fk TEXT,
-	linked_value_column TEXT, -- column to be searched for min value
-	options JSONB default '{}'::JSONB
+-- TOPN_TABLE: maintain the N best rows of each group of a table, in a dedicated table.
+-- Each group also keeps a buffer of the next best rows (table _pgf_internal_topn_buffer_<id>), which refills the top N rows
+-- when one of them is deleted. The group is re-read from the source table only when its buffer is exhausted.
+-- The number of rows of each group, in the source table, in the top N and in the buffer are kept in the table
+-- _pgf_internal_topn_group_<id>.
+CREATE or replace PROCEDURE pgf_topn_table (
+	id text,
+    table_name TEXT,
+	pk TEXT,
+    sort_column TEXT,
+	options JSONB DEFAULT '{}'::JSONB
 )
 LANGUAGE plpgsql AS $proc$
 DECLARE
+	group_by_column TEXT[];
+	topn_table TEXT;
+	buffer_table TEXT := '_pgf_internal_topn_buffer_' || id;
+	group_table TEXT := '_pgf_internal_topn_group_' || id;
+	n int;
+	buffer_size int;
+	direction TEXT;
 	row_filter TEXT;
+	has_groups boolean;
+	best_order TEXT; -- SQL fragment : "sort_column desc, pk": best rows first
+	worst_order TEXT; -- SQL fragment : "sort_column asc, pk desc": worst rows first
+	better_pattern TEXT; -- format pattern, true if row (%1$s = sort, %2$s = pk) comes before row (%3$s = sort, %4$s = pk)
+	group_columns_prefix TEXT; -- group by column names joined with ',', followed by ',' if not empty
+	key_columns TEXT; -- key of the group table: group by column names joined with ',', or _pgf_all_rows if there are none
+	partition_clause TEXT; -- SQL fragment : "partition by grp1, grp2..."
+	where_condition_on_group_by TEXT; -- SQL fragment : "grp1 = _pgf_row.grp1 AND grp2 = _pgf_row.grp2..."
 BEGIN
 	-- set default values for optional arguments
-	options := jsonb_build_object(
-		'filter', 'true'
-	) || options;
-	row_filter := options->>'filter';
-	if row_filter is null or row_filter = '' then
-		row_filter := 'true';
+	options := _pgf_internal_default_options('topn_table', jsonb_build_object('table_name', table_name, 'options', options));
+
+	group_by_column := _pgf_internal_jsonb_to_text_array(options->'group_by_column');
+	topn_table := options->>'topn_table';
+	n := options->>'n';
+	buffer_size := options->>'buffer_size';
+	direction := lower(options->>'direction');
+	row_filter := coalesce(nullif(options->>'filter', ''), 'true');
+	if n is null or n <= 0 then
+		raise exception 'Invalid value for option "n": %. Expected a positive integer', options->>'n';
+	end if;
+	if buffer_size is null or buffer_size < 0 then
+		raise exception 'Invalid value for option "buffer_size": %. Expected a non-negative integer', options->>'buffer_size';
+	end if;
+	if direction is null or direction not in ('asc', 'desc') then
+		raise exception 'Invalid value for option "direction": %. Allowed values are: asc, desc', options->>'direction';
 	end if;
 
-	call _pgf_internal_insert_metadata(id, 'id_of_min', jsonb_build_object(
-		'base_table_name', base_table_name,
-		'base_pk', base_pk,
-		'base_aggregate_column', base_aggregate_column,
-		'linked_table_name', linked_table_name,
-		'linked_pk', linked_pk,
-		'linked_fk', linked_fk,
-		'linked_value_column', linked_value_column,
+	call _pgf_internal_insert_metadata(id, 'topn_table', jsonb_build_object(
+		'table_name', table_name,
+		'pk', pk,
+		'sort_column', sort_column,
 		'options', options
 	));
 
-	/* function to update the id of min of a single row identified by its PK given in parameter _pgf_id.*/
-	execute format($proc2$
-		CREATE OR REPLACE PROCEDURE _pgf_internal_refresh_single_%I(_pgf_id %I.%I%%TYPE) -- id, linked_table_name, linked_pk
-		LANGUAGE plpgsql AS $inner_proc2$
-		BEGIN
-			update %I set %I = ( -- base_table_name, base_aggregate_column
-				select %I -- linked_pk
-				from %I -- linked_table_name
-				where %I = _pgf_id -- linked_fk
-				and (%s) -- row_filter
-				order by %I ASC -- linked_value_column
-				limit 1
-			) where %I = _pgf_id; -- base_pk
-		END;
-		$inner_proc2$
-	$proc2$
-	, id, linked_table_name, linked_pk
-	, base_table_name, base_aggregate_column
-	, linked_pk
-	, linked_table_name
-	, linked_fk
-	, row_filter
-	, linked_value_column
-	, base_pk
+	/* rows are ranked by sort_column, then by pk. Rows with a NULL sort_column are ignored. */
+	row_filter := format('(%s) and %I is not null', row_filter, sort_column);
+	best_order := format('%I %s, %I', sort_column, direction, pk);
+	worst_order := format('%I %s, %I desc', sort_column, case when direction = 'desc' then 'asc' else 'desc' end, pk);
+	better_pattern := case when direction = 'desc' then '((%1$s, %4$s) > (%3$s, %2$s))' else '((%1$s, %2$s) < (%3$s, %4$s))' end;
+
+	has_groups := cardinality(group_by_column) > 0;
+	group_columns_prefix := case when has_groups then _pgf_internal_join(group_by_column) || ', ' else '' end;
+	key_columns := case when has_groups then _pgf_internal_join(group_by_column) else '_pgf_all_rows' end;
+	partition_clause := case when has_groups then 'partition by ' || _pgf_internal_join(group_by_column) else '' end;
+	where_condition_on_group_by := case when has_groups then _pgf_internal_join(group_by_column, '%s = _pgf_row.%s', ' AND ') else 'true' end;
+
+	-- create the top N table and the buffer table
+	execute format($tbl$
+		create table %I as
+		select %s %I, %I -- group_columns_prefix, pk, sort_column
+		from %I
+		limit 0;
+		$tbl$,
+		topn_table,
+		group_columns_prefix, pk, sort_column,
+		table_name
+	);
+	execute format('alter table %I ADD CONSTRAINT %I PRIMARY KEY (%s %I);', topn_table, topn_table || '_pk', group_columns_prefix, pk);
+	execute format('create index on %I (%s %s)', topn_table, group_columns_prefix, best_order);
+
+	execute format('DROP TABLE IF EXISTS %I', buffer_table);
+	execute format('create table %I (like %I including all)', buffer_table, topn_table);
+	call _pgf_internal_apply_storage(topn_table, options->'storage', group_by_column);
+
+	-- create the group table
+	execute format('DROP TABLE IF EXISTS %I', group_table);
+	execute format($tbl$
+		create table %I as
+		select %s, 0::bigint as row_count, 0 as top_count, 0 as buffer_count, false as stale -- key_columns
+		from %I
+		limit 0;
+		$tbl$,
+		group_table,
+		case when has_groups then _pgf_internal_join(group_by_column) else 'true as _pgf_all_rows' end,
+		table_name
 	);
+	execute format('alter table %I ADD PRIMARY KEY (%s), alter column stale set default false, alter column stale set not null;', group_table, key_columns);
+	execute format('create index on %I (%s) where stale', group_table, key_columns);
 
+	/* add a row of the source table. The row goes into the top N rows, then into the buffer, if it is better than their worst row.
+	A row pushed out of the top N goes into the buffer, a row pushed out of the buffer is only counted. */
 	execute format($fun$
-		CREATE OR REPLACE FUNCTION _pgf_internal_id_of_min_trgfun_%I() -- id
-		RETURNS TRIGGER AS $inner_trg$
+		CREATE OR REPLACE FUNCTION _pgf_internal_topn_table_add_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
 		DECLARE
-			old_row_matches_filter boolean := true;
-			new_row_matches_filter boolean := true;
-			current_id_of_min %I.%I%%TYPE; -- linked_table_name, linked_pk
-			current_min %I.%I%%TYPE; -- linked_table_name, linked_value_column
+			grp %I; -- group_table
+			worst_pk %I.%I%%TYPE; -- table_name, pk
+			worst_sort %I.%I%%TYPE; -- table_name, sort_column
 		BEGIN
-			/* test if OLD row matches filter */
-			select case when count(*)=1 then true else false end into old_row_matches_filter from (
-				select * from (
-					select (OLD.*)
-				) t
-				where %s -- row_filter
-			) t2;
-
-			/* test if NEW row matches filter */
-			select case when count(*)=1 then true else false end into new_row_matches_filter from (
-				select * from (
-					select NEW.*
-				) t
-				where %s -- row_filter
-			) t2;
+			insert into %I as t (%s, row_count, top_count, buffer_count) values (%s, 1, 0, 0) -- group_table, key_columns, key_values
+			on conflict (%s) do update set row_count = t.row_count + 1 -- key_columns
+			returning * into grp;
+			if grp.stale then
+				return; -- the group is refilled at the end of the statement
+			end if;
 
-			IF TG_OP='INSERT' and new_row_matches_filter then
-				select %I into current_min -- linked_value_column
-				from %I -- linked_table_name
-				where %I = (select %I from %I where %I = NEW.%I); -- linked_pk, base_aggregate_column, base_table_name, base_pk, linked_fk
+			if grp.top_count < %s then -- n
+				insert into %I (%s %I, %I) values (%s _pgf_row.%I, _pgf_row.%I); -- topn_table, group_columns_prefix, pk, sort_column, group_values_prefix, pk, sort_column
+				update %I set top_count = top_count + 1 where %s; -- group_table, where_condition_on_group_by
+				return;
+			end if;
 
-				if current_min is null or NEW.%I < current_min then -- linked_value_column
-					update %I -- base_table_name
-					set %I=NEW.%I -- base_aggregate_column, linked_pk
-					where %I=NEW.%I; -- base_pk, linked_fk
-				end if;
-			ELSIF TG_OP='DELETE' and old_row_matches_filter then
-				select %I into current_id_of_min from %I where %I = OLD.%I; -- base_aggregate_column, base_table_name, base_pk, linked_fk
-				if current_id_of_min = OLD.%I then -- linked_pk
-					call _pgf_internal_refresh_single_%I(OLD.%I); -- id, linked_fk
-				end if;
-			ELSIF TG_OP='UPDATE' then
-				if OLD.%I <> NEW.%I then -- linked_fk, linked_fk
-					/* case : FK changes */
-					select %I into current_id_of_min from %I where %I = OLD.%I; -- base_aggregate_column, base_table_name, base_pk, linked_fk
-					if current_id_of_min = OLD.%I then -- linked_pk
-						/* update id_of_min if current id_of_min = current id AND (FK has changed OR linked_value_column has decreased) */
-						/* full recompute on OLD FK */
-						call _pgf_internal_refresh_single_%I(OLD.%I); -- id, linked_fk
+			select %I, %I into worst_pk, worst_sort from %I where %s order by %s limit 1; -- pk, sort_column, topn_table, where_condition_on_group_by, worst_order
+			if %s then -- _pgf_row is better than worst
+				/* the worst row of the top N moves to the buffer */
+				with moved as (
+					delete from %I where %s and %I = worst_pk returning * -- topn_table, where_condition_on_group_by, pk
+				)
+				insert into %I select * from moved; -- buffer_table
+				insert into %I (%s %I, %I) values (%s _pgf_row.%I, _pgf_row.%I); -- topn_table, group_columns_prefix, pk, sort_column, group_values_prefix, pk, sort_column
+			else
+				if grp.row_count - 1 > grp.top_count + grp.buffer_count then
+					/* rows beyond the buffer: _pgf_row goes into the buffer only if it is better than the worst row of the buffer */
+					select %I, %I into worst_pk, worst_sort from %I where %s order by %s limit 1; -- pk, sort_column, buffer_table, where_condition_on_group_by, worst_order
+					if not found or not %s then -- _pgf_row is better than worst
+						return;
 					end if;
-					/* full recompute on NEW FK */
-					call _pgf_internal_refresh_single_%I(NEW.%I); -- id, linked_fk
-				elsif NEW.%I < OLD.%I then -- linked_value_column, linked_value_column
-					/* case : no FK change */
-					/* full recompute on OLD FK */
-					call _pgf_internal_refresh_single_%I(OLD.%I); -- id, linked_fk
 				end if;
-			ELSIF TG_OP='TRUNCATE' then
-				update %I set %I=NULL; -- base_table_name, base_aggregate_column
-			END IF;
-			RETURN NEW;
+				insert into %I (%s %I, %I) values (%s _pgf_row.%I, _pgf_row.%I); -- buffer_table, group_columns_prefix, pk, sort_column, group_values_prefix, pk, sort_column
+			end if;
+
+			if grp.buffer_count < %s then -- buffer_size
+				update %I set buffer_count = buffer_count + 1 where %s; -- group_table, where_condition_on_group_by
+			else
+				delete from %I where %s and %I = (select %I from %I where %s order by %s limit 1); -- buffer_table, where_condition_on_group_by, pk, pk, buffer_table, where_condition_on_group_by, worst_order
+			end if;
 		END;
-		$inner_trg$ LANGUAGE plpgsql;
-	$fun$
-        , id
-        , linked_table_name, linked_pk
-        , linked_table_name, linked_value_column
-        , row_filter
-        , row_filter
-        , linked_value_column
-        , linked_table_name
-        , linked_pk, base_aggregate_column, base_table_name, base_pk, linked_fk
-        , linked_value_column
-        , base_table_name
-        , base_aggregate_column, linked_pk
-        , base_pk, linked_fk
-        , base_aggregate_column, base_table_name, base_pk, linked_fk
-        , linked_pk
-        , id, linked_fk
-        , linked_fk, linked_fk
-        , base_aggregate_column, base_table_name, base_pk, linked_fk
-        , linked_pk
-        , id, linked_fk
-        , id, linked_fk
-        , linked_value_column, linked_value_column
-        , id, linked_fk
-        , base_table_name, base_aggregate_column
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		group_table,
+		table_name, pk,
+		table_name, sort_column,
+		group_table, key_columns, case when has_groups then _pgf_internal_join(group_by_column, '_pgf_row.%s') else 'true' end,
+		key_columns,
+		n,
+		topn_table, group_columns_prefix, pk, sort_column, _pgf_internal_join(group_by_column, '_pgf_row.%s, ', ''), pk, sort_column,
+		group_table, where_condition_on_group_by,
+		pk, sort_column, topn_table, where_condition_on_group_by, worst_order,
+		format(better_pattern, '_pgf_row.' || quote_ident(sort_column), '_pgf_row.' || quote_ident(pk), 'worst_sort', 'worst_pk'),
+		topn_table, where_condition_on_group_by, pk,
+		buffer_table,
+		topn_table, group_columns_prefix, pk, sort_column, _pgf_internal_join(group_by_column, '_pgf_row.%s, ', ''), pk, sort_column,
+		pk, sort_column, buffer_table, where_condition_on_group_by, worst_order,
+		format(better_pattern, '_pgf_row.' || quote_ident(sort_column), '_pgf_row.' || quote_ident(pk), 'worst_sort', 'worst_pk'),
+		buffer_table, group_columns_prefix, pk, sort_column, _pgf_internal_join(group_by_column, '_pgf_row.%s, ', ''), pk, sort_column,
+		buffer_size,
+		group_table, where_condition_on_group_by,
+		buffer_table, where_condition_on_group_by, pk, pk, buffer_table, where_condition_on_group_by, worst_order
+	);
+
+	/* remove a row of the source table. A row removed from the top N is replaced by the best row of the buffer.
+	If the buffer is empty while the group has other rows, the group is marked stale, and refilled at the end of the statement. */
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_topn_table_remove_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
+		DECLARE
+			grp %I; -- group_table
+		BEGIN
+			update %I set row_count = row_count - 1 where %s -- group_table, where_condition_on_group_by
+			returning * into grp;
+			if not found or grp.stale then
+				return; -- the group is refilled at the end of the statement
+			end if;
+
+			if grp.row_count = 0 then
+				delete from %I where %s; -- group_table, where_condition_on_group_by
+				delete from %I where %s; -- topn_table, where_condition_on_group_by
+				delete from %I where %s; -- buffer_table, where_condition_on_group_by
+				return;
+			end if;
+
+			delete from %I where %s and %I = _pgf_row.%I; -- topn_table, where_condition_on_group_by, pk, pk
+			if found then
+				/* the best row of the buffer moves to the top N */
+				with moved as (
+					delete from %I where %s and %I = (select %I from %I where %s order by %s limit 1) returning * -- buffer_table, where_condition_on_group_by, pk, pk, buffer_table, where_condition_on_group_by, best_order
+				)
+				insert into %I select * from moved; -- topn_table
+				if found then
+					update %I set buffer_count = buffer_count - 1 where %s; -- group_table, where_condition_on_group_by
+				elsif grp.row_count > grp.top_count - 1 then
+					update %I set stale = true where %s; -- group_table, where_condition_on_group_by
+				else
+					update %I set top_count = top_count - 1 where %s; -- group_table, where_condition_on_group_by
+				end if;
+				return;
+			end if;
 
+			delete from %I where %s and %I = _pgf_row.%I; -- buffer_table, where_condition_on_group_by, pk, pk
+			if found then
+				update %I set buffer_count = buffer_count - 1 where %s; -- group_table, where_condition_on_group_by
+			end if;
+		END;
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		group_table,
+		group_table, where_condition_on_group_by,
+		group_table, where_condition_on_group_by,
+		topn_table, where_condition_on_group_by,
+		buffer_table, where_condition_on_group_by,
+		topn_table, where_condition_on_group_by, pk, pk,
+		buffer_table, where_condition_on_group_by, pk, pk, buffer_table, where_condition_on_group_by, best_order,
+		topn_table,
+		group_table, where_condition_on_group_by,
+		group_table, where_condition_on_group_by,
+		group_table, where_condition_on_group_by
+		, buffer_table, where_condition_on_group_by, pk, pk
+		, group_table, where_condition_on_group_by
 	);
 
+	/* refill the stale groups from the source table */
 	execute format($inner_proc$
-		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
+		CREATE or replace PROCEDURE _pgf_internal_topn_table_refill_%I() -- id
 		LANGUAGE plpgsql
-		AS $inner_proc2$
+		AS $body$
 			begin
-			    update %I set %I = NULL; -- base_table_name, base_aggregate_column
-				update %I set %I = sub.id -- base_table_name, base_aggregate_column
-				from (
-					select distinct on (%I) %I as parent_id, %I as id -- linked_fk, linked_fk, linked_pk
-					from %I -- linked_table_name
-					where %s -- row_filter
-					order by %I, %I -- linked_fk, linked_value_column
-				) as sub
-				where %I.%I = sub.parent_id; -- base_table_name, base_pk
+				if not exists (select 1 from %I where stale) then -- group_table
+					return;
+				end if;
+				delete from %I t using %I g where g.stale and %s; -- topn_table, group_table, where_condition_on_group_by
+				delete from %I t using %I g where g.stale and %s; -- buffer_table, group_table, where_condition_on_group_by
+
+				with ranked as (
+					select %s %I, %I, row_number() over (%s order by %s) as _pgf_rn, count(*) over (%s) as _pgf_cnt -- group_columns_prefix, pk, sort_column, partition_clause, best_order, partition_clause
+					from %I -- table_name
+					where (%s) and %s -- row_filter, stale_condition
+				), top_rows as (
+					insert into %I (%s %I, %I) -- topn_table, group_columns_prefix, pk, sort_column
+					select %s %I, %I from ranked where _pgf_rn <= %s -- group_columns_prefix, pk, sort_column, n
+				), buffer_rows as (
+					insert into %I (%s %I, %I) -- buffer_table, group_columns_prefix, pk, sort_column
+					select %s %I, %I from ranked where _pgf_rn > %s and _pgf_rn <= %s -- group_columns_prefix, pk, sort_column, n, n + buffer_size
+				)
+				update %I t set row_count = r._pgf_cnt, top_count = least(r._pgf_cnt, %s), buffer_count = least(greatest(r._pgf_cnt - %s, 0), %s), stale = false -- group_table, n, n, buffer_size
+				from ranked r
+				where r._pgf_rn = 1 and %s; -- where_condition_on_group_by
+
+				/* groups without rows left */
+				delete from %I where stale; -- group_table
 			end;
-			$inner_proc2$;
+			$body$;
 		$inner_proc$
-        , id
-        , base_table_name, base_aggregate_column
-        , base_table_name, base_aggregate_column
-        , linked_fk, linked_fk, linked_pk
-        , linked_table_name
-        , row_filter
-        , linked_fk, linked_value_column
-        , base_table_name, base_pk
+		, id
+		, group_table
+		, topn_table, group_table, case when has_groups then _pgf_internal_join(group_by_column, 't.%s = g.%s', ' AND ') else 'true' end
+		, buffer_table, group_table, case when has_groups then _pgf_internal_join(group_by_column, 't.%s = g.%s', ' AND ') else 'true' end
+		, group_columns_prefix, pk, sort_column, partition_clause, best_order, partition_clause
+		, table_name
+		, row_filter, case when has_groups then format('(%s) in (select %s from %I where stale)', key_columns, key_columns, group_table) else 'true' end
+		, topn_table, group_columns_prefix, pk, sort_column
+		, group_columns_prefix, pk, sort_column, n
+		, buffer_table, group_columns_prefix, pk, sort_column
+		, group_columns_prefix, pk, sort_column, n, n + buffer_size
+		, group_table, n, n, buffer_size
+		, case when has_groups then _pgf_internal_join(group_by_column, 't.%s = r.%s', ' AND ') else 'true' end
+		, group_table
+	);
+
+	-- create main trigger
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_topn_table_trgfun_%I() -- id
+		RETURNS TRIGGER AS $inner_trg$
+		DECLARE
+			old_row_matches_filter boolean := false;
+			new_row_matches_filter boolean := false;
+		BEGIN
+			IF TG_OP = 'TRUNCATE' then
+				delete from %I; -- topn_table
+				truncate %I, %I; -- buffer_table, group_table
+				RETURN NULL;
+			ELSIF TG_LEVEL = 'STATEMENT' then
+				call _pgf_internal_topn_table_refill_%I(); -- id
+				RETURN NULL;
+			END IF;
 
+			/* test if OLD row matches filter */
+			IF TG_OP in ('UPDATE', 'DELETE') then
+				select count(*) = 1 into old_row_matches_filter from (select OLD.*) t where %s; -- row_filter
+			END IF;
+
+			/* test if NEW row matches filter */
+			IF TG_OP in ('UPDATE', 'INSERT') then
+				select count(*) = 1 into new_row_matches_filter from (select NEW.*) t where %s; -- row_filter
+			END IF;
+
+			IF TG_OP = 'UPDATE' and old_row_matches_filter = new_row_matches_filter
+				and (%s OLD.%I, OLD.%I) is not distinct from (%s NEW.%I, NEW.%I) then -- old_group_values_prefix, pk, sort_column, new_group_values_prefix, pk, sort_column
+				RETURN NULL; -- the ranking has not changed
+			END IF;
+			IF old_row_matches_filter then
+				perform _pgf_internal_topn_table_remove_%I(OLD); -- id
+			END IF;
+			IF new_row_matches_filter then
+				perform _pgf_internal_topn_table_add_%I(NEW); -- id
+			END IF;
+			RETURN NULL;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
+		$fun$
+		, id
+		, topn_table
+		, buffer_table, group_table
+		, id
+		, row_filter
+		, row_filter
+		, _pgf_internal_join(group_by_column, 'OLD.%s, ', ''), pk, sort_column, _pgf_internal_join(group_by_column, 'NEW.%s, ', ''), pk, sort_column
+		, id
+		, id
 	);
 
     execute format($trg$
-		CREATE TRIGGER _pgf_internal_id_of_min_trg_%I -- id
-		after delete or insert or update ON %I -- linked_table_name
+		CREATE TRIGGER _pgf_internal_topn_table_trg_%I -- id
+		after delete or insert or update ON %I -- table_name
 		FOR EACH ROW
-		execute procedure _pgf_internal_id_of_min_trgfun_%I(); -- id
+		execute procedure _pgf_internal_topn_table_trgfun_%I(); -- id
 		$trg$,
 		id,
-		linked_table_name,
+		table_name,
 		id
 	);
 
+	/* runs after the row triggers of each statement: refills the groups whose buffer was exhausted, or empties the tables on truncate */
     execute format($trg$
-		CREATE TRIGGER _pgf_internal_id_of_min_trg_truncate_%I -- id
-		after truncate ON %I -- linked_table_name
+		CREATE TRIGGER _pgf_internal_topn_table_trg_stmt_%I -- id
+		after delete or insert or update or truncate ON %I -- table_name
 		FOR EACH STATEMENT
-		execute procedure _pgf_internal_id_of_min_trgfun_%I(); -- id
+		execute procedure _pgf_internal_topn_table_trgfun_%I(); -- id
 		$trg$,
 		id,
-		linked_table_name,
+		table_name,
 		id
 	);
 
-	call pgf_refresh(id);
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
+		LANGUAGE plpgsql
+		AS $body$
+			begin
+			    delete from %I; -- topn_table
+				truncate %I, %I; -- buffer_table, group_table
+
+				/* single pass over the table: rank the rows of each group, then split them into the top N and the buffer */
+				with ranked as (
+					select %s %I, %I, row_number() over (%s order by %s) as _pgf_rn, count(*) over (%s) as _pgf_cnt -- group_columns_prefix, pk, sort_column, partition_clause, best_order, partition_clause
+					from %I -- table_name
+					where %s -- row_filter
+				), top_rows as (
+					insert into %I (%s %I, %I) -- topn_table, group_columns_prefix, pk, sort_column
+					select %s %I, %I from ranked where _pgf_rn <= %s -- group_columns_prefix, pk, sort_column, n
+				), buffer_rows as (
+					insert into %I (%s %I, %I) -- buffer_table, group_columns_prefix, pk, sort_column
+					select %s %I, %I from ranked where _pgf_rn > %s and _pgf_rn <= %s -- group_columns_prefix, pk, sort_column, n, n + buffer_size
+				)
+				insert into %I (%s, row_count, top_count, buffer_count, stale) -- group_table, key_columns
+				select %s, _pgf_cnt, least(_pgf_cnt, %s), least(greatest(_pgf_cnt - %s, 0), %s), false -- key_values, n, n, buffer_size
+				from ranked
+				where _pgf_rn = 1;
+			end;
+			$body$;
+		$inner_proc$
+		, id
+		, topn_table
+		, buffer_table, group_table
+		, group_columns_prefix, pk, sort_column, partition_clause, best_order, partition_clause
+		, table_name
+		, row_filter
+		, topn_table, group_columns_prefix, pk, sort_column
+		, group_columns_prefix, pk, sort_column, n
+		, buffer_table, group_columns_prefix, pk, sort_column
+		, group_columns_prefix, pk, sort_column, n, n + buffer_size
+		, group_table, key_columns
+		, case when has_groups then _pgf_internal_join(group_by_column) else 'true' end, n, n, buffer_size
+	);
 
+	call _pgf_internal_post_create(id);
 END;
 $proc$;
 
+
 --------------------------------------------------------------------------------
--- ARRAY_AGG
+-- HISTOGRAM_TABLE
 --------------------------------------------------------------------------------
-CREATE or replace PROCEDURE pgf_array_agg (
-	id TEXT,
-    base_table_name TEXT,
-    base_pk TEXT,
-    base_aggregate_column TEXT, -- column holding the 'ARRAY_AGG' value
-    linked_table_name TEXT,
-    linked_fk TEXT,
-	linked_value_column TEXT, -- column to be used for array aggregation
-	options JSONB default '{}'::JSONB
+-- Bucket of a value: 1 to bucket_count for values in [min_value, max_value), 0 below, bucket_count + 1 above (like width_bucket).
+-- With the 'log' scale, the bucket bounds are a geometric progression: each bucket has the same relative width.
+CREATE or replace FUNCTION _pgf_internal_histogram_bucket(x double precision, scale TEXT, min_value double precision, max_value double precision, bucket_count int)
+RETURNS int
+LANGUAGE sql IMMUTABLE AS $$
+	select case
+		when scale = 'linear' then width_bucket(x, min_value, max_value, bucket_count)
+		when x > 0 then width_bucket(ln(x), ln(min_value), ln(max_value), bucket_count)
+		else 0 end;
+$$;
+
+-- Lower bound of a bucket (NULL for bucket 0, and for buckets after bucket_count + 1, whose lower bound is max_value).
+CREATE or replace FUNCTION _pgf_internal_histogram_bound(bucket int, scale TEXT, min_value double precision, max_value double precision, bucket_count int)
+RETURNS double precision
+LANGUAGE sql IMMUTABLE AS $$
+	select case
+		when bucket < 1 or bucket > bucket_count + 1 then NULL
+		when bucket = bucket_count + 1 then max_value
+		when scale = 'linear' then min_value + (max_value - min_value) * (bucket - 1) / bucket_count
+		else min_value * power(max_value / min_value, (bucket - 1)::double precision / bucket_count) end;
+$$;
+
+-- HISTOGRAM_TABLE: maintain, for each group of rows of a table, the number of rows whose value falls in each bucket.
+-- Buckets have a fixed width ('linear' scale) or a fixed relative width ('log' scale) between the options min and max.
+-- pgf_quantile and pgf_cdf read the table to return approximate percentiles.
+CREATE or replace PROCEDURE pgf_histogram_table (
+	id text,
+    table_name TEXT,
+    aggregate_column TEXT,
+	options JSONB DEFAULT '{}'::JSONB
 )
 LANGUAGE plpgsql AS $proc$
 DECLARE
+	group_by_column TEXT[];
+	agg_table TEXT;
 	row_filter TEXT;
-	order_by TEXT;
-	distinct_values boolean;
-	max_length int;
-	order_by_clause TEXT;
-	limit_clause TEXT;
+	has_groups boolean;
+	group_columns_prefix TEXT; -- group by column names joined with ',', followed by ',' if not empty
+	where_condition_on_group_by TEXT; -- SQL fragment : "grp1 = _pgf_row.grp1 AND grp2 = _pgf_row.grp2..."
+	bucket_function TEXT; -- SQL fragment: bucket of the value %s
 BEGIN
 	-- set default values for optional arguments
-	options := jsonb_build_object(
-		'filter', 'true',
-		'order_by', NULL,
-		'distinct', true,
-		'limit', NULL
-
-	) || options;
-	row_filter := options->>'filter';
-	order_by := options->>'order_by';
-	distinct_values := options->>'distinct';
-	max_length := options->>'limit';
-	if row_filter is null or row_filter = '' then
-		row_filter := 'true';
-	end if;
+	options := _pgf_internal_default_options('histogram_table', jsonb_build_object('table_name', table_name, 'options', options));
 
-	/* set SQL clauses */
-	order_by_clause := CASE when order_by IS NULL OR order_by = '' then '' else 'ORDER BY ' || order_by end;
-	limit_clause := case when max_length IS NULL or max_length <= 0 then '' else '[1:' || max_length::text || ']' end;
+	if options->>'scale' not in ('linear', 'log') then
+		raise exception 'Invalid value for option "scale": %. Allowed values are: linear, log', options->>'scale';
+	end if;
+	if options->>'min' is null or options->>'max' is null or (options->>'min')::double precision >= (options->>'max')::double precision then
+		raise exception 'Options "min" and "max" are required, and "min" must be lower than "max"';
+	end if;
+	if options->>'scale' = 'log' and (options->>'min')::double precision <= 0 then
+		raise exception 'Option "min" must be positive with "scale"=''log''';
+	end if;
+	if (options->>'bucket_count')::int < 1 then
+		raise exception 'Invalid value for option "bucket_count": %. The value must be positive', options->>'bucket_count';
+	end if;
 
-	call _pgf_internal_insert_metadata(id, 'array_agg', jsonb_build_object(
-		'base_table_name', base_table_name,
-		'base_pk', base_pk,
-		'base_aggregate_column', base_aggregate_column,
-		'linked_table_name', linked_table_name,
-		'linked_fk', linked_fk,
-		'linked_value_column', linked_value_column,
+	call _pgf_internal_insert_metadata(id, 'histogram_table', jsonb_build_object(
+		'table_name', table_name,
+		'aggregate_column', aggregate_column,
 		'options', options
 	));
 
-	/* function to update the array_agg value of a single row identified by its PK given in parameter _pgf_id.*/
-	execute format($proc2$
-		CREATE OR REPLACE PROCEDURE _pgf_internal_refresh_single_%I(_pgf_id %I.%I%%TYPE) -- id, linked_table_name, linked_fk
-		LANGUAGE plpgsql AS $inner_proc2$
+	group_by_column := _pgf_internal_jsonb_to_text_array(options->'group_by_column');
+	agg_table := options->>'agg_table';
+	row_filter := coalesce(nullif(options->>'filter', ''), 'true');
+	row_filter := format('(%s) and %I is not null', row_filter, aggregate_column); -- like the percentile_cont aggregate, NULL values are ignored
+
+	has_groups := cardinality(group_by_column) > 0;
+	group_columns_prefix := case when has_groups then _pgf_internal_join(group_by_column) || ', ' else '' end;
+	where_condition_on_group_by := case when has_groups then _pgf_internal_join(group_by_column, '%s = _pgf_row.%s', ' AND ') else 'true' end;
+	bucket_function := format('_pgf_internal_histogram_bucket(%%s::double precision, %L, %s, %s, %s)',
+		options->>'scale', (options->>'min')::double precision, (options->>'max')::double precision, (options->>'bucket_count')::int);
+
+	-- create aggregate table
+	execute format($tbl$
+		create table %I as
+		select %s 0 as bucket, 0::bigint as row_count -- group_columns_prefix
+		from %I -- table_name
+		limit 0;
+		$tbl$,
+		agg_table,
+		group_columns_prefix,
+		table_name
+	);
+	execute format($tbl$
+		alter table %I -- agg_table
+		add column lower_bound double precision generated always as (%s) stored, -- bound of bucket
+		add column upper_bound double precision generated always as (%s) stored, -- bound of bucket + 1
+		ADD CONSTRAINT %I PRIMARY KEY (%s bucket); -- pk name, group_columns_prefix
+		$tbl$,
+		agg_table,
+		format('_pgf_internal_histogram_bound(bucket, %L, %s, %s, %s)', options->>'scale', (options->>'min')::double precision, (options->>'max')::double precision, (options->>'bucket_count')::int),
+		format('_pgf_internal_histogram_bound(bucket + 1, %L, %s, %s, %s)', options->>'scale', (options->>'min')::double precision, (options->>'max')::double precision, (options->>'bucket_count')::int),
+		agg_table || '_pk', group_columns_prefix
+	);
+	call _pgf_internal_apply_storage(agg_table, options->'storage', group_by_column);
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_histogram_table_add_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
 		BEGIN
-			update %I set %I = ( -- base_table_name, base_aggregate_column
-				select _pgf_internal_array_dedup((array_agg(%I %s))%s, %s) from ( -- linked_value_column, order_by_clause, limit_clause, distinct_values::text
-					select * /* need to select all columns in case they are referenced in the order by clause */
-					from %I -- linked_table_name
-					where %I = _pgf_id -- linked_fk
-					and (%s) -- row_filter
-				) t
-			) where %I = _pgf_id; -- base_pk
+			insert into %I as t (%s bucket, row_count) values (%s %s, 1) -- agg_table, group_columns_prefix, group values, bucket
+			on conflict (%s bucket) do update set row_count = t.row_count + 1; -- group_columns_prefix
 		END;
-		$inner_proc2$
-	$proc2$
-        , id, linked_table_name, linked_fk
-        , base_table_name, base_aggregate_column
-        , linked_value_column, order_by_clause, limit_clause, distinct_values::text
-        , linked_table_name
-        , linked_fk
-        , row_filter
-        , base_pk
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		agg_table, group_columns_prefix, _pgf_internal_join(group_by_column, '_pgf_row.%s, ', ''), format(bucket_function, '_pgf_row.' || quote_ident(aggregate_column)),
+		group_columns_prefix
 	);
 
+	-- empty buckets are deleted
 	execute format($fun$
-		CREATE OR REPLACE FUNCTION _pgf_internal_array_agg_trgfun_%I() -- id
+		CREATE OR REPLACE FUNCTION _pgf_internal_histogram_table_remove_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
+		BEGIN
+			with deleted as (
+				delete from %I where row_count = 1 and %s and bucket = %s -- agg_table, where_condition_on_group_by, bucket
+			)
+			update %I set row_count = row_count - 1 where row_count > 1 and %s and bucket = %s; -- agg_table, where_condition_on_group_by, bucket
+		END;
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		agg_table, where_condition_on_group_by, format(bucket_function, '_pgf_row.' || quote_ident(aggregate_column)),
+		agg_table, where_condition_on_group_by, format(bucket_function, '_pgf_row.' || quote_ident(aggregate_column))
+	);
+
+	-- create main trigger
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_histogram_table_trgfun_%I() -- id
 		RETURNS TRIGGER AS $inner_trg$
 		DECLARE
-			old_row_matches_filter boolean := true;
-			new_row_matches_filter boolean := true;
+			old_row_matches_filter boolean := false;
+			new_row_matches_filter boolean := false;
 		BEGIN
+			IF TG_OP = 'TRUNCATE' then
+				call _pgf_internal_refresh_%I(); -- id
+				RETURN NULL;
+			END IF;
+
 			/* test if OLD row matches filter */
-			select case when count(*)=1 then true else false end into old_row_matches_filter from (
-				select * from (
-					select (OLD.*)
-				) t
-				where %s -- row_filter
-			) t2;
+			IF TG_OP in ('UPDATE', 'DELETE') then
+				select count(*) = 1 into old_row_matches_filter from (select OLD.*) t where %s; -- row_filter
+			END IF;
 
 			/* test if NEW row matches filter */
-			select case when count(*)=1 then true else false end into new_row_matches_filter from (
-				select * from (
-					select NEW.*
-				) t
-				where %s -- row_filter
-			) t2;
+			IF TG_OP in ('UPDATE', 'INSERT') then
+				select count(*) = 1 into new_row_matches_filter from (select NEW.*) t where %s; -- row_filter
+			END IF;
 
-			IF TG_OP='INSERT' and new_row_matches_filter then
-				call _pgf_internal_refresh_single_%I(NEW.%I); -- id, linked_fk
-			ELSIF TG_OP='DELETE' and old_row_matches_filter then
-				call _pgf_internal_refresh_single_%I(OLD.%I); -- id, linked_fk
-			ELSIF TG_OP='UPDATE' then
-				if OLD.%I <> NEW.%I then -- linked_fk, linked_fk
-					/* case : FK changes */
-					if old_row_matches_filter then
-						call _pgf_internal_refresh_single_%I(OLD.%I); -- id, linked_fk
-					end if;
-					if new_row_matches_filter then
-						call _pgf_internal_refresh_single_%I(NEW.%I); -- id, linked_fk
-					end if;
-				else
-					/* case : no FK change */
-					/* full recompute on OLD FK */
-					if old_row_matches_filter then
-						call _pgf_internal_refresh_single_%I(OLD.%I); -- id, linked_fk
-					end if;
-				end if;
-			ELSIF TG_OP='TRUNCATE' then
-				update %I set %I=NULL; -- base_table_name, base_aggregate_column
+			IF TG_OP = 'UPDATE' and old_row_matches_filter = new_row_matches_filter
+				and (%s %s) is not distinct from (%s %s) then -- old_group_values_prefix, old bucket, new_group_values_prefix, new bucket
+				RETURN NULL; -- the counts have not changed
 			END IF;
-			RETURN NEW;
+			IF old_row_matches_filter then
+				perform _pgf_internal_histogram_table_remove_%I(OLD); -- id
+			END IF;
+			IF new_row_matches_filter then
+				perform _pgf_internal_histogram_table_add_%I(NEW); -- id
+			END IF;
+			RETURN NULL;
 		END;
 		$inner_trg$ LANGUAGE plpgsql;
-	$fun$
-        , id
-        , row_filter
-        , row_filter
-        , id, linked_fk
-        , id, linked_fk
-        , linked_fk, linked_fk
-        , id, linked_fk
-        , id, linked_fk
-        , id, linked_fk
-        , base_table_name, base_aggregate_column
-	);
-
-	execute format($inner_proc$
-		CREATE or replace PROCEDURE "_pgf_internal_refresh_%I"() -- id
-		LANGUAGE plpgsql
-		AS $inner_proc2$
-			begin
-			    update %I set %I = NULL; -- base_table_name, base_aggregate_column
-				update %I set %I = sub.agg -- base_table_name, base_aggregate_column
-				from (
-					select %I as id, _pgf_internal_array_dedup((array_agg(%I %s))%s, %s) as agg -- -- linked_fk, linked_value_column, order_by_clause, limit_clause, distinct_values::text
-					from %I -- linked_table_name
-					where %s -- row_filter
-					group by %I -- linked_fk
-				) as sub
-				where %I.%I = sub.id; -- base_table_name, base_pk
-			end;
-			$inner_proc2$;
-		$inner_proc$
-        , id
-        , base_table_name, base_aggregate_column
-        , base_table_name, base_aggregate_column
-        , linked_fk, linked_value_column, order_by_clause, limit_clause, distinct_values::text
-        , linked_table_name
-        , row_filter
-        , linked_fk
-        , base_table_name, base_pk
+		$fun$
+		, id
+		, id
+		, row_filter
+		, row_filter
+		, _pgf_internal_join(group_by_column, 'OLD.%s, ', ''), format(bucket_function, 'OLD.' || quote_ident(aggregate_column))
+		, _pgf_internal_join(group_by_column, 'NEW.%s, ', ''), format(bucket_function, 'NEW.' || quote_ident(aggregate_column))
+		, id
+		, id
 	);
 
     execute format($trg$
-		CREATE TRIGGER _pgf_internal_array_agg_trg_%I -- id
-		after delete or insert or update ON %I -- linked_table_name
+		CREATE TRIGGER _pgf_internal_histogram_table_trg_%I -- id
+		after delete or insert or update ON %I -- table_name
 		FOR EACH ROW
-		execute procedure _pgf_internal_array_agg_trgfun_%I(); -- id
+		execute procedure _pgf_internal_histogram_table_trgfun_%I(); -- id
 		$trg$,
 		id,
-		linked_table_name,
+		table_name,
 		id
 	);
 
     execute format($trg$
-		CREATE TRIGGER _pgf_internal_array_agg_trg_truncate_%I -- id
-		after truncate ON %I -- linked_table_name
+		CREATE TRIGGER _pgf_internal_histogram_table_trg_truncate_%I -- id
+		after truncate ON %I -- table_name
 		FOR EACH STATEMENT
-		execute procedure _pgf_internal_array_agg_trgfun_%I(); -- id
+		execute procedure _pgf_internal_histogram_table_trgfun_%I(); -- id
 		$trg$,
 		id,
-		linked_table_name,
+		table_name,
 		id
 	);
 
-	call pgf_refresh(id);
+	execute format($inner_proc$
+		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
+		LANGUAGE plpgsql
+		AS $body$
+			begin
+			    delete from %I; -- agg_table
+				insert into %I (%s bucket, row_count) -- agg_table, group_columns_prefix
+				select %s %s, count(*) -- group_columns_prefix, bucket
+				from %I -- table_name
+				where %s -- row_filter
+				group by %s %s; -- group_columns_prefix, bucket
+			end;
+			$body$;
+		$inner_proc$
+		, id
+		, agg_table
+		, agg_table, group_columns_prefix
+		, group_columns_prefix, format(bucket_function, quote_ident(aggregate_column))
+		, table_name
+		, row_filter
+		, group_columns_prefix, format(bucket_function, quote_ident(aggregate_column))
+	);
 
+	call _pgf_internal_post_create(id);
 END;
 $proc$;
+
+-- Condition on the group by columns of a HISTOGRAM_TABLE, from a JSON object {column: value}. The values are read from
+-- the parameter $1. Group by columns missing from the object are not filtered: their groups are merged.
+CREATE or replace FUNCTION _pgf_internal_histogram_group_condition(args JSONB, group_values JSONB)
+RETURNS TEXT
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+	k TEXT;
+	condition TEXT := 'true';
+BEGIN
+	for k in select jsonb_object_keys(coalesce(group_values, '{}'::JSONB)) loop
+		if not k = any(coalesce(_pgf_internal_jsonb_to_text_array(args->'options'->'group_by_column'), ARRAY[]::TEXT[])) then
+			raise exception 'Unknown group by column: %', k;
+		end if;
+		condition := condition || format(' and h.%I = (select r.%I from jsonb_populate_record(NULL::%I, $1) r)', k, k, args->'options'->>'agg_table');
+	end loop;
+	return condition;
+END;
+$$;
+
+-- Approximate q-quantile (0 <= q <= 1) of the values of a group of a HISTOGRAM_TABLE, like percentile_cont(q).
+-- The values are assumed uniformly distributed in each bucket (log-uniformly with the 'log' scale). Values below min are
+-- reported as min, values above max as max. Returns NULL if the group has no rows.
+CREATE or replace FUNCTION pgf_quantile(id TEXT, group_values JSONB, q double precision)
+RETURNS double precision
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+	args JSONB;
+	bucket int;
+	bucket_rows bigint;
+	rows_before numeric;
+	total_rows numeric;
+	fraction double precision;
+	lower_bound double precision;
+	upper_bound double precision;
+BEGIN
+	args := _pgf_internal_get_metadata(id);
+	if args->>'kind' is distinct from 'histogram_table' then
+		raise exception 'Formula % is not a HISTOGRAM_TABLE formula', id;
+	end if;
+	if q is null or q < 0 or q > 1 then
+		raise exception 'Invalid quantile: %. The value must be between 0 and 1', q;
+	end if;
+
+	execute format($sql$
+		select bucket, row_count, rows_before, total_rows, lower_bound, upper_bound from (
+			select b.*, sum(row_count) over (order by bucket) - row_count as rows_before, sum(row_count) over () as total_rows
+			from (
+				select h.bucket, sum(h.row_count) as row_count, min(h.lower_bound) as lower_bound, min(h.upper_bound) as upper_bound
+				from %I h -- agg_table
+				where %s -- group condition
+				group by h.bucket
+			) b
+		) c
+		where rows_before + row_count >= $2 * total_rows
+		order by bucket
+		limit 1
+		$sql$,
+		args->'options'->>'agg_table',
+		_pgf_internal_histogram_group_condition(args, group_values)
+	) into bucket, bucket_rows, rows_before, total_rows, lower_bound, upper_bound using group_values, q;
+
+	if bucket is null then
+		return NULL;
+	elsif lower_bound is null then
+		return (args->'options'->>'min')::double precision;
+	elsif upper_bound is null then
+		return (args->'options'->>'max')::double precision;
+	end if;
+	fraction := least(greatest((q * total_rows - rows_before) / bucket_rows, 0), 1);
+	if args->'options'->>'scale' = 'log' then
+		return lower_bound * power(upper_bound / lower_bound, fraction);
+	end if;
+	return lower_bound + (upper_bound - lower_bound) * fraction;
+END;
+$$;
+
+-- Approximate fraction of the values of a group of a HISTOGRAM_TABLE that are lower than or equal to x, like
+-- cume_dist(). The values are assumed uniformly distributed in each bucket (log-uniformly with the 'log' scale).
+-- Returns NULL if the group has no rows.
+CREATE or replace FUNCTION pgf_cdf(id TEXT, group_values JSONB, x double precision)
+RETURNS double precision
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+	args JSONB;
+	x_bucket int;
+	lower_bound double precision;
+	upper_bound double precision;
+	fraction double precision := 0; -- fraction of the bucket of x lower than x
+	result double precision;
+BEGIN
+	args := _pgf_internal_get_metadata(id);
+	if args->>'kind' is distinct from 'histogram_table' then
+		raise exception 'Formula % is not a HISTOGRAM_TABLE formula', id;
+	end if;
+
+	x_bucket := _pgf_internal_histogram_bucket(x, args->'options'->>'scale', (args->'options'->>'min')::double precision,
+		(args->'options'->>'max')::double precision, (args->'options'->>'bucket_count')::int);
+	lower_bound := _pgf_internal_histogram_bound(x_bucket, args->'options'->>'scale', (args->'options'->>'min')::double precision,
+		(args->'options'->>'max')::double precision, (args->'options'->>'bucket_count')::int);
+	upper_bound := _pgf_internal_histogram_bound(x_bucket + 1, args->'options'->>'scale', (args->'options'->>'min')::double precision,
+		(args->'options'->>'max')::double precision, (args->'options'->>'bucket_count')::int);
+	if lower_bound is not null and upper_bound is not null then
+		fraction := case when args->'options'->>'scale' = 'log' then ln(x / lower_bound) / ln(upper_bound / lower_bound)
+			else (x - lower_bound) / (upper_bound - lower_bound) end;
+	elsif upper_bound is null and x > (args->'options'->>'max')::double precision then
+		fraction := 1; -- x > max: all the values of the overflow bucket are counted
+	end if;
+
+	execute format($sql$
+		select (coalesce(sum(h.row_count) filter (where h.bucket < $2), 0) + coalesce(sum(h.row_count) filter (where h.bucket = $2), 0) * $3)
+			/ nullif(sum(h.row_count), 0)
+		from %I h -- agg_table
+		where %s -- group condition
+		$sql$,
+		args->'options'->>'agg_table',
+		_pgf_internal_histogram_group_condition(args, group_values)
+	) into result using group_values, x_bucket, fraction;
+	return result;
+END;
+$$;
+
 --------------------------------------------------------------------------------
--- MINMAX_TABLE
+-- TIMESERIES_TABLE
 --------------------------------------------------------------------------------
-CREATE or replace PROCEDURE pgf_minmax_table (
+-- SQL expression of the start of the time bucket of width 'width' holding the timestamp expression 'expr' (or, if
+-- bucket_end is true, of the end of the bucket starting at 'expr'). Buckets do not depend on the session time zone: fixed
+-- length buckets are aligned on the Unix epoch, and '1 month' and '1 year' buckets start at UTC month or year boundaries.
+CREATE or replace FUNCTION _pgf_internal_time_bucket_sql(width interval, expr TEXT, with_time_zone boolean, bucket_end boolean default false)
+RETURNS TEXT
+LANGUAGE plpgsql IMMUTABLE AS $$
+DECLARE
+	unit TEXT;
+	seconds numeric;
+BEGIN
+	if date_part('year', width) <> 0 or date_part('month', width) <> 0 then
+		if width::text not in ('1 mon', '1 year') then
+			raise exception 'Invalid interval: %. Intervals of months are supported for ''1 month'' and ''1 year'' only', width;
+		end if;
+		unit := case when width::text = '1 mon' then 'month' else 'year' end;
+		if bucket_end and with_time_zone then
+			return format('(((%s) at time zone ''UTC'' + interval ''1 %s'') at time zone ''UTC'')', expr, unit);
+		elsif bucket_end then
+			return format('((%s) + interval ''1 %s'')', expr, unit);
+		elsif with_time_zone then
+			return format('(date_trunc(%L, (%s) at time zone ''UTC'') at time zone ''UTC'')', unit, expr);
+		end if;
+		return format('date_trunc(%L, %s)', unit, expr);
+	end if;
+
+	seconds := extract(epoch from width);
+	if seconds <= 0 then
+		raise exception 'Invalid interval: %. The interval must be positive', width;
+	end if;
+	if bucket_end then
+		return format('((%s) + %s * interval ''1 second'')', expr, seconds);
+	end if;
+	-- the remainder is made positive for timestamps before the epoch
+	return format('((%s) - ((extract(epoch from %s)::numeric %% %s + %s) %% %s) * interval ''1 second'')', expr, expr, seconds, seconds, seconds);
+END;
+$$;
+
+-- Create a range partition of a TIMESERIES_TABLE aggregate table. A concurrent session may create it at the same time.
+CREATE or replace PROCEDURE _pgf_internal_timeseries_create_partition(agg_table TEXT, partition_name TEXT, range_start TEXT, range_end TEXT)
+LANGUAGE plpgsql AS $$
+BEGIN
+	execute format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)', partition_name, agg_table, range_start, range_end);
+EXCEPTION WHEN duplicate_table or unique_violation THEN
+	NULL;
+END;
+$$;
+
+-- TIMESERIES_TABLE: maintain, for each time bucket and group of rows of a table, the row count and the sum, min and max
+-- of columns. Each resolution (the bucket, and each rollup bucket) has its own aggregate table, updated from the rows of
+-- the table: late rows, and updates moving a row to another bucket, update the right buckets.
+-- A table with a partition interval is partitioned by range of bucket_start, and its partitions are created on demand:
+-- pgf_timeseries_expire drops the expired buckets with their partitions.
+CREATE or replace PROCEDURE pgf_timeseries_table (
 	id text,
     table_name TEXT,
-	pk TEXT,
-    aggregate_column TEXT,
+	timestamp_column TEXT,
 	options JSONB DEFAULT '{}'::JSONB
 )
 LANGUAGE plpgsql AS $proc$
 DECLARE
 	group_by_column TEXT[];
-    agg_table TEXT;
-	str TEXT := ''; -- string buffer
-	c TEXT; -- loop index
-	i int; -- loop index
-	group_by_columns_joined TEXT; -- group by column names, joined with ','
-	group_by_columns_new_joined TEXT; -- group by column names where each name is prefixed with 'NEW.', joined with ','
-	where_condition_on_group_by TEXT := ''; -- SQL fragment : "grp1 = OLD.grp1 AND grp2 = OLD.grp2..."
-	where_condition_on_group_by_OLDNEW TEXT := ''; -- SQL fragment : "OLD.grp1 = NEW.grp1 AND OLD.grp2 = NEW.grp2..."
-	where_condition_on_group_by_qual TEXT := ''; -- SQL fragment : "grp1 = table_name.grp1 AND grp2 = table_name.grp2..."
+	sum_columns TEXT[];
+	min_columns TEXT[];
+	max_columns TEXT[];
+	row_filter TEXT;
+	with_time_zone boolean;
+	timestamp_type TEXT;
+	resolutions JSONB; -- [{bucket, agg_table, retention, partition_interval}], the base resolution first
+	r JSONB; -- loop variable
+	i int; -- resolution index
+	agg_table TEXT;
+	key_columns TEXT; -- SQL fragment: "bucket_start, grp1, grp2..."
+	aggregate_columns TEXT; -- SQL fragment: "row_count, sum_x, min_y, max_z..."
+	declare_fragment TEXT := '';
+	add_fragment TEXT := '';
+	remove_fragment TEXT := '';
+	refresh_fragment TEXT := '';
+	bucket_variable TEXT;
+	key_condition TEXT; -- SQL fragment: the row of the bucket of _pgf_row
+	source_condition TEXT; -- SQL fragment: the rows of the table in the bucket of _pgf_row
+	refresh_condition TEXT; -- SQL fragment: the rows of the table in the buckets not expired
 BEGIN
-
-	create table if not exists log(msg text);
-
 	-- set default values for optional arguments
-	options := jsonb_build_object(
-		'group_by_column', '[]'::jsonb,
-		'agg_table', table_name || '_minmax'
-	) || options;
+	options := _pgf_internal_default_options('timeseries_table', jsonb_build_object('table_name', table_name, 'options', options));
+
+	resolutions := jsonb_build_array(jsonb_build_object(
+		'bucket', options->>'bucket',
+		'agg_table', options->>'agg_table',
+		'retention', options->'retention',
+		'partition_interval', options->'partition_interval'
+	)) || (options->'rollups');
+	if options->'storage' <> '{}'::jsonb and exists (select 1 from jsonb_array_elements(resolutions) x where x->>'partition_interval' is not null) then
+		raise exception 'Options "partition_interval" and "storage" cannot be combined';
+	end if;
 
-	call _pgf_internal_insert_metadata(id, 'minmax_table', jsonb_build_object(
+	call _pgf_internal_insert_metadata(id, 'timeseries_table', jsonb_build_object(
 		'table_name', table_name,
-		'pk', pk,
-		'aggregate_column', aggregate_column,
+		'timestamp_column', timestamp_column,
 		'options', options
 	));
-	
-
-	group_by_column = _pgf_internal_jsonb_to_text_array(options->'group_by_column');
-	agg_table = options->>'agg_table';
 
+	group_by_column := coalesce(_pgf_internal_jsonb_to_text_array(options->'group_by_column'), ARRAY[]::TEXT[]);
+	sum_columns := coalesce(_pgf_internal_jsonb_to_text_array(options->'sum_columns'), ARRAY[]::TEXT[]);
+	min_columns := coalesce(_pgf_internal_jsonb_to_text_array(options->'min_columns'), ARRAY[]::TEXT[]);
+	max_columns := coalesce(_pgf_internal_jsonb_to_text_array(options->'max_columns'), ARRAY[]::TEXT[]);
+	row_filter := coalesce(nullif(options->>'filter', ''), 'true');
+	row_filter := format('(%s) and %I is not null', row_filter, timestamp_column);
+	select c.data_type into timestamp_type from _pgf_internal_table_columns(ARRAY[table_name]) c where c.column_name = timestamp_column;
+	if timestamp_type is null then
+		raise exception 'Column %.% does not exist', table_name, timestamp_column;
+	end if;
+	with_time_zone := timestamp_type like 'timestamp%with time zone';
+	timestamp_type := case when with_time_zone then 'timestamp with time zone' else 'timestamp without time zone' end; -- type of bucket_start
+
+	key_columns := 'bucket_start' || _pgf_internal_join(group_by_column, ', %s', '');
+	aggregate_columns := 'row_count' || _pgf_internal_join(sum_columns, ', sum_%s', '') || _pgf_internal_join(min_columns, ', min_%s', '')
+		|| _pgf_internal_join(max_columns, ', max_%s', '');
+
+	i := 0;
+	for r in select * from jsonb_array_elements(resolutions) loop
+		i := i + 1;
+		agg_table := r->>'agg_table';
+		bucket_variable := '_pgf_bucket_' || i;
+
+		-- create aggregate table
+		execute format($tbl$
+			create table %I as
+			select %s as bucket_start %s, 0::bigint as row_count %s %s %s -- bucket, group by columns, aggregates
+			from %I -- table_name
+			group by 1 %s -- group by columns
+			limit 0;
+			$tbl$,
+			agg_table,
+			_pgf_internal_time_bucket_sql((r->>'bucket')::interval, quote_ident(timestamp_column), with_time_zone), _pgf_internal_join(group_by_column, ', %s', ''),
+			(select coalesce(string_agg(format(', coalesce(sum(%I), 0) as %I', c, 'sum_' || c), ''), '') from unnest(sum_columns) c),
+			(select coalesce(string_agg(format(', min(%I) as %I', c, 'min_' || c), ''), '') from unnest(min_columns) c),
+			(select coalesce(string_agg(format(', max(%I) as %I', c, 'max_' || c), ''), '') from unnest(max_columns) c),
+			table_name,
+			_pgf_internal_join(group_by_column, ', %s', '')
+		);
+		if r->>'partition_interval' is not null then
+			-- replace the (empty) table by a table partitioned by range of bucket_start
+			perform _pgf_internal_time_bucket_sql((r->>'partition_interval')::interval, 'bucket_start', with_time_zone);
+			execute format('ALTER TABLE %I RENAME TO %I', agg_table, agg_table || '_pgf_tmp');
+			execute format('CREATE TABLE %I (LIKE %I INCLUDING ALL) PARTITION BY RANGE (bucket_start)', agg_table, agg_table || '_pgf_tmp');
+			execute format('DROP TABLE %I', agg_table || '_pgf_tmp');
+		end if;
+		execute format('alter table %I ADD CONSTRAINT %I PRIMARY KEY (%s);', agg_table, agg_table || '_pk', key_columns);
+		if r->>'partition_interval' is null then
+			call _pgf_internal_apply_storage(agg_table, options->'storage', ARRAY['bucket_start'] || group_by_column);
+		end if;
 
-	group_by_columns_joined := _pgf_internal_join(group_by_column);
-	group_by_columns_new_joined := _pgf_internal_join(group_by_column, 'NEW.%s');
-	
-	-- init where condition SQL fragments
-	where_condition_on_group_by := _pgf_internal_join(group_by_column, '%s = OLD.%s', ' AND ');
-	where_condition_on_group_by_qual := _pgf_internal_join(group_by_column, '%s = ' || table_name || '.%s', ' AND ');
-	where_condition_on_group_by_OLDNEW := _pgf_internal_join(group_by_column, 'OLD.%s = NEW.%s', ' AND ');
-	
-	-- create aggregate table
-	execute format($tbl$
-		create table %I as
-		select %s, %I as min_value, %I as id_of_min, %I as max_value, %I as id_of_max, 0::bigint as row_count
-		from %I
-		limit 0;
-		$tbl$,
-		agg_table,
-		group_by_columns_joined,
-		aggregate_column, pk, aggregate_column, pk,
-		table_name
+		key_condition := format('bucket_start = %s', bucket_variable) || _pgf_internal_join(group_by_column, ' and %s = _pgf_row.%s', '');
+		source_condition := format('%I >= %s and %I < %s', timestamp_column, bucket_variable, timestamp_column,
+				_pgf_internal_time_bucket_sql((r->>'bucket')::interval, bucket_variable, with_time_zone, true))
+			|| _pgf_internal_join(group_by_column, ' and %s = _pgf_row.%s', '') || format(' and (%s)', row_filter);
+		declare_fragment := declare_fragment || format(E'\n\t\t\t%s %s;', bucket_variable, timestamp_type);
+
+		/* add: one upsert per resolution. The partition of the bucket is created if needed. */
+		add_fragment := add_fragment || format($sql$
+			%s := %s; -- bucket_variable, bucket
+			%s -- create partition
+			insert into %I as t (%s, %s) -- agg_table, key_columns, aggregate_columns
+			values (%s %s, 1 %s %s %s) -- bucket_variable, group values, aggregates
+			on conflict (%s) do update set row_count = t.row_count + 1 %s %s %s; -- key_columns, aggregates
+			$sql$,
+			bucket_variable, _pgf_internal_time_bucket_sql((r->>'bucket')::interval, '_pgf_row.' || quote_ident(timestamp_column), with_time_zone),
+			case when r->>'partition_interval' is null then '' else format($part$
+			if to_regclass(quote_ident(%L || '_p' || extract(epoch from %s)::bigint)) is null then -- agg_table, partition start
+				call _pgf_internal_timeseries_create_partition(%L, %L || '_p' || extract(epoch from %s)::bigint, (%s)::text, (%s)::text); -- agg_table, agg_table, partition start, partition start, partition end
+			end if;$part$,
+				agg_table, _pgf_internal_time_bucket_sql((r->>'partition_interval')::interval, bucket_variable, with_time_zone),
+				agg_table, agg_table, _pgf_internal_time_bucket_sql((r->>'partition_interval')::interval, bucket_variable, with_time_zone),
+				_pgf_internal_time_bucket_sql((r->>'partition_interval')::interval, bucket_variable, with_time_zone),
+				_pgf_internal_time_bucket_sql((r->>'partition_interval')::interval,
+					_pgf_internal_time_bucket_sql((r->>'partition_interval')::interval, bucket_variable, with_time_zone), with_time_zone, true))
+			end,
+			agg_table, key_columns, aggregate_columns,
+			bucket_variable, _pgf_internal_join(group_by_column, ', _pgf_row.%s', ''),
+			_pgf_internal_join(sum_columns, ', coalesce(_pgf_row.%s, 0)', ''), _pgf_internal_join(min_columns, ', _pgf_row.%s', ''), _pgf_internal_join(max_columns, ', _pgf_row.%s', ''),
+			key_columns,
+			_pgf_internal_join(sum_columns, ', sum_%s = t.sum_%s + excluded.sum_%s', ''),
+			_pgf_internal_join(min_columns, ', min_%s = least(t.min_%s, excluded.min_%s)', ''),
+			_pgf_internal_join(max_columns, ', max_%s = greatest(t.max_%s, excluded.max_%s)', '')
+		);
+
+		/* remove: the bucket is deleted with its last row. Removing the min or max of a bucket recomputes it from the
+		rows of the bucket (the removed row is not visible anymore). */
+		remove_fragment := remove_fragment || format($sql$
+			%s := %s; -- bucket_variable, bucket
+			delete from %I where %s and row_count = 1; -- agg_table, key_condition
+			if not found then
+				update %I t set row_count = t.row_count - 1 %s %s %s -- agg_table, aggregates
+				where %s; -- key_condition
+			end if;
+			$sql$,
+			bucket_variable, _pgf_internal_time_bucket_sql((r->>'bucket')::interval, '_pgf_row.' || quote_ident(timestamp_column), with_time_zone),
+			agg_table, key_condition,
+			agg_table,
+			_pgf_internal_join(sum_columns, ', sum_%s = t.sum_%s - coalesce(_pgf_row.%s, 0)', ''),
+			(select coalesce(string_agg(format(', %I = case when _pgf_row.%I <= t.%I then (select min(%I) from %I where %s) else t.%I end',
+				'min_' || c, c, 'min_' || c, c, table_name, source_condition, 'min_' || c), ''), '') from unnest(min_columns) c),
+			(select coalesce(string_agg(format(', %I = case when _pgf_row.%I >= t.%I then (select max(%I) from %I where %s) else t.%I end',
+				'max_' || c, c, 'max_' || c, c, table_name, source_condition, 'max_' || c), ''), '') from unnest(max_columns) c),
+			key_condition
+		);
+
+		/* refresh: the buckets older than the retention are not recreated, nor their partitions */
+		refresh_condition := row_filter;
+		if r->>'retention' is not null then
+			refresh_condition := refresh_condition || format(' and %s >= now() - %L::interval',
+				_pgf_internal_time_bucket_sql((r->>'bucket')::interval, quote_ident(timestamp_column), with_time_zone), r->>'retention');
+		end if;
+		refresh_fragment := refresh_fragment || format($sql$
+			delete from %I; -- agg_table
+			%s -- create partitions
+			insert into %I (%s, %s) -- agg_table, key_columns, aggregate_columns
+			select %s as bucket_start %s, count(*) %s %s %s -- bucket, group by columns, aggregates
+			from %I -- table_name
+			where %s -- refresh_condition
+			group by 1 %s; -- group by columns
+			$sql$,
+			agg_table,
+			case when r->>'partition_interval' is null then '' else format($part$
+			for _pgf_partition_start in select distinct %s from %I where %s loop -- partition start, table_name, refresh_condition
+				if to_regclass(quote_ident(%L || '_p' || extract(epoch from _pgf_partition_start)::bigint)) is null then -- agg_table
+					call _pgf_internal_timeseries_create_partition(%L, %L || '_p' || extract(epoch from _pgf_partition_start)::bigint, _pgf_partition_start::text, (%s)::text); -- agg_table, agg_table, partition end
+				end if;
+			end loop;$part$,
+				_pgf_internal_time_bucket_sql((r->>'partition_interval')::interval,
+					_pgf_internal_time_bucket_sql((r->>'bucket')::interval, quote_ident(timestamp_column), with_time_zone), with_time_zone),
+				table_name, refresh_condition,
+				agg_table,
+				agg_table, agg_table,
+				_pgf_internal_time_bucket_sql((r->>'partition_interval')::interval, '_pgf_partition_start', with_time_zone, true))
+			end,
+			agg_table, key_columns, aggregate_columns,
+			_pgf_internal_time_bucket_sql((r->>'bucket')::interval, quote_ident(timestamp_column), with_time_zone), _pgf_internal_join(group_by_column, ', %s', ''),
+			_pgf_internal_join(sum_columns, ', coalesce(sum(%s), 0)', ''), _pgf_internal_join(min_columns, ', min(%s)', ''), _pgf_internal_join(max_columns, ', max(%s)', ''),
+			table_name,
+			refresh_condition,
+			_pgf_internal_join(group_by_column, ', %s', '')
+		);
+	end loop;
+
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_timeseries_table_add_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
+		DECLARE %s -- bucket variables
+		BEGIN %s -- add_fragment
+		END;
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		declare_fragment,
+		add_fragment
 	);
 
-	execute format($tbl$
-		alter table %I ADD CONSTRAINT %I_PK PRIMARY KEY (%s);
-		$tbl$,
-		agg_table,
-		agg_table,
-		group_by_columns_joined
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_timeseries_table_remove_%I(_pgf_row %I) -- id, table_name
+		RETURNS void
+		LANGUAGE plpgsql AS $inner_fun$
+		DECLARE %s -- bucket variables
+		BEGIN %s -- remove_fragment
+		END;
+		$inner_fun$
+		$fun$,
+		id, table_name,
+		declare_fragment,
+		remove_fragment
 	);
 
 	-- create main trigger
-	str := format($fun$
-		CREATE OR REPLACE FUNCTION _pgf_internal_minmax_table_trgfun_%I() --id
+	execute format($fun$
+		CREATE OR REPLACE FUNCTION _pgf_internal_timeseries_table_trgfun_%I() -- id
 		RETURNS TRIGGER AS $inner_trg$
-			DECLARE
-				id_of_min_val %I.%I%%TYPE; -- table_name, pk
-				id_of_max_val %I.%I%%TYPE; -- table_name, pk
-			BEGIN
-				IF TG_OP='INSERT' then
-			    	insert into %I(%s, min_value, id_of_min, max_value, id_of_max, row_count) --agg_table, group_by_columns_joined
-					values(%s, NEW.%I, NEW.%I, NEW.%I, NEW.%I, 1) --group_by_columns_new_joined, aggregate_column, pk, aggregate_column, pk
-					on conflict(%s) do update set -- group_by_columns_joined
-						min_value = least(%I.min_value, NEW.%I), --agg_table, aggregate_column
-						id_of_min=case when NEW.%I < %I.min_value then NEW.%I else %I.id_of_min END, --aggregate_column, agg_table, pk, agg_table
-						max_value=GREATEST(%I.max_value, NEW.%I), --agg_table, aggregate_column
-						id_of_max=case when  NEW.%I > %I.max_value then NEW.%I else %I.id_of_max END, --aggregate_column, agg_table, pk, agg_table
-						row_count=%I.row_count+1; -- agg_table
-				ELSIF TG_OP='DELETE' then
-					select id_of_min, id_of_max
-					into id_of_min_val, id_of_max_val
-					from %I --agg_table
-					where %s; -- where_condition_on_group_by
-
-					update %I set row_count=row_count-1 -- agg_table
-					where %s; -- where_condition_on_group_by
-
-					/* handle case when row_count goes down to zero -> row should be removed */
-					delete from %I -- agg_table
-					where row_count = 0
-					and %s; -- where_condition_on_group_by
-
-					if id_of_min_val = OLD.%I then -- pk
-						update %I set -- agg_table
-							min_value = (select min(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
-							id_of_min = (select %I from %I where %s order by %I asc limit 1) --pk, table_name, where_condition_on_group_by, aggregate_column
-						where %s; -- where_condition_on_group_by
-					end if;
-					if id_of_max_val = OLD.%I then -- pk
-						update %I set -- agg_table
-							max_value = (select max(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
-							id_of_max = (select %I from %I where %s order by %I desc limit 1) --pk, table_name, where_condition_on_group_by, aggregate_column
-						where %s; -- where_condition_on_group_by
-					end if;
-		$fun$
-        , id
-        , table_name, pk
-        , table_name, pk
-        , agg_table, group_by_columns_joined
-        , group_by_columns_new_joined, aggregate_column, pk, aggregate_column, pk
-        , group_by_columns_joined
-        , agg_table, aggregate_column
-        , aggregate_column, agg_table, pk, agg_table
-        , agg_table, aggregate_column
-        , aggregate_column, agg_table, pk, agg_table
-        , agg_table
-        , agg_table
-        , where_condition_on_group_by
-        , agg_table
-        , where_condition_on_group_by
-        , agg_table
-        , where_condition_on_group_by
-        , pk
-        , agg_table
-        , aggregate_column, table_name, where_condition_on_group_by
-        , pk, table_name, where_condition_on_group_by, aggregate_column
-        , where_condition_on_group_by
-        , pk
-        , agg_table
-        , aggregate_column, table_name, where_condition_on_group_by
-        , pk, table_name, where_condition_on_group_by, aggregate_column
-        , where_condition_on_group_by
-		) || format($fun$
-				ELSIF TG_OP = 'UPDATE' then
-					/* Only update if group by columns changed */
-					/* compare each group by column between OLD and NEW */
-					IF NOT (%s) THEN -- where_condition_on_group_by_OLDNEW
-						/* Decrement row_count and update min/max for OLD group */
-						select id_of_min, id_of_max
-						into id_of_min_val, id_of_max_val
-						from %I -- agg_table
-						where %s; -- where_condition_on_group_by
-
-						update %I set row_count=row_count-1 -- agg_table
-						where %s; -- where_condition_on_group_by
+		DECLARE
+			old_row_matches_filter boolean := false;
+			new_row_matches_filter boolean := false;
+		BEGIN
+			IF TG_OP = 'TRUNCATE' then
+				call _pgf_internal_refresh_%I(); -- id
+				RETURN NULL;
+			END IF;
 
-						/* handle case when row_count goes down to zero -> row should be removed */
-						delete from %I -- agg_table
-						where row_count = 0
-						and %s; -- where_condition_on_group_by
+			/* test if OLD row matches filter */
+			IF TG_OP in ('UPDATE', 'DELETE') then
+				select count(*) = 1 into old_row_matches_filter from (select OLD.*) t where %s; -- row_filter
+			END IF;
 
-						if id_of_min_val = OLD.%I then -- pk
-							update %I set -- agg_table
-								min_value = (select min(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
-								id_of_min = (select %I from %I where %s order by %I asc limit 1) -- pk, table_name, where_condition_on_group_by, aggregate_column
-							where %s; -- where_condition_on_group_by
-						end if;
-						if id_of_max_val = OLD.%I then -- pk
-							update %I set -- agg_table
-								max_value = (select max(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
-								id_of_max = (select %I from %I where %s order by %I desc limit 1) -- pk, table_name, where_condition_on_group_by, aggregate_column
-							where %s; -- where_condition_on_group_by
-						end if;
+			/* test if NEW row matches filter */
+			IF TG_OP in ('UPDATE', 'INSERT') then
+				select count(*) = 1 into new_row_matches_filter from (select NEW.*) t where %s; -- row_filter
+			END IF;
 
-						/* Increment row_count and update min/max for NEW group */
-						insert into %I(%s, min_value, id_of_min, max_value, id_of_max, row_count) -- agg_table, group_by_columns_joined
-						values(%s, NEW.%I, NEW.%I, NEW.%I, NEW.%I, 1) -- group_by_columns_new_joined, aggregate_column, pk, aggregate_column, pk
-						on conflict(%s) do update set -- group_by_columns_joined
-							min_value = least(%I.min_value, NEW.%I), -- agg_table, aggregate_column
-							id_of_min=case when NEW.%I < %I.min_value then NEW.%I else %I.id_of_min END, -- aggregate_column, agg_table, pk, agg_table
-							max_value=GREATEST(%I.max_value, NEW.%I), -- agg_table, aggregate_column
-							id_of_max=case when  NEW.%I > %I.max_value then NEW.%I else %I.id_of_max END, -- aggregate_column, agg_table, pk, agg_table
-							row_count=%I.row_count+1; -- agg_table
-					/* If group by columns did not change, only update min/max if aggregate_column changed */
-					ELSIF OLD.%I <> NEW.%I THEN -- aggregate_column, aggregate_column
-						update %I set -- agg_table
-							min_value = (select min(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
-							id_of_min = (select %I from %I where %s order by %I asc limit 1), -- pk, table_name, where_condition_on_group_by, aggregate_column
-							max_value = (select max(%I) from %I where %s), -- aggregate_column, table_name, where_condition_on_group_by
-							id_of_max = (select %I from %I where %s order by %I desc limit 1) -- pk, table_name, where_condition_on_group_by, aggregate_column
-						where %s; -- where_condition_on_group_by
-					END IF;
-				END IF;
-				RETURN NEW;
-			END;
-			$inner_trg$ LANGUAGE plpgsql;
+			IF TG_OP = 'UPDATE' and old_row_matches_filter = new_row_matches_filter
+				and (%s) is not distinct from (%s) then -- old values, new values
+				RETURN NULL; -- the aggregates have not changed
+			END IF;
+			IF old_row_matches_filter then
+				perform _pgf_internal_timeseries_table_remove_%I(OLD); -- id
+			END IF;
+			IF new_row_matches_filter then
+				perform _pgf_internal_timeseries_table_add_%I(NEW); -- id
+			END IF;
+			RETURN NULL;
+		END;
+		$inner_trg$ LANGUAGE plpgsql;
 		$fun$
-        , where_condition_on_group_by_OLDNEW
-        , agg_table
-        , where_condition_on_group_by
-        , agg_table
-        , where_condition_on_group_by
-        , agg_table
-        , where_condition_on_group_by
-        , pk
-        , agg_table
-        , aggregate_column, table_name, where_condition_on_group_by
-        , pk, table_name, where_condition_on_group_by, aggregate_column
-        , where_condition_on_group_by
-        , pk
-        , agg_table
-        , aggregate_column, table_name, where_condition_on_group_by
-        , pk, table_name, where_condition_on_group_by, aggregate_column
-        , where_condition_on_group_by
-        , agg_table, group_by_columns_joined
-        , group_by_columns_new_joined, aggregate_column, pk, aggregate_column, pk
-        , group_by_columns_joined
-        , agg_table, aggregate_column
-        , aggregate_column, agg_table, pk, agg_table
-        , agg_table, aggregate_column
-        , aggregate_column, agg_table, pk, agg_table
-        , agg_table
-        , aggregate_column, aggregate_column
-        , agg_table
-        , aggregate_column, table_name, where_condition_on_group_by
-        , pk, table_name, where_condition_on_group_by, aggregate_column
-        , aggregate_column, table_name, where_condition_on_group_by
-        , pk, table_name, where_condition_on_group_by, aggregate_column
-        , where_condition_on_group_by
-
+		, id
+		, id
+		, row_filter
+		, row_filter
+		, _pgf_internal_join(ARRAY[timestamp_column] || group_by_column || sum_columns || min_columns || max_columns, 'OLD.%s', ', ')
+		, _pgf_internal_join(ARRAY[timestamp_column] || group_by_column || sum_columns || min_columns || max_columns, 'NEW.%s', ', ')
+		, id
+		, id
 	);
-	execute str;
 
     execute format($trg$
-		CREATE TRIGGER _pgf_internal_minmax_table_trg_%I
-		after delete or insert or update ON %I
+		CREATE TRIGGER _pgf_internal_timeseries_table_trg_%I -- id
+		after delete or insert or update ON %I -- table_name
 		FOR EACH ROW
-		execute procedure _pgf_internal_minmax_table_trgfun_%I();
+		execute procedure _pgf_internal_timeseries_table_trgfun_%I(); -- id
 		$trg$,
 		id,
-		quote_ident(table_name),
+		table_name,
+		id
+	);
+
+    execute format($trg$
+		CREATE TRIGGER _pgf_internal_timeseries_table_trg_truncate_%I -- id
+		after truncate ON %I -- table_name
+		FOR EACH STATEMENT
+		execute procedure _pgf_internal_timeseries_table_trgfun_%I(); -- id
+		$trg$,
+		id,
+		table_name,
 		id
 	);
 
@@ -1751,54 +7460,59 @@ BEGIN
 		CREATE or replace PROCEDURE _pgf_internal_refresh_%I() -- id
 		LANGUAGE plpgsql
 		AS $body$
-			begin
-			    delete from %I; -- agg_table
-
-				WITH t_ranked AS (
-				SELECT
-					%s, -- group_by_columns_joined
-					%I, -- pk
-					%I, -- aggregate_column
-					ROW_NUMBER() OVER (PARTITION BY %s ORDER BY %I ASC) AS rn_min, -- group_by_columns_joined, aggregate_column
-					ROW_NUMBER() OVER (PARTITION BY %s ORDER BY %I DESC) AS rn_max, -- group_by_columns_joined, aggregate_column
-					COUNT(*)  OVER (PARTITION BY %s) AS row_count -- group_by_columns_joined
-				FROM %I -- table_name
-				)
-				insert into %I -- agg_table
-				SELECT
-				%s, -- group_by_columns_joined
-				MIN(CASE WHEN rn_min = 1 THEN %I END) AS min_value, -- aggregate_column
-				MIN(CASE WHEN rn_min = 1 THEN %I END) AS id_of_min, -- pk
-				MAX(CASE WHEN rn_max = 1 THEN %I END) AS max_value, -- aggregate_column
-				MAX(CASE WHEN rn_max = 1 THEN %I END) AS id_of_max, -- pk
-				MIN(row_count) as row_count
-				FROM t_ranked
-				GROUP BY %s; -- group_by_columns_joined
+			declare
+				_pgf_partition_start %s; -- timestamp_type
+			begin %s -- refresh_fragment
 			end;
 			$body$;
 		$inner_proc$
 		, id
-		, agg_table
-		, group_by_columns_joined
-		, pk
-		, aggregate_column
-		, group_by_columns_joined, aggregate_column
-		, group_by_columns_joined, aggregate_column
-		, group_by_columns_joined
-		, table_name
-		, agg_table
-		, group_by_columns_joined
-		, aggregate_column
-		, pk
-		, aggregate_column
-		, pk
-		, group_by_columns_joined
+		, timestamp_type
+		, refresh_fragment
 	);
 
-	call pgf_refresh(id);
+	call _pgf_internal_post_create(id);
 END;
 $proc$;
 
+-- Delete the buckets of a TIMESERIES_TABLE formula older than the retention of their resolution (options 'retention' and
+-- 'rollups'). The partitions holding only expired buckets are dropped; the remaining expired buckets are deleted.
+-- Schedule it, e.g. every hour with pg_cron.
+CREATE or replace PROCEDURE pgf_timeseries_expire(id TEXT)
+LANGUAGE plpgsql AS $proc$
+DECLARE
+	args JSONB;
+	r JSONB;
+	partition_name TEXT;
+	is_expired boolean;
+BEGIN
+	args := _pgf_internal_get_metadata(id);
+	if args->>'kind' is distinct from 'timeseries_table' then
+		raise exception 'Formula % is not a TIMESERIES_TABLE formula', id;
+	end if;
+
+	for r in select * from jsonb_array_elements(jsonb_build_array(jsonb_build_object(
+			'agg_table', args->'options'->>'agg_table',
+			'retention', args->'options'->'retention',
+			'partition_interval', args->'options'->'partition_interval'
+		)) || (args->'options'->'rollups')) loop
+		if r->>'retention' is null then
+			continue;
+		end if;
+		for partition_name in
+			select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid
+			where i.inhparent = to_regclass(quote_ident(r->>'agg_table')) and r->>'partition_interval' is not null
+			order by c.relname
+		loop
+			execute format('select not exists (select 1 from %I where bucket_start >= now() - %L::interval)', partition_name, r->>'retention') into is_expired;
+			if is_expired then
+				execute format('DROP TABLE %I', partition_name);
+			end if;
+		end loop;
+		execute format('delete from %I where bucket_start < now() - %L::interval', r->>'agg_table', r->>'retention');
+	end loop;
+END;
+$proc$;
 
 --------------------------------------------------------------------------------
 -- TREE_LEVEL
@@ -1958,7 +7672,7 @@ BEGIN
 	, table_name, pk_column, pk_column
 	);
     -- Full refresh: update all levels in the table
-	call pgf_refresh(id);
+	call _pgf_internal_post_create(id);
 
 END;
 $proc$;
@@ -1989,12 +7703,7 @@ DECLARE
 	depth_column_name TEXT;
 BEGIN
 	-- set default values for optional arguments
-	options := jsonb_build_object(
-		'closure_table_name', table_name || '_closure',
-		'ancestor_id_column_name', 'ancestor_id',
-		'descendant_id_column_name', 'descendant_id',
-		'depth_column_name', 'depth'
-	) || options;
+	options := _pgf_internal_default_options('tree_closure_table', jsonb_build_object('table_name', table_name, 'options', options));
 
 	call _pgf_internal_insert_metadata(id, 'tree_closure_table', jsonb_build_object(
 		'table_name', table_name,
@@ -2024,6 +7733,7 @@ BEGIN
     );
 
 	execute format('alter table %I add primary key(%I, %I);', closure_table_name, ancestor_id_column_name, descendant_id_column_name);
+	call _pgf_internal_apply_storage(closure_table_name, options->'storage', ARRAY[ancestor_id_column_name]);
 
     /* Create the trigger function */
     execute format($f$
@@ -2170,7 +7880,7 @@ BEGIN
         , closure_table_name, ancestor_id_column_name, descendant_id_column_name, depth_column_name
 	);
     -- Full refresh: update all levels in the table
-	call pgf_refresh(id);
+	call _pgf_internal_post_create(id);
 
 END;
 $proc$;
@@ -2195,7 +7905,7 @@ DECLARE
     col_defs TEXT := '';
     cols_union TEXT := '';
     sub_cols TEXT[];
-    sub_col_names TEXT;
+    sub_table_columns JSONB; -- sub-table name -> array of column names
     insert_cols TEXT;
     select_expr TEXT;
 	sql TEXT;
@@ -2203,10 +7913,7 @@ DECLARE
 	discriminator_values TEXT[];
 BEGIN
 	-- Apply default values to options
-	options := jsonb_build_object(
-        'discriminator_column', 'discriminator',
-		'discriminator_values', sub_tables
-    ) || options;
+	options := _pgf_internal_default_options('inheritance_table', jsonb_build_object('sub_tables', sub_tables, 'options', options));
 	discriminator_column := options->>'discriminator_column';
 	discriminator_values := _pgf_internal_jsonb_to_text_array(options->'discriminator_values');
 
@@ -2217,14 +7924,21 @@ BEGIN
 		'options', options
 	));
 
+    -- Read the columns of all sub-tables once from the catalog
+    select jsonb_object_agg(t.table_name, t.column_names) into sub_table_columns from (
+        select c.table_name, jsonb_agg(c.column_name order by c.ordinal_position) as column_names
+        from _pgf_internal_table_columns(sub_tables) c
+        where c.column_name <> discriminator_column
+        group by c.table_name
+    ) t;
+
     -- Gather all columns from all sub-tables (excluding duplicates)
     col_defs := format('%I TEXT', discriminator_column);
     FOR col_name, col_type IN
 		select column_name, data_type from (
 			SELECT DISTINCT on (column_name) column_name, data_type, ordinal_position
-			FROM information_schema.columns
-			WHERE table_name = ANY(sub_tables)
-			AND column_name <> discriminator_column
+			FROM _pgf_internal_table_columns(sub_tables)
+			WHERE column_name <> discriminator_column
 		) t order by ordinal_position
 	LOOP
         col_defs := col_defs || format(', %I %s', col_name, col_type);
@@ -2233,22 +7947,14 @@ BEGIN
 
     -- Create union table with all columns
     EXECUTE format('CREATE TABLE IF NOT EXISTS %I (%s);', base_table_name, col_defs);
+	call _pgf_internal_apply_storage(base_table_name, options->'storage'); -- no primary key: cannot be partitioned
 
     -- create refresh procedure: copy all sub-tables into base table
 	sql := format('delete from %I;', base_table_name);
 
     FOR i IN 1..array_length(sub_tables, 1) LOOP
         -- Get columns for this sub-table
-        sub_cols := ARRAY[]::TEXT[];
-        sub_col_names := '';
-        FOR col_name IN
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_name = sub_tables[i]
-              AND column_name <> discriminator_column
-        LOOP
-            sub_cols := array_append(sub_cols, col_name);
-        END LOOP;
+        sub_cols := coalesce(_pgf_internal_jsonb_to_text_array(sub_table_columns->sub_tables[i]), ARRAY[]::TEXT[]);
 
         -- Build insert column list for union table
         insert_cols := '';
@@ -2288,15 +7994,7 @@ BEGIN
         -- Propagate changes from sub-tables to base table
         FOR i IN 1..array_length(sub_tables, 1) LOOP
             -- Get columns for this sub-table
-            sub_cols := ARRAY[]::TEXT[];
-            FOR col_name IN
-                SELECT column_name
-                FROM information_schema.columns
-                WHERE table_name = sub_tables[i]
-                  AND column_name <> discriminator_column
-            LOOP
-                sub_cols := array_append(sub_cols, col_name);
-            END LOOP;
+            sub_cols := coalesce(_pgf_internal_jsonb_to_text_array(sub_table_columns->sub_tables[i]), ARRAY[]::TEXT[]);
 
             -- Build insert column list and select expr for NEW row
             insert_cols := '';
@@ -2342,15 +8040,7 @@ BEGIN
         -- Propagate changes from base table to sub-tables
         FOR i IN 1..array_length(sub_tables, 1) LOOP
             -- Get columns for this sub-table
-            sub_cols := ARRAY[]::TEXT[];
-            FOR col_name IN
-                SELECT column_name
-                FROM information_schema.columns
-                WHERE table_name = sub_tables[i]
-                  AND column_name <> discriminator_column
-            LOOP
-                sub_cols := array_append(sub_cols, col_name);
-            END LOOP;
+            sub_cols := coalesce(_pgf_internal_jsonb_to_text_array(sub_table_columns->sub_tables[i]), ARRAY[]::TEXT[]);
 
             -- Build insert column list and select expr for NEW row
             insert_cols := '';
@@ -2397,7 +8087,7 @@ BEGIN
         END LOOP;
     END IF;
 
-	call pgf_refresh(id);
+	call _pgf_internal_post_create(id);
 
 END;
 $proc$;
@@ -2430,13 +8120,7 @@ DECLARE
 	is_delete_audited TEXT; -- 'true' if delete operations are audited, 'false' otherwise
 BEGIN
     -- Set default options
-    options := jsonb_build_object(
-		'operation_column_name', 'OPERATION',
-        'operations_mapping', jsonb_build_object('INSERT', 'INSERT', 'UPDATE', 'UPDATE', 'DELETE', 'DELETE'),
-        'old_value_column_name', 'OLD_VALUE',
-        'new_value_column_name', 'NEW_VALUE',
-		'audited_operations', json_build_array('INSERT', 'UPDATE', 'DELETE')
-	) || options;
+    options := _pgf_internal_default_options('audit_table', jsonb_build_object('options', options));
 
     operation_column_name := options->>'operation_column_name';
     operations_mapping := options->'operations_mapping';
@@ -2475,6 +8159,8 @@ BEGIN
         old_value_column_name,
         new_value_column_name
     );
+	-- the audit trail cannot be rebuilt: it cannot be unlogged
+	call _pgf_internal_apply_storage(audit_table_name, options->'storage', rebuildable => false);
 
     -- Create triggers for each audited table
     FOR i IN 1..array_length(audited_table_names, 1) LOOP
@@ -2537,6 +8223,8 @@ BEGIN
             trg_func_name
         );
     END LOOP;
+
+    call _pgf_internal_post_create(id);
 END;
 $proc$;
 
@@ -2627,7 +8315,7 @@ BEGIN
 	);
 
 	-- refresh
-	call pgf_refresh(id);
+	call _pgf_internal_post_create(id);
 
 END;
 $proc$;
@@ -2637,12 +8325,18 @@ $proc$;
 --------------------------------------------------------------------------------
 -- INTERSECT_TABLE / UNION_TABLE
 --------------------------------------------------------------------------------
+-- previous signatures, without options
+DROP PROCEDURE IF EXISTS _pgf_internal_intersect_union_table(TEXT, TEXT[], TEXT[], TEXT, TEXT);
+DROP PROCEDURE IF EXISTS pgf_intersect_table(TEXT, TEXT[], TEXT[], TEXT);
+DROP PROCEDURE IF EXISTS pgf_union_table(TEXT, TEXT[], TEXT[], TEXT);
+
 CREATE OR REPLACE PROCEDURE _pgf_internal_intersect_union_table(
     id TEXT,
     table_names TEXT[],
 	column_names TEXT[],
     combined_table_name TEXT,
-	operation TEXT -- 'intersection' or 'union'
+	operation TEXT, -- 'intersection' or 'union'
+	options JSONB
 )
 LANGUAGE plpgsql
 AS $proc$
@@ -2691,6 +8385,7 @@ BEGIN
 	for i in 1..array_length(table_names, 1) loop
 		execute format('alter table %I alter column pgf_row_count_%I set default 0;', combined_table_name, table_names[i]);
 	end loop;
+	call _pgf_internal_apply_storage(combined_table_name, options->'storage', column_names);
 
     -- Create trigger functions
 	foreach t in array table_names loop
@@ -2773,7 +8468,7 @@ BEGIN
 	);
 
 	-- refresh
-	call pgf_refresh(id);
+	call _pgf_internal_post_create(id);
 END;
 $proc$;
 
@@ -2781,19 +8476,23 @@ CREATE OR REPLACE PROCEDURE pgf_intersect_table(
     id TEXT,
     table_names TEXT[],
 	column_names TEXT[],
-    intersect_table_name TEXT
+    intersect_table_name TEXT,
+	options JSONB DEFAULT '{}'::JSONB
 )
 LANGUAGE plpgsql
 AS $proc$
 BEGIN
+	options := _pgf_internal_default_options('intersect_table', jsonb_build_object('options', options));
+
     -- Insert metadata
     call _pgf_internal_insert_metadata(id, 'intersect_table', jsonb_build_object(
         'table_names', table_names,
         'column_names', column_names,
-        'intersect_table_name', intersect_table_name
+        'intersect_table_name', intersect_table_name,
+        'options', options
     ));
 
-	call _pgf_internal_intersect_union_table(id, table_names, column_names, intersect_table_name, 'intersection');
+	call _pgf_internal_intersect_union_table(id, table_names, column_names, intersect_table_name, 'intersection', options);
 
 END;
 $proc$;
@@ -2802,19 +8501,23 @@ CREATE OR REPLACE PROCEDURE pgf_union_table(
     id TEXT,
     table_names TEXT[],
 	column_names TEXT[],
-    union_table_name TEXT
+    union_table_name TEXT,
+	options JSONB DEFAULT '{}'::JSONB
 )
 LANGUAGE plpgsql
 AS $proc$
 BEGIN
+	options := _pgf_internal_default_options('union_table', jsonb_build_object('options', options));
+
     -- Insert metadata
-    call _pgf_internal_insert_metadata(id, 'intersect_table', jsonb_build_object(
+    call _pgf_internal_insert_metadata(id, 'union_table', jsonb_build_object(
         'table_names', table_names,
         'column_names', column_names,
-        'union_table_name', union_table_name
+        'union_table_name', union_table_name,
+        'options', options
     ));
 
-	call _pgf_internal_intersect_union_table(id, table_names, column_names, union_table_name, 'union');
+	call _pgf_internal_intersect_union_table(id, table_names, column_names, union_table_name, 'union', options);
 
 END;
 $proc$;
@@ -0,0 +1,258 @@
+"""Parallel refresh of pg_formulas formulas.
+
+Refreshes all formulas declared in pgf_metadata (or the given formula ids) over a pool of connections:
+- a formula is refreshed only after the formulas it depends on (see the pgf_dependency view),
+- large refreshes of formulas supported by pgf_refresh_range are split into disjoint primary key ranges,
+- two formulas writing the same table are never refreshed at the same time, to avoid lock conflicts.
+
+Usage (from the repository root):
+    python -m scripts.pgf_parallel_refresh --workers 32 [formula_id ...]
+
+Connection settings are read from tests/settings.py.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import psycopg2
+import psycopg2.errors
+
+from tests import settings
+
+MAX_DEADLOCK_RETRIES = 3
+
+
+class RefreshTask:
+    def __init__(self, formula_id, target_tables, range_start=None, range_end=None, range_index=0, range_count=1,
+                 estimated_rows=0):
+        self.formula_id = formula_id
+        self.target_tables = target_tables
+        self.range_start = range_start
+        self.range_end = range_end
+        self.range_index = range_index
+        self.range_count = range_count
+        self.estimated_rows = estimated_rows
+
+    def describe(self):
+        if self.range_count == 1:
+            return self.formula_id
+        return f'{self.formula_id} (range {self.range_index + 1}/{self.range_count})'
+
+    def run(self, conn):
+        with conn.cursor() as cur:
+            if self.range_count == 1:
+                cur.execute('call pgf_refresh(%s)', (self.formula_id,))
+            else:
+                cur.execute('call pgf_refresh_range(%s, %s, %s)', (self.formula_id, self.range_start, self.range_end))
+        conn.commit()
+
+
+class ParallelRefresh:
+    def __init__(self, workers, chunk_rows, connect=None, log=None):
+        self.workers = workers
+        self.chunk_rows = chunk_rows
+        self.connect = connect or connect_from_settings
+        self.log = log or (lambda msg: print(msg, file=sys.stderr, flush=True))
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    # ----------------------------------------------------------------
+    # PLANNING
+    # ----------------------------------------------------------------
+
+    # returns a dict: formula id -> {kind, args, sources, targets}
+    def load_formulas(self, conn, ids=None):
+        with conn.cursor() as cur:
+            cur.execute("""
+                select id, kind, args, _pgf_internal_source_tables(kind, args), _pgf_internal_target_tables(kind, args)
+                from pgf_metadata
+                order by id
+            """)
+            formulas = {}
+            for id, kind, args, sources, targets in cur.fetchall():
+                if ids and id not in ids:
+                    continue
+                formulas[id] = {'kind': kind, 'args': args, 'sources': set(sources), 'targets': set(targets)}
+        unknown_ids = set(ids or []) - set(formulas)
+        if unknown_ids:
+            raise ValueError(f'Unknown formula id(s): {", ".join(sorted(unknown_ids))}')
+        return formulas
+
+    # returns a dict: formula id -> set of formula ids it depends on (see the pgf_dependency view)
+    def dependencies(self, conn, formulas):
+        deps = {id: set() for id in formulas}
+        with conn.cursor() as cur:
+            cur.execute('select id, depends_on_id from pgf_dependency')
+            for id, depends_on_id in cur.fetchall():
+                if id in deps and depends_on_id in formulas:
+                    deps[id].add(depends_on_id)
+        return deps
+
+    def split_ranges(self, conn, formula_id, formula):
+        args = formula['args']
+        with conn.cursor() as cur:
+            cur.execute('select _pgf_internal_range_refresh_kinds()')
+            range_kinds = cur.fetchone()[0]
+            cur.execute("select greatest(reltuples, 0)::bigint from pg_class where oid = to_regclass(quote_ident(%s))",
+                        (args.get('base_table_name'),))
+            row = cur.fetchone()
+            estimated_rows = row[0] if row else 0
+            if formula['kind'] not in range_kinds or estimated_rows <= self.chunk_rows:
+                return [RefreshTask(formula_id, formula['targets'], estimated_rows=estimated_rows)]
+
+            range_count = -(-estimated_rows // self.chunk_rows)
+            fractions = [i / range_count for i in range(1, range_count)]
+            cur.execute(f"""
+                select array_agg(distinct b order by b)::text[] from (
+                    select unnest(percentile_disc(%s::float8[]) within group (order by {quote_ident(args['base_pk'])})) as b
+                    from {quote_ident(args['base_table_name'])}
+                ) t
+            """, (fractions,))
+            boundaries = cur.fetchone()[0] or []
+        bounds = [None] + boundaries + [None]
+        count = len(bounds) - 1
+        return [RefreshTask(formula_id, formula['targets'], bounds[i], bounds[i + 1], i, count, estimated_rows // count)
+                for i in range(count)]
+
+    def plan(self, ids=None):
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute('call pgf_recover_unlogged()')  # after a crash, unlogged tables are rebuilt first
+            formulas = self.load_formulas(conn, ids)
+            deps = self.dependencies(conn, formulas)
+            tasks = {id: self.split_ranges(conn, id, f) for id, f in formulas.items()}
+            conn.commit()
+        finally:
+            conn.close()
+        return formulas, deps, tasks
+
+    # ----------------------------------------------------------------
+    # EXECUTION
+    # ----------------------------------------------------------------
+
+    def worker_connection(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.connect()
+            with self.connections_lock:
+                self.connections.append(self.local.conn)
+        return self.local.conn
+
+    def run_task(self, task):
+        conn = self.worker_connection()
+        for attempt in range(MAX_DEADLOCK_RETRIES + 1):
+            try:
+                start = time.monotonic()
+                task.run(conn)
+                return time.monotonic() - start
+            except psycopg2.errors.DeadlockDetected:
+                conn.rollback()
+                if attempt == MAX_DEADLOCK_RETRIES:
+                    raise
+                self.log(f'deadlock detected while refreshing {task.describe()}, retrying')
+            except Exception:
+                conn.rollback()
+                raise
+
+    def run(self, ids=None):
+        formulas, deps, tasks = self.plan(ids)
+        pending = {id: list(formula_tasks) for id, formula_tasks in tasks.items()}
+        remaining_tasks = {id: len(formula_tasks) for id, formula_tasks in tasks.items()}
+        done_formulas = set()
+        total = sum(remaining_tasks.values())
+        done = 0
+        rows = 0
+        running = {}  # future -> task
+        start = time.monotonic()
+        self.log(f'refreshing {len(formulas)} formula(s) as {total} task(s) with {self.workers} worker(s)')
+
+        try:
+            # on error, leaving the with block waits for the running tasks to complete
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while pending or running:
+                    for task in self.next_tasks(pending, deps, done_formulas, running, cycle_breaker=not running):
+                        running[executor.submit(self.run_task, task)] = task
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        task = running.pop(future)
+                        duration = future.result()
+                        done += 1
+                        rows += task.estimated_rows
+                        remaining_tasks[task.formula_id] -= 1
+                        if remaining_tasks[task.formula_id] == 0:
+                            done_formulas.add(task.formula_id)
+                        elapsed = time.monotonic() - start
+                        self.log(f'[{done}/{total}] {task.describe()} refreshed in {duration:.2f}s'
+                                 f' - {done / elapsed:.1f} tasks/s, {rows / elapsed:,.0f} rows/s')
+        finally:
+            self.close_connections()
+
+        elapsed = time.monotonic() - start
+        self.log(f'refreshed {len(formulas)} formula(s) in {elapsed:.2f}s')
+        return done
+
+    # returns the tasks that can be started now
+    def next_tasks(self, pending, deps, done_formulas, running, cycle_breaker):
+        started = []
+        busy_tables = {}  # table name -> formula id currently writing it
+        for task in running.values():
+            for t in task.target_tables:
+                busy_tables[t] = task.formula_id
+        ready_ids = [id for id in pending if deps[id] <= done_formulas]
+        if not ready_ids and cycle_breaker:
+            # dependency cycle (created before cycles were rejected): refresh the remaining formulas in id order
+            self.log(f'dependency cycle between formulas: {", ".join(sorted(pending))}')
+            ready_ids = sorted(pending)[:1]
+        for id in ready_ids:
+            while pending[id] and len(running) + len(started) < self.workers:
+                task = pending[id][0]
+                if any(busy_tables.get(t, id) != id for t in task.target_tables):
+                    break
+                started.append(pending[id].pop(0))
+                for t in task.target_tables:
+                    busy_tables[t] = id
+            if not pending[id]:
+                del pending[id]
+        return started
+
+    def close_connections(self):
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def connect_from_settings():
+    conn = psycopg2.connect(
+        host=settings.DATABASE["host"],
+        port=settings.DATABASE["port"],
+        dbname=settings.DATABASE["name"],
+        user=settings.DATABASE["user"],
+        password=settings.DATABASE["password"],
+    )
+    with conn.cursor() as cur:
+        cur.execute(f'SET search_path TO {quote_ident(settings.DATABASE["schema"])}')
+    conn.commit()
+    return conn
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Refresh pg_formulas formulas in parallel.')
+    parser.add_argument('ids', nargs='*', help='ids of the formulas to refresh (default: all formulas)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of connections (default: cpu count)')
+    parser.add_argument('--chunk-rows', type=int, default=1_000_000,
+                        help='split refreshes of tables larger than this estimated row count into key ranges')
+    args = parser.parse_args(argv)
+    ParallelRefresh(args.workers, args.chunk_rows).run(args.ids or None)
+
+
+if __name__ == '__main__':
+    main()
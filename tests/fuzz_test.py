@@ -71,6 +71,8 @@ class TestDbFuzzerModule(unittest.TestCase):
         self.__test_kind('count')
     def test_minmax_table(self):
         self.__test_kind('minmax_table')
+    def test_topn_table(self):
+        self.__test_kind('topn_table')
     def test_tree_level(self):
         self.__test_kind('tree_level')
     def test_inheritance_table(self):
@@ -90,4 +92,22 @@ class TestDbFuzzerModule(unittest.TestCase):
     def test_id_of_min(self):
         self.__test_kind('id_of_min')
     def test_array_agg(self):
-        self.__test_kind('array_agg')
\ No newline at end of file
+        self.__test_kind('array_agg')
+    def test_string_agg(self):
+        self.__test_kind('string_agg')
+    def test_count_distinct(self):
+        self.__test_kind('count_distinct')
+    def test_approx_count_distinct(self):
+        self.__test_kind('approx_count_distinct')
+    def test_histogram_table(self):
+        self.__test_kind('histogram_table')
+    def test_timeseries_table(self):
+        self.__test_kind('timeseries_table')
+    def test_window_count(self):
+        self.__test_kind('window_count')
+    def test_window_sum(self):
+        self.__test_kind('window_sum')
+    def test_running_sum(self):
+        self.__test_kind('running_sum')
+    def test_rank(self):
+        self.__test_kind('rank')
\ No newline at end of file
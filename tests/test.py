@@ -1,4 +1,5 @@
 from decimal import Decimal
+import json
 import psycopg2
 import psycopg2.extras
 import unittest
@@ -92,9 +93,9 @@ class TestModule(unittest.TestCase):
     # COMMUN FUNCTIONS TESTS
     # --------------------------------------------------------------------
     def test_enable_disable_drop(self):
-        kinds = ['revdate', 'count', 'minmax_table', 'tree_level', 'inheritance_table', 'audit_table',
-                 'sync', 'sum', 'intersect_table', 'union_table', 'min', 'max', 'id_of_min', 'array_agg',
-                 'tree_closure_table']
+        kinds = ['revdate', 'count', 'minmax_table', 'sum_table', 'count_table', 'histogram_table', 'timeseries_table', 'topn_table', 'tree_level', 'inheritance_table', 'audit_table',
+                 'sync', 'sum', 'intersect_table', 'union_table', 'min', 'max', 'id_of_min', 'id_of_max', 'array_agg',
+                 'string_agg', 'count_distinct', 'approx_count_distinct', 'window_count', 'window_sum', 'running_sum', 'rank', 'tree_closure_table']
         for kind in kinds:
             for i in range(1, 2):
                 id = f'{kind}_id'
@@ -113,7 +114,125 @@ class TestModule(unittest.TestCase):
                 self.assert_sql_equal_scalar("select count(*) from pg_proc p where p.proname like '_pgf_internal_%%_' || %s;", 0, (id,) )
                 self.assert_sql_equal_scalar( "select count(*) from pg_trigger t where t.tgname like '_pgf_internal_%%_' || %s;",0, (id,) )
                 self.cur.execute("commit");
-    
+
+    def test_deploy(self):
+        self.create_tables('sum', 'deploy_sum', False)
+        self.cur.execute("alter table customer add column invoice_count int default 0;")
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) values(1, 'invoice 1', 1, 10.0), (2, 'invoice 2', 1, 5.0), (3, 'invoice 3', 2, 1.0);")
+        manifest = """{"formulas": [
+            {"id": "deploy_count", "kind": "count", "args": {"base_table_name": "customer", "base_pk": "id", "base_count_column": "invoice_count",
+                "linked_table_name": "invoice", "linked_fk": "customer_id"}},
+            {"id": "deploy_sum", "kind": "sum", "args": {"base_table_name": "customer", "base_pk": "id", "base_aggregate_column": "sum_amount",
+                "linked_table_name": "invoice", "linked_fk": "customer_id", "linked_value_column": "amount"}}
+        ]}"""
+
+        # test 1 : formulas are created and refreshed
+        self.cur.execute("call pgf_deploy(%s)", (manifest,))
+        self.assert_sql_equal_list("select id, invoice_count, sum_amount from customer order by id", [(1, 2, 15.0), (2, 1, 1.0)])
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) values(4, 'invoice 4', 2, 2.0);")
+        self.assert_sql_equal_list("select id, invoice_count, sum_amount from customer order by id", [(1, 2, 15.0), (2, 2, 3.0)])
+
+        # test 2 : unchanged formulas are skipped
+        triggers_sql = "select oid from pg_trigger t where t.tgname like '_pgf_internal_%%_deploy_%%' order by oid"
+        triggers = self.fetch_all(triggers_sql)
+        self.cur.execute("call pgf_deploy(%s)", (manifest,))
+        self.assertListEqual(self.fetch_all(triggers_sql), triggers)
+
+        # test 3 : changed formula is re-created, unlisted formula is dropped
+        self.cur.execute("""call pgf_deploy('{"drop_unlisted": true, "formulas": [
+            {"id": "deploy_sum", "kind": "sum", "args": {"base_table_name": "customer", "base_pk": "id", "base_aggregate_column": "sum_amount",
+                "linked_table_name": "invoice", "linked_fk": "customer_id", "linked_value_column": "amount", "options": {"filter": "amount > 1"}}}
+        ]}')""")
+        self.assert_sql_equal_list("select id from pgf_metadata where id like 'deploy_%%' order by id", [('deploy_sum',)])
+        self.assert_sql_equal_list("select id, sum_amount from customer order by id", [(1, 15.0), (2, 2.0)])
+        self.assert_sql_equal_scalar("select count(*) from pg_trigger t where t.tgname like '_pgf_internal_%%_deploy_count';", 0)
+
+        # test 4 : an option removed from the manifest is reset to its default value
+        self.cur.execute("call pgf_deploy(%s)", (manifest,))
+        self.assert_sql_equal_scalar("select args->'options'->>'filter' from pgf_metadata where id = 'deploy_sum'", 'true')
+        self.assert_sql_equal_list("select id, sum_amount from customer order by id", [(1, 15.0), (2, 3.0)])
+
+        # test 4b : an option set to its default value in the manifest leaves the formula unchanged
+        triggers = self.fetch_all(triggers_sql)
+        self.cur.execute("""call pgf_deploy('{"formulas": [
+            {"id": "deploy_sum", "kind": "sum", "args": {"base_table_name": "customer", "base_pk": "id", "base_aggregate_column": "sum_amount",
+                "linked_table_name": "invoice", "linked_fk": "customer_id", "linked_value_column": "amount", "options": {"filter": "true"}}}
+        ]}')""")
+        self.assertListEqual(self.fetch_all(triggers_sql), triggers)
+
+        # test 5 : unknown tables are reported before any change
+        with self.assertRaises(psycopg2.errors.RaiseException):
+            self.cur.execute("""call pgf_deploy('{"formulas": [{"id": "deploy_count2", "kind": "count", "args": {"base_table_name": "customer",
+                "base_pk": "id", "base_count_column": "invoice_count", "linked_table_name": "no_such_table", "linked_fk": "customer_id"}}]}')""")
+        self.conn.rollback()
+        self.drop_formula('deploy_count')
+        self.drop_formula('deploy_sum')
+        self.cur.execute("commit")
+
+    def test_refresh_range_parallel(self):
+        self.create_tables('sum', 'range_sum')
+        self.cur.execute("insert into customer(id, name) select i, 'customer ' || i from generate_series(1, 10) i;")
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) select i, 'invoice ' || i, i % 10 + 1, 1.0 from generate_series(1, 100) i;")
+
+        # test 1 : only rows in range are refreshed
+        self.cur.execute("update customer set sum_amount=0;")
+        self.cur.execute("call pgf_refresh_range(%s, %s, %s)", ('range_sum', '3', '5'))
+        self.assert_sql_equal_list("select id, sum_amount from customer where sum_amount <> 0 order by id", [(3, 10.0), (4, 10.0)])
+        self.cur.execute("call pgf_refresh_range(%s, %s, %s)", ('range_sum', None, '3'))
+        self.cur.execute("call pgf_refresh_range(%s, %s, %s)", ('range_sum', '5', None))
+        self.assert_sql_equal_scalar("select count(*) from customer where sum_amount = 10.0", 10)
+
+        # test 2 : parallel refresh split into ranges
+        from scripts.pgf_parallel_refresh import ParallelRefresh
+        self.cur.execute("update customer set sum_amount=0;")
+        self.cur.execute("commit")
+        self.cur.execute("analyze customer")
+        messages = []
+        done = ParallelRefresh(workers=2, chunk_rows=3, log=messages.append).run(['range_sum'])
+        self.assertEqual(done, 4)
+        self.assert_sql_equal_scalar("select count(*) from customer where sum_amount = 10.0", 10)
+        self.drop_formula('range_sum')
+        self.cur.execute("commit")
+
+    def test_dependency_graph(self):
+        self.create_tables('sum', 'dep_customer_sum', False)
+        self.cur.execute("drop table if exists region cascade;")
+        self.cur.execute("create table region (id int primary key, sum_amount numeric default 0);")
+        self.cur.execute("alter table customer add column region_id int references region(id);")
+        self.cur.execute("call pgf_sum('dep_region_sum', 'region', 'id', 'sum_amount', 'customer', 'region_id', 'sum_amount');")
+        self.cur.execute("call pgf_sum('dep_customer_sum', 'customer', 'id', 'sum_amount', 'invoice', 'customer_id', 'amount');")
+
+        # test 1 : dependency view
+        self.assert_sql_equal_list("select id, depends_on_id, columns from pgf_dependency where id like 'dep_%%' order by id",
+                                   [('dep_region_sum', 'dep_customer_sum', ['customer.sum_amount'])])
+
+        # test 2 : triggers of downstream formulas fire after upstream ones
+        self.assert_sql_equal_list("select tgname from pg_trigger where tgrelid = 'customer'::regclass and tgname like '%%dep_region_sum' order by 1",
+                                   [('_pgf_o0001_sum_trg_dep_region_sum',), ('_pgf_o0001_sum_trg_truncate_dep_region_sum',)])
+        self.cur.execute("insert into region(id) values(1);")
+        self.cur.execute("insert into customer(id, name, region_id) values(1, 'customer A', 1), (2, 'customer B', 1);")
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) values(1, 'invoice 1', 1, 10.0), (2, 'invoice 2', 2, 5.0);")
+        self.assert_sql_equal_scalar("select sum_amount from region where id=1;", 15.0)
+
+        # test 3 : cycles are rejected
+        with self.assertRaises(psycopg2.errors.RaiseException):
+            self.cur.execute("call pgf_sum('dep_cycle', 'invoice', 'id', 'amount', 'region', 'id', 'sum_amount');")
+        self.conn.rollback()
+
+        # test 4 : refresh all, enable/disable and drop with ordered trigger names
+        self.cur.execute("update region set sum_amount=0;")
+        self.cur.execute("update customer set sum_amount=0;")
+        self.cur.execute("call pgf_refresh_all();")
+        self.assert_sql_equal_scalar("select sum_amount from region where id=1;", 15.0)
+        self.cur.execute("call pgf_set_enabled('dep_region_sum', false);")
+        self.cur.execute("call pgf_set_enabled('dep_region_sum', true);")
+        self.assert_sql_equal_scalar("select count(*) from pg_trigger where tgname like '_pgf_o0001_%%dep_region_sum';", 2)
+        self.drop_formula('dep_region_sum')
+        self.drop_formula('dep_customer_sum')
+        self.assert_sql_equal_scalar("select count(*) from pg_trigger where tgname like '%%dep_region_sum';", 0)
+        self.cur.execute("commit")
+
     # --------------------------------------------------------------------
     # FORMULA TESTS
     # --------------------------------------------------------------------
@@ -197,9 +316,62 @@ class TestModule(unittest.TestCase):
         self.assert_sql_equal_scalar("select invoice_count from customer where id=2;", 0)
 
         # clean up
+        self.drop_formula(formula_id)
         # self.cur.execute("drop table if exists invoice cascade;");
         # self.cur.execute("drop table if exists customer cascade;");
 
+    def test_count_adaptive_strategy(self):
+        formula_id = 'count_adaptive'
+        self.create_tables('count', formula_id, False)
+        self.cur.execute("""call pgf_count(%s, 'customer', 'id', 'invoice_count', 'invoice', 'customer_id',
+            '{"strategy": "adaptive", "recompute_threshold": 2, "full_refresh_ratio": 10, "filter": "name <> ''void''"}');""", (formula_id,))
+        self.assert_sql_equal_scalar("select count(*) from pg_trigger t where t.tgname like '_pgf_internal_count_trg_%%_' || %s;", 3, (formula_id,))
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+
+        # test 1 : small statements are applied as deltas
+        self.cur.execute("insert into invoice (id, name, customer_id) values(1, 'invoice 1', 1), (2, 'void', 1);")
+        self.assert_sql_equal_list("select id, invoice_count from customer order by id", [(1, 1), (2, 0)])
+        self.cur.execute("update invoice set name = 'invoice 2' where id = 2;")
+        self.assert_sql_equal_list("select id, invoice_count from customer order by id", [(1, 2), (2, 0)])
+
+        # test 2 : large statements recompute the referenced customers (which also fixes the wrong count)
+        self.cur.execute("update customer set invoice_count = 100 where id = 2;")
+        self.cur.execute("insert into invoice (id, name, customer_id) select i, 'invoice ' || i, 2 from generate_series(3, 7) i;")
+        self.assert_sql_equal_list("select id, invoice_count from customer order by id", [(1, 2), (2, 5)])
+        self.cur.execute("update invoice set customer_id = 3 - customer_id;")
+        self.assert_sql_equal_list("select id, invoice_count from customer order by id", [(1, 5), (2, 2)])
+
+        # test 3 : very large statements run a full refresh
+        self.drop_formula(formula_id)
+        self.cur.execute("""call pgf_count(%s, 'customer', 'id', 'invoice_count', 'invoice', 'customer_id',
+            '{"strategy": "adaptive", "recompute_threshold": 0, "full_refresh_ratio": 0}');""", (formula_id,))
+        self.cur.execute("analyze invoice;")
+        self.cur.execute("update customer set invoice_count = 100 where id = 2;")
+        self.cur.execute("delete from invoice where customer_id = 1;")
+        self.assert_sql_equal_list("select id, invoice_count from customer order by id", [(1, 0), (2, 2)])
+
+        self.cur.execute("call pgf_set_enabled(%s, false);", (formula_id,))
+        self.cur.execute("call pgf_set_enabled(%s, true);", (formula_id,))
+        self.drop_formula(formula_id)
+        self.assert_sql_equal_scalar("select count(*) from pg_trigger t where t.tgname like '_pgf_internal_%%_' || %s;", 0, (formula_id,))
+
+    def test_count_ordered_locking(self):
+        formula_id = 'count_ordered_locking'
+        self.create_tables('count', formula_id, False)
+        with self.assertRaises(psycopg2.errors.RaiseException):
+            self.cur.execute("""call pgf_count(%s, 'customer', 'id', 'invoice_count', 'invoice', 'customer_id', '{"ordered_locking": true}');""", (formula_id,))
+        self.conn.rollback()
+
+        self.create_tables('count', formula_id, False)
+        self.cur.execute("""call pgf_count(%s, 'customer', 'id', 'invoice_count', 'invoice', 'customer_id',
+            '{"strategy": "adaptive", "ordered_locking": true, "recompute_threshold": 2}');""", (formula_id,))
+        self.cur.execute("insert into customer(id, name) select i, 'customer ' || i from generate_series(1, 5) i;")
+        self.cur.execute("insert into invoice (id, name, customer_id) select i, 'invoice ' || i, i % 5 + 1 from generate_series(1, 10) i;")
+        self.assert_sql_equal_scalar("select count(*) from customer where invoice_count = 2;", 5)
+        self.cur.execute("delete from invoice where id = 1;")
+        self.assert_sql_equal_scalar("select sum(invoice_count) from customer;", 9)
+        self.drop_formula(formula_id)
+
     def test_sum_insert_delete(self):
         formula_id = 'sum1'
         self.create_tables('sum', formula_id)
@@ -294,6 +466,144 @@ class TestModule(unittest.TestCase):
         self.cur.execute("delete from invoice where id = 3")
         self.assert_sql_equal_scalar("select sum_amount from customer where id=1;", 5.5)
 
+    def test_count_shared_trigger(self):
+        formula_id = 'count_shared_trigger'
+        self.create_tables('count', formula_id, False)
+        self.cur.execute("call pgf_count(%s, 'customer', 'id', 'invoice_count', 'invoice', 'customer_id', jsonb_build_object('shared_trigger', true));", (formula_id,))
+
+        # no function is generated for the formula
+        self.assert_sql_equal_scalar("select count(*) from pg_proc p where p.proname like '_pgf_internal_%%_' || %s;", 0, (formula_id,))
+
+        # test 1 : insert invoices
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("insert into invoice (id, name, customer_id) values(1, 'invoice 1', 1), (2, 'invoice 2', 1), (3, 'invoice 3', 2);")
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=1;", 2)
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=2;", 1)
+
+        # test 2 : update invoice customer, then invoice name
+        self.cur.execute("update invoice set customer_id=2 where id=2")
+        self.cur.execute("update invoice set name='invoice 2 new' where id=2")
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=1;", 1)
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=2;", 2)
+
+        # test 3 : delete invoices
+        self.cur.execute("delete from invoice where id in (1, 3);")
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=1;", 0)
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=2;", 1)
+
+        # test 3b : prepared statements deallocated by the client are prepared again
+        self.cur.execute("deallocate all;")
+        self.cur.execute("insert into invoice (id, name, customer_id) values(4, 'invoice 4', 1);")
+        self.cur.execute("delete from invoice where id = 4;")
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=1;", 0)
+
+        # test 4 : manual refresh
+        self.cur.execute("update customer set invoice_count=10;")
+        self.cur.execute("call pgf_refresh(%s);", (formula_id,))
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=1;", 0)
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=2;", 1)
+
+        # test 5 : truncate table
+        self.cur.execute("truncate table invoice;")
+        self.assert_sql_equal_scalar("select invoice_count from customer where id=2;", 0)
+
+        self.drop_formula(formula_id)
+        self.assert_sql_equal_scalar("select count(*) from pg_trigger t where t.tgname like '_pgf_internal_%%_' || %s;", 0, (formula_id,))
+
+    def test_sum_shared_trigger(self):
+        formula_id = 'sum_shared_trigger'
+        self.create_tables('sum', formula_id, False)
+        self.cur.execute("alter table invoice add column deleted boolean default false;")
+        self.cur.execute("call pgf_sum(%s, 'customer', 'id', 'sum_amount', 'invoice', 'customer_id', 'amount', jsonb_build_object('filter', 'deleted = false', 'shared_trigger', true));", (formula_id,))
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+
+        # test : insert invoices
+        # Contents of invoice table at the end of the step:
+        # | id | name      | customer_id | amount | deleted |
+        # | 1  | invoice 1 | 1           | 10.0   | false   |
+        # | 2  | invoice 2 | 1           | 5.5    | false   |
+        # | 3  | invoice 3 | 1           | 5.5    | true    |
+        self.cur.execute("insert into invoice (id, name, customer_id, amount, deleted) values(1, 'invoice 1', 1, 10.0, false), (2, 'invoice 2', 1, 5.5, false), (3, 'invoice 3', 1, 5.5, true)")
+        self.assert_sql_equal_scalar("select sum_amount from customer where id=1;", 15.5)
+
+        # test : update amount, then filter column, then customer
+        self.cur.execute("update invoice set amount=8.0 where id=1;")
+        self.assert_sql_equal_scalar("select sum_amount from customer where id=1;", 13.5)
+        self.cur.execute("update invoice set deleted=false where id=3;")
+        self.assert_sql_equal_scalar("select sum_amount from customer where id=1;", 19.0)
+        self.cur.execute("update invoice set customer_id=2 where id=1;")
+        self.assert_sql_equal_scalar("select sum_amount from customer where id=1;", 11.0)
+        self.assert_sql_equal_scalar("select sum_amount from customer where id=2;", 8.0)
+
+        # test : delete invoice
+        self.cur.execute("delete from invoice where id = 2")
+        self.assert_sql_equal_scalar("select sum_amount from customer where id=1;", 5.5)
+
+        # test : manual refresh
+        self.cur.execute("update customer set sum_amount=0;")
+        self.cur.execute("call pgf_refresh(%s);", (formula_id,))
+        self.assert_sql_equal_scalar("select sum_amount from customer where id=1;", 5.5)
+        self.assert_sql_equal_scalar("select sum_amount from customer where id=2;", 8.0)
+
+    def test_sum_adaptive_strategy(self):
+        formula_id = 'sum_adaptive'
+        self.create_tables('sum', formula_id, False)
+        self.cur.execute("""call pgf_sum(%s, 'customer', 'id', 'sum_amount', 'invoice', 'customer_id', 'amount',
+            '{"strategy": "adaptive", "recompute_threshold": 2, "full_refresh_ratio": 10}');""", (formula_id,))
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+
+        # test 1 : small statements are applied as deltas
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) values(1, 'invoice 1', 1, 10.0), (2, 'invoice 2', 2, 5.0);")
+        self.cur.execute("update invoice set customer_id = 1, amount = 6.0 where id = 2;")
+        self.assert_sql_equal_list("select id, sum_amount from customer order by id", [(1, 16.0), (2, 0.0)])
+
+        # test 2 : large statements recompute the referenced customers (which also fixes the wrong sum)
+        self.cur.execute("update customer set sum_amount = 100 where id = 2;")
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) select i, 'invoice ' || i, 2, 1.0 from generate_series(3, 7) i;")
+        self.cur.execute("update invoice set amount = amount * 2;")
+        self.assert_sql_equal_list("select id, sum_amount from customer order by id", [(1, 32.0), (2, 10.0)])
+
+        # test 3 : very large statements run a full refresh
+        self.drop_formula(formula_id)
+        self.cur.execute("""call pgf_sum(%s, 'customer', 'id', 'sum_amount', 'invoice', 'customer_id', 'amount',
+            '{"strategy": "adaptive", "recompute_threshold": 0, "full_refresh_ratio": 0}');""", (formula_id,))
+        self.cur.execute("analyze invoice;")
+        self.cur.execute("delete from invoice where customer_id = 2;")
+        self.assert_sql_equal_list("select id, sum_amount from customer order by id", [(1, 32.0), (2, 0.0)])
+        self.drop_formula(formula_id)
+
+    def test_sum_side_table(self):
+        self.create_tables('sum', 'sum_side_table', False)
+        self.cur.execute("drop table if exists customer_agg cascade;")
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A');")
+        self.cur.execute("""call pgf_sum('sum_side_table', 'customer', 'id', 'sum_amount', 'invoice', 'customer_id', 'amount', '{"side_table": "customer_agg"}');""")
+        self.cur.execute("""call pgf_count('count_side_table', 'customer', 'id', 'invoice_count', 'invoice', 'customer_id', '{"side_table": "customer_agg"}');""")
+        self.cur.execute("insert into customer(id, name) values(2, 'customer B');")
+
+        # test 1 : results are stored in the side table, shared by both formulas, and exposed by the view.
+        # The side column sum_amount replaces the base column of the same name in the view
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) values(1, 'invoice 1', 1, 10.0), (2, 'invoice 2', 1, 5.0), (3, 'invoice 3', 2, 1.0);")
+        self.assert_sql_equal_list("select id, sum_amount, invoice_count from customer_agg order by id", [(1, 15.0, 2), (2, 1.0, 1)])
+        self.assert_sql_equal_list("select id, name, sum_amount, invoice_count from customer_agg_view order by id",
+                                   [(1, 'customer A', 15.0, 2), (2, 'customer B', 1.0, 1)])
+        self.assert_sql_equal_list("select id, sum_amount from customer order by id", [(1, 0.0), (2, 0.0)])
+
+        # test 2 : refresh, and deletion of the base row
+        self.cur.execute("update customer_agg set sum_amount = 0, invoice_count = 0;")
+        self.cur.execute("call pgf_refresh('sum_side_table');")
+        self.cur.execute("call pgf_refresh('count_side_table');")
+        self.assert_sql_equal_list("select id, sum_amount, invoice_count from customer_agg order by id", [(1, 15.0, 2), (2, 1.0, 1)])
+        self.cur.execute("delete from customer where id = 1;")
+        self.assert_sql_equal_list("select id, sum_amount, invoice_count from customer_agg order by id", [(2, 1.0, 1)])
+
+        # test 3 : the side column is dropped with its formula, the view shows the base column again. The side table, its view and its trigger are dropped with the last one
+        self.drop_formula('sum_side_table')
+        self.assert_sql_equal_list("select id, name, sum_amount, invoice_count from customer_agg_view order by id", [(2, 'customer B', 0.0, 1)])
+        self.assert_sql_equal_scalar("select count(*) from information_schema.columns where table_name = 'customer_agg' and column_name = 'sum_amount'", 0)
+        self.drop_formula('count_side_table')
+        self.assert_sql_equal_scalar("select count(*) from pg_class where relname in ('customer_agg', 'customer_agg_view')", 0)
+        self.assert_sql_equal_scalar("select count(*) from pg_trigger where tgname like '_pgf_internal_side_table_trg_%%'", 0)
+
     def test_min(self):
         formula_id = 'min1'
         self.create_tables('min', formula_id)
@@ -555,6 +865,235 @@ class TestModule(unittest.TestCase):
         self.assert_sql_equal_scalar("select min_amount from customer where id=1;", 4.0)
         self.assert_sql_equal_scalar("select min_amount from customer where id=2;", None)
 
+    def test_min_adaptive_strategy(self):
+        formula_id = 'min_adaptive'
+        self.create_tables('min', formula_id, False)
+        self.cur.execute("""call pgf_min(%s, 'customer', 'id', 'min_amount', 'invoice', 'customer_id', 'amount',
+            '{"strategy": "adaptive", "recompute_threshold": 2, "full_refresh_ratio": 10}');""", (formula_id,))
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+
+        # test 1 : small statements merge new values, and rescan when the min is removed
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) values(1, 'invoice 1', 1, 10.0), (2, 'invoice 2', 1, 5.0);")
+        self.assert_sql_equal_list("select id, min_amount from customer order by id", [(1, 5.0), (2, None)])
+        self.cur.execute("update invoice set amount = 20.0 where id = 2;")
+        self.assert_sql_equal_list("select id, min_amount from customer order by id", [(1, 10.0), (2, None)])
+        self.cur.execute("delete from invoice where id = 1;")
+        self.assert_sql_equal_list("select id, min_amount from customer order by id", [(1, 20.0), (2, None)])
+
+        # test 2 : large statements recompute the referenced customers
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) select i, 'invoice ' || i, 2, i from generate_series(3, 7) i;")
+        self.assert_sql_equal_list("select id, min_amount from customer order by id", [(1, 20.0), (2, 3.0)])
+        self.cur.execute("delete from invoice where amount < 5;")
+        self.assert_sql_equal_list("select id, min_amount from customer order by id", [(1, 20.0), (2, 5.0)])
+        self.drop_formula(formula_id)
+
+    def test_min_max_update(self):
+        self.create_tables('min', 'min_update', False)
+        self.cur.execute("alter table customer add column max_amount numeric;")
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) select i, 'invoice ' || i, 1, i * 10 from generate_series(1, 5) i;")
+        self.cur.execute("""call pgf_min('min_update', 'customer', 'id', 'min_amount', 'invoice', 'customer_id', 'amount', '{"filter": "name <> ''hidden''"}');""")
+        self.cur.execute("""call pgf_max('max_update', 'customer', 'id', 'max_amount', 'invoice', 'customer_id', 'amount', '{"filter": "name <> ''hidden''"}');""")
+        expected = """select c.id, min(i.amount) as min_amount, max(i.amount) as max_amount
+            from customer c left join invoice i on i.customer_id = c.id and i.name <> 'hidden' group by c.id order by c.id"""
+
+        # test 1 : updating a row which is neither the min nor the max does not rescan the invoices
+        self.cur.execute("update customer set min_amount = 1, max_amount = 100 where id = 1;")
+        self.cur.execute("update invoice set amount = 35 where id = 3;")
+        self.assert_sql_equal_list("select id, min_amount, max_amount from customer order by id", [(1, 1, 100), (2, None, None)])
+        self.cur.execute("call pgf_refresh('min_update'); call pgf_refresh('max_update');")
+
+        # test 2 : value changes, FK changes and filter transitions
+        for statement in [
+            "update invoice set amount = 5 where id = 3",
+            "update invoice set amount = 60 where id = 3",
+            "update invoice set amount = 55 where id = 3",
+            "update invoice set amount = 25 where id = 1",
+            "update invoice set customer_id = 2 where id = 2",
+            "update invoice set customer_id = 2, amount = 1 where id = 3",
+            "update invoice set name = 'hidden' where id = 1",
+            "update invoice set name = 'visible', amount = 70 where id = 1",
+            "update invoice set name = 'hidden' where customer_id = 2",
+            "update invoice set customer_id = 1 where customer_id = 2",
+        ]:
+            self.cur.execute(statement)
+            self.assertEqual(self.fetch_all("select id, min_amount, max_amount from customer order by id"), self.fetch_all(expected),
+                             statement)
+
+        self.drop_formula('min_update')
+        self.drop_formula('max_update')
+
+    def test_min_max_cache(self):
+        self.create_tables('min', 'min_cache', False)
+        self.cur.execute("alter table customer add column max_amount numeric;")
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) select i, 'invoice ' || i, 1, i from generate_series(1, 5) i;")
+        self.cur.execute("""call pgf_min('min_cache', 'customer', 'id', 'min_amount', 'invoice', 'customer_id', 'amount', '{"cache_size": 2}');""")
+        self.cur.execute("""call pgf_max('max_cache', 'customer', 'id', 'max_amount', 'invoice', 'customer_id', 'amount', '{"cache_size": 2}');""")
+        expected = "select c.id, min(i.amount) as min_amount, max(i.amount) as max_amount from customer c left join invoice i on i.customer_id = c.id group by c.id order by c.id"
+
+        # test 1 : the refresh caches the 2 smallest (largest) values of each customer
+        self.assert_sql_equal_list("select parent_id, value, row_count from _pgf_internal_cache_min_cache order by 1, 2", [(1, 1, 1), (1, 2, 1)])
+        self.assert_sql_equal_list("select parent_id, value, row_count from _pgf_internal_cache_max_cache order by 1, 2", [(1, 4, 1), (1, 5, 1)])
+        self.assertEqual(self.fetch_all("select id, min_amount, max_amount from customer order by id"), self.fetch_all(expected))
+
+        # test 2 : deletes and updates are served from the cache, which is refilled when it runs empty
+        for statement in [
+            "delete from invoice where id = 1",
+            "insert into invoice (id, name, customer_id, amount) values(6, 'invoice 6', 1, 2), (7, 'invoice 7', 2, 7)",
+            "delete from invoice where id = 2",
+            "update invoice set amount = 10 where id = 6",
+            "update invoice set amount = 0 where id = 4",
+            "update invoice set customer_id = 2 where id = 5",
+            "delete from invoice where id in (3, 4)",
+            "delete from invoice where customer_id = 1",
+            "insert into invoice (id, name, customer_id, amount) values(8, 'invoice 8', 1, 8), (9, 'invoice 9', 2, 7)",
+            "delete from invoice where id = 7",
+        ]:
+            self.cur.execute(statement)
+            self.assertEqual(self.fetch_all("select id, min_amount, max_amount from customer order by id"), self.fetch_all(expected),
+                             statement)
+        self.assert_sql_equal_list("select parent_id, value, row_count from _pgf_internal_cache_min_cache order by 1, 2", [(1, 8, 1), (2, 5, 1), (2, 7, 1)])
+
+        # test 3 : a range refresh also rebuilds the cache entries of the range
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) values(10, 'invoice 10', 2, 8)")
+        self.cur.execute("set session_replication_role = replica")  # skip the triggers
+        self.cur.execute("delete from invoice where id = 5")
+        self.cur.execute("reset session_replication_role")
+        for formula_id in ['min_cache', 'max_cache']:
+            self.cur.execute("call pgf_refresh_range(%s, %s, %s)", (formula_id, '2', None))
+        self.assert_sql_equal_list("select parent_id, value, row_count from _pgf_internal_cache_min_cache order by 1, 2", [(1, 8, 1), (2, 7, 1), (2, 8, 1)])
+        self.cur.execute("delete from invoice where id = 9")
+        self.assertEqual(self.fetch_all("select id, min_amount, max_amount from customer order by id"), self.fetch_all(expected))
+
+        self.drop_formula('min_cache')
+        self.drop_formula('max_cache')
+        self.assert_sql_equal_scalar("select count(*) from pg_class where relname like '_pgf_internal_cache_%%'", 0)
+
+    def test_min_max_cache_multi_row(self):
+        self.create_tables('min', 'min_cache', False)
+        self.cur.execute("alter table customer add column max_amount numeric;")
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) values(1, 'invoice 1', 1, 1), (3, 'invoice 3', 1, 3);")
+        self.cur.execute("""call pgf_min('min_cache', 'customer', 'id', 'min_amount', 'invoice', 'customer_id', 'amount', '{"cache_size": 1}');""")
+        self.cur.execute("""call pgf_max('max_cache', 'customer', 'id', 'max_amount', 'invoice', 'customer_id', 'amount', '{"cache_size": 1}');""")
+        expected = "select c.id, min(i.amount) as min_amount, max(i.amount) as max_amount from customer c left join invoice i on i.customer_id = c.id group by c.id order by c.id"
+
+        # a cache running empty during a multi-row statement is refilled once, from the final state of the statement
+        for statement in [
+            "update invoice set amount = case id when 1 then 5 else 0 end",
+            "delete from invoice where amount = 0",
+            "insert into invoice (id, name, customer_id, amount) values(4, 'invoice 4', 1, 9), (5, 'invoice 5', 2, 2), (6, 'invoice 6', 2, 4)",
+            "update invoice set amount = 10 - amount, customer_id = 3 - customer_id",
+            "update invoice set amount = amount + 1 where customer_id = 2",
+            "delete from invoice where id in (4, 5)",
+            # rows without parent are not cached
+            "insert into invoice (id, name, customer_id, amount) values(7, 'invoice 7', NULL, 1)",
+            "update invoice set customer_id = 1 where id = 7",
+            "update invoice set customer_id = NULL",
+            "delete from invoice where customer_id is NULL",
+        ]:
+            self.cur.execute(statement)
+            self.assertEqual(self.fetch_all("select id, min_amount, max_amount from customer order by id"), self.fetch_all(expected),
+                             statement)
+        self.cur.execute("call pgf_refresh('min_cache')")
+        self.cur.execute("call pgf_refresh('max_cache')")
+        self.assertEqual(self.fetch_all("select id, min_amount, max_amount from customer order by id"), self.fetch_all(expected))
+
+        self.drop_formula('min_cache')
+        self.drop_formula('max_cache')
+        self.assert_sql_equal_scalar("select count(*) from pg_class where relname like '_pgf_internal_cache_%%'", 0)
+
+    def test_id_of_min_cache(self):
+        formula_id = 'id_of_min_cache'
+        self.create_tables('id_of_min', formula_id, False)
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("""call pgf_id_of_min(%s, 'customer', 'id', 'id_of_min_amount', 'invoice', 'id', 'customer_id', 'amount', '{"cache_size": 2}');""",
+                         (formula_id,))
+        expected = """select c.id, (select i.id from invoice i where i.customer_id = c.id order by i.amount, i.id limit 1) as id_of_min_amount
+            from customer c order by c.id"""
+        for statement in [
+            "insert into invoice (id, name, customer_id, amount) values(1, 'invoice 1', 1, 5), (2, 'invoice 2', 1, 5), (3, 'invoice 3', 1, 3)",
+            "delete from invoice where id = 3",
+            "update invoice set amount = 6 where id = 1",
+            "delete from invoice where id = 2",
+            "update invoice set customer_id = 2 where id = 1",
+            "insert into invoice (id, name, customer_id, amount) values(4, 'invoice 4', 2, 6)",
+            "delete from invoice where id = 1",
+        ]:
+            self.cur.execute(statement)
+            self.assertEqual(self.fetch_all("select id, id_of_min_amount from customer order by id"), self.fetch_all(expected), statement)
+        self.drop_formula(formula_id)
+
+    def test_min_cascade_delete(self):
+        formula_id = 'min_cascade_delete'
+        self.create_tables('min', formula_id)
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("insert into invoice (id, name, customer_id, amount) select i, 'invoice ' || i, i % 2 + 1, i from generate_series(1, 100) i;")
+
+        # test 1 : invoices deleted by cascade do not update the deleted customer
+        self.cur.execute("delete from customer where id = 1;")
+        self.assert_sql_equal_scalar("select count(*) from invoice;", 50)
+        self.assert_sql_equal_list("select id, min_amount from customer order by id", [(2, 1.0)])
+
+        # test 2 : invoices deleted by another trigger still update their customer
+        self.cur.execute("drop table if exists invoice_cleanup cascade;")
+        self.cur.execute("create table invoice_cleanup(invoice_id int);")
+        self.cur.execute("""create function invoice_cleanup_trgfun() returns trigger language plpgsql as $$
+            begin
+                delete from invoice where id = NEW.invoice_id;
+                return NEW;
+            end; $$;""")
+        self.cur.execute("create trigger invoice_cleanup_trg after insert on invoice_cleanup for each row execute procedure invoice_cleanup_trgfun();")
+        self.cur.execute("insert into invoice_cleanup values(1);")
+        self.assert_sql_equal_list("select id, min_amount from customer order by id", [(2, 3.0)])
+
+        self.cur.execute("drop table invoice_cleanup;")
+        self.cur.execute("drop function invoice_cleanup_trgfun;")
+        self.drop_formula(formula_id)
+
+    def test_id_of_min_max_value_column(self):
+        for kind, options in [('id_of_min', '{}'), ('id_of_min', '{"value_column": "extremum"}'), ('id_of_max', '{}'),
+                              ('id_of_max', '{"value_column": "extremum"}'), ('id_of_max', '{"value_column": "extremum", "cache_size": 2}')]:
+            formula_id = f'{kind}_value_column'
+            self.create_tables(kind, formula_id, False)
+            self.cur.execute("alter table customer add column extremum numeric;")
+            self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+            self.cur.execute(f"call pgf_{kind}(%s, 'customer', 'id', '{kind}_amount', 'invoice', 'id', 'customer_id', 'amount', %s);",
+                             (formula_id, options))
+            direction = 'asc' if kind == 'id_of_min' else 'desc'
+            expected = f"""select c.id, i.id as {kind}_amount, i.amount as extremum from customer c left join lateral (
+                select id, amount from invoice where customer_id = c.id order by amount {direction}, id {direction} limit 1) i on true
+                order by c.id"""
+            actual = f"select id, {kind}_amount, extremum from customer order by id"
+            if 'value_column' not in options:
+                expected = expected.replace(', i.amount as extremum', '')
+                actual = actual.replace(', extremum', '')
+
+            # ties are broken by the invoice id, in the same order as the refresh procedure
+            for statement in [
+                "insert into invoice (id, name, customer_id, amount) values(2, 'invoice 2', 1, 5), (1, 'invoice 1', 1, 5), (3, 'invoice 3', 1, 3)",
+                "insert into invoice (id, name, customer_id, amount) values(4, 'invoice 4', 1, 7), (5, 'invoice 5', 2, 5)",
+                "update invoice set amount = 4 where id = 3",
+                "update invoice set amount = 6 where id = 4",
+                "update invoice set amount = 5 where id in (3, 4)",
+                "update invoice set id = 10 where id = 1",
+                "update invoice set customer_id = 2 where id = 2",
+                "delete from invoice where id = 10",
+                f"call pgf_refresh('{formula_id}')",
+                "delete from invoice where customer_id = 2",
+                # rows inserted without triggers, then refreshed by range
+                f"""set session_replication_role = replica;
+                insert into invoice (id, name, customer_id, amount) values(10, 'invoice 10', 1, 3), (11, 'invoice 11', 1, 9), (13, 'invoice 13', 1, 1);
+                set session_replication_role = origin;
+                call pgf_refresh_range('{formula_id}', NULL, NULL);""",
+                # multi-row update: the trigger of row 11 runs while the current extremum (row 13) already has its new value
+                "update invoice set amount = 3 where id in (11, 13)",
+            ]:
+                self.cur.execute(statement)
+                self.assertEqual(self.fetch_all(actual), self.fetch_all(expected), f'{kind} {options}: {statement}')
+            self.drop_formula(formula_id)
+
     def test_id_of_min(self):
         formula_id = 'id_of_min1'
         self.create_tables('id_of_min', formula_id)
@@ -1106,6 +1645,7 @@ class TestModule(unittest.TestCase):
         self.cur.execute("insert into invoice (id, name, customer_id) values (3, 'invoice 1', 1)")
         self.assert_sql_equal_scalar("select invoice_names from customer where id=1;", ["invoice 1", "invoice 1", "invoice 4"])
         self.assert_sql_equal_scalar("select invoice_names from customer where id=2;", None)
+        self.drop_formula(formula_id)
 
     def test_array_agg_nodistinct_orderbyname_limit(self):
         formula_id = 'test_array_agg_nodistinct_orderbyname_limit'
@@ -1231,6 +1771,7 @@ class TestModule(unittest.TestCase):
         self.cur.execute("insert into invoice (id, name, customer_id) values (3, 'invoice 1', 1)")
         self.assert_sql_equal_scalar("select invoice_names from customer where id=1;", ["invoice 1", "invoice 1"])
         self.assert_sql_equal_scalar("select invoice_names from customer where id=2;", None)
+        self.drop_formula(formula_id)
 
     def test_array_agg_distinct_orderbyid_nolimit(self):
         formula_id = 'test_array_agg_distinct_orderbyid_nolimit'
@@ -1356,6 +1897,339 @@ class TestModule(unittest.TestCase):
         self.cur.execute("insert into invoice (id, name, customer_id) values (3, 'C-invoice 1', 1)")
         self.assert_sql_equal_scalar("select invoice_names from customer where id=1;", ["C-invoice 1", "invoice 4"])
         self.assert_sql_equal_scalar("select invoice_names from customer where id=2;", None)
+        self.drop_formula(formula_id)
+
+    def test_array_agg_incremental(self):
+        # the array is maintained from the changed value alone, inserted in place (no order_by, or order_by on the value)
+        for options in ['{}', '{"distinct": false}', '{"limit": 2}', '{"order_by": "name"}', '{"order_by": "name desc", "distinct": false, "limit": 2}',
+                        '{"order_by": "name asc nulls first", "limit": 2}', '{"order_by": "name", "limit": 2}',
+                        '{"order_by": "name", "filter": "visible"}']:
+            formula_id = 'array_agg_incremental'
+            self.create_tables('array_agg', formula_id, False)
+            self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+            self.cur.execute("call pgf_array_agg(%s, 'customer', 'id', 'invoice_names', 'invoice', 'customer_id', 'name', %s);",
+                             (formula_id, options))
+            opts = json.loads(options)
+            order_by = opts.get('order_by', 'name')
+            aggregate = f"array_agg({'distinct ' if opts.get('distinct', True) else ''}name order by {order_by})"
+            expected = f"""select c.id, (select ({aggregate})[1:{opts.get('limit', 100)}] from invoice
+                where customer_id = c.id and ({opts.get('filter', 'true')})) as invoice_names from customer c order by c.id"""
+            actual = "select id, invoice_names from customer order by id"
+
+            for statement in [
+                "insert into invoice (id, name, customer_id, visible) values(1, 'b', 1, true), (2, 'a', 1, true), (3, 'c', 1, false)",
+                "insert into invoice (id, name, customer_id, visible) values(4, 'a', 1, true), (5, NULL, 1, true), (6, 'd', 2, true)",
+                "update invoice set name = 'e' where id = 2",
+                "update invoice set name = 'a' where id = 1",
+                "update invoice set visible = true where id = 3",
+                "update invoice set customer_id = 2 where id in (1, 3)",
+                "delete from invoice where id = 4",
+                "update invoice set name = NULL where id = 6",
+                "delete from invoice where id = 5",
+                # multi-row statements: a parent re-aggregated by a row trigger must not get the deltas of the next rows
+                "insert into invoice (id, name, customer_id, visible) values(9, NULL, 1, true), (10, 'x', 1, true), (11, 'b', 2, true)",
+                "update invoice set name = case id when 1 then 'z' when 3 then '0' else name end where id in (1, 3)",
+                "update invoice set name = case when name = 'x' then NULL when name is null then 'y' else name end",
+                "delete from invoice where id in (9, 10, 11)",
+                f"call pgf_refresh('{formula_id}')",
+                "insert into invoice (id, name, customer_id, visible) values(7, 'a', 2, true)",
+                "delete from invoice where customer_id = 2",
+                "truncate invoice",
+                "insert into invoice (id, name, customer_id, visible) values(8, 'f', 1, true)",
+            ]:
+                self.cur.execute(statement)
+                self.assertEqual(self.fetch_all(actual), self.fetch_all(expected), f'{options}: {statement}')
+            self.drop_formula(formula_id)
+
+    def test_string_agg(self):
+        for options in ['{}', '{"order_by": "name", "delimiter": "|"}', '{"order_by": "name desc", "distinct": true, "limit": 2}',
+                        '{"order_by": "name", "limit": 2, "filter": "visible"}', '{"order_by": "id desc"}', '{"order_by": "visible, name"}']:
+            formula_id = 'string_agg1'
+            self.create_tables('string_agg', formula_id, False)
+            self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+            self.cur.execute("call pgf_string_agg(%s, 'customer', 'id', 'invoice_names', 'invoice', 'customer_id', 'name', %s);",
+                             (formula_id, options))
+            opts = json.loads(options)
+            delimiter = opts.get('delimiter', ', ')
+            aggregate = f"array_agg({'distinct ' if opts.get('distinct') else ''}name order by {opts.get('order_by', 'name')})"
+            expected = f"""select c.id, (select array_to_string(({aggregate})[1:{opts.get('limit', 100)}], '{delimiter}') from invoice
+                where customer_id = c.id and name is not null and ({opts.get('filter', 'true')})) as invoice_names from customer c order by c.id"""
+            actual = "select id, invoice_names from customer order by id"
+
+            # values may contain the delimiter
+            for statement in [
+                "insert into invoice (id, name, customer_id, visible) values(1, 'b', 1, true), (2, 'a, c', 1, true), (3, 'c', 1, false)",
+                "insert into invoice (id, name, customer_id, visible) values(4, 'b', 1, true), (5, NULL, 1, true), (6, 'd|e', 2, true)",
+                "update invoice set name = 'e' where id = 2",
+                "update invoice set name = 'a' where id = 1",
+                "update invoice set visible = true where id = 3",
+                "update invoice set customer_id = 2 where id in (1, 3)",
+                "delete from invoice where id = 4",
+                "update invoice set name = NULL where id = 6",
+                "insert into invoice (id, name, customer_id, visible) values(7, 'g', NULL, true)",
+                "update invoice set customer_id = NULL where id = 1",
+                f"call pgf_refresh('{formula_id}')",
+                "delete from invoice where customer_id = 2",
+                "truncate invoice",
+                "insert into invoice (id, name, customer_id, visible) values(8, 'f', 1, true)",
+            ]:
+                self.cur.execute(statement)
+                self.assertEqual(self.fetch_all(actual), self.fetch_all(expected), f'{options}: {statement}')
+            self.drop_formula(formula_id)
+
+    def test_count_distinct(self):
+        for options in ['{}', '{"filter": "visible"}', '{"filter": "product like \'p%\'"}']:
+            formula_id = 'count_distinct1'
+            self.create_tables('count_distinct', formula_id, False)
+            self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B'), (3, 'customer C');")
+            self.cur.execute("call pgf_count_distinct(%s, 'customer', 'id', 'product_count', 'invoice', 'customer_id', 'product', %s);",
+                             (formula_id, options))
+            opts = json.loads(options)
+            row_filter = opts.get('filter', 'true').replace('%', '%%')  # fetch_all interpolates parameters
+            expected = f"""select c.id, (select count(distinct product) from invoice
+                where customer_id = c.id and ({row_filter})) as product_count from customer c order by c.id"""
+            actual = "select id, product_count from customer order by id"
+
+            for statement in [
+                "insert into invoice (id, customer_id, product, visible) values(1, 1, 'a', true), (2, 1, 'a', true), (3, 1, 'b', false)",
+                "insert into invoice (id, customer_id, product, visible) values(4, 1, 'c', true), (5, 1, NULL, true), (6, 2, 'a', true)",
+                "insert into invoice (id, customer_id, product, visible) select i, i % 3 + 1, 'p' || (i % 7), i % 2 = 0 from generate_series(10, 200) i",
+                "update invoice set product = 'b' where id = 1",
+                "update invoice set product = 'd' where id = 2",
+                "update invoice set visible = true where id = 3",
+                "update invoice set customer_id = 2 where id in (1, 3)",
+                "update invoice set customer_id = 3 - customer_id where customer_id in (1, 2)",
+                "update invoice set product = 'p' || (id % 2) where id >= 100",
+                "delete from invoice where id = 4",
+                "update invoice set product = NULL where id = 6",
+                "delete from invoice where id between 50 and 150",
+                f"call pgf_refresh('{formula_id}')",
+                "delete from customer where id = 2",
+                "truncate invoice",
+                "insert into invoice (id, customer_id, product, visible) values(8, 1, 'f', true), (9, 1, 'f', true)",
+            ]:
+                self.cur.execute(statement)
+                self.assertEqual(self.fetch_all(actual), self.fetch_all(expected), f'{options}: {statement}')
+            self.assert_sql_equal_scalar(f"select count(*) from _pgf_internal_refcount_{formula_id} where row_count <= 0", 0)
+            self.drop_formula(formula_id)
+
+    def test_approx_count_distinct(self):
+        formula_id = 'approx_count_distinct1'
+        self.create_tables('approx_count_distinct', formula_id, False)
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B'), (3, 'customer C');")
+        self.cur.execute("call pgf_approx_count_distinct(%s, 'customer', 'id', 'product_count', 'invoice', 'customer_id', 'product', '{\"filter\": \"visible\"}');",
+                         (formula_id,))
+        actual = "select id, product_count from customer order by id"
+
+        # small sets are counted exactly
+        self.cur.execute("insert into invoice (id, customer_id, product, visible) values(1, 1, 'a', true), (2, 1, 'a', true), (3, 1, 'b', true), (4, 1, 'c', false), (5, 1, NULL, true)")
+        self.assertEqual(self.fetch_all(actual), [{'id': 1, 'product_count': 2}, {'id': 2, 'product_count': 0}, {'id': 3, 'product_count': 0}])
+        self.cur.execute("update invoice set visible = true where id = 4")
+        self.cur.execute("update invoice set customer_id = 2 where id = 3")
+        self.assertEqual(self.fetch_all(actual), [{'id': 1, 'product_count': 3}, {'id': 2, 'product_count': 1}, {'id': 3, 'product_count': 0}])
+
+        # deleted values are kept until the next refresh
+        self.cur.execute("delete from invoice where product = 'c'")
+        self.assert_sql_equal_scalar("select product_count from customer where id = 1", 3)
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assertEqual(self.fetch_all(actual), [{'id': 1, 'product_count': 1}, {'id': 2, 'product_count': 1}, {'id': 3, 'product_count': 0}])
+
+        # large sets: the standard error is 1.04 / sqrt(2^12) = 1.6%
+        self.cur.execute("insert into invoice (id, customer_id, product, visible) select i, 3, 'p' || (i % 5000), true from generate_series(10, 20000) i")
+        self.assertAlmostEqual(self.fetch_one("select product_count from customer where id = 3")['product_count'], 5000, delta=5000 * 0.05)
+
+        self.cur.execute("truncate invoice")
+        self.assertEqual(self.fetch_all(actual), [{'id': 1, 'product_count': 0}, {'id': 2, 'product_count': 0}, {'id': 3, 'product_count': 0}])
+        self.drop_formula(formula_id)
+
+        # 'rebuild' policy: the sketches of the parents of deleted rows are rebuilt
+        self.create_tables('approx_count_distinct', formula_id)
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("insert into invoice (id, customer_id, product) values(1, 1, 'a'), (2, 1, 'b'), (3, 2, 'a'), (4, 2, 'c')")
+        self.cur.execute("delete from invoice where id = 1")
+        self.cur.execute("update invoice set customer_id = 1 where id = 4")
+        self.assertEqual(self.fetch_all(actual), [{'id': 1, 'product_count': 2}, {'id': 2, 'product_count': 1}])
+        self.drop_formula(formula_id)
+
+        # filters may contain '%'
+        self.create_tables('approx_count_distinct', formula_id, False)
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("call pgf_approx_count_distinct(%s, 'customer', 'id', 'product_count', 'invoice', 'customer_id', 'product', %s);",
+                         (formula_id, '{"filter": "product like \'p%\'", "delete_policy": "rebuild"}'))
+        self.cur.execute("insert into invoice (id, customer_id, product) values(1, 1, 'p1'), (2, 1, 'p2'), (3, 1, 'a'), (4, 2, 'p1')")
+        self.assertEqual(self.fetch_all(actual), [{'id': 1, 'product_count': 2}, {'id': 2, 'product_count': 1}])
+        self.cur.execute("delete from invoice where id = 2")
+        self.assertEqual(self.fetch_all(actual), [{'id': 1, 'product_count': 1}, {'id': 2, 'product_count': 1}])
+        self.cur.execute("update invoice set product = 'p3' where id = 3")
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assertEqual(self.fetch_all(actual), [{'id': 1, 'product_count': 2}, {'id': 2, 'product_count': 1}])
+        self.drop_formula(formula_id)
+
+    def test_window_count(self):
+        formula_id = 'window_count1'
+        self.create_tables('window_count', formula_id, False)
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B'), (3, 'customer C');")
+        self.cur.execute("call pgf_window_count(%s, 'customer', 'id', 'invoice_count_24h', 'invoice', 'customer_id', 'created_at', '{\"filter\": \"name is null\"}');",
+                         (formula_id,))
+        window_start = f"(select window_start from _pgf_internal_window_start_{formula_id})"
+        expected = f"""select c.id, (select count(*) from invoice
+            where customer_id = c.id and name is null and created_at >= {window_start}) as invoice_count_24h from customer c order by c.id"""
+        actual = "select id, invoice_count_24h from customer order by id"
+
+        # the window holds the current hour and the 23 previous ones
+        self.assertEqual(self.fetch_one(f"select {window_start} = date_trunc('hour', now()::timestamp) - interval '23 hours' as ok")['ok'], True)
+        for statement in [
+            "insert into invoice (id, customer_id, created_at) values(1, 1, now()), (2, 1, now() - interval '2 hours'), (3, 1, now() - interval '30 hours')",
+            "insert into invoice (id, customer_id, created_at, name) values(4, 2, now(), 'hidden'), (5, 2, NULL, NULL), (6, 2, now() + interval '1 hour', NULL)",
+            "insert into invoice (id, customer_id, created_at) select i, i % 3 + 1, now() - i * interval '17 minutes' from generate_series(10, 200) i",
+            "update invoice set created_at = now() where id = 3",
+            "update invoice set created_at = now() - interval '3 days' where id = 1",
+            "update invoice set customer_id = 3 - customer_id where customer_id in (1, 2)",
+            "update invoice set created_at = created_at - interval '12 hours' where id % 3 = 0",
+            "update invoice set name = 'hidden' where id % 7 = 0",
+            "delete from invoice where id between 50 and 150",
+            f"call pgf_refresh('{formula_id}')",
+            "delete from customer where id = 2",
+            "truncate invoice",
+            "insert into invoice (id, customer_id, created_at) values(8, 1, now()), (9, 3, now())",
+        ]:
+            self.cur.execute(statement)
+            self.assertEqual(self.fetch_all(actual), self.fetch_all(expected), statement)
+        self.assert_sql_equal_scalar(f"select count(*) from _pgf_internal_window_{formula_id} where row_count <= 0", 0)
+        self.drop_formula(formula_id)
+
+    def test_window_sum(self):
+        formula_id = 'window_sum1'
+        self.create_tables('window_sum', formula_id, False)
+        self.cur.execute("insert into customer(id, name) values(1, 'customer A'), (2, 'customer B');")
+        self.cur.execute("call pgf_window_sum(%s, 'customer', 'id', 'amount_24h', 'invoice', 'customer_id', 'created_at', 'amount', '{\"window\": \"6 hours\", \"bucket\": \"30 minutes\"}');",
+                         (formula_id,))
+        window_start = f"(select window_start from _pgf_internal_window_start_{formula_id})"
+        expected = f"""select c.id, (select coalesce(sum(amount), 0) from invoice
+            where customer_id = c.id and created_at >= {window_start}) as amount_24h from customer c order by c.id"""
+        actual = "select id, amount_24h from customer order by id"
+
+        # time passes: the window started 3 hours ago
+        self.cur.execute(f"update _pgf_internal_window_start_{formula_id} set window_start = window_start - interval '3 hours'")
+        self.cur.execute("""insert into invoice (id, customer_id, created_at, amount)
+            select i, i % 2 + 1, now() - i * interval '7 minutes', i from generate_series(1, 100) i""")
+        self.cur.execute("update invoice set amount = NULL where id = 1")
+        self.assertEqual(self.fetch_all(actual), self.fetch_all(expected))
+        total_before_expiry = self.fetch_one("select sum(amount_24h) as s from customer")['s']
+
+        # expiry subtracts the buckets older than the window of the current time
+        self.cur.execute("call pgf_window_expire(%s)", (formula_id,))
+        self.assertEqual(self.fetch_all(actual), self.fetch_all(expected))
+        self.assertLess(self.fetch_one("select sum(amount_24h) as s from customer")['s'], total_before_expiry)
+        self.assert_sql_equal_scalar("select sum(amount_24h) from customer",
+            self.fetch_one("select sum(amount) as s from invoice where created_at >= date_trunc('hour', now()) + (extract(minute from now())::int / 30) * interval '30 minutes' - interval '5 hours 30 minutes'")['s'])
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assertEqual(self.fetch_all(actual), self.fetch_all(expected))
+        self.drop_formula(formula_id)
+
+    def test_running_sum(self):
+        formula_id = 'running_sum1'
+        self.create_tables('running_sum', formula_id, False)
+        self.cur.execute("call pgf_running_sum(%s, 'invoice', 'id', 'customer_id', 'created_at', 'amount', 'balance', '{\"block_size\": 3}');", (formula_id,))
+        expected = """select id, case when customer_id is not null and created_at is not null
+            then sum(coalesce(amount, 0)) over (partition by customer_id, created_at is null order by created_at, id) end as balance
+            from invoice order by id"""
+        actual = "select id, balance from invoice_balance order by id"
+
+        for statement in [
+            "insert into invoice (id, customer_id, created_at, amount) values(1, 1, '2024-01-01', 10), (2, 1, '2024-01-03', 20), (3, 2, '2024-01-02', 5)",
+            "insert into invoice (id, customer_id, created_at, amount) values(4, 1, '2024-01-02', 1), (5, 1, '2024-01-02', NULL), (6, 1, NULL, 7), (7, NULL, '2024-01-01', 7)",
+            "insert into invoice (id, customer_id, created_at, amount) select i, i % 3, timestamp '2024-01-01' + i * interval '5 hours', i from generate_series(10, 200) i",
+            "insert into invoice (id, customer_id, created_at, amount) values(8, 1, '2023-12-31', 100)",
+            "update invoice set amount = amount + 1 where id = 2",
+            "update invoice set created_at = created_at - interval '10 days' where id % 7 = 0",
+            "update invoice set customer_id = 2 - customer_id where id % 5 = 0",
+            "update invoice set customer_id = NULL where id = 3",
+            "update invoice set balance = 0 where id = 100",
+            "delete from invoice where id between 50 and 150",
+            "update invoice set id = id + 1000 where id = 20",
+            f"call pgf_refresh('{formula_id}')",
+            "delete from invoice where customer_id = 1",
+            "truncate invoice",
+            "insert into invoice (id, customer_id, created_at, amount) values(1, 1, '2024-01-01', 10), (2, 1, '2024-01-03', 20)",
+        ]:
+            self.cur.execute(statement)
+            self.assertEqual(self.fetch_all(actual), self.fetch_all(expected), statement)
+        # blocks have at most 2 * block_size rows
+        self.cur.execute("insert into invoice (id, customer_id, created_at, amount) select i, 1, timestamp '2024-01-02' + i * interval '1 second', 1 from generate_series(10, 100) i")
+        self.assertEqual(self.fetch_all(actual), self.fetch_all(expected))
+        self.assert_sql_equal_scalar(f"select max(row_count) <= 6 and min(row_count) > 0 from _pgf_internal_blocks_{formula_id}", True)
+        self.drop_formula(formula_id)
+
+    def test_running_sum_two_formulas(self):
+        # the updates of each formula fire the statement triggers of the other one
+        formula_id = 'running_sum1'
+        amount_formula_id = 'running_sum2'
+        self.create_tables('running_sum', formula_id, False)
+        self.cur.execute("alter table invoice add column amount_balance numeric")
+        self.cur.execute("call pgf_running_sum(%s, 'invoice', 'id', 'customer_id', 'created_at', 'amount', 'balance', '{\"block_size\": 3}');", (formula_id,))
+        self.cur.execute("call pgf_running_sum(%s, 'invoice', 'id', 'customer_id', 'amount', 'amount', 'amount_balance', '{\"block_size\": 2}');", (amount_formula_id,))
+        expected = """select id, case when customer_id is not null and created_at is not null
+            then sum(coalesce(amount, 0)) over (partition by customer_id, created_at is null order by created_at, id) end as balance,
+            case when customer_id is not null and amount is not null
+            then sum(amount) over (partition by customer_id, amount is null order by amount, id) end as amount_balance
+            from invoice order by id"""
+        actual = "select b.id, b.balance, a.amount_balance from invoice_balance b join invoice_amount_balance a on a.id = b.id order by b.id"
+
+        for statement in [
+            "insert into invoice (id, customer_id, created_at, amount) values(1, 1, '2024-01-01', 10), (2, 1, '2024-01-03', 20), (3, 2, '2024-01-02', 5)",
+            "insert into invoice (id, customer_id, created_at, amount) values(4, 1, NULL, 1), (5, NULL, '2024-01-02', 7)",
+            "insert into invoice (id, customer_id, created_at, amount) select i, i % 3, timestamp '2024-01-01' + i * interval '5 hours', i from generate_series(10, 30) i",
+            "update invoice set amount = amount + 1 where id = 2",
+            "update invoice set customer_id = 2 - customer_id where id % 5 = 0",
+            "delete from invoice where id between 12 and 15",
+            f"call pgf_refresh('{formula_id}')",
+            f"call pgf_refresh('{amount_formula_id}')",
+        ]:
+            self.cur.execute(statement)
+            self.assertEqual(self.fetch_all(actual), self.fetch_all(expected), statement)
+        self.drop_formula(amount_formula_id)
+        self.drop_formula(formula_id)
+
+    def test_rank(self):
+        formula_id = 'rank1'
+        leaderboard_id = 'rank2'
+        self.create_tables('rank', formula_id, False)
+        self.cur.execute("alter table invoice add column leaderboard_position bigint")
+        self.cur.execute("call pgf_rank(%s, 'invoice', 'id', 'customer_id', 'amount', 'position', '{\"block_size\": 3}');", (formula_id,))
+        self.cur.execute("call pgf_rank(%s, 'invoice', 'id', NULL, 'amount', 'leaderboard_position', '{\"block_size\": 2, \"rank_function\": \"rank\", \"order_direction\": \"desc\"}');", (leaderboard_id,))
+        expected = """select id, case when customer_id is not null and amount is not null
+            then row_number() over (partition by customer_id, amount is null order by amount, id) end as position
+            from invoice order by id"""
+        actual = "select id, position from invoice_position order by id"
+        expected_leaderboard = """select id, case when amount is not null then rank() over (partition by amount is null order by amount desc) end as position
+            from invoice order by id"""
+        actual_leaderboard = "select id, leaderboard_position as position from invoice_leaderboard_position order by id"
+
+        for statement in [
+            "insert into invoice (id, customer_id, amount) values(1, 1, 10), (2, 1, 20), (3, 2, 5)",
+            "insert into invoice (id, customer_id, amount) values(4, 1, 20), (5, 1, NULL), (6, NULL, 20), (7, 2, 20)",
+            "insert into invoice (id, customer_id, amount) select i, i % 3, i % 17 from generate_series(10, 200) i",
+            "insert into invoice (id, customer_id, amount) values(8, 1, 100)",
+            "update invoice set amount = amount + 1 where id = 2",
+            "update invoice set amount = 16 - amount where id % 7 = 0",
+            "update invoice set customer_id = 2 - customer_id where id % 5 = 0",
+            "update invoice set customer_id = NULL where id = 3",
+            "update invoice set position = 0, leaderboard_position = 0 where id = 100",
+            "delete from invoice where id between 50 and 150",
+            "update invoice set id = id + 1000 where id = 20",
+            f"call pgf_refresh('{formula_id}')",
+            f"call pgf_refresh('{leaderboard_id}')",
+            "update invoice set amount = 3 where amount between 2 and 8",
+            "delete from invoice where customer_id = 1",
+            "truncate invoice",
+            "insert into invoice (id, customer_id, amount) values(1, 1, 10), (2, 1, 10), (3, 1, 20)",
+        ]:
+            self.cur.execute(statement)
+            self.assertEqual(self.fetch_all(actual), self.fetch_all(expected), statement)
+            self.assertEqual(self.fetch_all(actual_leaderboard), self.fetch_all(expected_leaderboard), statement)
+        self.drop_formula(leaderboard_id)
+        self.drop_formula(formula_id)
 
     def test_minmax_table(self):
         formula_id = 'customer_invoices_agg'
@@ -1555,6 +2429,346 @@ class TestModule(unittest.TestCase):
         self.assert_sql_equal_scalar("select level from node where id=6;", 3)
         self.cur.execute("commit");
 
+    def test_minmax_table_storage(self):
+        formula_id = 'minmax_table_storage'
+        self.create_tables('minmax_table', formula_id, False)
+        self.cur.execute("drop table if exists pgf_unlogged_sentinel;")
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) values(1, 'invoice 1', 1, 'FR', 5.5);")
+        self.cur.execute("""call pgf_minmax_table(%s, 'invoice', 'id', 'amount', jsonb_build_object(
+            'agg_table', 'agg', 'group_by_column', ARRAY['customer_id', 'country'],
+            'storage', '{"unlogged": true, "fillfactor": 70, "autovacuum": {"vacuum_scale_factor": 0.01}, "partitions": 4}'::jsonb));""",
+                         (formula_id,))
+
+        # test 1 : agg is hash partitioned, its partitions are unlogged and have the storage parameters
+        self.assert_sql_equal_scalar("select count(*) from pg_partitioned_table where partrelid = 'agg'::regclass", 1)
+        self.assert_sql_equal_list("""
+            select c.relname::text, c.relpersistence::text, c.reloptions::text from pg_inherits i join pg_class c on c.oid = i.inhrelid
+            where i.inhparent = 'agg'::regclass order by c.relname""",
+                                   [(f'agg_p{i}', 'u', '{fillfactor=70,autovacuum_vacuum_scale_factor=0.01}') for i in range(4)])
+
+        # test 2 : the formula is maintained as usual
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) values(2, 'invoice 2', 1, 'FR', 1.1), (3, 'invoice 3', 2, 'US', 2.2);")
+        self.assert_sql_equal_list("select customer_id, country, min_value, max_value, row_count from agg order by customer_id",
+                                   [(1, 'FR', Decimal('1.10'), Decimal('5.50'), 2), (2, 'US', Decimal('2.20'), Decimal('2.20'), 1)])
+
+        # test 3 : after a crash, unlogged tables and the sentinel are empty -> pgf_recover_unlogged rebuilds them
+        self.cur.execute("call pgf_recover_unlogged();")
+        self.assert_sql_equal_scalar("select count(*) from agg", 2)
+        self.cur.execute("truncate agg; truncate pgf_unlogged_sentinel;")
+        self.cur.execute("call pgf_recover_unlogged();")
+        self.assert_sql_equal_scalar("select count(*) from agg", 2)
+        self.assert_sql_equal_scalar("select count(*) from pgf_unlogged_sentinel", 1)
+        self.drop_formula(formula_id)
+
+        # test 4 : invalid storage options
+        self.create_tables('audit_table', 'audit_table_storage', False)
+        self.cur.execute("drop table if exists customer_events;")
+        with self.assertRaises(psycopg2.errors.RaiseException):
+            self.cur.execute("""call pgf_audit_table('audit_table_storage', 'customer_events', ARRAY['customer'], '{"storage": {"unlogged": true}}');""")
+        self.conn.rollback()
+        with self.assertRaises(psycopg2.errors.RaiseException):
+            self.cur.execute("""call pgf_audit_table('audit_table_storage', 'customer_events', ARRAY['customer'], '{"storage": {"compression": "lz4"}}');""")
+        self.conn.rollback()
+
+    def test_minmax_table_refresh(self):
+        formula_id = 'minmax_table_refresh'
+        self.create_tables('minmax_table', formula_id)
+        self.cur.execute("""insert into invoice (id, name, customer_id, country, amount) values
+            (1, 'invoice 1', 1, 'FR', 5), (2, 'invoice 2', 1, 'FR', 1), (3, 'invoice 3', 1, 'FR', 5),
+            (4, 'invoice 4', 1, 'FR', 1), (5, 'invoice 5', 2, 'US', 2)""")
+
+        # the refresh computes all the columns in a single pass. Ties: smallest id for the min, largest id for the max
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assert_sql_equal_list("select customer_id, country, min_value, id_of_min, max_value, id_of_max, row_count from agg order by customer_id",
+                                   [(1, 'FR', Decimal('1.00'), 2, Decimal('5.00'), 3, 4), (2, 'US', Decimal('2.00'), 5, Decimal('2.00'), 5, 1)])
+        self.assert_sql_equal_list("""select (a).min_value, (a).id_of_min, (a).max_value, (a).id_of_max, (a).row_count
+            from (select _pgf_internal_minmax_agg(amount, id) as a from invoice where customer_id = 3) t""",
+                                   [(None, None, None, None, 0)])
+        self.drop_formula(formula_id)
+
+    def test_sum_table(self):
+        formula_id = 'sum_table'
+        self.create_tables('sum_table', formula_id)
+        # population skewness and excess kurtosis, from the central moments
+        expected_sql = """select customer_id, country, count(*), sum(amount), round(avg(amount), 6) as mean, round(var_samp(amount), 6) as variance,
+                round(stddev_samp(amount), 6) as stddev,
+                round((sqrt(count(*)) * sum(power(amount - mean, 3)) / nullif(power(sum(power(amount - mean, 2)), 1.5), 0))::numeric, 6) as skewness,
+                round((count(*) * sum(power(amount - mean, 4)) / nullif(power(sum(power(amount - mean, 2)), 2), 0) - 3)::numeric, 6) as kurtosis
+            from (select *, avg(amount) over (partition by customer_id, country) as mean from invoice where amount is not null) t
+            group by customer_id, country order by customer_id, country"""
+        actual_sql = """select customer_id, country, row_count, sum_value, round(mean::numeric, 6) as mean, round(variance::numeric, 6) as variance, round(stddev::numeric, 6) as stddev,
+                round(skewness::numeric, 6) as skewness, round(kurtosis::numeric, 6) as kurtosis
+            from agg order by customer_id, country"""
+        expected = lambda: [tuple(record.values()) for record in self.fetch_all(expected_sql)]
+
+        # test 1 : inserts. NULL values are ignored
+        self.cur.execute("""insert into invoice (id, name, customer_id, country, amount) values
+            (1, 'invoice 1', 1, 'FR', 1000000.10), (2, 'invoice 2', 1, 'FR', 1000000.20), (3, 'invoice 3', 1, 'FR', 1000000.60),
+            (4, 'invoice 4', 1, 'US', 5), (5, 'invoice 5', 2, 'FR', 3), (6, 'invoice 6', 2, 'FR', NULL)""")
+        self.assert_sql_equal_list("select customer_id, country, row_count, sum_value, round(mean::numeric, 6) as mean, round(variance::numeric, 12) as variance from agg where customer_id = 1 order by country",
+                                   [(1, 'FR', 3, Decimal('3000000.90'), Decimal('1000000.300000'), Decimal('0.070000000000')), (1, 'US', 1, Decimal('5.00'), Decimal('5.000000'), None)])
+        self.assert_sql_equal_list(actual_sql, expected())
+
+        # test 2 : updates and deletes, including the group by columns
+        self.cur.execute("update invoice set amount = 1000000.90 where id = 2")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("update invoice set country = 'US' where id = 3")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("update invoice set amount = 4 where id = 6")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("delete from invoice where id in (1, 5)")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("delete from invoice where customer_id = 1 and country = 'FR'")
+        self.assert_sql_equal_list(actual_sql, expected())
+
+        # test 3 : many rows, then the refresh gives the same result
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) select i, 'invoice ' || i, i % 3, 'FR', (i * 7) % 11 + 0.25 from generate_series(10, 200) i")
+        self.cur.execute("delete from invoice where id % 4 = 0")
+        self.cur.execute("update invoice set amount = amount * 2 where id % 5 = 0")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("truncate invoice")
+        self.assert_sql_equal_scalar("select count(*) from agg", 0)
+        self.drop_formula(formula_id)
+
+        # test 4 : no group by column, without higher moments
+        self.create_tables('sum_table', formula_id, False)
+        self.cur.execute("call pgf_sum_table(%s, 'invoice', 'amount', '{\"agg_table\": \"agg\"}')", (formula_id,))
+        self.assert_sql_equal_list("select row_count, sum_value, mean, variance from agg", [(0, Decimal('0'), None, None)])
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) values (1, 'invoice 1', 1, 'FR', 2), (2, 'invoice 2', 2, 'US', 4)")
+        self.assert_sql_equal_list("select row_count, sum_value, mean, variance from agg", [(2, Decimal('6.00'), 3.0, 2.0)])
+        self.cur.execute("delete from invoice")
+        self.assert_sql_equal_list("select row_count, sum_value, mean, variance from agg", [(0, Decimal('0'), None, None)])
+        self.drop_formula(formula_id)
+
+    def test_count_table(self):
+        formula_id = 'count_table'
+        self.create_tables('count_table', formula_id)
+        expected_sql = """select customer_id, country, grouping(customer_id, country), count(*) from invoice
+            group by cube(customer_id, country) order by 3, 1, 2"""
+        actual_sql = "select customer_id, country, grouping_id, row_count from agg order by 3, 1, 2"
+        expected = lambda: [tuple(record.values()) for record in self.fetch_all(expected_sql)]
+
+        # test 1 : the grand total is kept when the table is empty, like GROUP BY CUBE
+        self.assert_sql_equal_list(actual_sql, [(None, None, 3, 0)])
+
+        # test 2 : inserts update the 4 grouping sets of each row
+        self.cur.execute("""insert into invoice (id, name, customer_id, country, amount) values
+            (1, 'invoice 1', 1, 'FR', 1), (2, 'invoice 2', 1, 'US', 1), (3, 'invoice 3', 2, 'FR', 1), (4, 'invoice 4', 2, 'FR', 1)""")
+        self.assert_sql_equal_list(actual_sql, [
+            (1, 'FR', 0, 1), (1, 'US', 0, 1), (2, 'FR', 0, 2),
+            (1, None, 1, 2), (2, None, 1, 2),
+            (None, 'FR', 2, 3), (None, 'US', 2, 1),
+            (None, None, 3, 4)])
+
+        # test 3 : updates and deletes. Grouping sets going down to zero are deleted
+        self.cur.execute("update invoice set country = 'US' where id = 3")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("update invoice set amount = 2")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("delete from invoice where customer_id = 1")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) select i, 'invoice ' || i, i % 3, (array['FR', 'US', 'DE'])[i % 3 + 1], 1 from generate_series(10, 100) i")
+        self.cur.execute("delete from invoice where id % 5 = 0")
+        self.assert_sql_equal_list(actual_sql, expected())
+
+        # NULL group values are counted in a single group, like GROUP BY CUBE
+        self.cur.execute("alter table invoice alter column country drop not null")
+        for statement in [
+            "insert into invoice (id, name, customer_id, country, amount) values (200, 'invoice 200', 1, NULL, 1), (201, 'invoice 201', 1, NULL, 1), (202, 'invoice 202', 2, NULL, 1)",
+            "update invoice set country = NULL where id between 10 and 20",
+            "update invoice set country = 'FR' where id = 201",
+            "delete from invoice where id in (200, 202)",
+        ]:
+            self.cur.execute(statement)
+            self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("truncate invoice")
+        self.assert_sql_equal_list(actual_sql, [(None, None, 3, 0)])
+        self.drop_formula(formula_id)
+
+        # test 4 : rollup, with a filter
+        self.create_tables('count_table', formula_id, False)
+        self.cur.execute("""call pgf_count_table(%s, 'invoice', '{"agg_table": "agg", "group_by_column": ["customer_id", "country"],
+            "multidimensional_aggregation": "rollup", "filter": "amount > 1"}')""", (formula_id,))
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) select i, 'invoice ' || i, i % 3, (array['FR', 'US', 'DE'])[i % 3 + 1], i % 3 from generate_series(10, 100) i")
+        self.cur.execute("update invoice set amount = 5, customer_id = 4 where id % 7 = 0")
+        self.assert_sql_equal_list(actual_sql, [tuple(record.values()) for record in self.fetch_all("""select customer_id, country, grouping(customer_id, country), count(*) from invoice
+            where amount > 1 group by rollup(customer_id, country) order by 3, 1, 2""")])
+        self.drop_formula(formula_id)
+
+        # test 5 : no group by column
+        self.create_tables('count_table', formula_id, False)
+        self.cur.execute("""call pgf_count_table(%s, 'invoice', '{"agg_table": "agg"}')""", (formula_id,))
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) values (1, 'invoice 1', 1, 'FR', 1), (2, 'invoice 2', 1, 'US', 1)")
+        self.cur.execute("delete from invoice where id = 1")
+        self.assert_sql_equal_list("select row_count from agg", [(1,)])
+        self.drop_formula(formula_id)
+
+    def test_histogram_table(self):
+        formula_id = 'histogram_table'
+        self.create_tables('histogram_table', formula_id)
+        expected_sql = """select customer_id, width_bucket(amount, 0, 1000, 20) as bucket, count(*) from invoice
+            where amount is not null group by 1, 2 order by 1, 2"""
+        actual_sql = "select customer_id, bucket, row_count from agg order by 1, 2"
+        expected = lambda: [tuple(record.values()) for record in self.fetch_all(expected_sql)]
+
+        # test 1 : buckets of 50, values out of [min, max) are counted in buckets 0 and 21
+        self.cur.execute("""insert into invoice (id, name, customer_id, country, amount) values
+            (1, 'invoice 1', 1, 'FR', 10), (2, 'invoice 2', 1, 'US', 20), (3, 'invoice 3', 1, 'FR', 60), (4, 'invoice 4', 2, 'FR', -1),
+            (5, 'invoice 5', 2, 'FR', 1000), (6, 'invoice 6', 2, 'FR', NULL)""")
+        self.assert_sql_equal_list("select customer_id, bucket, row_count, lower_bound, upper_bound from agg order by 1, 2", [
+            (1, 1, 2, 0, 50), (1, 2, 1, 50, 100), (2, 0, 1, None, 0), (2, 21, 1, 1000, None)])
+
+        # test 2 : updates and deletes. Empty buckets are deleted
+        self.cur.execute("update invoice set amount = 70 where id = 1")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("update invoice set customer_id = 2 where id = 2")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) select i, 'invoice ' || i, i % 3, 'FR', i % 1003 from generate_series(10, 5000) i")
+        self.cur.execute("update invoice set amount = amount / 2 where id % 3 = 0")
+        self.cur.execute("delete from invoice where id % 5 = 0")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assert_sql_equal_list(actual_sql, expected())
+
+        # test 3 : quantiles and cdf are exact to the bucket width
+        for group_values, condition in [('{"customer_id": 1}', 'customer_id = 1'), ('{}', 'true')]:
+            for q in [0.05, 0.5, 0.95]:
+                self.assertAlmostEqual(
+                    self.fetch_one("select pgf_quantile(%s, %s, %s) as q", (formula_id, group_values, q))['q'],
+                    self.fetch_one(f"select percentile_cont(%s) within group (order by amount) as q from invoice where {condition} and amount between 0 and 1000", (q,))['q'],
+                    delta=50)
+            self.assertAlmostEqual(
+                self.fetch_one("select pgf_cdf(%s, %s, 300) as p", (formula_id, group_values))['p'],
+                self.fetch_one(f"select avg((amount <= 300)::int)::float as p from invoice where {condition} and amount is not null")['p'],
+                delta=0.01)
+            # values above max are counted in the overflow bucket
+            self.assertAlmostEqual(self.fetch_one("select pgf_cdf(%s, %s, 1e300) as p", (formula_id, group_values))['p'], 1)
+        # at x = max, the values of the overflow bucket are not counted
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) values (6000, 'invoice 6000', 1, 'FR', 1e7)")
+        self.assertAlmostEqual(
+            self.fetch_one("select pgf_cdf(%s, '{}', 1000) as p", (formula_id,))['p'],
+            self.fetch_one("select avg((amount < 1000)::int)::float as p from invoice where amount is not null")['p'])
+        self.assert_sql_equal_scalar("select pgf_quantile(%s, '{\"customer_id\": 7}', 0.5)", None, (formula_id,))
+        self.cur.execute("truncate invoice")
+        self.assert_sql_equal_list(actual_sql, [])
+        self.drop_formula(formula_id)
+
+        # test 4 : log scale, no group by column
+        self.create_tables('histogram_table', formula_id, False)
+        self.cur.execute("""call pgf_histogram_table(%s, 'invoice', 'amount', '{"agg_table": "agg", "scale": "log", "min": 1, "max": 10000, "bucket_count": 4}')""", (formula_id,))
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) values (1, 'invoice 1', 1, 'FR', 0), (2, 'invoice 2', 1, 'FR', 5), (3, 'invoice 3', 1, 'FR', 50), (4, 'invoice 4', 1, 'FR', 55)")
+        self.assert_sql_equal_list("select bucket, row_count, round(lower_bound) as lower_bound from agg order by 1", [(0, 1, None), (1, 1, 1), (2, 2, 10)])
+        self.assertAlmostEqual(self.fetch_one("select pgf_quantile(%s, NULL, 0.75) as q", (formula_id,))['q'], 10 ** 1.5)
+        self.assertAlmostEqual(self.fetch_one("select pgf_cdf(%s, NULL, 100) as p", (formula_id,))['p'], 1)
+        self.drop_formula(formula_id)
+
+    def test_timeseries_table(self):
+        formula_id = 'timeseries_table'
+        self.create_tables('timeseries_table', formula_id)
+        expected_sql = """select date_trunc('{0}', created_at) as bucket_start, customer_id, count(*), coalesce(sum(amount), 0), min(amount), max(amount) from invoice
+            where created_at is not null group by 1, 2 order by 1, 2"""
+        actual_sql = "select bucket_start, customer_id, row_count, sum_amount, min_amount, max_amount from {0} order by 1, 2"
+        expected = lambda unit: [tuple(record.values()) for record in self.fetch_all(expected_sql.format(unit))]
+
+        # test 1 : hourly buckets and daily rollup. Rows without timestamp are ignored
+        self.cur.execute("""insert into invoice (id, name, customer_id, created_at, amount) values
+            (1, 'invoice 1', 1, '2024-01-01 10:05', 10), (2, 'invoice 2', 1, '2024-01-01 10:55', 20), (3, 'invoice 3', 1, '2024-01-01 11:00', 60),
+            (4, 'invoice 4', 2, '2024-01-02 00:30', NULL), (5, 'invoice 5', 2, NULL, 5)""")
+        self.assert_sql_equal_list(actual_sql.format('agg'), [
+            (datetime(2024, 1, 1, 10), 1, 2, 30, 10, 20), (datetime(2024, 1, 1, 11), 1, 1, 60, 60, 60), (datetime(2024, 1, 2, 0), 2, 1, 0, None, None)])
+        self.assert_sql_equal_list(actual_sql.format('agg_1_day'), [(datetime(2024, 1, 1), 1, 3, 90, 10, 60), (datetime(2024, 1, 2), 2, 1, 0, None, None)])
+
+        # test 2 : late rows, and updates and deletes moving rows between buckets. Empty buckets are deleted
+        self.cur.execute("update invoice set amount = 5 where id = 2")
+        self.cur.execute("update invoice set created_at = '2024-01-01 11:30' where id = 1")
+        self.cur.execute("delete from invoice where id = 3")
+        self.assert_sql_equal_list(actual_sql.format('agg'), expected('hour'))
+        self.cur.execute("""insert into invoice (id, name, customer_id, created_at, amount)
+            select i, 'invoice ' || i, i % 3, timestamp '2024-01-05' - i * interval '7 minutes', i % 1003 from generate_series(10, 5000) i""")
+        self.cur.execute("update invoice set created_at = created_at + interval '2 days' where id % 3 = 0")
+        self.cur.execute("update invoice set amount = amount / 2, customer_id = 7 where id % 7 = 0")
+        self.cur.execute("delete from invoice where id % 5 = 0")
+        self.assert_sql_equal_list(actual_sql.format('agg'), expected('hour'))
+        self.assert_sql_equal_list(actual_sql.format('agg_1_day'), expected('day'))
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assert_sql_equal_list(actual_sql.format('agg'), expected('hour'))
+        self.assert_sql_equal_list(actual_sql.format('agg_1_day'), expected('day'))
+
+        # test 3 : the hourly table is partitioned by day
+        self.assert_sql_equal_scalar("select count(*) from pg_inherits where inhparent = 'agg'::regclass",
+            self.fetch_one("select count(distinct date_trunc('day', created_at)) as n from invoice")['n'])
+        self.cur.execute("truncate invoice")
+        self.assert_sql_equal_list(actual_sql.format('agg'), [])
+        self.drop_formula(formula_id)
+
+        # test 4 : retention. Expired partitions are dropped
+        self.create_tables('timeseries_table', formula_id, False)
+        self.cur.execute("""call pgf_timeseries_table(%s, 'invoice', 'created_at', '{"agg_table": "agg", "bucket": "1 day", "retention": "10 days", "partition_interval": "1 day"}')""", (formula_id,))
+        self.cur.execute("""insert into invoice (id, name, customer_id, created_at, amount)
+            select i, 'invoice ' || i, 1, now()::timestamp - i * interval '1 day', i from generate_series(1, 30) i""")
+        self.cur.execute("call pgf_timeseries_expire(%s)", (formula_id,))
+        self.assert_sql_equal_scalar("select count(*) from agg where bucket_start < now() - interval '10 days'", 0)
+        self.assert_sql_equal_scalar("select count(*) from agg", 9)
+        self.assert_sql_equal_scalar("select count(*) from pg_inherits where inhparent = 'agg'::regclass", 9)
+        # the refresh does not recreate the expired buckets
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assert_sql_equal_scalar("select count(*) from agg", 9)
+        self.assert_sql_equal_scalar("select count(*) from pg_inherits where inhparent = 'agg'::regclass", 9)
+        self.drop_formula(formula_id)
+
+    def test_topn_table(self):
+        formula_id = 'topn_table'
+        self.create_tables('topn_table', formula_id)
+        expected_sql = """select customer_id, id, amount from (
+            select customer_id, id, amount, row_number() over (partition by customer_id order by amount desc, id) as rn from invoice
+            ) t where rn <= 3 order by customer_id, amount desc, id"""
+        actual_sql = "select customer_id, id, amount from invoice_topn order by customer_id, amount desc, id"
+        expected = lambda: [tuple(record.values()) for record in self.fetch_all(expected_sql)]
+
+        # test 1 : inserts. Rows beyond the top 3 go into the buffer (2 rows), the others are only counted
+        self.cur.execute("""insert into invoice (id, name, customer_id, country, amount) values
+            (1, 'invoice 1', 1, 'FR', 10), (2, 'invoice 2', 1, 'FR', 20), (3, 'invoice 3', 1, 'FR', 30), (4, 'invoice 4', 1, 'FR', 40),
+            (5, 'invoice 5', 1, 'FR', 50), (6, 'invoice 6', 1, 'FR', 5), (7, 'invoice 7', 2, 'US', 1)""")
+        self.assert_sql_equal_list(actual_sql, [(1, 5, Decimal('50.00')), (1, 4, Decimal('40.00')), (1, 3, Decimal('30.00')), (2, 7, Decimal('1.00'))])
+        self.assert_sql_equal_list("select id from _pgf_internal_topn_buffer_topn_table order by id", [(1,), (2,)])
+        self.assert_sql_equal_list("select customer_id, row_count, top_count, buffer_count, stale from _pgf_internal_topn_group_topn_table order by customer_id",
+                                   [(1, 6, 3, 2, False), (2, 1, 1, 0, False)])
+
+        # test 2 : ties are ranked by pk
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) values (8, 'invoice 8', 1, 'FR', 40)")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.assert_sql_equal_list("select id from _pgf_internal_topn_buffer_topn_table order by id", [(2,), (3,)])
+
+        # test 3 : deletes in the top 3 are refilled from the buffer, then from the source table once the buffer is exhausted
+        for invoice_id in [5, 4, 8, 3]:
+            self.cur.execute("delete from invoice where id = %s", (invoice_id,))
+            self.assert_sql_equal_list(actual_sql, expected())
+        self.assert_sql_equal_list("select customer_id, row_count, top_count, buffer_count, stale from _pgf_internal_topn_group_topn_table order by customer_id",
+                                   [(1, 3, 3, 0, False), (2, 1, 1, 0, False)])
+
+        # test 4 : updates, multi-row statements and groups left empty
+        self.cur.execute("update invoice set amount = amount + 100 where id in (1, 6)")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("update invoice set customer_id = 2 where customer_id = 1 and amount > 100")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("delete from invoice where customer_id = 2")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.assert_sql_equal_list("select customer_id, row_count from _pgf_internal_topn_group_topn_table order by customer_id", [(1, 1)])
+
+        # test 5 : the refresh gives the same result
+        self.cur.execute("insert into invoice (id, name, customer_id, country, amount) select i, 'invoice ' || i, i % 3, 'FR', (i * 7) % 11 from generate_series(10, 60) i")
+        self.cur.execute("delete from invoice where id % 4 = 0")
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("call pgf_refresh(%s)", (formula_id,))
+        self.assert_sql_equal_list(actual_sql, expected())
+        self.cur.execute("truncate invoice")
+        self.assert_sql_equal_scalar("select count(*) from invoice_topn", 0)
+        self.drop_formula(formula_id)
+
     def test_tree_closure_table(self):
         formula_id = 'tree_closure_table'
         self.create_tables('tree_closure_table', formula_id)
@@ -1771,6 +2985,8 @@ class TestModule(unittest.TestCase):
         self.assert_sql_equal_scalar("select count(*) from bike;", 0)
         self.assert_sql_equal_scalar("select count(*) from car;", 0)
 
+        # the reverse formula of test_inheritance_table_SUB_TO_BASE would create a dependency cycle
+        self.drop_formula('uvehicle2')
         self.cur.execute("commit");
 
     def test_inheritance_table_SUB_TO_BASE(self):
@@ -1865,6 +3081,7 @@ class TestModule(unittest.TestCase):
         self.assertEqual(audit_row['old_value'], {'id': 1, 'name': 'row1', 'value': 20})
         self.assertEqual(audit_row['new_value'], None)
         self.assertEqual(audit_row['operation'], 'DELETE')
+        self.drop_formula('audit1')
         self.conn.commit()
 
     def test_sync(self):
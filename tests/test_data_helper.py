@@ -67,7 +67,69 @@ class TestDataHelper:
                 if (create_formula):
                     self.cur.execute(f"call pgf_{kind}(%s, 'customer', 'id', 'invoice_names', 'invoice', 'customer_id', 'name');", (id,))
                 res = TestDataStructure(['invoice', 'customer'], 'customer.invoice_names')
+
+            case 'string_agg':
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute(f"create table customer (id int PRIMARY KEY, name text, invoice_names text default NULL);")
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int references customer(id) on delete cascade, visible boolean);")
+                if (create_formula):
+                    self.cur.execute(f"call pgf_{kind}(%s, 'customer', 'id', 'invoice_names', 'invoice', 'customer_id', 'name');", (id,))
+                res = TestDataStructure(['invoice', 'customer'], 'customer.invoice_names')
             
+            case 'count_distinct':
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute("create table customer (id int PRIMARY KEY, name text, product_count int default 0);")
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int references customer(id) on delete cascade, product text, visible boolean);")
+                if (create_formula):
+                    self.cur.execute(f"call pgf_{kind}(%s, 'customer', 'id', 'product_count', 'invoice', 'customer_id', 'product');", (id,))
+                res = TestDataStructure(['invoice', 'customer'], 'customer.product_count')
+
+            case 'approx_count_distinct':
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute("create table customer (id int PRIMARY KEY, name text, product_count bigint default 0);")
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int references customer(id) on delete cascade, product text, visible boolean);")
+                if (create_formula):
+                    # with the 'rebuild' policy, sketches are the same as after a full refresh
+                    self.cur.execute(f"call pgf_{kind}(%s, 'customer', 'id', 'product_count', 'invoice', 'customer_id', 'product', '{{\"delete_policy\": \"rebuild\"}}');", (id,))
+                res = TestDataStructure(['invoice', 'customer'], 'customer.product_count')
+
+            case 'window_count':
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute("create table customer (id int PRIMARY KEY, name text, invoice_count_24h bigint default 0);")
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int references customer(id) on delete cascade, created_at timestamp);")
+                if (create_formula):
+                    self.cur.execute(f"call pgf_{kind}(%s, 'customer', 'id', 'invoice_count_24h', 'invoice', 'customer_id', 'created_at');", (id,))
+                res = TestDataStructure(['invoice', 'customer'], 'customer.invoice_count_24h')
+
+            case 'window_sum':
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute("create table customer (id int PRIMARY KEY, name text, amount_24h numeric default 0);")
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int references customer(id) on delete cascade, created_at timestamptz, amount numeric);")
+                if (create_formula):
+                    self.cur.execute(f"call pgf_{kind}(%s, 'customer', 'id', 'amount_24h', 'invoice', 'customer_id', 'created_at', 'amount', '{{\"bucket\": \"15 minutes\"}}');", (id,))
+                res = TestDataStructure(['invoice', 'customer'], 'customer.amount_24h')
+
+            case 'running_sum':
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int, created_at timestamp, amount numeric, balance numeric);")
+                if (create_formula):
+                    # the blocks differ after a refresh: the running sums are compared through the view
+                    self.cur.execute(f"call pgf_{kind}(%s, 'invoice', 'id', 'customer_id', 'created_at', 'amount', 'balance', '{{\"block_size\": 4}}');", (id,))
+                res = TestDataStructure(['invoice'], 'invoice_balance')
+
+            case 'rank':
+                self.cur.execute("drop table if exists invoice cascade;")
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int, amount numeric, position bigint);")
+                if (create_formula):
+                    # the blocks differ after a refresh: the ranks are compared through the view
+                    self.cur.execute(f"call pgf_{kind}(%s, 'invoice', 'id', 'customer_id', 'amount', 'position', '{{\"block_size\": 4, \"rank_function\": \"rank\", \"order_direction\": \"desc\"}}');", (id,))
+                res = TestDataStructure(['invoice'], 'invoice_position')
+
             case 'minmax_table':
                 self.cur.execute("drop table if exists customer cascade;");
                 self.cur.execute("drop table if exists invoice cascade;");
@@ -77,6 +139,59 @@ class TestDataHelper:
                     self.cur.execute(f"call pgf_{kind}(%s, 'invoice', 'id', 'amount', jsonb_build_object('agg_table', 'agg', 'group_by_column', ARRAY['customer_id', 'country']));", (id,))
                     self.cur.execute("commit;")
                 res = TestDataStructure(['invoice'], 'agg')
+
+            case 'sum_table':
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute(f"drop table if exists agg cascade;");
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int not null, country text not null, amount NUMERIC(10, 2));")
+                if (create_formula):
+                    self.cur.execute(f"call pgf_{kind}(%s, 'invoice', 'amount', jsonb_build_object('agg_table', 'agg', 'group_by_column', ARRAY['customer_id', 'country'], 'higher_moments', true));", (id,))
+                    self.cur.execute("commit;")
+                res = TestDataStructure(['invoice'], 'agg')
+
+            case 'histogram_table':
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute(f"drop table if exists agg cascade;");
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int not null, country text not null, amount NUMERIC(10, 2));")
+                if (create_formula):
+                    self.cur.execute(f"call pgf_{kind}(%s, 'invoice', 'amount', jsonb_build_object('agg_table', 'agg', 'group_by_column', ARRAY['customer_id'], 'min', 0, 'max', 1000, 'bucket_count', 20));", (id,))
+                    self.cur.execute("commit;")
+                res = TestDataStructure(['invoice'], 'agg')
+
+            case 'timeseries_table':
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute(f"drop table if exists agg cascade;");
+                self.cur.execute(f"drop table if exists agg_1_day cascade;");
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int not null, created_at timestamp, amount NUMERIC(10, 2));")
+                if (create_formula):
+                    self.cur.execute(f"""call pgf_{kind}(%s, 'invoice', 'created_at', jsonb_build_object('agg_table', 'agg', 'bucket', '1 hour', 'group_by_column', ARRAY['customer_id'],
+                        'sum_columns', ARRAY['amount'], 'min_columns', ARRAY['amount'], 'max_columns', ARRAY['amount'], 'partition_interval', '1 day',
+                        'rollups', jsonb_build_array(jsonb_build_object('bucket', '1 day'))));""", (id,))
+                    self.cur.execute("commit;")
+                res = TestDataStructure(['invoice'], 'agg')
+
+            case 'count_table':
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute(f"drop table if exists agg cascade;");
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int not null, country text not null, amount NUMERIC(10, 2) not null);")
+                if (create_formula):
+                    self.cur.execute(f"call pgf_{kind}(%s, 'invoice', jsonb_build_object('agg_table', 'agg', 'group_by_column', ARRAY['customer_id', 'country'], 'multidimensional_aggregation', 'cube'));", (id,))
+                    self.cur.execute("commit;")
+                res = TestDataStructure(['invoice'], 'agg')
+
+            case 'topn_table':
+                self.cur.execute("drop table if exists customer cascade;");
+                self.cur.execute("drop table if exists invoice cascade;");
+                self.cur.execute("drop table if exists invoice_topn cascade;");
+                self.cur.execute("create table invoice(id int PRIMARY KEY, name text, customer_id int not null, country text not null, amount NUMERIC(10, 2) not null);")
+                if (create_formula):
+                    self.cur.execute(f"call pgf_{kind}(%s, 'invoice', 'id', 'amount', jsonb_build_object('group_by_column', ARRAY['customer_id'], 'n', 3, 'buffer_size', 2));", (id,))
+                    self.cur.execute("commit;")
+                res = TestDataStructure(['invoice'], 'invoice_topn')
             
             case 'inheritance_table':
                 self.cur.execute("drop table if exists bike cascade;");